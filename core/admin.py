@@ -1,14 +1,19 @@
 from django.contrib import admin
-from .models import CachedRoute, ApiLog, SearchHistory
+from .models import CachedRoute, ApiLog, SearchHistory, ProfileRecord, RouteGeometry
 import json
-from django.utils import timezone
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html, format_html_join
+from .profiling import top_functions
 
 @admin.register(CachedRoute)
 class CachedRouteAdmin(admin.ModelAdmin):
-    list_display = ('hash_key_short', 'created_at', 'expires_at')
-    list_filter = ('created_at',)
-    search_fields = ('hash_key',)
-    readonly_fields = ('hash_key', 'route_data_prettified', 'created_at')
+    list_display = ('hash_key_short', 'schema_version', 'created_at', 'expires_at')
+    list_filter = ('created_at', 'schema_version')
+    search_fields = ('hash_key', 'request_hash')
+    readonly_fields = ('hash_key', 'request_hash', 'schema_version', 'route_data_prettified', 'created_at')
+    exclude = ('raw_response',)
     
     def hash_key_short(self, obj):
         return f"{obj.hash_key[:12]}..." if obj.hash_key else "-"
@@ -18,6 +23,12 @@ class CachedRouteAdmin(admin.ModelAdmin):
         return json.dumps(obj.route_data, indent=2, ensure_ascii=False)
     route_data_prettified.short_description = "Данные маршрута (форматированные)"
 
+@admin.register(RouteGeometry)
+class RouteGeometryAdmin(admin.ModelAdmin):
+    list_display = ('key', 'points', 'precision', 'created_at', 'last_used_at')
+    search_fields = ('key',)
+    readonly_fields = ('key', 'precision', 'points', 'line', 'lod', 'created_at', 'last_used_at')
+
 @admin.register(ApiLog)
 class ApiLogAdmin(admin.ModelAdmin):
     list_display = ('timestamp', 'provider', 'response_status', 'response_time_ms', 'was_cached', 'error_short')
@@ -36,3 +47,53 @@ class SearchHistoryAdmin(admin.ModelAdmin):
     list_display = ('start_query', 'end_query', 'timestamp', 'is_successful', 'routes_count')
     list_filter = ('is_successful', 'timestamp')
     search_fields = ('start_query', 'end_query')
+
+@admin.register(ProfileRecord)
+class ProfileRecordAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'method', 'path', 'status_code', 'duration_ms', 'samples', 'username')
+    list_filter = ('created_at', 'method')
+    search_fields = ('path', 'username')
+    readonly_fields = ('created_at', 'username', 'method', 'path', 'status_code', 'duration_ms',
+                       'interval_ms', 'samples', 'collapsed_download', 'top_functions_table', 'collapsed_pre')
+    exclude = ('collapsed',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/collapsed/', self.admin_site.admin_view(self.collapsed_view),
+                 name='core_profilerecord_collapsed'),
+        ] + super().get_urls()
+
+    def collapsed_view(self, request, pk):
+        """Файл collapsed stacks для flamegraph.pl / speedscope.app"""
+        record = get_object_or_404(ProfileRecord, pk=pk)
+        response = HttpResponse(record.collapsed, content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="profile_{record.pk}.folded"'
+        return response
+
+    def collapsed_download(self, obj):
+        return format_html('<a href="{}">Скачать .folded</a> (открывается в speedscope.app или flamegraph.pl)',
+                           reverse('admin:core_profilerecord_collapsed', args=[obj.pk]))
+    collapsed_download.short_description = "Collapsed stacks"
+
+    def top_functions_table(self, obj):
+        rows = top_functions(obj.collapsed)
+        if not rows:
+            return "Нет сэмплов"
+        return format_html(
+            '<table><tr><th>Функция</th><th>Self</th><th>Total</th></tr>{}</table>',
+            format_html_join('', '<tr><td><code>{}</code></td><td>{}%</td><td>{}%</td></tr>', (
+                (name, round(own / samples * 100, 1), round(total / samples * 100, 1))
+                for name, own, total, samples in rows
+            )),
+        )
+    top_functions_table.short_description = "Самые затратные функции"
+
+    def collapsed_pre(self, obj):
+        return format_html('<pre style="max-height: 400px; overflow: auto;">{}</pre>', obj.collapsed)
+    collapsed_pre.short_description = "Стеки"
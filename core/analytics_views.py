@@ -0,0 +1,197 @@
+import logging
+from datetime import date, timedelta
+
+from django.shortcuts import render
+from django.http import JsonResponse, FileResponse, Http404, StreamingHttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import Count, Avg, Max
+from django.db.models.functions import TruncHour
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import SearchHistory, CachedRoute, ApiLog
+from .query_budget import query_budget
+from .services.chart_cache_service import ChartCacheService
+from .services.analytics_service import AnalyticsService
+from .services.export_service import ExportService, ExportError
+
+logger = logging.getLogger(__name__)
+
+
+@query_budget(40)
+@staff_member_required
+def analytics_dashboard(request):
+    """Дашборд аналитики для администраторов с графиками и статистикой"""
+
+    cache_key = f"analytics_dashboard_{date.today().strftime('%Y%m%d')}"
+    chart_service = ChartCacheService()
+    
+
+    if (cached_data := cache.get(cache_key)) is not None and not request.GET.get('refresh'):
+        context = cached_data
+        logger.debug("Используем кэшированные данные дашборда")
+    else:
+        logger.info("Генерация новых данных для дашборда")
+        
+
+        total_searches = SearchHistory.objects.count()
+        successful_searches = SearchHistory.objects.filter(is_successful=True).count()
+        failed_searches = SearchHistory.objects.filter(is_successful=False).count()
+
+        today = timezone.localdate()
+        week_ago = today - timedelta(days=6)
+        analytics = AnalyticsService()
+
+        # Недельные серии собираются из дневных агрегатов, пересчитывается только сегодня
+        top_routes = analytics.get_series('top_routes', week_ago, today)
+        provider_stats = analytics.get_series('provider_stats', week_ago, today)
+        hourly_stats = analytics.get_series('hourly_activity', today, today)
+        travel_mode_stats = analytics.get_series('travel_modes', week_ago, today)
+        
+        conversion_rate = (successful_searches / total_searches * 100) if total_searches > 0 else 0
+        
+        common_errors = ApiLog.objects.filter(
+            response_status__gte=400
+        ).values('error_message', 'provider').annotate(
+            count=Count('id'),
+            last_occurred=Max('timestamp')
+        ).exclude(error_message='').order_by('-count')[:10]
+        
+
+        peak_hours = SearchHistory.objects.annotate(
+            hour=TruncHour('timestamp')
+        ).values('hour').annotate(
+            searches=Count('id')
+        ).order_by('-searches')[:10]
+        
+
+        chart_data = {
+            'top_routes': top_routes,
+            'provider_stats': provider_stats,
+            'hourly_activity': hourly_stats,
+            'travel_modes': travel_mode_stats,
+            'daily_trends': analytics.get_series('daily_trends', week_ago, today),
+            'response_times': analytics.get_series('response_times', week_ago, today),
+        }
+        
+        # Графики рисуются в фоновом пуле процессов, страница ссылается на файлы
+        chart_digests = {}
+        for name, records in chart_data.items():
+            if records:
+                chart_digests[name] = chart_service.submit(name, records)['digest']
+        
+
+        context = {
+            'total_searches': total_searches,
+            'successful_searches': successful_searches,
+            'failed_searches': failed_searches,
+            'conversion_rate': round(conversion_rate, 1),
+            'top_routes': top_routes,
+            'provider_stats': provider_stats,
+            'hourly_stats': hourly_stats,
+            'travel_mode_stats': travel_mode_stats,
+            'common_errors': list(common_errors),
+            'peak_hours': list(peak_hours),
+            'chart_digests': chart_digests,
+            'week_ago': week_ago,
+            'today': today,
+            'cache_timestamp': timezone.now(),
+            'total_api_requests': ApiLog.objects.count(),
+            'total_cached_items': CachedRoute.objects.count(),
+            'avg_response_time': ApiLog.objects.aggregate(
+                avg=Avg('response_time_ms')
+            )['avg'] or 0,
+        }
+        
+
+        cache.set(cache_key, context, 300)
+        logger.info("Данные дашборда сгенерированы и закэшированы")
+    
+    context = dict(context)
+    context['graphs'] = {
+        name: chart_service.describe(digest)
+        for name, digest in context.get('chart_digests', {}).items()
+    }
+    return render(request, 'core/admin/analytics_dashboard.html', context)
+
+
+@query_budget(12)
+@staff_member_required
+def analytics_series_api(request, series):
+    """
+    JSON-данные одной серии дашборда за период.
+    Параметры: start и end (YYYY-MM-DD) или days — число последних дней.
+    """
+    if series not in AnalyticsService.SERIES:
+        return JsonResponse({'status': 'error', 'message': f'Неизвестная серия: {series}'}, status=404)
+    try:
+        start, end = AnalyticsService.resolve_range(
+            start=request.GET.get('start'),
+            end=request.GET.get('end'),
+            days=request.GET.get('days'),
+        )
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    data = AnalyticsService().get_series(series, start, end)
+    chart = None
+    if series in AnalyticsService.CHART_SERIES and data:
+        chart = ChartCacheService().submit(series, data)
+
+    return JsonResponse({
+        'status': 'success',
+        'series': series,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'data': data,
+        'chart': chart,
+    })
+
+
+@query_budget(3)
+@staff_member_required
+def analytics_chart(request, digest, fmt):
+    """
+    Отдаёт готовый график из контентно-адресуемого кэша.
+    Пока график рендерится, возвращает 202, чтобы страница повторила запрос.
+    """
+    chart_service = ChartCacheService()
+    path = chart_service.path_for(digest, fmt)
+    if path.exists():
+        response = FileResponse(open(path, 'rb'), content_type='image/svg+xml' if fmt == 'svg' else 'image/png')
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return response
+    if not chart_service.submit_digest(digest, fmt):
+        raise Http404("График не найден")
+    return JsonResponse({'status': 'pending', 'digest': digest}, status=202)
+
+
+@query_budget(5)
+@staff_member_required
+def analytics_export(request, dataset):
+    """
+    Потоковая выгрузка search_history или api_logs за период.
+    Параметры: format (csv или parquet), start/end (YYYY-MM-DD) или days.
+    """
+    fmt = request.GET.get('format', 'csv')
+    export_service = ExportService()
+    try:
+        export_service.validate(dataset, fmt)
+        start, end = AnalyticsService.resolve_range(
+            start=request.GET.get('start'),
+            end=request.GET.get('end'),
+            days=request.GET.get('days'),
+            max_days=None,
+        )
+    except (ExportError, ValueError) as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    logger.info(f"Экспорт {dataset} ({fmt}) за {start} – {end} запрошен {request.user}")
+    response = StreamingHttpResponse(
+        export_service.stream(dataset, fmt, start, end),
+        content_type=ExportService.FORMATS[fmt],
+    )
+    response['Content-Disposition'] = f'attachment; filename="{export_service.filename(dataset, fmt, start, end)}"'
+    # Отключает буферизацию ответа в nginx-подобных прокси
+    response['X-Accel-Buffering'] = 'no'
+    return response
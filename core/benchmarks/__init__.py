@@ -0,0 +1,213 @@
+"""
+Микробенчмарки горячих путей: разбор ответов провайдеров, ключ и
+обращения к кэшу маршрутов, подготовка маршрутов к показу.
+
+Бенчмарк регистрируется декоратором @benchmark на функции подготовки:
+она выполняется один раз (загрузка фикстур, объекты сервисов) и
+возвращает функцию без аргументов, время которой измеряется. Результат —
+документ JSON со статистикой по каждому бенчмарку; его можно сравнить
+с сохранённой базой (baseline.json) и найти регрессии. Для бенчмарков
+с payload=True дополнительно записывается размер результата функции
+(строки или байтов) — payload_bytes, для memory=True — память,
+которую удерживает результат одного вызова (retained_bytes), и пик
+выделений за вызов (peak_bytes) по tracemalloc.
+
+Запуск: python manage.py run_benchmarks
+"""
+import gc
+import gzip
+import json
+import platform
+import statistics
+import sys
+import timeit
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+
+import django
+from django.utils import timezone
+
+FIXTURES_DIR = Path(__file__).with_name('fixtures')
+BASELINE_PATH = Path(__file__).with_name('baseline.json')
+RESULTS_VERSION = 1
+
+BENCHMARKS = {}
+
+
+@dataclass
+class Benchmark:
+    name: str
+    setup: object
+    needs_db: bool = False
+    description: str = ''
+    payload: bool = False
+    memory: bool = False
+
+
+def benchmark(name, needs_db=False, payload=False, memory=False):
+    """Регистрирует функцию подготовки бенчмарка под именем name"""
+    def decorator(setup):
+        if name in BENCHMARKS:
+            raise ValueError(f"Бенчмарк {name} уже зарегистрирован")
+        description = (setup.__doc__ or '').strip().splitlines()
+        BENCHMARKS[name] = Benchmark(name, setup, needs_db, description[0] if description else '', payload, memory)
+        return setup
+    return decorator
+
+
+# Фикстуры, которые можно заменить записанными ответами провайдеров:
+# имя кассеты и условие на параметры записанного запроса
+CASSETTE_FIXTURES = {
+    'twogis_public_transport': ('2gis_public_transport', lambda request: True),
+    'tomtom_route_car': ('tomtom_routing', lambda request: request.get('params', {}).get('travelMode') == 'car'),
+}
+_cassette_dir = None
+
+
+def use_cassettes(directory):
+    """Брать фикстуры из кассет каталога directory (None — из fixtures/)"""
+    global _cassette_dir
+    _cassette_dir = directory
+
+
+def _fixture_from_cassette(name):
+    from core.services import provider_http
+
+    cassette_name, matches = CASSETTE_FIXTURES[name]
+    for entry in provider_http.cassette(cassette_name, _cassette_dir).entries:
+        response = entry['response']
+        if response.get('status') == 200 and matches(entry['request']):
+            return json.loads(response['body'])
+    return None
+
+
+def load_fixture(name):
+    """
+    Ответ провайдера: первая успешная запись подходящей кассеты (если
+    включены use_cassettes) или fixtures/<name>.json.gz
+    """
+    if _cassette_dir is not None and name in CASSETTE_FIXTURES:
+        data = _fixture_from_cassette(name)
+        if data is not None:
+            return data
+        raise LookupError(f"В кассетах {_cassette_dir} нет успешного ответа для фикстуры {name}")
+    with gzip.open(FIXTURES_DIR / f'{name}.json.gz', 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def measure(func, rounds=7, min_time=0.05):
+    """
+    Подбирает число вызовов за раунд так, чтобы раунд длился не меньше
+    min_time секунд, и выполняет rounds раундов. Сборщик мусора на время
+    замера отключается (поведение timeit).
+    """
+    timer = timeit.Timer(func)
+    iterations = 1
+    while True:
+        elapsed = timer.timeit(iterations)
+        if elapsed >= min_time:
+            break
+        # Оценка по прошлому раунду, но не больше чем в 10 раз за шаг
+        iterations = max(iterations + 1, min(iterations * 10, int(iterations * min_time / max(elapsed, 1e-9) * 1.2)))
+    per_call_us = [total / iterations * 1e6 for total in timer.repeat(rounds, iterations)]
+    return {
+        'median_us': round(statistics.median(per_call_us), 3),
+        'min_us': round(min(per_call_us), 3),
+        'mean_us': round(statistics.fmean(per_call_us), 3),
+        'stdev_us': round(statistics.stdev(per_call_us), 3) if len(per_call_us) > 1 else 0.0,
+        'rounds': rounds,
+        'iterations': iterations,
+    }
+
+
+def measure_memory(func):
+    """Память, удерживаемая результатом одного вызова func, и пик выделений за вызов"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        output = func()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del output
+    return {'retained_bytes': retained, 'peak_bytes': peak}
+
+
+def select(patterns=None):
+    """Бенчмарки, в имени которых есть хотя бы одна из подстрок patterns"""
+    # Регистрация происходит при импорте модуля с бенчмарками
+    from core.benchmarks import hot_paths  # noqa: F401
+    return [
+        bench for name, bench in sorted(BENCHMARKS.items())
+        if not patterns or any(pattern in name for pattern in patterns)
+    ]
+
+
+def run(benchmarks, rounds=7, min_time=0.05, progress=None):
+    """Выполняет бенчмарки и возвращает документ с результатами"""
+    results = {}
+    for bench in benchmarks:
+        func = bench.setup()
+        results[bench.name] = measure(func, rounds=rounds, min_time=min_time)
+        if bench.payload:
+            output = func()
+            results[bench.name]['payload_bytes'] = len(output.encode('utf-8') if isinstance(output, str) else output)
+        if bench.memory:
+            results[bench.name].update(measure_memory(func))
+        if progress:
+            progress(bench, results[bench.name])
+    return {
+        'version': RESULTS_VERSION,
+        'created_at': timezone.now().isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': sys.implementation.name,
+            'django': django.get_version(),
+            'machine': platform.machine(),
+            'platform': platform.platform(terse=True),
+        },
+        'fixtures': f'cassettes:{_cassette_dir}' if _cassette_dir is not None else 'packaged',
+        'benchmarks': results,
+    }
+
+
+def load_results(path):
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('version') != RESULTS_VERSION:
+        raise ValueError(f"{path}: неподдерживаемая версия результатов {data.get('version')}")
+    return data
+
+
+def save_results(path, results):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False, sort_keys=True)
+        f.write('\n')
+
+
+def compare(results, baseline, tolerance=0.25, stat='median_us'):
+    """
+    Сравнивает статистику stat (медиана или минимум) с базой. Статус:
+    regression — медленнее базы более чем в (1 + tolerance) раз,
+    improvement — настолько же быстрее, new — бенчмарка нет в базе,
+    ok — в пределах допуска. На шумных машинах минимум стабильнее медианы.
+    """
+    rows = []
+    base = baseline.get('benchmarks', {})
+    for name, stats in sorted(results['benchmarks'].items()):
+        reference = base.get(name)
+        if not reference or not reference.get(stat):
+            rows.append({'name': name, 'value_us': stats[stat], 'baseline_us': None,
+                         'ratio': None, 'status': 'new'})
+            continue
+        ratio = stats[stat] / reference[stat]
+        if ratio > 1 + tolerance:
+            status = 'regression'
+        elif ratio < 1 / (1 + tolerance):
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append({'name': name, 'value_us': stats[stat], 'baseline_us': reference[stat],
+                     'ratio': round(ratio, 3), 'status': status})
+    return rows
@@ -0,0 +1,424 @@
+"""
+Локальный HTTP-двойник 2GIS Public Transport и TomTom Routing/Search
+для нагрузочных тестов фолбэков, таймаутов и поведения под отказами.
+
+Эндпоинты повторяют формат настоящих API:
+- POST .../public_transport/2.0?key=... — варианты проезда 2GIS;
+- GET /routing/1/calculateRoute/<lat>,<lon>:<lat>,<lon>/json — маршрут TomTom;
+- GET /search/2/search/<запрос>.json — геокодирование TomTom.
+
+Поведение каждого эндпоинта (2gis, tomtom_routing, tomtom_search)
+задаётся сценарием: распределение задержки, доля ошибок, доля
+«зависаний» (ответ позже таймаута клиента), ограничение частоты с 429,
+окна полного отказа и размер ответа. Служебные эндпоинты:
+GET /_fake/stats — счётчики исходов, POST /_fake/scenario — заменить
+сценарий на лету (JSON в теле), POST /_fake/reset — обнулить счётчики.
+
+Приложение направляется на двойник переменными окружения
+TWOGIS_PUBLIC_TRANSPORT_URL и TOMTOM_API_URL (вместе с USE_REAL_API=True,
+USE_PUBLIC_TRANSPORT_API=True и любыми непустыми ключами).
+"""
+import copy
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+ENDPOINTS = ('2gis', 'tomtom_routing', 'tomtom_search')
+
+DEFAULT_BEHAVIOUR = {
+    # fixed: {ms}; uniform: {min_ms, max_ms}; lognormal: {median_ms, p99_ms}
+    'latency': {'distribution': 'lognormal', 'median_ms': 120, 'p99_ms': 600},
+    # Медленный хвост поверх распределения: с вероятностью probability ещё ms
+    'slow_tail': {'probability': 0.0, 'ms': 3000},
+    'error_rate': 0.0,
+    'error_status': 503,
+    # Доля запросов, ответ на которые задерживается на hang_ms (таймаут клиента)
+    'timeout_rate': 0.0,
+    'hang_ms': 20000,
+    # Ограничение частоты (token bucket): rps, burst; превышение — 429
+    'rate_limit': None,
+    # Окна полного отказа в секундах от старта сервера: [[начало, конец], ...]
+    'outages': [],
+    'outage_status': 503,
+    # Размер ответа: число маршрутов/точек/результатов
+    'payload': {'routes': 5, 'points_per_segment': 40, 'points': 400, 'results': 5},
+}
+
+PRESETS = {
+    'healthy': {},
+    'slow-tail': {'*': {'slow_tail': {'probability': 0.05, 'ms': 4000}}},
+    'flaky': {'*': {'error_rate': 0.1, 'timeout_rate': 0.02}},
+    'rate-limited': {'*': {'rate_limit': {'rps': 5, 'burst': 10}}},
+    'outage': {'2gis': {'outages': [[10, 40]]}},
+    'huge-payload': {'*': {'payload': {'routes': 10, 'points_per_segment': 300, 'points': 5000}}},
+}
+
+_ROUTE_RE = re.compile(r'^/routing/1/calculateRoute/(-?[\d.]+),(-?[\d.]+):(-?[\d.]+),(-?[\d.]+)/json$')
+_SEARCH_RE = re.compile(r'^/search/2/search/(.+)\.json$')
+
+STREETS = ('улица Ленина', 'улица Малышева', 'улица 8 Марта', 'улица Мира', 'проспект Космонавтов',
+           'улица Куйбышева', 'улица Луначарского', 'Вокзальная улица')
+STOPS = ('Площадь 1905 года', 'Оперный театр', 'Дом кино', 'Цирк', 'Уральская', 'Динамо',
+         'Геологическая', 'Бажовская', 'Ботаническая', 'ЖД Вокзал', 'Машиностроителей')
+TRANSPORT_NAMES = {'bus': 'автобус', 'tram': 'трамвай', 'trolleybus': 'троллейбус'}
+CAR_SPEED_MPS = {'car': 11.0, 'bicycle': 4.5, 'pedestrian': 1.3}
+
+
+def _merge(base, override):
+    result = copy.deepcopy(base)
+    for key, value in (override or {}).items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = _merge(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+
+def build_scenario(preset='healthy', overrides=None):
+    """
+    Поведение всех эндпоинтов: умолчания, затем пресет, затем overrides.
+    Ключ '*' в пресете/overrides относится ко всем эндпоинтам.
+    """
+    if preset not in PRESETS:
+        raise ValueError(f"Неизвестный пресет {preset}: {', '.join(PRESETS)}")
+    scenario = {}
+    for name in ENDPOINTS:
+        behaviour = DEFAULT_BEHAVIOUR
+        for layer in (PRESETS[preset], overrides or {}):
+            behaviour = _merge(behaviour, layer.get('*'))
+            behaviour = _merge(behaviour, layer.get(name))
+        scenario[name] = behaviour
+    unknown = set(overrides or {}) - set(ENDPOINTS) - {'*'}
+    if unknown:
+        raise ValueError(f"Неизвестные эндпоинты в сценарии: {', '.join(sorted(unknown))}")
+    return scenario
+
+
+def _distance_m(lat1, lon1, lat2, lon2):
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 6371000 * 2 * math.asin(math.sqrt(a))
+
+
+def _path(rng, start, end, count):
+    """Ломаная из count точек от start к end с небольшим отклонением"""
+    count = max(2, count)
+    points = []
+    for i in range(count):
+        t = i / (count - 1)
+        jitter = 0.0 if i in (0, count - 1) else 0.0004
+        points.append((
+            start[0] + (end[0] - start[0]) * t + rng.uniform(-jitter, jitter),
+            start[1] + (end[1] - start[1]) * t + rng.uniform(-jitter, jitter),
+        ))
+    return points
+
+
+def _wkt(points):
+    return 'LINESTRING(' + ', '.join(f'{lon:.6f} {lat:.6f}' for lat, lon in points) + ')'
+
+
+def twogis_payload(rng, source, target, payload):
+    """Варианты проезда в формате ответа 2GIS Public Transport 2.0"""
+    routes = []
+    per_segment = payload.get('points_per_segment', 40)
+    for _ in range(payload.get('routes', 5)):
+        legs = rng.choice((1, 1, 2, 3))
+        # Остановки посадки/пересадок/высадки между точками отправления и прибытия
+        fractions = sorted(rng.uniform(0.05, 0.95) for _ in range(legs + 1))
+        stop_points = [
+            (source[0] + (target[0] - source[0]) * t + rng.uniform(-0.002, 0.002),
+             source[1] + (target[1] - source[1]) * t + rng.uniform(-0.002, 0.002))
+            for t in fractions
+        ]
+        movements = []
+        stops = []
+        transport = []
+        total_duration = 0
+        total_distance = 0
+
+        def walkway(start, end, subtype, name):
+            distance = int(_distance_m(*start, *end)) + 50
+            movements.append({
+                'id': str(rng.getrandbits(48)), 'type': 'walkway', 'distance': distance,
+                'moving_duration': int(distance / 1.3),
+                'waypoint': {'name': name, 'comment': '', 'subtype': subtype},
+                'alternatives': [{'geometry': [{'selection': _wkt(_path(rng, start, end, 10))}]}],
+            })
+            return distance, int(distance / 1.3)
+
+        distance, duration = walkway(source, stop_points[0], 'start', rng.choice(STOPS))
+        total_distance += distance
+        total_duration += duration
+        for leg in range(legs):
+            start, end = stop_points[leg], stop_points[leg + 1]
+            subtype = rng.choice(tuple(TRANSPORT_NAMES))
+            stops_count = rng.randint(3, 10)
+            distance = int(_distance_m(*start, *end)) + 200
+            duration = stops_count * 110
+            waiting = rng.randint(60, 600)
+            points = _path(rng, start, end, per_segment * stops_count)
+            step = max(1, len(points) // stops_count)
+            movements.append({
+                'id': str(rng.getrandbits(48)), 'type': 'passage', 'distance': distance,
+                'moving_duration': duration, 'waiting_duration': waiting, 'stops_count': stops_count,
+                'routes': [{'names': [str(rng.randint(1, 90))], 'subtype': subtype,
+                            'subtype_name': TRANSPORT_NAMES[subtype], 'color': f'#{rng.getrandbits(24):06x}'}],
+                'waypoint': {'name': rng.choice(STOPS), 'comment': '', 'subtype': subtype},
+                'alternatives': [{'geometry': [
+                    {'selection': _wkt(points[i:i + step + 1])} for i in range(0, len(points) - 1, step)
+                ]}],
+            })
+            for point in (start, end):
+                stops.append({'id': str(rng.getrandbits(32)), 'type': 'stop', 'name': rng.choice(STOPS),
+                              'point': {'lat': point[0], 'lon': point[1]}})
+            transport.append(subtype)
+            total_distance += distance
+            total_duration += duration + waiting
+        distance, duration = walkway(stop_points[-1], target, 'finish', '')
+        total_distance += distance
+        total_duration += duration
+        routes.append({
+            'id': str(len(routes) + 1), 'route_id': f'{rng.getrandbits(64):x}',
+            'total_duration': total_duration, 'total_distance': total_distance,
+            'transfer_count': legs - 1, 'crossing_count': 0, 'pedestrian': False,
+            'transport': transport, 'movements': movements, 'waypoints': stops,
+        })
+    return routes
+
+
+def tomtom_route_payload(rng, start, end, travel_mode, payload):
+    """Маршрут в формате TomTom Routing API 1 (calculateRoute)"""
+    points = _path(rng, start, end, payload.get('points', 400))
+    length = int(_distance_m(*start, *end) * 1.3)
+    travel_time = int(length / CAR_SPEED_MPS.get(travel_mode, CAR_SPEED_MPS['car']))
+    instructions = [
+        {'pointIndex': i, 'routeOffsetInMeters': length * i // len(points),
+         'point': {'latitude': points[i][0], 'longitude': points[i][1]},
+         'message': f"Поверните {rng.choice(('направо', 'налево'))} на {rng.choice(STREETS)}"}
+        for i in range(0, len(points), 30)
+    ]
+    return {
+        'formatVersion': '0.0.12',
+        'routes': [{
+            'summary': {'lengthInMeters': length, 'travelTimeInSeconds': travel_time,
+                        'trafficDelayInSeconds': rng.randint(0, 300) if travel_mode == 'car' else 0},
+            'legs': [{'points': [{'latitude': round(lat, 5), 'longitude': round(lon, 5)} for lat, lon in points]}],
+            'guidance': {'instructions': instructions},
+        }],
+    }
+
+
+def tomtom_search_payload(rng, query, center, payload):
+    """Результаты в формате TomTom Search API 2"""
+    count = payload.get('results', 5)
+    return {
+        'summary': {'query': query, 'numResults': count, 'totalResults': count},
+        'results': [{
+            'type': 'Point Address',
+            'score': round(rng.uniform(5, 10), 3),
+            'address': {'streetName': rng.choice(STREETS), 'streetNumber': str(rng.randint(1, 150)),
+                        'municipality': 'Екатеринбург', 'countrySubdivision': 'Свердловская область'},
+            'position': {'lat': center[0] + rng.uniform(-0.03, 0.03), 'lon': center[1] + rng.uniform(-0.03, 0.03)},
+        } for _ in range(count)],
+    }
+
+
+class TokenBucket:
+    def __init__(self, rps, burst):
+        self.rps = rps
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rps)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class FakeProviders:
+    """Состояние двойника: сценарий, генератор случайности и счётчики"""
+
+    def __init__(self, scenario, seed=None):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.stats = {name: Counter() for name in ENDPOINTS}
+        self.set_scenario(scenario)
+
+    def set_scenario(self, scenario):
+        with self.lock:
+            self.scenario = scenario
+            self.buckets = {
+                name: TokenBucket(behaviour['rate_limit']['rps'], behaviour['rate_limit'].get('burst', 1))
+                for name, behaviour in scenario.items() if behaviour.get('rate_limit')
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {name: Counter() for name in ENDPOINTS}
+
+    def _latency_ms(self, latency):
+        kind = latency.get('distribution', 'fixed')
+        if kind == 'uniform':
+            return self.rng.uniform(latency.get('min_ms', 0), latency.get('max_ms', 0))
+        if kind == 'lognormal':
+            median = max(latency.get('median_ms', 100), 0.001)
+            # p99 = median * exp(2.326 * sigma)
+            sigma = math.log(max(latency.get('p99_ms', median), median) / median) / 2.326
+            return self.rng.lognormvariate(math.log(median), sigma)
+        return latency.get('ms', 0)
+
+    def decide(self, name):
+        """Исход запроса к эндпоинту: (исход, HTTP-статус или None, задержка в секундах)"""
+        behaviour = self.scenario[name]
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            delay_ms = self._latency_ms(behaviour['latency'])
+            tail = behaviour.get('slow_tail') or {}
+            if self.rng.random() < tail.get('probability', 0):
+                delay_ms += tail.get('ms', 0)
+            if any(start <= elapsed < end for start, end in behaviour.get('outages', [])):
+                outcome, status = 'outage', behaviour.get('outage_status', 503)
+            elif name in self.buckets and not self.buckets[name].allow():
+                outcome, status, delay_ms = 'rate_limited', 429, min(delay_ms, 5)
+            elif self.rng.random() < behaviour.get('timeout_rate', 0):
+                outcome, status, delay_ms = 'timeout', behaviour.get('error_status', 503), behaviour.get('hang_ms', 20000)
+            elif self.rng.random() < behaviour.get('error_rate', 0):
+                outcome, status = 'error', behaviour.get('error_status', 503)
+            else:
+                outcome, status = 'ok', None
+            self.stats[name][outcome] += 1
+        return outcome, status, delay_ms / 1000
+
+    def payload_rng(self, *parts):
+        """Детерминированный ответ для одинаковых запросов при заданном seed"""
+        return random.Random(f"{self.seed}:{':'.join(map(str, parts))}")
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    server_version = 'FakeProviders/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _reply(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _serve(self, name, query, build):
+        if not query.get('key'):
+            self._reply(403, {'message': 'API key is required'})
+            return
+        outcome, status, delay = self.state.decide(name)
+        if delay > 0:
+            time.sleep(delay)
+        if status == 429:
+            self._reply(429, {'message': 'Too Many Requests'}, {'Retry-After': '1'})
+        elif status is not None:
+            self._reply(status, {'message': f'Simulated {outcome}'})
+        else:
+            self._reply(200, build())
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        path = unquote(parts.path)
+
+        if path == '/_fake/stats':
+            with self.state.lock:
+                stats = {name: dict(counter) for name, counter in self.state.stats.items()}
+            self._reply(200, {'stats': stats, 'scenario': self.state.scenario,
+                              'uptime_s': round(time.monotonic() - self.state.started, 1)})
+            return
+        match = _ROUTE_RE.match(path)
+        if match:
+            start_lat, start_lon, end_lat, end_lon = map(float, match.groups())
+            travel_mode = query.get('travelMode', ['car'])[0]
+            payload = self.state.scenario['tomtom_routing']['payload']
+            self._serve('tomtom_routing', query, lambda: tomtom_route_payload(
+                self.state.payload_rng(path, travel_mode), (start_lat, start_lon), (end_lat, end_lon),
+                travel_mode, payload,
+            ))
+            return
+        match = _SEARCH_RE.match(path)
+        if match:
+            center = (float(query.get('lat', [56.8379])[0]), float(query.get('lon', [60.5975])[0]))
+            payload = self.state.scenario['tomtom_search']['payload']
+            self._serve('tomtom_search', query, lambda: tomtom_search_payload(
+                self.state.payload_rng(path), match.group(1), center, payload,
+            ))
+            return
+        self._reply(404, {'message': f'Unknown endpoint {path}'})
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        body = self._read_body()
+
+        if parts.path == '/_fake/scenario':
+            try:
+                overrides = json.loads(body or b'{}')
+                self.state.set_scenario(build_scenario(overrides.pop('preset', 'healthy'), overrides))
+            except (ValueError, TypeError, AttributeError) as e:
+                self._reply(400, {'message': str(e)})
+                return
+            self._reply(200, {'scenario': self.state.scenario})
+            return
+        if parts.path == '/_fake/reset':
+            self.state.reset_stats()
+            self._reply(200, {'status': 'ok'})
+            return
+        if parts.path.rstrip('/').endswith('/public_transport/2.0'):
+            try:
+                request = json.loads(body)
+                source = (request['source']['point']['lat'], request['source']['point']['lon'])
+                target = (request['target']['point']['lat'], request['target']['point']['lon'])
+            except (ValueError, KeyError, TypeError):
+                self._reply(400, {'message': 'Invalid request body'})
+                return
+            payload = self.state.scenario['2gis']['payload']
+            self._serve('2gis', query, lambda: twogis_payload(
+                self.state.payload_rng(source, target), source, target, payload,
+            ))
+            return
+        self._reply(404, {'message': f'Unknown endpoint {parts.path}'})
+
+
+def make_server(host, port, scenario, seed=None, verbose=False):
+    server = ThreadingHTTPServer((host, port), FakeProviderHandler)
+    server.daemon_threads = True
+    server.state = FakeProviders(scenario, seed)
+    server.verbose = verbose
+    return server
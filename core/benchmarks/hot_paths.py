@@ -0,0 +1,295 @@
+"""
+Бенчмарки разбора ответов 2GIS/TomTom, кэша маршрутов и подготовки
+маршрутов к показу. Фикстуры повторяют структуру реальных ответов
+для Екатеринбурга: 7 вариантов проезда 2GIS (разбираются первые 5) с
+WKT-геометрией по остановкам и маршрут TomTom на ~900 точек.
+"""
+import dataclasses
+import itertools
+import json
+import re
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from core.benchmarks import benchmark, load_fixture
+from core.services import geometry, geometry_store, presentation, route_model
+from core.services.cached_routing_service import CachedRoutingService
+from core.services.routing_service import TomTomRoutingService
+from core.services.twogis_public_transport_service import TwoGisPublicTransportService
+from core.testing import ROUTE_END, ROUTE_START, FixtureRoutingService, parsed_car_routes, parsed_public_routes
+
+START, END = ROUTE_START, ROUTE_END
+PUBLIC_KWARGS = {
+    'travel_mode': 'public',
+    'transport_types': ['tram', 'bus'],
+    'max_transfers': 2,
+    'only_direct': False,
+}
+PUBLIC_FILTERS = {'transport_types': ['tram', 'bus'], 'max_transfers': '2', 'only_direct': False}
+
+
+def _twogis_service():
+    return TwoGisPublicTransportService(api_key='benchmark')
+
+
+@benchmark('twogis.parse_api_response')
+def twogis_parse_api_response():
+    """Полный разбор ответа 2GIS: сегменты, остановки, инструкции, геометрия"""
+    service = _twogis_service()
+    api_data = load_fixture('twogis_public_transport')
+    return lambda: service._parse_api_response(api_data, *START, *END)
+
+
+def legacy_parse_wkt_linestring(wkt_string):
+    """
+    Прежний разбор WKT (регулярное выражение и цикл по точкам) — эталон
+    для сравнения скорости и результата core.services.geometry
+    """
+    coordinates = []
+    match = re.search(r'LINESTRING\((.+?)\)', wkt_string)
+    if match:
+        for point in match.group(1).split(','):
+            lon, lat = point.strip().split()
+            coordinates.append([float(lat), float(lon)])
+    return coordinates
+
+
+def wkt_selections():
+    """Все WKT-линии первых 5 вариантов ответа 2GIS"""
+    return [
+        geometry['selection']
+        for route in load_fixture('twogis_public_transport')[:5]
+        for movement in route['movements']
+        for alternative in movement.get('alternatives', [])
+        for geometry in alternative.get('geometry', [])
+    ]
+
+
+def long_wkt(points=5000):
+    """Линия длинного маршрута (трамвай через весь город) с шагом ~10 м"""
+    lon, lat = START[1], START[0]
+    coordinates = []
+    for i in range(points):
+        coordinates.append(f"{lon + i * 0.00012:.6f} {lat - i * 0.00003 + 0.0004 * ((i // 40) % 2):.6f}")
+    return f"LINESTRING({', '.join(coordinates)})"
+
+
+@benchmark('twogis.parse_wkt_linestring')
+def twogis_parse_wkt_linestring():
+    """Разбор всех WKT-линий одного ответа 2GIS"""
+    service = _twogis_service()
+    selections = wkt_selections()
+
+    def parse_all():
+        for selection in selections:
+            service._parse_wkt_linestring(selection)
+    return parse_all
+
+
+@benchmark('twogis.parse_wkt_linestring_legacy')
+def twogis_parse_wkt_linestring_legacy():
+    """То же прежним разбором на регулярном выражении"""
+    selections = wkt_selections()
+
+    def parse_all():
+        for selection in selections:
+            legacy_parse_wkt_linestring(selection)
+    return parse_all
+
+
+@benchmark('geometry.parse_wkt_long')
+def geometry_parse_wkt_long():
+    """Линия на 5000 точек: разбор в массив NumPy и перевод в списки"""
+    service = _twogis_service()
+    wkt = long_wkt()
+    return lambda: service._parse_wkt_linestring(wkt)
+
+
+@benchmark('geometry.parse_wkt_long_legacy')
+def geometry_parse_wkt_long_legacy():
+    """Линия на 5000 точек прежним разбором"""
+    wkt = long_wkt()
+    return lambda: legacy_parse_wkt_linestring(wkt)
+
+
+@benchmark('geometry.levels_public')
+def geometry_levels_public():
+    """Уровни детализации 5 маршрутов общественного транспорта (Дуглас–Пекер)"""
+    lines = [route.lines for route in parsed_public_routes()['result']]
+    return lambda: [geometry.build_levels(route_lines) for route_lines in lines]
+
+
+@benchmark('geometry.levels_public_parts')
+def geometry_levels_public_parts():
+    """То же по участкам, уже встречавшимся в других поисках (память уровней участков)"""
+    routes = parsed_public_routes()['result']
+    return lambda: geometry.add_levels_of_detail(
+        {'result': [dataclasses.replace(route, lod={}, lod_parts={}) for route in routes]}
+    )
+
+
+@benchmark('geometry.levels_car')
+def geometry_levels_car():
+    """Уровни детализации маршрута TomTom на ~900 точек"""
+    lines = parsed_car_routes()['result'][0].lines
+    return lambda: geometry.build_levels(lines)
+
+
+@benchmark('views.routes_json_public', payload=True)
+def views_routes_json_public():
+    """routes_json для карты: выбор уровня детализации, кодирование и сериализация"""
+    from core.views import routes_for_map
+    routes = geometry.add_levels_of_detail(parsed_public_routes())['result']
+    return lambda: json.dumps(routes_for_map(routes, PUBLIC_FILTERS), cls=DjangoJSONEncoder, ensure_ascii=False)
+
+
+@benchmark('views.routes_page_public', payload=True)
+def views_routes_page_public():
+    """routes-data страницы: первый маршрут для карты, остальные — краткие сведения со ссылками"""
+    from core.views import routes_for_page
+    routes = geometry.add_levels_of_detail(parsed_public_routes())['result']
+    return lambda: json.dumps(routes_for_page(routes, PUBLIC_FILTERS, '0' * 32), cls=DjangoJSONEncoder,
+                              ensure_ascii=False)
+
+
+@benchmark('geometry.polyline_encode_car', payload=True)
+def geometry_polyline_encode_car():
+    """Кодирование маршрута TomTom (~900 точек) в Encoded Polyline"""
+    line = parsed_car_routes()['result'][0].lines[0]
+    return lambda: geometry.encode_polyline(line)
+
+
+@benchmark('geometry.polyline_decode_car')
+def geometry_polyline_decode_car():
+    """Раскодирование того же маршрута в списки [lat, lon]"""
+    encoded = geometry.encode_polyline(parsed_car_routes()['result'][0].lines[0])
+    return lambda: geometry.decode_polyline(encoded).tolist()
+
+
+@benchmark('geometry.json_car', payload=True)
+def geometry_json_car():
+    """Тот же маршрут в JSON — для сравнения размера и времени"""
+    line = parsed_car_routes()['result'][0].lines[0].tolist()
+    return lambda: json.dumps(line)
+
+
+@benchmark('cache.payload_public_json', payload=True)
+def cache_payload_public_json():
+    """route_data 5 маршрутов 2GIS с уровнями детализации в JSON (как в CachedRoute до кодирования)"""
+    route_data = geometry.add_levels_of_detail(parsed_public_routes())
+    return lambda: json.dumps(route_model.dump_route_data(route_data), ensure_ascii=False)
+
+
+@benchmark('cache.payload_public_packed', payload=True)
+def cache_payload_public_packed():
+    """То же с линиями Encoded Polyline: pack_route_data и сериализация"""
+    route_data = geometry.add_levels_of_detail(parsed_public_routes())
+    return lambda: json.dumps(
+        geometry.pack_route_data(route_model.dump_route_data(route_data, arrays=True)), ensure_ascii=False
+    )
+
+
+@benchmark('cache.payload_public_shared', needs_db=True, payload=True)
+def cache_payload_public_shared():
+    """Запись кэша для повторного поиска: участки уже в RouteGeometry, в записи только ссылки"""
+    route_data = geometry.add_levels_of_detail(parsed_public_routes())
+    geometry_store.pack_route_data(route_data)
+    return lambda: json.dumps(geometry_store.pack_route_data(route_data), ensure_ascii=False)
+
+
+@benchmark('cache.unpack_public')
+def cache_unpack_public():
+    """Раскодирование route_data из кэша при попадании"""
+    route_data = geometry.add_levels_of_detail(parsed_public_routes())
+    packed = json.loads(json.dumps(geometry.pack_route_data(route_model.dump_route_data(route_data, arrays=True))))
+    return lambda: route_model.load_route_data(geometry.unpack_route_data(packed, arrays=True))
+
+
+@benchmark('tomtom.parse_response')
+def tomtom_parse_response():
+    """Разбор ответа TomTom (авто): точки маршрута и инструкции"""
+    service = TomTomRoutingService(api_key='benchmark')
+    api_data = load_fixture('tomtom_route_car')
+    return lambda: service._parse_tomtom_response(api_data, 'car')
+
+
+@benchmark('cache.make_key')
+def cache_make_key():
+    """Строка и md5-ключ кэша для запроса общественного транспорта с фильтрами"""
+    return lambda: CachedRoutingService.make_cache_key(*START, *END, **PUBLIC_KWARGS)
+
+
+@benchmark('cache.hit', needs_db=True)
+def cache_hit():
+    """CachedRoutingService: попадание в кэш (чтение CachedRoute, запись ApiLog)"""
+    service = CachedRoutingService(FixtureRoutingService(parsed_public_routes()), provider_name='benchmark')
+    service.get_routes(*START, *END, **PUBLIC_KWARGS)
+    return lambda: service.get_routes(*START, *END, **PUBLIC_KWARGS)
+
+
+@benchmark('cache.miss', needs_db=True)
+def cache_miss():
+    """CachedRoutingService: промах (поиск, вызов провайдера, сохранение, ApiLog)"""
+    service = CachedRoutingService(FixtureRoutingService(parsed_public_routes()), provider_name='benchmark')
+    counter = itertools.count()
+
+    def miss():
+        # Каждый вызов — новая конечная точка, чтобы не попадать в кэш
+        shift = next(counter) * 1e-6
+        return service.get_routes(*START, END[0] + shift, END[1], **PUBLIC_KWARGS)
+    return miss
+
+
+@benchmark('presentation.prepare_car')
+def presentation_prepare_car():
+    """Подготовка маршрута TomTom (авто) к показу с построением инструкций из сегментов"""
+    routes_data = parsed_car_routes()
+
+    def prepare():
+        # Инструкции строятся только при их отсутствии: копия без них на каждый вызов
+        data = {'result': [dataclasses.replace(route, instructions=[]) for route in routes_data['result']]}
+        return presentation.prepare_route_data(data, START, END, 'car')
+    return prepare
+
+
+@benchmark('views.search_hit_public', needs_db=True)
+def views_search_hit_public():
+    """Поиск с попаданием в кэш: чтение подготовленных маршрутов и JSON для карты"""
+    from core.views import routes_for_map
+    service = CachedRoutingService(FixtureRoutingService(parsed_public_routes()), provider_name='benchmark')
+    service.get_routes(*START, *END, **PUBLIC_KWARGS)
+
+    def search():
+        routes = service.get_routes(*START, *END, **PUBLIC_KWARGS)['result']
+        return json.dumps(routes_for_map(routes, PUBLIC_FILTERS), cls=DjangoJSONEncoder, ensure_ascii=False)
+    return search
+
+
+@benchmark('pipeline.public_transport')
+def pipeline_public_transport():
+    """Разбор ответа 2GIS и подготовка маршрутов к показу: работа промаха без сети и БД"""
+    service = _twogis_service()
+    api_data = load_fixture('twogis_public_transport')
+
+    def pipeline():
+        routes_data = service._parse_api_response(api_data, *START, *END)
+        return presentation.prepare_route_data(routes_data, START, END, 'public')
+    return pipeline
+
+
+@benchmark('memory.routes_public_model', memory=True)
+def memory_routes_public_model():
+    """Разобранный ответ 2GIS с уровнями детализации: объекты Route, геометрия в массивах"""
+    service = _twogis_service()
+    api_data = load_fixture('twogis_public_transport')
+    return lambda: geometry.add_levels_of_detail(service._parse_api_response(api_data, *START, *END))
+
+
+@benchmark('memory.routes_public_dicts', memory=True)
+def memory_routes_public_dicts():
+    """То же вложенными словарями со списками координат (прежний вид route_data)"""
+    service = _twogis_service()
+    api_data = load_fixture('twogis_public_transport')
+    return lambda: route_model.dump_route_data(
+        geometry.add_levels_of_detail(service._parse_api_response(api_data, *START, *END))
+    )
@@ -0,0 +1,386 @@
+"""
+Нагрузочное тестирование запущенного сервера на реалистичной смеси
+запросов: поиск маршрута (home), автодополнение и /api/status/.
+
+Источники нагрузки:
+- history — пары запросов и фильтры из SearchHistory;
+- trace — JSONL-файл, по строке на запрос:
+  {"endpoint": "home", "params": {...}, "at": 0.25}
+  (или "path" вместо "endpoint"; "at" — смещение от начала в секундах);
+- synthetic — пары известных заглушке геокодирования мест Екатеринбурга.
+
+Модели нагрузки: закрытая (concurrency потоков шлют запросы подряд) и
+открытая (пуассоновский поток с интенсивностью rate запросов/с или
+временные метки трассы). В открытой модели задержка считается от
+запланированного момента отправки, поэтому очередь перед перегруженным
+сервером видна в квантилях, а не прячется.
+
+Попадания в кэш маршрутов определяются по заголовку Server-Timing
+(есть этап cache_lookup, нет этапа provider), а если он выключен — по
+приросту route_cache_requests_total в /metrics.
+"""
+import json
+import queue
+import random
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from itertools import cycle
+
+import requests
+from django.utils import timezone
+
+from core.services.geocoding_service import StubGeocodingService
+from core.services.latency_service import LatencyHistogram
+
+ENDPOINTS = {
+    'home': '/',
+    'autocomplete': '/api/autocomplete/',
+    'status': '/api/status/',
+}
+DEFAULT_MIX = {'home': 0.5, 'autocomplete': 0.45, 'status': 0.05}
+REPORT_QUANTILES = (0.5, 0.9, 0.95, 0.99)
+TRAVEL_MODES = ('public', 'public', 'public', 'car', 'pedestrian', 'bicycle')
+
+_CACHE_METRIC_RE = re.compile(r'^route_cache_requests_total\{tier="db",result="(\w+)"\} (\d+)', re.M)
+
+
+class LoadTestError(Exception):
+    pass
+
+
+@dataclass
+class WorkItem:
+    endpoint: str
+    path: str
+    params: dict = field(default_factory=dict)
+    at: float = None
+
+
+def parse_mix(value):
+    """'home=0.6,autocomplete=0.35,status=0.05' -> веса по эндпоинтам"""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise LoadTestError(f"Неизвестный эндпоинт в смеси: {name}")
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise LoadTestError(f"Некорректный вес для {name}: {weight}")
+    if sum(mix.values()) <= 0:
+        raise LoadTestError("Сумма весов смеси должна быть положительной")
+    return mix
+
+
+def history_searches(limit=1000):
+    """Последние поиски из SearchHistory в виде параметров формы home"""
+    from core.models import SearchHistory
+
+    searches = []
+    rows = SearchHistory.objects.order_by('-timestamp').values_list(
+        'start_query', 'end_query', 'travel_mode', 'transport_types', 'max_transfers'
+    )[:limit]
+    for start_query, end_query, travel_mode, transport_types, max_transfers in rows:
+        params = {'start_point': start_query, 'end_point': end_query, 'travel_mode': travel_mode or 'public'}
+        if transport_types:
+            params['transport_types'] = transport_types.split(',')
+        if max_transfers:
+            params['max_transfers'] = max_transfers
+        searches.append(params)
+    return searches
+
+
+def synthetic_searches(count=200, seed=None):
+    """Случайные пары мест, которые знает StubGeocodingService"""
+    rng = random.Random(seed)
+    places = list(StubGeocodingService.EKB_PLACES)
+    searches = []
+    for _ in range(count):
+        start, end = rng.sample(places, 2)
+        searches.append({'start_point': start, 'end_point': end, 'travel_mode': rng.choice(TRAVEL_MODES)})
+    return searches
+
+
+def mixed_workload(searches, mix=None, seed=None):
+    """
+    Бесконечный поток запросов по весам mix. Автодополнение получает
+    префиксы тех же адресов, что вводятся в форму поиска.
+    """
+    if not searches:
+        raise LoadTestError("Нет поисковых запросов для построения нагрузки")
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    while True:
+        endpoint = rng.choices(names, weights)[0]
+        if endpoint == 'home':
+            yield WorkItem('home', ENDPOINTS['home'], dict(rng.choice(searches)))
+        elif endpoint == 'autocomplete':
+            search = rng.choice(searches)
+            query = search['start_point' if rng.random() < 0.5 else 'end_point']
+            prefix = query[:rng.randint(min(2, len(query)), len(query))] if query else ''
+            yield WorkItem('autocomplete', ENDPOINTS['autocomplete'], {'q': prefix})
+        else:
+            yield WorkItem('status', ENDPOINTS['status'])
+
+
+def trace_workload(path, loop=False):
+    """Запросы из JSONL-трассы в порядке файла"""
+    items = []
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise LoadTestError(f"{path}:{line_number}: некорректный JSON: {e}")
+            endpoint = record.get('endpoint')
+            if endpoint and endpoint not in ENDPOINTS:
+                raise LoadTestError(f"{path}:{line_number}: неизвестный эндпоинт {endpoint}")
+            request_path = record.get('path') or ENDPOINTS.get(endpoint)
+            if not request_path:
+                raise LoadTestError(f"{path}:{line_number}: нужен endpoint или path")
+            endpoint = endpoint or next(
+                (name for name, url in ENDPOINTS.items() if url == request_path), request_path
+            )
+            items.append(WorkItem(endpoint, request_path, record.get('params') or {}, record.get('at')))
+    if not items:
+        raise LoadTestError(f"Трасса {path} пуста")
+    return cycle(items) if loop else iter(items)
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.statuses = Counter()
+        self.errors = 0
+        self.bytes = 0
+
+    def to_dict(self):
+        summary = self.latency.summary(REPORT_QUANTILES)
+        count = summary.pop('count')
+        return {
+            'requests': count,
+            'errors': self.errors,
+            'error_rate': round(self.errors / count, 4) if count else 0.0,
+            'statuses': dict(sorted(self.statuses.items())),
+            'bytes': self.bytes,
+            'latency_ms': {key: round(value, 1) if value is not None else None for key, value in summary.items()},
+        }
+
+
+class LoadTest:
+    """
+    Прогон нагрузки против base_url. Если задан rate или у запросов трассы
+    есть метки времени — открытая модель, иначе закрытая.
+    """
+
+    def __init__(self, base_url, workload, concurrency=10, rate=None, duration=30.0,
+                 max_requests=None, timeout=30.0, speed=1.0, headers=None, seed=None):
+        self.base_url = base_url.rstrip('/')
+        self.workload = workload
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.speed = speed
+        self.headers = headers or {}
+        self.rng = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.total = EndpointStats()
+        self.cache = Counter()
+        self.issued = 0
+        self.max_backlog = 0
+        self._local = threading.local()
+
+    # --- отправка ---
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.headers.update(self.headers)
+        return session
+
+    def _take(self):
+        """Следующий запрос для закрытой модели или None, если лимиты исчерпаны"""
+        with self.lock:
+            if self.max_requests is not None and self.issued >= self.max_requests:
+                return None
+            if time.perf_counter() >= self.deadline:
+                return None
+            item = next(self.workload, None)
+            if item is not None:
+                self.issued += 1
+            return item
+
+    def _send(self, item, scheduled):
+        status = None
+        size = 0
+        cache_result = None
+        try:
+            response = self._session().get(self.base_url + item.path, params=item.params, timeout=self.timeout)
+            status = response.status_code
+            size = len(response.content)
+            if item.endpoint == 'home':
+                cache_result = self._cache_result(response.headers.get('Server-Timing', ''))
+        except requests.RequestException as e:
+            status = type(e).__name__
+        latency_ms = (time.perf_counter() - scheduled) * 1000
+        is_error = not isinstance(status, int) or status >= 400
+
+        with self.lock:
+            for stats in (self.stats.setdefault(item.endpoint, EndpointStats()), self.total):
+                stats.latency.add(latency_ms)
+                stats.statuses[str(status)] += 1
+                stats.errors += is_error
+                stats.bytes += size
+            if cache_result:
+                self.cache[cache_result] += 1
+
+    @staticmethod
+    def _cache_result(server_timing):
+        stages = {part.split(';', 1)[0].strip() for part in server_timing.split(',')}
+        if 'cache_lookup' not in stages:
+            return None
+        return 'miss' if 'provider' in stages else 'hit'
+
+    # --- модели нагрузки ---
+
+    def _closed_worker(self):
+        while True:
+            item = self._take()
+            if item is None:
+                return
+            self._send(item, time.perf_counter())
+
+    def _open_worker(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            scheduled, item = job
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self._send(item, scheduled)
+
+    def _schedule(self, jobs):
+        """Раскладывает запросы по времени: метки трассы или пуассоновский поток"""
+        next_at = self.started
+        try:
+            while True:
+                item = next(self.workload, None)
+                if item is None:
+                    break
+                if self.rate:
+                    next_at += self.rng.expovariate(self.rate)
+                elif item.at is not None:
+                    next_at = self.started + item.at / self.speed
+                if next_at >= self.deadline:
+                    break
+                if self.max_requests is not None and self.issued >= self.max_requests:
+                    break
+                # Очередь заполняется не раньше чем за 50 мс до отправки
+                delay = next_at - time.perf_counter() - 0.05
+                if delay > 0:
+                    time.sleep(delay)
+                jobs.put((next_at, item))
+                self.issued += 1
+                self.max_backlog = max(self.max_backlog, jobs.qsize())
+        finally:
+            for _ in range(self.concurrency):
+                jobs.put(None)
+
+    def run(self):
+        self.started = time.perf_counter()
+        self.deadline = self.started + self.duration if self.duration else float('inf')
+        started_at = timezone.now()
+
+        if self.rate or self._is_timed():
+            jobs = queue.Queue()
+            threads = [threading.Thread(target=self._open_worker, args=(jobs,), daemon=True)
+                       for _ in range(self.concurrency)]
+            threads.append(threading.Thread(target=self._schedule, args=(jobs,), daemon=True))
+            model = 'open'
+        else:
+            threads = [threading.Thread(target=self._closed_worker, daemon=True) for _ in range(self.concurrency)]
+            model = 'closed'
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.perf_counter() - self.started
+        total = self.total.to_dict()
+        return {
+            'started_at': started_at.isoformat(),
+            'model': model,
+            'elapsed_s': round(elapsed, 3),
+            'requests': total['requests'],
+            'throughput_rps': round(total['requests'] / elapsed, 2) if elapsed else 0.0,
+            'errors': total['errors'],
+            'error_rate': total['error_rate'],
+            'latency_ms': total['latency_ms'],
+            'max_backlog': self.max_backlog if model == 'open' else None,
+            'endpoints': {name: stats.to_dict() for name, stats in sorted(self.stats.items())},
+            'cache': self._cache_summary(self.cache, 'server-timing'),
+        }
+
+    def _is_timed(self):
+        """Трасса с метками времени: первый запрос определяет модель"""
+        first = next(self.workload, None)
+        if first is None:
+            return False
+        self.workload = _prepend(first, self.workload)
+        return first.at is not None
+
+    @staticmethod
+    def _cache_summary(counts, source):
+        hits, misses = counts.get('hit', 0), counts.get('miss', 0)
+        if not hits + misses:
+            return None
+        return {'hits': hits, 'misses': misses, 'hit_ratio': round(hits / (hits + misses), 4), 'source': source}
+
+
+def _prepend(item, iterator):
+    yield item
+    yield from iterator
+
+
+def server_status(base_url, timeout=10.0):
+    """Ответ /api/status/ целевого сервера (проверка доступности и провайдеров)"""
+    try:
+        response = requests.get(base_url.rstrip('/') + ENDPOINTS['status'], timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+    except (requests.RequestException, ValueError) as e:
+        raise LoadTestError(f"Сервер {base_url} недоступен: {e}")
+
+
+def scrape_cache_counters(base_url, token=None, timeout=10.0):
+    """Счётчики route_cache_requests_total{tier="db"} из /metrics или None"""
+    headers = {'Authorization': f'Bearer {token}'} if token else {}
+    try:
+        response = requests.get(base_url.rstrip('/') + '/metrics', headers=headers, timeout=timeout)
+    except requests.RequestException:
+        return None
+    if response.status_code != 200:
+        return None
+    return Counter({result: int(value) for result, value in _CACHE_METRIC_RE.findall(response.text)})
+
+
+def cache_from_metrics(before, after):
+    if before is None or after is None:
+        return None
+    return LoadTest._cache_summary(after - before, 'metrics')
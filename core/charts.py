@@ -0,0 +1,382 @@
+"""
+Построение графиков аналитического дашборда.
+
+Модуль не зависит от Django: функции вызываются в дочерних процессах пула
+рендеринга (см. services/chart_cache_service.py) и получают только
+сериализуемые данные.
+"""
+import logging
+import os
+from io import BytesIO
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+def create_top_routes_chart(df, fmt='png'):
+    """Создает горизонтальную столбчатую диаграмму ТОП маршрутов"""
+    try:
+        plt.figure(figsize=(14, 8))
+        
+
+        labels = []
+        for _, row in df.iterrows():
+            start = str(row['start_query'])[:20] + ('...' if len(str(row['start_query'])) > 20 else '')
+            end = str(row['end_query'])[:20] + ('...' if len(str(row['end_query'])) > 20 else '')
+            labels.append(f"{start}\n→ {end}")
+
+        colors = plt.cm.viridis(np.linspace(0.2, 0.8, len(df)))
+        bars = plt.barh(range(len(df)), df['count'], color=colors, edgecolor='black', linewidth=0.5)
+
+        plt.yticks(range(len(df)), labels, fontsize=10)
+        plt.xlabel('Количество запросов', fontsize=12, fontweight='bold')
+        plt.title('ТОП-10 популярных маршрутов за неделю', fontsize=14, fontweight='bold', pad=20)
+        plt.gca().invert_yaxis()
+        plt.grid(axis='x', alpha=0.3, linestyle='--')
+        
+
+        for i, (_, row) in enumerate(df.iterrows()):
+            plt.text(row['count'] + max(df['count']) * 0.01, i, 
+                    f"{int(row['count'])} запр.\n({row['success_rate']:.0f}% успешных)", 
+                    va='center', fontsize=9, fontweight='bold')
+        
+        plt.tight_layout()
+        return save_plot(fmt)
+    except Exception as e:
+        logger.error(f"Ошибка создания графика top_routes: {e}")
+        return None
+
+
+def create_provider_stats_chart(df, fmt='png'):
+    """Создает комбинированный график статистики по провайдерам"""
+    try:
+        plt.figure(figsize=(14, 8))
+        
+        x = np.arange(len(df))
+        width = 0.35
+
+        fig, ax1 = plt.subplots(figsize=(14, 8))
+        bars = ax1.bar(x - width/2, df['request_count'], width, 
+                      label='Запросы', color='#4e79a7', edgecolor='black', alpha=0.8)
+
+        ax2 = ax1.twinx()
+        line = ax2.plot(x + width/2, df['avg_response_time'], 'o-', color='#e15759', 
+                       linewidth=3, markersize=10, markerfacecolor='white', 
+                       markeredgewidth=2, label='Ср. время ответа (мс)')
+        
+
+        ax1.set_xlabel('Провайдер API', fontsize=12, fontweight='bold')
+        ax1.set_ylabel('Количество запросов', fontsize=12, fontweight='bold')
+        ax2.set_ylabel('Среднее время ответа (мс)', fontsize=12, fontweight='bold', color='#e15759')
+        ax2.tick_params(axis='y', labelcolor='#e15759')
+
+        ax1.set_xticks(x)
+        ax1.set_xticklabels([p[:15] + '...' if len(p) > 15 else p for p in df['provider']], 
+                           rotation=45, ha='right', fontsize=10)
+
+        plt.title('Статистика по провайдерам API за неделю', fontsize=14, fontweight='bold', pad=20)
+        
+
+        lines1, labels1 = ax1.get_legend_handles_labels()
+        lines2, labels2 = ax2.get_legend_handles_labels()
+        ax1.legend(lines1 + lines2, labels1 + labels2, loc='upper left', fontsize=10)
+        
+
+        ax1.grid(axis='y', alpha=0.3, linestyle='--')
+        
+
+        for bar in bars:
+            height = bar.get_height()
+            ax1.text(bar.get_x() + bar.get_width()/2., height + max(df['request_count']) * 0.01,
+                    f'{int(height)}', ha='center', va='bottom', fontsize=9, fontweight='bold')
+        
+        plt.tight_layout()
+        return save_plot(fmt)
+    except Exception as e:
+        logger.error(f"Ошибка создания графика provider_stats: {e}")
+        return None
+
+
+def create_hourly_chart(df, fmt='png'):
+    """Создает график почасовой активности"""
+    try:
+        if df.empty:
+            return None
+
+        if not pd.api.types.is_integer_dtype(df['hour']):
+            df['hour'] = pd.to_datetime(df['hour']).dt.hour
+        df = df.sort_values('hour')
+        
+        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 10), sharex=True, 
+                                       gridspec_kw={'height_ratios': [2, 1]})
+        
+        # График 1: Количество запросов по часам
+        bars = ax1.bar(df['hour'], df['requests'], color='#76b7b2', 
+                      edgecolor='black', alpha=0.7, width=0.8)
+        ax1.set_ylabel('Количество запросов', fontsize=12, fontweight='bold')
+        ax1.set_title('Почасовая активность API', fontsize=14, fontweight='bold', pad=20)
+        ax1.grid(True, alpha=0.3, linestyle='--')
+        ax1.set_axisbelow(True)
+
+        for bar in bars:
+            height = bar.get_height()
+            ax1.text(bar.get_x() + bar.get_width()/2., height + 0.1,
+                    f'{int(height)}', ha='center', va='bottom', fontsize=9, fontweight='bold')
+        
+        # График 2: Среднее время ответа по часам
+        ax2.plot(df['hour'], df['avg_time'], 'o-', color='#edc949', 
+                linewidth=2.5, markersize=10, markerfacecolor='white', 
+                markeredgewidth=2, markeredgecolor='#edc949')
+        ax2.fill_between(df['hour'], 0, df['avg_time'], color='#edc949', alpha=0.2)
+        ax2.set_xlabel('Час дня', fontsize=12, fontweight='bold')
+        ax2.set_ylabel('Среднее время ответа (мс)', fontsize=12, fontweight='bold')
+        ax2.grid(True, alpha=0.3, linestyle='--')
+        ax2.set_axisbelow(True)
+        ax2.set_xticks(df['hour'])
+        ax2.set_xticklabels([f'{int(h)}:00' for h in df['hour']], rotation=45)
+        
+
+        avg_time = df['avg_time'].mean()
+        ax2.axhline(y=avg_time, color='r', linestyle='--', alpha=0.5, 
+                   label=f'Среднее: {avg_time:.0f} мс')
+        ax2.legend(loc='upper right')
+        
+        plt.tight_layout()
+        return save_plot(fmt)
+    except Exception as e:
+        logger.error(f"Ошибка создания графика hourly_activity: {e}")
+        return None
+
+
+def create_travel_modes_chart(df, fmt='png'):
+    """Создает круговую диаграмму типов маршрутов"""
+    try:
+        if df.empty:
+            return None
+            
+        plt.figure(figsize=(12, 10))
+        
+        labels = []
+        for mode in df['travel_mode']:
+            mode_names = {
+                'public': 'Общественный транспорт',
+                'car': 'Автомобиль',
+                'pedestrian': 'Пешком',
+                'bicycle': 'Велосипед'
+            }
+            labels.append(mode_names.get(mode, mode))
+        
+
+        colors = ['#4e79a7', '#f28e2c', '#e15759', '#76b7b2', '#59a14f', 
+                 '#edc949', '#af7aa1', '#ff9da7', '#9c755f', '#bab0ab']
+        
+
+        wedges, texts, autotexts = plt.pie(
+            df['count'], 
+            labels=labels,
+            autopct=lambda pct: f'{pct:.1f}%\n({int(pct/100.*df["count"].sum()):d})',
+            colors=colors[:len(df)],
+            startangle=90,
+            textprops={'fontsize': 11},
+            wedgeprops={'edgecolor': 'white', 'linewidth': 2},
+            explode=[0.05] * len(df)  
+        )
+        
+
+        for autotext in autotexts:
+            autotext.set_color('white')
+            autotext.set_fontweight('bold')
+            autotext.set_fontsize(10)
+        
+        for text in texts:
+            text.set_fontsize(12)
+            text.set_fontweight('bold')
+        
+        plt.title('Распределение по типам маршрутов за неделю', 
+                 fontsize=14, fontweight='bold', pad=30)
+        
+
+        plt.legend(wedges, [f"{l} ({c})" for l, c in zip(labels, df['count'])],
+                  title="Типы маршрутов", loc="center left", bbox_to_anchor=(1, 0, 0.5, 1),
+                  fontsize=10)
+        
+        plt.tight_layout()
+        return save_plot(fmt)
+    except Exception as e:
+        logger.error(f"Ошибка создания графика travel_modes: {e}")
+        return None
+
+
+def create_daily_trends_chart(df, fmt='png'):
+    """Создает график трендов по дням"""
+    try:
+        if df.empty:
+            return None
+            
+
+        df['day'] = pd.to_datetime(df['day']).dt.strftime('%d.%m')
+        df = df.sort_values('day')
+        
+        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 10), 
+                                       gridspec_kw={'height_ratios': [2, 1]})
+        
+        # График 1: Количество запросов по дням
+        x = range(len(df))
+        bars = ax1.bar(x, df['requests'], color='#59a14f', alpha=0.7, 
+                      edgecolor='black', linewidth=1, width=0.7)
+        ax1.set_ylabel('Количество запросов', fontsize=12, fontweight='bold')
+        ax1.set_title('Динамика запросов по дням', fontsize=14, fontweight='bold', pad=20)
+        ax1.grid(axis='y', alpha=0.3, linestyle='--')
+        ax1.set_axisbelow(True)
+        ax1.set_xticks(x)
+        ax1.set_xticklabels(df['day'], rotation=45, ha='right', fontsize=10)
+        for bar in bars:
+            height = bar.get_height()
+            ax1.text(bar.get_x() + bar.get_width()/2., height + max(df['requests']) * 0.02,
+                    f'{int(height)}', ha='center', va='bottom', fontsize=9, fontweight='bold')
+        
+        # График 2: Время ответа и кэш-хиты
+        ax2.plot(x, df['avg_time'], 's-', color='#b07aa1', linewidth=2.5, 
+                markersize=8, markerfacecolor='white', markeredgewidth=2, 
+                label='Ср. время ответа (мс)')
+        
+        if 'cache_hits' in df.columns:
+            ax2_twin = ax2.twinx()
+            ax2_twin.bar(x, df['cache_hits'], color='#ff9da7', alpha=0.5, 
+                        width=0.6, label='Кэш-хиты')
+            ax2_twin.set_ylabel('Кэш-хиты', fontsize=12, fontweight='bold', color='#ff9da7')
+            ax2_twin.tick_params(axis='y', labelcolor='#ff9da7')
+
+            lines1, labels1 = ax2.get_legend_handles_labels()
+            lines2, labels2 = ax2_twin.get_legend_handles_labels()
+            ax2.legend(lines1 + lines2, labels1 + labels2, loc='upper left')
+        else:
+            ax2.legend(loc='upper left')
+        
+        ax2.set_xlabel('Дата', fontsize=12, fontweight='bold')
+        ax2.set_ylabel('Ср. время ответа (мс)', fontsize=12, fontweight='bold')
+        ax2.grid(True, alpha=0.3, linestyle='--')
+        ax2.set_axisbelow(True)
+        ax2.set_xticks(x)
+        ax2.set_xticklabels(df['day'], rotation=45, ha='right', fontsize=10)
+        
+
+        if len(df) > 2:
+            x_numeric = np.array(x)
+            z = np.polyfit(x_numeric, df['avg_time'], 1)
+            p = np.poly1d(z)
+            ax2.plot(x, p(x_numeric), "r--", alpha=0.7, linewidth=2, label='Тренд')
+        
+        plt.tight_layout()
+        return save_plot(fmt)
+    except Exception as e:
+        logger.error(f"Ошибка создания графика daily_trends: {e}")
+        return None
+
+
+def create_response_times_chart(df, fmt='png'):
+    """
+    Создает боксплот времени ответа по реальным квантилям гистограмм:
+    ящик p25–p75, медиана p50, усы p5–p99, отметки p95/p99.
+    """
+    try:
+        if df.empty or len(df) == 0:
+            return None
+            
+        fig, ax = plt.subplots(figsize=(12, 8))
+        stats = []
+        for _, row in df.iterrows():
+            label = f"{row['provider'][:15]}...\n(n={row['count']})" if len(row['provider']) > 15 else f"{row['provider']}\n(n={row['count']})"
+            stats.append({
+                'label': label,
+                'med': row['p50'],
+                'q1': row['p25'],
+                'q3': row['p75'],
+                'whislo': row['p5'],
+                'whishi': row['p99'],
+                'mean': row['avg_time'],
+                'fliers': [],
+            })
+        box = ax.bxp(stats, patch_artist=True, showmeans=True,
+                     medianprops={'color': 'white', 'linewidth': 2},
+                     whiskerprops={'color': '#333', 'linewidth': 1.5},
+                     capprops={'color': '#333', 'linewidth': 1.5},
+                     meanprops={'marker': 'D', 'markerfacecolor': '#e15759', 'markeredgecolor': 'white'})
+        colors = plt.cm.Set3(np.linspace(0, 1, len(stats)))
+        for patch, color in zip(box['boxes'], colors):
+            patch.set_facecolor(color)
+            patch.set_alpha(0.7)
+        ax.set_yscale('log')
+        ax.set_title('Распределение времени ответа по провайдерам (p5–p99)', 
+                     fontsize=14, fontweight='bold', pad=20)
+        ax.set_xlabel('Провайдер API', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Время ответа (мс, лог. шкала)', fontsize=12, fontweight='bold')
+        ax.grid(axis='y', alpha=0.3, linestyle='--')
+        plt.xticks(rotation=45, ha='right')
+        
+        # Подписи с хвостовыми квантилями
+        for i, (_, row) in enumerate(df.iterrows()):
+            ax.text(i + 1, row['p99'] * 1.1, f"p95 {row['p95']:.0f} мс\np99 {row['p99']:.0f} мс", 
+                    ha='center', va='bottom', fontsize=9, fontweight='bold',
+                    bbox=dict(boxstyle="round,pad=0.3", facecolor="white", alpha=0.8))
+        
+        plt.tight_layout()
+        return save_plot(fmt)
+    except Exception as e:
+        logger.error(f"Ошибка создания графика response_times: {e}")
+        return None
+
+
+def save_plot(fmt='png'):
+    """Сохраняет текущий график matplotlib в байты (PNG или SVG)"""
+    try:
+        buffer = BytesIO()
+        plt.savefig(buffer, format=fmt, bbox_inches='tight',
+                   dpi=100, facecolor='white', edgecolor='none')
+        return buffer.getvalue()
+    except Exception as e:
+        logger.error(f"Ошибка сохранения графика в {fmt}: {e}")
+        return None
+    finally:
+        plt.close('all')
+
+
+CHART_RENDERERS = {
+    'top_routes': create_top_routes_chart,
+    'provider_stats': create_provider_stats_chart,
+    'hourly_activity': create_hourly_chart,
+    'travel_modes': create_travel_modes_chart,
+    'daily_trends': create_daily_trends_chart,
+    'response_times': create_response_times_chart,
+}
+
+
+def render_chart(name, records, fmt='png'):
+    """Строит график по имени из списка записей и возвращает байты изображения"""
+    renderer = CHART_RENDERERS.get(name)
+    if renderer is None or fmt not in ('png', 'svg'):
+        logger.error(f"Неизвестный график или формат: {name}.{fmt}")
+        return None
+    df = pd.DataFrame(records)
+    if df.empty:
+        return None
+    return renderer(df, fmt)
+
+
+def render_chart_to_file(name, records, fmt, path):
+    """
+    Точка входа для процесса пула: строит график и атомарно записывает
+    его в файл. Возвращает путь или None, если график не построен.
+    """
+    image = render_chart(name, records, fmt)
+    if image is None:
+        return None
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(image)
+    os.replace(tmp_path, path)
+    return str(path)
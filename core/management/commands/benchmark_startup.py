@@ -0,0 +1,89 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Библиотеки, которые допустимы только в процессах рендеринга графиков
+HEAVY_MODULES = ('matplotlib', 'pandas', 'numpy')
+
+# Выполняется в чистом интерпретаторе: повторяет старт воркера gunicorn
+# (WSGI-приложение + загрузка всех URL и представлений)
+WORKER_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+from django.urls import get_resolver
+get_wsgi_application()
+get_resolver().url_patterns
+elapsed_ms = (time.perf_counter() - start) * 1000
+print(json.dumps({
+    'import_ms': elapsed_ms,
+    'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'heavy_modules': sorted(name for name in %r if name in sys.modules),
+}))
+"""
+
+
+class Command(BaseCommand):
+    help = ("Замеряет время старта воркера и потребление памяти (RSS) в отдельных процессах. "
+            "Завершается с ошибкой, если превышены пороги или загружены тяжёлые библиотеки")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help="Количество запусков")
+        parser.add_argument('--max-import-ms', type=float, default=None,
+                            help="Допустимая медиана времени старта, мс")
+        parser.add_argument('--max-rss-mb', type=float, default=None,
+                            help="Допустимая медиана RSS, МБ")
+        parser.add_argument('--json', action='store_true', help="Вывести результат в JSON")
+
+    def run_worker(self):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get(
+            'DJANGO_SETTINGS_MODULE', 'transport_planner.settings'))
+        result = subprocess.run(
+            [sys.executable, '-c', WORKER_SCRIPT % (HEAVY_MODULES,)],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            raise CommandError(f"Воркер завершился с ошибкой:\n{result.stderr}")
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def handle(self, *args, **options):
+        samples = [self.run_worker() for _ in range(max(1, options['runs']))]
+        import_times = [sample['import_ms'] for sample in samples]
+        rss_values = [sample['rss_mb'] for sample in samples]
+        heavy_modules = sorted({name for sample in samples for name in sample['heavy_modules']})
+
+        report = {
+            'runs': len(samples),
+            'import_ms': {'median': statistics.median(import_times), 'max': max(import_times)},
+            'rss_mb': {'median': statistics.median(rss_values), 'max': max(rss_values)},
+            'heavy_modules': heavy_modules,
+        }
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write(
+                f"Старт воркера: медиана {report['import_ms']['median']:.0f} мс, "
+                f"макс. {report['import_ms']['max']:.0f} мс"
+            )
+            self.stdout.write(
+                f"RSS: медиана {report['rss_mb']['median']:.1f} МБ, "
+                f"макс. {report['rss_mb']['max']:.1f} МБ"
+            )
+
+        problems = []
+        if heavy_modules:
+            problems.append(f"при старте загружены тяжёлые библиотеки: {', '.join(heavy_modules)}")
+        if options['max_import_ms'] is not None and report['import_ms']['median'] > options['max_import_ms']:
+            problems.append(f"время старта {report['import_ms']['median']:.0f} мс > {options['max_import_ms']:.0f} мс")
+        if options['max_rss_mb'] is not None and report['rss_mb']['median'] > options['max_rss_mb']:
+            problems.append(f"RSS {report['rss_mb']['median']:.1f} МБ > {options['max_rss_mb']:.1f} МБ")
+        if problems:
+            raise CommandError('; '.join(problems))
+
+        self.stdout.write(self.style.SUCCESS("Регрессий старта не обнаружено"))
@@ -0,0 +1,45 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.services.analytics_service import AnalyticsService
+from core.services.export_service import ExportService, ExportError, EXPORT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = "Потоковая выгрузка SearchHistory или ApiLog за период в CSV или Parquet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(ExportService.DATASETS))
+        parser.add_argument('--format', dest='fmt', choices=sorted(ExportService.FORMATS), default='csv')
+        parser.add_argument('--start', help="Начало периода, YYYY-MM-DD")
+        parser.add_argument('--end', help="Конец периода, YYYY-MM-DD (по умолчанию сегодня)")
+        parser.add_argument('--days', type=int, default=7, help="Число последних дней, если не указан --start")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help="Размер порции чтения из БД и группы строк Parquet")
+        parser.add_argument('--output', '-o', help="Файл результата (по умолчанию stdout)")
+
+    def handle(self, *args, **options):
+        export_service = ExportService(chunk_size=options['chunk_size'])
+        try:
+            start, end = AnalyticsService.resolve_range(
+                start=options['start'], end=options['end'], days=options['days'], max_days=None,
+            )
+            chunks = export_service.stream(options['dataset'], options['fmt'], start, end)
+        except (ExportError, ValueError) as e:
+            raise CommandError(str(e))
+
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        written = 0
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if options['output']:
+                output.close()
+
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Выгружено {written / 1024 / 1024:.1f} МБ в {options['output']}"
+            ))
@@ -0,0 +1,57 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmarks import fake_providers
+
+
+class Command(BaseCommand):
+    help = ("Запускает локальный двойник 2GIS Public Transport и TomTom Routing/Search "
+            "с настраиваемыми задержками, ошибками, 429, таймаутами и отказами")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8090)
+        parser.add_argument('--preset', choices=sorted(fake_providers.PRESETS), default='healthy',
+                            help="Готовый сценарий отказов")
+        parser.add_argument('--scenario', help="JSON-файл с переопределениями сценария по эндпоинтам")
+        parser.add_argument('--seed', type=int, default=None,
+                            help="Зерно случайности: одинаковые ответы на одинаковые запросы")
+        parser.add_argument('--verbose', action='store_true', help="Логировать каждый запрос")
+        parser.add_argument('--print-scenario', action='store_true', help="Показать итоговый сценарий и выйти")
+
+    def handle(self, *args, **options):
+        overrides = {}
+        if options['scenario']:
+            try:
+                with open(options['scenario'], encoding='utf-8') as f:
+                    overrides = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Не удалось прочитать сценарий {options['scenario']}: {e}")
+        try:
+            scenario = fake_providers.build_scenario(overrides.pop('preset', options['preset']), overrides)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['print_scenario']:
+            self.stdout.write(json.dumps(scenario, indent=2, ensure_ascii=False))
+            return
+
+        try:
+            server = fake_providers.make_server(options['host'], options['port'], scenario,
+                                                seed=options['seed'], verbose=options['verbose'])
+        except OSError as e:
+            raise CommandError(f"Не удалось открыть {options['host']}:{options['port']}: {e}")
+        base_url = f"http://{options['host']}:{server.server_port}"
+        self.stdout.write(
+            f"Двойник провайдеров на {base_url}. Запустите приложение с переменными:\n"
+            f"  USE_REAL_API=True USE_PUBLIC_TRANSPORT_API=True TOMTOM_API_KEY=fake "
+            f"TWOGIS_PUBLIC_TRANSPORT_API_KEY=fake\n"
+            f"  TOMTOM_API_URL={base_url} TWOGIS_PUBLIC_TRANSPORT_URL={base_url}/public_transport/2.0\n"
+            f"Счётчики: {base_url}/_fake/stats, смена сценария: POST {base_url}/_fake/scenario"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
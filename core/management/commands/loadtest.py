@@ -0,0 +1,163 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmarks import loadtest
+
+MODELS = {'open': 'открытая', 'closed': 'закрытая'}
+
+
+class Command(BaseCommand):
+    help = ("Нагрузочный прогон запущенного сервера: поиск маршрутов, автодополнение и /api/status/ "
+            "из SearchHistory, JSONL-трассы или синтетики. Отчёт: пропускная способность, квантили "
+            "задержки, доля ошибок и попаданий в кэш маршрутов")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help="Адрес сервера")
+        parser.add_argument('--source', choices=('history', 'trace', 'synthetic'), default='history')
+        parser.add_argument('--trace', help="JSONL-трасса для --source trace")
+        parser.add_argument('--loop', action='store_true', help="Повторять трассу по кругу")
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help="Ускорение воспроизведения меток времени трассы")
+        parser.add_argument('--history-limit', type=int, default=1000,
+                            help="Сколько последних поисков взять из SearchHistory")
+        parser.add_argument('--mix', default=None,
+                            help="Веса эндпоинтов, например home=0.5,autocomplete=0.45,status=0.05")
+        parser.add_argument('--concurrency', type=int, default=10, help="Число параллельных клиентов")
+        parser.add_argument('--rate', type=float, default=None,
+                            help="Интенсивность открытой модели, запросов/с (по умолчанию закрытая модель)")
+        parser.add_argument('--duration', type=float, default=30.0, help="Длительность прогона, с")
+        parser.add_argument('--requests', type=int, default=None, help="Ограничение числа запросов")
+        parser.add_argument('--timeout', type=float, default=30.0, help="Таймаут запроса, с")
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--label', default='', help="Метка прогона (конфигурация сервера)")
+        parser.add_argument('--metrics-token', default=None, help="Bearer-токен для /metrics")
+        parser.add_argument('--allow-real-api', action='store_true',
+                            help="Разрешить прогон, если сервер ходит в реальные API")
+        parser.add_argument('--output', help="Сохранить отчёт в JSON-файл")
+        parser.add_argument('--compare', help="Сравнить с отчётом прошлого прогона")
+        parser.add_argument('--json', action='store_true', help="Вывести отчёт в JSON")
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError("--concurrency должен быть не меньше 1")
+        if options['rate'] is not None and options['rate'] <= 0:
+            raise CommandError("--rate должен быть положительным")
+        try:
+            workload = self.build_workload(options)
+            status = loadtest.server_status(options['url'])
+        except loadtest.LoadTestError as e:
+            raise CommandError(str(e))
+
+        services = status.get('services', {})
+        real = [name for name, value in services.items()
+                if name not in ('caching', 'provider_http') and value != 'stub']
+        # Воспроизведение кассет и локальный двойник не обращаются к провайдерам
+        if real and services.get('provider_http') not in ('replay', 'local') and not options['allow_real_api']:
+            raise CommandError(
+                f"Сервер использует реальные API ({', '.join(real)}). Запустите его с USE_REAL_API=False "
+                f"и USE_PUBLIC_TRANSPORT_API=False, включите PROVIDER_CASSETTE_MODE=replay, "
+                f"направьте провайдеров на manage.py fake_providers или передайте --allow-real-api"
+            )
+
+        metrics_before = loadtest.scrape_cache_counters(options['url'], options['metrics_token'])
+        test = loadtest.LoadTest(
+            options['url'], workload,
+            concurrency=options['concurrency'], rate=options['rate'], duration=options['duration'],
+            max_requests=options['requests'], timeout=options['timeout'], speed=options['speed'],
+            seed=options['seed'],
+        )
+        if not options['json']:
+            self.stderr.write(f"Нагрузка на {options['url']}: {options['concurrency']} клиентов, "
+                              f"{'%g запросов/с' % options['rate'] if options['rate'] else 'закрытая модель'}, "
+                              f"до {options['duration']:g} с")
+        report = test.run()
+        if report['cache'] is None and metrics_before is not None:
+            # Воркеры сбрасывают метрики раз в METRICS_FLUSH_INTERVAL секунд
+            time.sleep(getattr(settings, 'METRICS_FLUSH_INTERVAL', 5) + 0.5)
+            report['cache'] = loadtest.cache_from_metrics(
+                metrics_before, loadtest.scrape_cache_counters(options['url'], options['metrics_token'])
+            )
+        report.update({
+            'label': options['label'],
+            'url': options['url'],
+            'config': {key: options[key] for key in ('source', 'concurrency', 'rate', 'duration', 'requests', 'mix')},
+            'server_services': services,
+        })
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+        previous = None
+        if options['compare']:
+            try:
+                with open(options['compare'], encoding='utf-8') as f:
+                    previous = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Не удалось прочитать {options['compare']}: {e}")
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
+        else:
+            self.print_report(report)
+            if previous:
+                self.print_comparison(previous, report)
+
+    def build_workload(self, options):
+        if options['source'] == 'trace':
+            if not options['trace']:
+                raise loadtest.LoadTestError("Для --source trace нужен --trace файл.jsonl")
+            return loadtest.trace_workload(options['trace'], loop=options['loop'])
+        mix = loadtest.parse_mix(options['mix']) if options['mix'] else None
+        if options['source'] == 'history':
+            searches = loadtest.history_searches(options['history_limit'])
+            if not searches:
+                raise loadtest.LoadTestError("SearchHistory пуста: используйте --source synthetic или trace")
+        else:
+            searches = loadtest.synthetic_searches(seed=options['seed'])
+        return loadtest.mixed_workload(searches, mix, seed=options['seed'])
+
+    def print_report(self, report):
+        latency = report['latency_ms']
+        self.stdout.write(
+            f"{report['requests']} запросов за {report['elapsed_s']:.1f} с ({MODELS[report['model']]} модель): "
+            f"{report['throughput_rps']:.1f} запросов/с, ошибок {report['error_rate']:.2%}"
+        )
+        if report['max_backlog'] is not None:
+            self.stdout.write(f"Максимальная очередь на стороне клиента: {report['max_backlog']}")
+        self.stdout.write(f"{'Эндпоинт':<14} {'запросов':>9} {'ошибок':>8} {'p50':>8} {'p90':>8} "
+                          f"{'p95':>8} {'p99':>8} {'max':>8}  коды")
+        rows = list(report['endpoints'].items()) + [('всего', {
+            'requests': report['requests'], 'error_rate': report['error_rate'],
+            'latency_ms': latency, 'statuses': {},
+        })]
+        for name, stats in rows:
+            values = stats['latency_ms']
+            cells = ' '.join(
+                f"{values[key]:>8.1f}" if values.get(key) is not None else f"{'-':>8}"
+                for key in ('p50', 'p90', 'p95', 'p99', 'max')
+            )
+            codes = ', '.join(f"{code}×{count}" for code, count in stats['statuses'].items())
+            self.stdout.write(f"{name:<14} {stats['requests']:>9} {stats['error_rate']:>8.2%} {cells}  {codes}")
+        cache = report['cache']
+        if cache:
+            self.stdout.write(
+                f"Кэш маршрутов ({cache['source']}): попаданий {cache['hits']}, промахов {cache['misses']}, "
+                f"доля попаданий {cache['hit_ratio']:.1%}"
+            )
+        else:
+            self.stdout.write("Кэш маршрутов: нет данных (включите SERVER_TIMING_ENABLED или /metrics)")
+
+    def print_comparison(self, previous, report):
+        self.stdout.write(f"Сравнение с «{previous.get('label') or 'прошлый прогон'}»:")
+        pairs = [('запросов/с', previous.get('throughput_rps'), report['throughput_rps'])]
+        pairs += [(key, previous.get('latency_ms', {}).get(key), report['latency_ms'].get(key))
+                  for key in ('p50', 'p95', 'p99')]
+        pairs.append(('ошибок', previous.get('error_rate'), report['error_rate']))
+        for name, before, after in pairs:
+            if before is None or after is None:
+                continue
+            change = f"{(after - before) / before:+.1%}" if before else ''
+            self.stdout.write(f"  {name:<12} {before:>10.2f} -> {after:>10.2f} {change}")
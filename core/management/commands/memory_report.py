@@ -0,0 +1,126 @@
+import gc
+import json
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections, transaction
+from django.test import Client, RequestFactory
+from django.test.utils import override_settings
+
+from core.memory import MemoryTracker, memory_info, rss_bytes
+
+# Сценарии, которые воспроизводят типичные причины роста памяти воркера
+SCENARIOS = {
+    'search': [('/', {'start_point': 'жд вокзал', 'end_point': 'упи', 'travel_mode': 'public'})],
+    'autocomplete': [('/api/autocomplete/', {'q': 'цирк'})],
+    'dashboard': [('/admin/analytics/', {'refresh': '1'})],
+    'status': [('/api/status/', {})],
+}
+
+
+class Command(BaseCommand):
+    help = ("Прогоняет сценарий запросов в текущем процессе и показывает, какие места "
+            "аллокаций и насколько выросли (tracemalloc), а также прирост RSS. "
+            "Изменения в БД откатываются")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='search')
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5,
+                            help="Прогоны до базового снимка (импорты, кэши, пулы соединений)")
+        parser.add_argument('--frames', type=int, default=1, help="Глубина трассировки tracemalloc")
+        parser.add_argument('--key-type', choices=MemoryTracker.KEY_TYPES, default='lineno')
+        parser.add_argument('--limit', type=int, default=15)
+        parser.add_argument('--json', action='store_true', help="Вывести результат в JSON")
+
+    def run_scenario(self, handler, requests, times, cookie=''):
+        """
+        Запросы идут через WSGIHandler, как в gunicorn: тестовый Client
+        сам удерживает ответы и подписки на сигналы и искажает отчёт
+        """
+        factory = RequestFactory()
+        statuses = []
+        for _ in range(times):
+            for path, params in requests:
+                environ = factory.get(path, params).environ
+                if cookie:
+                    environ['HTTP_COOKIE'] = cookie
+                response = handler(environ, lambda status, headers, exc_info=None: statuses.append(status))
+                for _chunk in response:
+                    pass
+                response.close()
+                if statuses.pop().startswith('5'):
+                    raise CommandError(f"{path} вернул ошибку сервера")
+
+    @override_settings(ALLOWED_HOSTS=['*'], SECURE_SSL_REDIRECT=False)
+    def handle(self, *args, **options):
+        # Как и тестовый клиент: соединение с БД не закрывается между запросами,
+        # иначе откатываемая транзакция сценария оборвётся
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        try:
+            report = self.measure(options)
+        finally:
+            request_started.connect(close_old_connections)
+            request_finished.connect(close_old_connections)
+        self.print_report(report, options)
+
+    def measure(self, options):
+        requests = SCENARIOS[options['scenario']]
+        tracker = MemoryTracker()
+        handler = WSGIHandler()
+        with transaction.atomic():
+            cookie = ''
+            if options['scenario'] == 'dashboard':
+                user, _ = get_user_model().objects.get_or_create(
+                    username='memory_report', defaults={'is_staff': True, 'is_superuser': True}
+                )
+                client = Client()
+                client.force_login(user)
+                cookie = f"{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}"
+
+            self.run_scenario(handler, requests, options['warmup'], cookie)
+            gc.collect()
+            rss_before = rss_bytes()
+            tracker.start(frames=options['frames'])
+            try:
+                self.run_scenario(handler, requests, options['iterations'], cookie)
+                gc.collect()
+                diff = tracker.diff(limit=options['limit'], key_type=options['key_type'])
+            finally:
+                tracker.stop()
+            rss_after = rss_bytes()
+            transaction.set_rollback(True)
+
+        iterations = max(1, options['iterations'])
+        return {
+            'scenario': options['scenario'],
+            'iterations': options['iterations'],
+            'rss_growth_mb': round((rss_after - rss_before) / 1024 / 1024, 2),
+            'retained_kb_per_iteration': round(diff['total_diff_kb'] / iterations, 2),
+            'diff': diff,
+            'process': memory_info(),
+        }
+
+    def print_report(self, report, options):
+        diff = report['diff']
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
+            return
+
+        self.stdout.write(
+            f"Сценарий {report['scenario']}, {report['iterations']} итераций: "
+            f"RSS {report['rss_growth_mb']:+.2f} МБ, удержано tracemalloc "
+            f"{diff['total_diff_kb']:+.1f} КБ ({report['retained_kb_per_iteration']:+.2f} КБ/итерацию)"
+        )
+        for row in diff['top']:
+            self.stdout.write(
+                f"  {row['size_diff_kb']:+10.1f} КБ {row['count_diff']:+7d} объектов  {row['site']}"
+            )
+        gc_info = report['process']['gc']
+        self.stdout.write(
+            f"GC: счётчики поколений {gc_info['counts']}, несобираемых объектов {gc_info['uncollectable']}"
+        )
@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.services.latency_service import LatencyService
+
+
+class Command(BaseCommand):
+    help = "Пересобирает почасовые гистограммы времени ответа провайдеров из ApiLog"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help="За сколько последних дней пересобрать")
+
+    def handle(self, *args, **options):
+        end = timezone.now()
+        start = end - timedelta(days=options['days'])
+        count = LatencyService().rebuild(start, end)
+        self.stdout.write(self.style.SUCCESS(f"Пересобрано гистограмм: {count}"))
@@ -0,0 +1,124 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+
+from core import benchmarks
+
+STATUS_MARKS = {'ok': '', 'new': 'новый', 'improvement': 'быстрее', 'regression': 'РЕГРЕССИЯ'}
+
+
+class Command(BaseCommand):
+    help = ("Микробенчмарки разбора ответов провайдеров, кэша маршрутов и подготовки маршрутов к показу. "
+            "Сравнивает результаты с сохранённой базой (core/benchmarks/baseline.json)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('-k', '--filter', action='append', dest='patterns', default=[],
+                            help="Только бенчмарки, в имени которых есть подстрока (можно повторять)")
+        parser.add_argument('--list', action='store_true', help="Показать бенчмарки и выйти")
+        parser.add_argument('--rounds', type=int, default=7, help="Количество раундов замера")
+        parser.add_argument('--min-time', type=float, default=0.05,
+                            help="Минимальная длительность раунда, с")
+        parser.add_argument('--cassettes', metavar='DIR',
+                            help="Брать ответы провайдеров из записанных кассет (PROVIDER_CASSETTE_DIR)")
+        parser.add_argument('--output', help="Сохранить результаты в JSON-файл")
+        parser.add_argument('--baseline', default=str(benchmarks.BASELINE_PATH),
+                            help="Файл базы для сравнения")
+        parser.add_argument('--no-compare', action='store_true', help="Не сравнивать с базой")
+        parser.add_argument('--save-baseline', action='store_true',
+                            help="Записать результаты как новую базу")
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help="Допустимое замедление относительно базы (0.25 = 25%%)")
+        parser.add_argument('--stat', choices=('median', 'min'), default='median',
+                            help="Какую статистику сравнивать с базой")
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help="Код выхода 1 при регрессии")
+        parser.add_argument('--json', action='store_true', help="Вывести результаты и сравнение в JSON")
+
+    def handle(self, *args, **options):
+        selected = benchmarks.select(options['patterns'])
+        if not selected:
+            raise CommandError("Нет бенчмарков под заданный фильтр")
+        if options['list']:
+            for bench in selected:
+                db = ' [БД]' if bench.needs_db else ''
+                self.stdout.write(f"{bench.name}{db}: {bench.description}")
+            return
+        if options['rounds'] < 1:
+            raise CommandError("--rounds должен быть не меньше 1")
+
+        if options['cassettes']:
+            benchmarks.use_cassettes(options['cassettes'])
+        try:
+            results = self.run(selected, options)
+        except LookupError as e:
+            raise CommandError(str(e))
+
+        comparison = None
+        if not options['no_compare'] and not options['save_baseline']:
+            try:
+                baseline = benchmarks.load_results(options['baseline'])
+            except FileNotFoundError:
+                self.stderr.write(f"База {options['baseline']} не найдена, сравнение пропущено")
+            except ValueError as e:
+                raise CommandError(str(e))
+            else:
+                comparison = benchmarks.compare(results, baseline, options['tolerance'], f"{options['stat']}_us")
+
+        if options['output']:
+            benchmarks.save_results(options['output'], results)
+        if options['save_baseline']:
+            benchmarks.save_results(options['baseline'], results)
+            self.stderr.write(f"База сохранена: {options['baseline']}")
+
+        if options['json']:
+            self.stdout.write(json.dumps({'results': results, 'comparison': comparison},
+                                         indent=2, ensure_ascii=False))
+        else:
+            self.print_report(results, comparison, options['stat'])
+
+        regressions = [row['name'] for row in comparison or [] if row['status'] == 'regression']
+        if regressions and options['fail_on_regression']:
+            raise CommandError(f"Регрессии производительности: {', '.join(regressions)}")
+
+    def run(self, selected, options):
+        def progress(bench, stats):
+            if not options['json']:
+                self.stderr.write(f"  {bench.name}: {stats['median_us']:.1f} мкс")
+
+        # Бенчмарки кэша пишут в CachedRoute/ApiLog: только во временной тестовой БД
+        old_config = None
+        if any(bench.needs_db for bench in selected):
+            setup_test_environment()
+            old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            return benchmarks.run(selected, rounds=options['rounds'], min_time=options['min_time'],
+                                  progress=progress)
+        finally:
+            if old_config is not None:
+                teardown_databases(old_config, verbosity=0)
+                teardown_test_environment()
+
+    def print_report(self, results, comparison, stat):
+        rows = {row['name']: row for row in comparison or []}
+        self.stdout.write(f"{'Бенчмарк':<32} {'медиана, мкс':>14} {'мин, мкс':>12} {'σ, мкс':>10} {f'база ({stat})':>12} {'×':>7}")
+        for name, stats in sorted(results['benchmarks'].items()):
+            row = rows.get(name, {})
+            baseline = f"{row['baseline_us']:.1f}" if row.get('baseline_us') else '-'
+            ratio = f"{row['ratio']:.2f}" if row.get('ratio') else '-'
+            mark = STATUS_MARKS.get(row.get('status'), '')
+            self.stdout.write(
+                f"{name:<32} {stats['median_us']:>14.1f} {stats['min_us']:>12.1f} "
+                f"{stats['stdev_us']:>10.1f} {baseline:>12} {ratio:>7} {mark}"
+            )
+        sizes = {name: stats['payload_bytes'] for name, stats in sorted(results['benchmarks'].items())
+                 if 'payload_bytes' in stats}
+        if sizes:
+            self.stdout.write("Размер результата:")
+            for name, size in sizes.items():
+                self.stdout.write(f"  {name:<30} {size:>10} байт")
+        memory = {name: stats for name, stats in sorted(results['benchmarks'].items()) if 'retained_bytes' in stats}
+        if memory:
+            self.stdout.write("Память (удерживает результат / пик за вызов):")
+            for name, stats in memory.items():
+                self.stdout.write(f"  {name:<30} {stats['retained_bytes']:>10} / {stats['peak_bytes']:>10} байт")
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import CachedRoute
+from core.services.cached_routing_service import CachedRoutingService
+from core.services.composite_routing_service import CompositeRoutingService
+
+TRAVEL_MODES = (None, 'public', 'car', 'pedestrian', 'bicycle')
+
+
+class Command(BaseCommand):
+    help = ("Переводит действующие записи кэша маршрутов прежних версий разбора в текущую "
+            "по сохранённым ответам провайдеров (ROUTE_CACHE_STORE_RAW), без запросов к API")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--purge', action='store_true',
+                            help="Удалить истёкшие записи и записи прежних версий без сохранённого ответа")
+
+    def handle(self, *args, **options):
+        service = CachedRoutingService(CompositeRoutingService(), provider_name='upgrade')
+        current = {service.schema_version(mode) for mode in TRAVEL_MODES}
+        stale = CachedRoute.objects.filter(expires_at__gt=timezone.now()).exclude(schema_version__in=current)
+
+        upgraded = failed = 0
+        for record in stale.filter(raw_response__isnull=False).iterator(chunk_size=50):
+            try:
+                if service.upgrade(record):
+                    upgraded += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Запись {record.hash_key[:8]}: {e}")
+        self.stdout.write(self.style.SUCCESS(f"Обновлено записей: {upgraded}, ошибок: {failed}"))
+
+        if options['purge']:
+            removed = stale.filter(raw_response__isnull=True).delete()[0]
+            removed += CachedRoute.objects.filter(expires_at__lte=timezone.now()).delete()[0]
+            self.stdout.write(self.style.SUCCESS(f"Удалено записей: {removed}"))
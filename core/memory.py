@@ -0,0 +1,138 @@
+"""
+Диагностика памяти процесса: RSS, статистика сборщика мусора и разница
+снимков tracemalloc между двумя моментами времени.
+
+tracemalloc замедляет аллокации, поэтому включается только явно
+(MemoryTracker.start) и выключается после анализа.
+"""
+import gc
+import os
+import resource
+import tracemalloc
+from collections import Counter
+
+from core.profiling import short_path
+
+# Аллокации самого анализатора не интересны
+_IGNORED_FILES = (
+    tracemalloc.__file__,
+    '<frozen importlib._bootstrap>',
+    '<frozen importlib._bootstrap_external>',
+    '<unknown>',
+)
+
+
+def rss_bytes():
+    """Текущий RSS процесса (Linux: /proc/self/statm, иначе — пиковый из getrusage)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def gc_stats(count_objects=False, top_types=0):
+    stats = {
+        'counts': list(gc.get_count()),
+        'thresholds': list(gc.get_threshold()),
+        'generations': gc.get_stats(),
+        'uncollectable': len(gc.garbage),
+        'frozen': gc.get_freeze_count(),
+    }
+    if count_objects or top_types:
+        objects = gc.get_objects()
+        stats['tracked_objects'] = len(objects)
+        if top_types:
+            types = Counter(type(obj).__name__ for obj in objects)
+            stats['top_types'] = types.most_common(top_types)
+        del objects
+    return stats
+
+
+def memory_info(count_objects=False, top_types=0):
+    return {
+        'pid': os.getpid(),
+        'rss_mb': round(rss_bytes() / 1024 / 1024, 1),
+        'peak_rss_mb': round(peak_rss_bytes() / 1024 / 1024, 1),
+        'gc': gc_stats(count_objects, top_types),
+        'tracemalloc': {
+            'tracing': tracemalloc.is_tracing(),
+            'traced_mb': round(tracemalloc.get_traced_memory()[0] / 1024 / 1024, 2) if tracemalloc.is_tracing() else None,
+        },
+    }
+
+
+class MemoryTracker:
+    """Снимок-база tracemalloc и отчёт о приросте аллокаций относительно неё"""
+
+    KEY_TYPES = ('lineno', 'filename', 'traceback')
+
+    def __init__(self):
+        self.baseline = None
+
+    @property
+    def active(self):
+        return self.baseline is not None and tracemalloc.is_tracing()
+
+    def start(self, frames=1):
+        """Включает tracemalloc (frames — глубина трассировки) и запоминает базу"""
+        if tracemalloc.is_tracing() and tracemalloc.get_traceback_limit() != frames:
+            tracemalloc.stop()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.baseline = self._snapshot()
+
+    def stop(self):
+        self.baseline = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, pattern) for pattern in _IGNORED_FILES]
+        )
+
+    @staticmethod
+    def _site(stat, key_type):
+        if key_type == 'filename':
+            return short_path(stat.traceback[0].filename)
+        frames = [f"{short_path(frame.filename)}:{frame.lineno}" for frame in stat.traceback]
+        return ' <- '.join(frames) if key_type == 'traceback' else frames[0]
+
+    def diff(self, limit=20, key_type='lineno', rebase=False):
+        """
+        Места с наибольшим приростом памяти с момента start() (или прошлого
+        rebase). rebase=True делает текущий снимок новой базой.
+        """
+        if not self.active:
+            raise RuntimeError("Отслеживание не запущено: вызовите start()")
+        if key_type not in self.KEY_TYPES:
+            raise ValueError(f"key_type должен быть одним из {', '.join(self.KEY_TYPES)}")
+        snapshot = self._snapshot()
+        stats = snapshot.compare_to(self.baseline, key_type)
+        if rebase:
+            self.baseline = snapshot
+        return {
+            'total_diff_kb': round(sum(stat.size_diff for stat in stats) / 1024, 1),
+            'total_kb': round(sum(stat.size for stat in stats) / 1024, 1),
+            'top': [
+                {
+                    'site': self._site(stat, key_type),
+                    'size_diff_kb': round(stat.size_diff / 1024, 1),
+                    'size_kb': round(stat.size / 1024, 1),
+                    'count_diff': stat.count_diff,
+                    'count': stat.count,
+                }
+                for stat in stats[:limit]
+            ],
+        }
+
+
+# Один трекер на процесс: в многопроцессном gunicorn запросы к нему
+# попадают в разные воркеры, ориентируйтесь на pid в ответе
+TRACKER = MemoryTracker()
@@ -0,0 +1,359 @@
+"""
+Реестр метрик процесса с выдачей в текстовом формате Prometheus.
+
+Обновление метрики — инкремент в словаре под локом, без обращений к БД.
+Если задан METRICS_MULTIPROCESS_DIR, фоновый поток каждого воркера gunicorn
+раз в METRICS_FLUSH_INTERVAL секунд (если были изменения) сбрасывает снимок
+процесса в файл worker_<pid>.json, а /metrics суммирует снимки всех
+воркеров. Счётчики и гистограммы завершившихся воркеров переносятся в
+archive.json, чтобы значения не уменьшались; их gauge-метрики отбрасываются.
+"""
+import atexit
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.registry = registry or REGISTRY
+        self.registry.register(self)
+
+    def _key(self, labels):
+        return tuple([str(labels.get(name, '')) for name in self.labelnames])
+
+    def reset(self):
+        self.values = {}
+
+    def snapshot(self):
+        return [[list(key), value] for key, value in self.values.items()]
+
+    def merge_samples(self, merged, samples):
+        for key, value in samples:
+            key = tuple(key)
+            merged[key] = merged.get(key, 0) + value
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.mark_dirty()
+
+
+class Gauge(_Metric):
+    """Значение процесса; в многопроцессном режиме суммируется по живым воркерам"""
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = value
+        self.registry.mark_dirty()
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.mark_dirty()
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.registry.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Счётчики по корзинам (последняя — +Inf), сумма, количество
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+        self.registry.mark_dirty()
+
+    def snapshot(self):
+        return [[list(key), [list(counts), total, count]] for key, (counts, total, count) in self.values.items()]
+
+    def merge_samples(self, merged, samples):
+        for key, (counts, total, count) in samples:
+            key = tuple(key)
+            if len(counts) != len(self.buckets) + 1:
+                continue  # снимок со старым набором корзин
+            state = merged.setdefault(key, [[0] * len(counts), 0.0, 0])
+            state[0] = [a + b for a, b in zip(state[0], counts)]
+            state[1] += total
+            state[2] += count
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """Метрики процесса и их агрегация между воркерами через файлы"""
+
+    ARCHIVE_NAME = 'archive.json'
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self._dirty = False
+        self._flusher = None
+        self._directory = None
+        self._flush_interval = None
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self.metrics[metric.name] = metric
+
+    def reset(self):
+        with self.lock:
+            for metric in self.metrics.values():
+                metric.reset()
+        self._dirty = False
+        self._flusher = None
+
+    def _after_fork(self):
+        # Лок мог быть захвачен другим потоком родителя, а поток сброса не наследуется
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            directory = getattr(settings, 'METRICS_MULTIPROCESS_DIR', None)
+            self._directory = Path(directory) if directory else False
+            if self._directory:
+                self._directory.mkdir(parents=True, exist_ok=True)
+        return self._directory
+
+    @property
+    def flush_interval(self):
+        if self._flush_interval is None:
+            self._flush_interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)
+        return self._flush_interval
+
+    def mark_dirty(self):
+        if self.directory:
+            self._dirty = True
+            if self._flusher is None:
+                self._start_flusher()
+
+    def _start_flusher(self):
+        with self.lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flusher', daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self._dirty:
+                self.flush()
+
+    def worker_path(self, pid=None):
+        return self.directory / f'worker_{pid or os.getpid()}.json'
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name: {'type': metric.type, 'samples': metric.snapshot()}
+                for name, metric in self.metrics.items()
+            }
+
+    def flush(self):
+        """Атомарно записывает снимок метрик процесса в его файл"""
+        if not self.directory:
+            return
+        self._dirty = False
+        path = self.worker_path()
+        tmp_path = path.with_suffix('.tmp')
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'pid': os.getpid(), 'metrics': self.snapshot()}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить метрики процесса: {e}")
+
+    @staticmethod
+    def _is_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @contextlib.contextmanager
+    def _archive_lock(self):
+        """Межпроцессный лок архива: перенос воркеров и чтение снимков не должны пересекаться"""
+        with open(self.directory / 'archive.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _archive_dead_workers(self):
+        """
+        Переносит счётчики и гистограммы завершившихся воркеров в archive.json.
+        Вызывается под _archive_lock.
+        """
+        archive_path = self.directory / self.ARCHIVE_NAME
+        dead = []
+        for path in self.directory.glob('worker_*.json'):
+            data = self._read(path)
+            if data and not self._is_alive(data.get('pid', 0)):
+                dead.append((path, data))
+        if not dead:
+            return
+        archive = self._read(archive_path) or {'metrics': {}}
+        merged = self._merge([archive] + [data for _, data in dead], include_gauges=False)
+        tmp_path = archive_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'metrics': {
+                name: {'type': self.metrics[name].type,
+                       'samples': [[list(key), value] for key, value in values.items()]}
+                for name, values in merged.items()
+            }}, f)
+        os.replace(tmp_path, archive_path)
+        for path, _ in dead:
+            path.unlink(missing_ok=True)
+
+    def _merge(self, snapshots, include_gauges=True):
+        merged = {}
+        for snapshot in snapshots:
+            for name, data in snapshot.get('metrics', {}).items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.type == 'gauge' and not include_gauges):
+                    continue
+                metric.merge_samples(merged.setdefault(name, {}), data.get('samples', []))
+        return merged
+
+    def collect(self):
+        """Значения метрик: по всем воркерам в многопроцессном режиме, иначе — процесса"""
+        if not self.directory:
+            with self.lock:
+                return {
+                    name: {key: value for key, value in metric.values.items()}
+                    for name, metric in self.metrics.items()
+                }
+        self.flush()
+        # Под тем же локом, что и перенос: иначе воркер, перенесённый между
+        # чтением архива и чтением файлов, попадёт в сумму дважды или ни разу
+        with self._archive_lock():
+            self._archive_dead_workers()
+            snapshots = [self._read(self.directory / self.ARCHIVE_NAME) or {}]
+            snapshots += [self._read(path) or {} for path in self.directory.glob('worker_*.json')]
+        return self._merge(snapshots)
+
+    def render(self):
+        """Текстовый формат экспозиции Prometheus 0.0.4"""
+        values = self.collect()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.extend(metric.render(values.get(name, {})))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+atexit.register(REGISTRY.flush)
+# Дочерний процесс после fork не должен повторно учитывать значения родителя
+os.register_at_fork(after_in_child=REGISTRY._after_fork)
+
+HTTP_REQUESTS = Counter(
+    'http_requests_total', 'Обработанные HTTP-запросы', ('view', 'method', 'status'))
+HTTP_REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'Время обработки HTTP-запроса', ('view',))
+PROVIDER_REQUESTS = Counter(
+    'routing_provider_requests_total', 'Запросы к провайдерам маршрутов (без кэша)', ('provider', 'outcome'))
+PROVIDER_REQUEST_DURATION = Histogram(
+    'routing_provider_request_duration_seconds', 'Время ответа провайдера маршрутов', ('provider',))
+ROUTE_CACHE_REQUESTS = Counter(
+    'route_cache_requests_total', 'Обращения к уровням кэша маршрутов', ('tier', 'result'))
+GEOCODE_REQUESTS = Counter(
+    'geocode_requests_total', 'Запросы геокодирования', ('geocoder', 'outcome'))
+GEOCODE_DURATION = Histogram(
+    'geocode_duration_seconds', 'Время геокодирования', ('geocoder',))
+FALLBACKS = Counter(
+    'routing_fallbacks_total', 'Переключения на резервный провайдер', ('source', 'target'))
+CHART_RENDER_QUEUE = Gauge(
+    'chart_render_queue', 'Графики в очереди на рендеринг')
+PROCESS_RSS = Gauge(
+    'process_resident_memory_bytes', 'RSS процесса воркера', ('pid',))
+DB_QUERIES = Histogram(
+    'http_request_db_queries', 'SQL-запросы на HTTP-запрос', ('view',),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200))
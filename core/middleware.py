@@ -0,0 +1,198 @@
+import logging
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+
+from core import metrics, timing
+from core.memory import rss_bytes
+from core.models import ProfileRecord
+from core.profiling import SamplingProfiler
+from core.query_budget import QueryBudgetExceeded, QueryCounter, budget_for
+
+logger = logging.getLogger(__name__)
+timing_logger = logging.getLogger('core.timing')
+
+
+class ServerTimingMiddleware:
+    """
+    Собирает замеры этапов (core.timing.span) за время запроса, отдаёт их
+    в заголовке Server-Timing и пишет сводку в лог.
+
+    При SERVER_TIMING_ENABLED=False Django исключает middleware из цепочки.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'SERVER_TIMING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_ms = getattr(settings, 'SERVER_TIMING_SLOW_MS', 1000)
+
+    def __call__(self, request):
+        timings, token = timing.activate()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            timing.deactivate(token)
+        total_ms = (time.perf_counter() - start) * 1000
+
+        response['Server-Timing'] = timings.header_value(total_ms)
+        # Сводка пишется только для запросов с размеченными этапами (не статика)
+        if timings.stages:
+            log = timing_logger.warning if total_ms >= self.slow_ms else timing_logger.info
+            log(
+                f"{request.method} {request.path} {response.status_code} "
+                f"total={total_ms:.1f}ms {timings.summary()}"
+            )
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Счётчик и гистограмма времени HTTP-запросов по именам URL-маршрутов,
+    RSS воркера (не чаще раза в RSS_INTERVAL секунд)
+    """
+
+    RSS_INTERVAL = 10
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.rss_checked_at = 0.0
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        # Имя маршрута вместо пути: ограниченный набор значений метки
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        metrics.HTTP_REQUESTS.inc(view=view, method=request.method, status=response.status_code)
+        metrics.HTTP_REQUEST_DURATION.observe(duration, view=view)
+
+        now = time.monotonic()
+        if now - self.rss_checked_at >= self.RSS_INTERVAL:
+            self.rss_checked_at = now
+            metrics.PROCESS_RSS.set(rss_bytes(), pid=os.getpid())
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Сэмплирующее профилирование одного запроса по требованию сотрудника:
+    параметр ?_profile=1 или заголовок X-Profile: 1. Результат сохраняется
+    в ProfileRecord (раздел «Профили запросов» админки), его id — в
+    заголовке X-Profile-Id. Число профилей ограничено PROFILER_MAX_PER_HOUR
+    на пользователя.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILER_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.interval = getattr(settings, 'PROFILER_INTERVAL_MS', 5) / 1000
+        self.max_per_hour = getattr(settings, 'PROFILER_MAX_PER_HOUR', 10)
+
+    @staticmethod
+    def is_requested(request):
+        return request.GET.get('_profile') == '1' or request.headers.get('X-Profile') == '1'
+
+    def allow(self, user):
+        """Скользящее окно в час по сохранённым профилям: лимит общий для всех воркеров"""
+        recent = ProfileRecord.objects.filter(
+            username=user.get_username(),
+            created_at__gte=timezone.now() - timedelta(hours=1),
+        ).count()
+        return recent < self.max_per_hour
+
+    def __call__(self, request):
+        # Пользователь (сессия) загружается только для запросов с триггером
+        if not self.is_requested(request):
+            return self.get_response(request)
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_staff:
+            return self.get_response(request)
+        if not self.allow(user):
+            logger.warning(f"Профилирование {request.path} отклонено: превышен лимит для {user}")
+            response = self.get_response(request)
+            response['X-Profile-Status'] = 'rate-limited'
+            return response
+
+        profiler = SamplingProfiler(interval=self.interval)
+        start = time.perf_counter()
+        with profiler:
+            response = self.get_response(request)
+        duration_ms = (time.perf_counter() - start) * 1000
+
+        record = ProfileRecord.objects.create(
+            username=user.get_username(),
+            method=request.method,
+            path=request.get_full_path()[:500],
+            status_code=response.status_code,
+            duration_ms=duration_ms,
+            interval_ms=self.interval * 1000,
+            samples=profiler.samples,
+            collapsed=profiler.collapsed(),
+        )
+        logger.info(f"Профиль #{record.pk}: {request.path} {duration_ms:.0f} мс, {profiler.samples} сэмплов")
+        response['X-Profile-Id'] = str(record.pk)
+        response['X-Profile-Status'] = 'recorded'
+        # Ответ с профилем сотрудника не должен попасть в общий кэш (CDN)
+        patch_cache_control(response, private=True)
+        return response
+
+
+class QueryBudgetMiddleware:
+    """
+    Число и время SQL-запросов каждого HTTP-запроса: заголовок X-DB-Queries,
+    этап db в Server-Timing, метрика http_request_db_queries. Превышение
+    бюджета представления (core.query_budget) — предупреждение или
+    исключение, повторы одного SQL — предупреждение о возможном N+1.
+
+    Запросы, выполненные при итерации потокового ответа, не учитываются:
+    их считает limit_stream_queries.
+    """
+
+    ACTIONS = ('warn', 'raise')
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'QUERY_BUDGET_ENABLED', settings.DEBUG):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.action = getattr(settings, 'QUERY_BUDGET_ACTION', 'warn')
+        if self.action not in self.ACTIONS:
+            raise ValueError(f"QUERY_BUDGET_ACTION должен быть одним из {', '.join(self.ACTIONS)}")
+        self.duplicate_threshold = getattr(settings, 'QUERY_BUDGET_DUPLICATES', 5)
+
+    def __call__(self, request):
+        with QueryCounter() as counter:
+            response = self.get_response(request)
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        response['X-DB-Queries'] = str(counter.count)
+        timings = timing.current()
+        if timings is not None and counter.count:
+            timings.add('db', counter.duration_ms, counter.count)
+        metrics.DB_QUERIES.observe(counter.count, view=view)
+
+        duplicates = counter.duplicates(self.duplicate_threshold)
+        if duplicates:
+            sql, count = duplicates[0]
+            logger.warning(f"Возможен N+1 в {request.path} ({view}): запрос выполнен {count} раз: {sql[:300]}")
+
+        budget = budget_for(match)
+        if counter.count > budget:
+            message = (f"{request.method} {request.path} ({view}): {counter.count} SQL-запросов "
+                       f"({counter.duration_ms:.1f} мс) при бюджете {budget}")
+            if self.action == 'raise':
+                raise QueryBudgetExceeded(f"{message}\n{counter.report()}")
+            logger.warning(message)
+        return response
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.9 on 2026-10-19 06:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_alter_apilog_provider'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=30)),
+                ('day', models.DateField()),
+                ('version', models.PositiveSmallIntegerField(default=1)),
+                ('data', models.JSONField(default=dict)),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Дневной агрегат аналитики',
+                'verbose_name_plural': 'Дневные агрегаты аналитики',
+                'ordering': ['-day', 'kind'],
+                'unique_together': {('kind', 'day')},
+            },
+        ),
+    ]
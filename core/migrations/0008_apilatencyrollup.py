@@ -0,0 +1,28 @@
+# Generated by Django 5.2.9 on 2026-10-19 06:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_analyticsrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApiLatencyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(max_length=50)),
+                ('hour', models.DateTimeField()),
+                ('histogram', models.JSONField(default=dict)),
+            ],
+            options={
+                'verbose_name': 'Гистограмма времени ответа',
+                'verbose_name_plural': 'Гистограммы времени ответа',
+                'ordering': ['-hour', 'provider'],
+                'unique_together': {('provider', 'hour')},
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.9 on 2026-10-19 07:04
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_profilerecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteGeometry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=32, unique=True)),
+                ('precision', models.PositiveSmallIntegerField(default=6)),
+                ('points', models.PositiveIntegerField(default=0)),
+                ('line', models.TextField()),
+                ('lod', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Геометрия участка маршрута',
+                'verbose_name_plural': 'Геометрия участков маршрутов',
+                'ordering': ['-last_used_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.9 on 2026-10-19 07:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_routegeometry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedroute',
+            name='raw_response',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cachedroute',
+            name='request_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='cachedroute',
+            name='schema_version',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+    ]
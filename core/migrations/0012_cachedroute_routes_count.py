@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-19 07:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_cachedroute_schema_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedroute',
+            name='routes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -1,7 +1,9 @@
 
+from datetime import timedelta
+
+from django.conf import settings
 from django.db import models
 import hashlib
-import json
 from django.utils import timezone
 
 class CachedRoute(models.Model):
@@ -10,10 +12,23 @@ class CachedRoute(models.Model):
     route_data = models.JSONField()  
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField() 
+    # Версия формата маршрутов и разбора ответов провайдеров (входит в hash_key)
+    schema_version = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    # md5 параметров запроса без версии: записи одного запроса разных версий
+    request_hash = models.CharField(max_length=32, blank=True, default='', db_index=True)
+    # Исходный ответ провайдера для обновления записи без запроса к API (ROUTE_CACHE_STORE_RAW)
+    raw_response = models.JSONField(null=True, blank=True)
+    # Число маршрутов записи: история поиска для ответов 304 без чтения route_data
+    routes_count = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"Кэш от {self.created_at.strftime('%d.%m %H:%M')}"
 
+    @staticmethod
+    def ttl():
+        """Срок жизни записи; столько же хранятся участки RouteGeometry, на которые она ссылается"""
+        return timedelta(minutes=getattr(settings, 'ROUTE_CACHE_TTL_MINUTES', 30))
+
     def save(self, *args, **kwargs):
         if not self.hash_key:
             self.hash_key = hashlib.md5(str(timezone.now()).encode()).hexdigest()
@@ -24,6 +39,27 @@ class CachedRoute(models.Model):
         verbose_name_plural = "Кэшированные маршруты"
         ordering = ['-created_at']
 
+class RouteGeometry(models.Model):
+    """
+    Общая геометрия участка маршрута (одно движение 2GIS), на которую ссылаются
+    записи CachedRoute. Ключ — хэш закодированной линии и параметров уровней.
+    """
+    key = models.CharField(max_length=32, unique=True)
+    precision = models.PositiveSmallIntegerField(default=6)
+    points = models.PositiveIntegerField(default=0)
+    line = models.TextField()
+    lod = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"Участок {self.key[:12]} ({self.points} точек)"
+
+    class Meta:
+        verbose_name = "Геометрия участка маршрута"
+        verbose_name_plural = "Геометрия участков маршрутов"
+        ordering = ['-last_used_at']
+
 class ApiLog(models.Model):
     """Лог всех запросов к внешним API"""
     PROVIDER_CHOICES = [
@@ -72,4 +108,58 @@ class SearchHistory(models.Model):
         verbose_name="Макс. пересадок"
     )
     def __str__(self):
-        return f"{self.start_query} -> {self.end_query}"
\ No newline at end of file
+        return f"{self.start_query} -> {self.end_query}"
+
+class AnalyticsRollup(models.Model):
+    """Дневные агрегаты для дашборда аналитики. Закрытые дни не пересчитываются."""
+    kind = models.CharField(max_length=30)
+    day = models.DateField()
+    version = models.PositiveSmallIntegerField(default=1)
+    data = models.JSONField(default=dict)
+    computed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.kind} за {self.day:%d.%m.%Y}"
+
+    class Meta:
+        verbose_name = "Дневной агрегат аналитики"
+        verbose_name_plural = "Дневные агрегаты аналитики"
+        unique_together = ('kind', 'day')
+        ordering = ['-day', 'kind']
+
+
+class ApiLatencyRollup(models.Model):
+    """Почасовая гистограмма времени ответа провайдера (логарифмические корзины)"""
+    provider = models.CharField(max_length=50)
+    hour = models.DateTimeField()
+    histogram = models.JSONField(default=dict)
+
+    def __str__(self):
+        return f"{self.provider} {self.hour:%d.%m %H}:00"
+
+    class Meta:
+        verbose_name = "Гистограмма времени ответа"
+        verbose_name_plural = "Гистограммы времени ответа"
+        unique_together = ('provider', 'hour')
+        ordering = ['-hour', 'provider']
+
+
+class ProfileRecord(models.Model):
+    """Результат сэмплирующего профилирования одного запроса (collapsed stacks)"""
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    username = models.CharField(max_length=150, blank=True)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    status_code = models.IntegerField(null=True)
+    duration_ms = models.FloatField()
+    interval_ms = models.FloatField()
+    samples = models.IntegerField(default=0)
+    collapsed = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} мс)"
+
+    class Meta:
+        verbose_name = "Профиль запроса"
+        verbose_name_plural = "Профили запросов"
+        ordering = ['-created_at']
@@ -0,0 +1,113 @@
+"""
+Статистический профилировщик одного запроса.
+
+Фоновый поток раз в interval секунд снимает стек потока, обрабатывающего
+запрос (sys._current_frames), и считает одинаковые стеки. Результат —
+текст в формате collapsed stacks ("корень;...;лист количество"), который
+понимают flamegraph.pl, speedscope и inferno.
+"""
+import os
+import sys
+import sysconfig
+import threading
+from collections import Counter
+
+from django.conf import settings
+
+# Префиксы путей, которые отрезаются в именах кадров (длинные пути только мешают)
+_PATH_PREFIXES = sorted(
+    {str(settings.BASE_DIR) + os.sep} | {
+        path + os.sep for path in (sysconfig.get_paths().get('purelib'), sysconfig.get_paths().get('stdlib'))
+        if path
+    },
+    key=len, reverse=True,
+)
+
+
+def short_path(filename):
+    """Путь к файлу относительно проекта, site-packages или stdlib"""
+    for prefix in _PATH_PREFIXES:
+        if filename.startswith(prefix):
+            return filename[len(prefix):]
+    return filename
+
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик заданного потока"""
+
+    def __init__(self, interval=0.005, max_depth=128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._target = None
+
+    def start(self, thread_id=None):
+        self._target = thread_id or threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            self.stacks[self._collapse(frame)] += 1
+            self.samples += 1
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({short_path(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+            self._labels[code] = label
+        return label
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            names.append(self._label(frame.f_code))
+            frame = frame.f_back
+        names.reverse()
+        return ';'.join(names)
+
+    def collapsed(self):
+        """Стеки в формате collapsed stacks, самые частые первыми"""
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+def top_functions(collapsed, limit=20):
+    """
+    Функции с наибольшим собственным (self) и общим (total) числом сэмплов.
+    Возвращает список (функция, self, total, всего сэмплов).
+    """
+    own = Counter()
+    total = Counter()
+    samples = 0
+    for line in collapsed.splitlines():
+        stack, _, count = line.rpartition(' ')
+        if not stack:
+            continue
+        count = int(count)
+        frames = stack.split(';')
+        samples += count
+        own[frames[-1]] += count
+        for name in set(frames):
+            total[name] += count
+    return [(name, own[name], total[name], samples) for name, _ in own.most_common(limit)]
@@ -0,0 +1,140 @@
+"""
+Подсчёт SQL-запросов и бюджеты на их количество.
+
+    from core.query_budget import QueryCounter, limit_queries, query_budget
+
+    with QueryCounter() as counter:
+        ...
+    counter.count, counter.duration_ms, counter.duplicates()
+
+    with limit_queries(5, 'пересчёт сводки'):   # QueryBudgetExceeded при превышении
+        ...
+
+    @query_budget(12)
+    def api_status(request): ...
+
+    StreamingHttpResponse(limit_stream_queries(events, 25, 'поток'))
+
+Бюджет представления берётся из QUERY_BUDGETS {'имя URL': n}, затем из
+декоратора @query_budget, иначе QUERY_BUDGET_DEFAULT. QueryBudgetMiddleware
+считает запросы каждого HTTP-запроса и при превышении пишет предупреждение
+(QUERY_BUDGET_ACTION='warn') или выбрасывает QueryBudgetExceeded ('raise').
+Повторы одного и того же SQL (признак N+1) попадают в лог, если их не
+меньше QUERY_BUDGET_DUPLICATES. Запросы при итерации потокового ответа
+middleware не видит: их считает limit_stream_queries по тем же настройкам.
+
+Счётчик подключается через connection.execute_wrapper и видит запросы
+только своего потока — для многопоточного gunicorn это и нужно.
+"""
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryCounter:
+    """Контекстный менеджер: SQL-запросы блока кода (шаблоны с %s) и их время"""
+
+    def __init__(self, using=None):
+        self.aliases = [using] if using else list(settings.DATABASES)
+        self.queries = []
+        self._stack = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, (time.perf_counter() - start) * 1000))
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        for alias in self.aliases:
+            self._stack.enter_context(connections[alias].execute_wrapper(self))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stack.close()
+        return False
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duration_ms(self):
+        return sum(duration for _, duration in self.queries)
+
+    def duplicates(self, threshold=2):
+        """Повторяющиеся шаблоны SQL: [(sql, количество)], частые первыми"""
+        counts = Counter(sql for sql, _ in self.queries)
+        return [(sql, count) for sql, count in counts.most_common() if count >= threshold]
+
+    def report(self, limit=20):
+        """Текстовый список запросов для сообщений об ошибках"""
+        lines = [f"{i}. {duration:.1f} мс  {sql}" for i, (sql, duration) in enumerate(self.queries[:limit], 1)]
+        if self.count > limit:
+            lines.append(f"... и ещё {self.count - limit}")
+        return '\n'.join(lines)
+
+
+def query_budget(max_queries):
+    """Декоратор представления: допустимое число SQL-запросов на HTTP-запрос"""
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+    return decorator
+
+
+def budget_for(resolver_match):
+    """Бюджет представления по результату resolve()"""
+    default = getattr(settings, 'QUERY_BUDGET_DEFAULT', 50)
+    if resolver_match is None:
+        return default
+    budgets = getattr(settings, 'QUERY_BUDGETS', {})
+    if resolver_match.url_name in budgets:
+        return budgets[resolver_match.url_name]
+    return getattr(resolver_match.func, 'query_budget', default)
+
+
+@contextmanager
+def limit_queries(max_queries, label='блок', using=None):
+    """Выбрасывает QueryBudgetExceeded, если блок выполнил больше max_queries запросов"""
+    with QueryCounter(using) as counter:
+        yield counter
+    if counter.count > max_queries:
+        raise QueryBudgetExceeded(
+            f"{label}: {counter.count} SQL-запросов при бюджете {max_queries}\n{counter.report()}"
+        )
+
+
+def limit_stream_queries(chunks, max_queries, label='поток', using=None):
+    """
+    Итерация потокового ответа (генератор) с бюджетом SQL-запросов: при
+    QUERY_BUDGET_ACTION='raise' превышение прерывает поток на ближайшей
+    порции, иначе в конце пишется предупреждение. При выключенном
+    QUERY_BUDGET_ENABLED порции отдаются без подсчёта.
+    """
+    if not getattr(settings, 'QUERY_BUDGET_ENABLED', settings.DEBUG):
+        yield from chunks
+        return
+    action = getattr(settings, 'QUERY_BUDGET_ACTION', 'warn')
+    with QueryCounter(using) as counter:
+        for chunk in chunks:
+            if action == 'raise' and counter.count > max_queries:
+                break
+            yield chunk
+    if counter.count > max_queries:
+        message = f"{label}: {counter.count} SQL-запросов при бюджете {max_queries}"
+        if action == 'raise':
+            raise QueryBudgetExceeded(f"{message}\n{counter.report()}")
+        logger.warning(message)
@@ -0,0 +1,408 @@
+import logging
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+
+from django.core.cache import cache
+from django.db.models import Count, Sum, Max, Q
+from django.db.models.functions import TruncDate, ExtractHour
+from django.utils import timezone
+
+from core.models import ApiLog, SearchHistory, AnalyticsRollup
+from core.services.latency_service import LatencyHistogram, LatencyService
+
+logger = logging.getLogger(__name__)
+
+# Меняется при изменении формата дневных агрегатов: старые строки пересчитываются
+ROLLUP_VERSION = 2
+MAX_RANGE_DAYS = 366
+TODAY_CACHE_SECONDS = 60
+RESPONSE_TIME_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99)
+
+
+def _date_range(start, end):
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+def _compute_api(start, end):
+    """Запросы к API по дням и провайдерам"""
+    rows = ApiLog.objects.filter(
+        timestamp__date__range=(start, end)
+    ).annotate(
+        day=TruncDate('timestamp')
+    ).values('day', 'provider').annotate(
+        requests=Count('id'),
+        time_sum=Sum('response_time_ms'),
+        success=Count('id', filter=Q(response_status=200)),
+        cached=Count('id', filter=Q(was_cached=True)),
+    ).order_by()
+    result = defaultdict(dict)
+    for row in rows:
+        result[row['day']][row['provider']] = {
+            'requests': row['requests'],
+            'time_sum': row['time_sum'] or 0,
+            'success': row['success'],
+            'cached': row['cached'],
+        }
+    return result
+
+
+def _compute_hourly(start, end):
+    """Запросы к API по дням и часам"""
+    rows = ApiLog.objects.filter(
+        timestamp__date__range=(start, end)
+    ).annotate(
+        day=TruncDate('timestamp'),
+        hour=ExtractHour('timestamp'),
+    ).values('day', 'hour').annotate(
+        requests=Count('id'),
+        time_sum=Sum('response_time_ms'),
+    ).order_by()
+    result = defaultdict(dict)
+    for row in rows:
+        result[row['day']][str(row['hour'])] = {
+            'requests': row['requests'],
+            'time_sum': row['time_sum'] or 0,
+        }
+    return result
+
+
+def _compute_searches(start, end):
+    """Поиски по дням: итоги и распределение по типам маршрутов"""
+    rows = SearchHistory.objects.filter(
+        timestamp__date__range=(start, end)
+    ).annotate(
+        day=TruncDate('timestamp')
+    ).values('day', 'travel_mode', 'is_successful').annotate(
+        count=Count('id'),
+        routes_sum=Sum('routes_count'),
+    ).order_by()
+    result = defaultdict(lambda: {'total': 0, 'successful': 0, 'modes': {}})
+    for row in rows:
+        day_data = result[row['day']]
+        day_data['total'] += row['count']
+        if row['is_successful']:
+            day_data['successful'] += row['count']
+            if row['travel_mode']:
+                mode = day_data['modes'].setdefault(row['travel_mode'], {'count': 0, 'routes_sum': 0})
+                mode['count'] += row['count']
+                mode['routes_sum'] += row['routes_sum'] or 0
+    return result
+
+
+def _compute_routes(start, end):
+    """Успешные поиски по дням и парам запросов откуда/куда"""
+    rows = SearchHistory.objects.filter(
+        timestamp__date__range=(start, end),
+        is_successful=True,
+    ).annotate(
+        day=TruncDate('timestamp')
+    ).values('day', 'start_query', 'end_query').annotate(
+        count=Count('id'),
+        routes_sum=Sum('routes_count'),
+    ).order_by()
+    result = defaultdict(list)
+    for row in rows:
+        result[row['day']].append([row['start_query'], row['end_query'], row['count'], row['routes_sum'] or 0])
+    return result
+
+
+def _compute_errors(start, end):
+    """Ошибки API по дням"""
+    rows = ApiLog.objects.filter(
+        timestamp__date__range=(start, end),
+        response_status__gte=400,
+    ).exclude(error_message='').annotate(
+        day=TruncDate('timestamp')
+    ).values('day', 'provider', 'error_message').annotate(
+        count=Count('id'),
+        last_occurred=Max('timestamp'),
+    ).order_by()
+    result = defaultdict(list)
+    for row in rows:
+        result[row['day']].append([
+            row['provider'], row['error_message'], row['count'], row['last_occurred'].isoformat()
+        ])
+    return result
+
+
+def _compute_latency(start, end):
+    """Почасовые гистограммы задержек, слитые по дням и провайдерам"""
+    tz = timezone.get_current_timezone()
+    merged = defaultdict(dict)
+    # Дашборд доступен только персоналу: пропущенные часы сворачиваются здесь
+    for provider, hour, histogram in LatencyService().hourly(
+        datetime.combine(start, time.min, tz), datetime.combine(end + timedelta(days=1), time.min, tz),
+        backfill=True,
+    ):
+        merged[timezone.localdate(hour)].setdefault(provider, LatencyHistogram()).merge(histogram)
+    return {
+        day: {provider: histogram.to_dict() for provider, histogram in providers.items()}
+        for day, providers in merged.items()
+    }
+
+
+def _merge_latency(days):
+    merged = {}
+    for _, day_data in days:
+        for provider, data in day_data.items():
+            merged.setdefault(provider, LatencyHistogram()).merge(LatencyHistogram.from_dict(data))
+    return merged
+
+
+def _merge_providers(days):
+    merged = {}
+    for _, day_data in days:
+        for provider, stats in day_data.items():
+            total = merged.setdefault(provider, {
+                'requests': 0, 'time_sum': 0, 'success': 0, 'cached': 0,
+            })
+            total['requests'] += stats['requests']
+            total['time_sum'] += stats['time_sum']
+            total['success'] += stats['success']
+            total['cached'] += stats['cached']
+    return merged
+
+
+def _build_provider_stats(rollups):
+    merged = _merge_providers(rollups['api'])
+    latency = _merge_latency(rollups['latency'])
+    stats = []
+    for provider, total in merged.items():
+        if not total['requests']:
+            continue
+        histogram = latency.get(provider, LatencyHistogram())
+        stats.append({
+            'provider': provider,
+            'request_count': total['requests'],
+            'avg_response_time': total['time_sum'] / total['requests'],
+            'success_rate': total['success'] / total['requests'] * 100,
+            'cache_hit_rate': total['cached'] / total['requests'] * 100,
+            'p50': histogram.percentile(0.5),
+            'p90': histogram.percentile(0.9),
+            'p99': histogram.percentile(0.99),
+        })
+    return sorted(stats, key=lambda s: -s['request_count'])
+
+
+def _build_response_times(rollups):
+    """Реальные квантили задержек провайдеров (без учёта ответов из кэша)"""
+    times = []
+    for provider, histogram in sorted(_merge_latency(rollups['latency']).items()):
+        if not histogram.count:
+            continue
+        summary = histogram.summary(RESPONSE_TIME_QUANTILES)
+        times.append({
+            'provider': provider,
+            'count': summary.pop('count'),
+            'avg_time': summary.pop('avg'),
+            'min_time': summary.pop('min'),
+            'max_time': summary.pop('max'),
+            **summary,
+        })
+    return times
+
+
+def _build_daily_trends(rollups):
+    trends = []
+    for day, day_data in rollups['api']:
+        requests = sum(s['requests'] for s in day_data.values())
+        if not requests:
+            continue
+        trends.append({
+            'day': day.isoformat(),
+            'requests': requests,
+            'avg_time': sum(s['time_sum'] for s in day_data.values()) / requests,
+            'cache_hits': sum(s['cached'] for s in day_data.values()),
+        })
+    return trends
+
+
+def _build_hourly_activity(rollups):
+    hours = {}
+    for _, day_data in rollups['hourly']:
+        for hour, stats in day_data.items():
+            total = hours.setdefault(int(hour), {'requests': 0, 'time_sum': 0})
+            total['requests'] += stats['requests']
+            total['time_sum'] += stats['time_sum']
+    return [{
+        'hour': hour,
+        'requests': total['requests'],
+        'avg_time': total['time_sum'] / total['requests'],
+    } for hour, total in sorted(hours.items()) if total['requests']]
+
+
+def _build_travel_modes(rollups):
+    modes = {}
+    for _, day_data in rollups['searches']:
+        for mode, stats in day_data['modes'].items():
+            total = modes.setdefault(mode, {'count': 0, 'routes_sum': 0})
+            total['count'] += stats['count']
+            total['routes_sum'] += stats['routes_sum']
+    stats = [{
+        'travel_mode': mode,
+        'count': total['count'],
+        'avg_routes': total['routes_sum'] / total['count'],
+        'avg_success': 100.0,
+    } for mode, total in modes.items() if total['count']]
+    return sorted(stats, key=lambda s: -s['count'])
+
+
+def _build_top_routes(rollups, limit=10):
+    pairs = {}
+    for _, day_data in rollups['routes']:
+        for start_query, end_query, count, routes_sum in day_data:
+            total = pairs.setdefault((start_query, end_query), [0, 0])
+            total[0] += count
+            total[1] += routes_sum
+    top = sorted(pairs.items(), key=lambda item: -item[1][0])[:limit]
+    return [{
+        'start_query': start_query,
+        'end_query': end_query,
+        'count': count,
+        'avg_routes': routes_sum / count,
+        'success_rate': 100.0,
+    } for (start_query, end_query), (count, routes_sum) in top]
+
+
+def _build_errors(rollups, limit=10):
+    errors = {}
+    for _, day_data in rollups['errors']:
+        for provider, message, count, last_occurred in day_data:
+            total = errors.setdefault((provider, message), [0, last_occurred])
+            total[0] += count
+            total[1] = max(total[1], last_occurred)
+    top = sorted(errors.items(), key=lambda item: -item[1][0])[:limit]
+    return [{
+        'provider': provider,
+        'error_message': message,
+        'count': count,
+        'last_occurred': last_occurred,
+    } for (provider, message), (count, last_occurred) in top]
+
+
+def _build_summary(rollups):
+    total_searches = sum(d['total'] for _, d in rollups['searches'])
+    successful = sum(d['successful'] for _, d in rollups['searches'])
+    merged = _merge_providers(rollups['api'])
+    requests = sum(t['requests'] for t in merged.values())
+    return {
+        'total_searches': total_searches,
+        'successful_searches': successful,
+        'failed_searches': total_searches - successful,
+        'conversion_rate': round(successful / total_searches * 100, 1) if total_searches else 0,
+        'total_api_requests': requests,
+        'avg_response_time': sum(t['time_sum'] for t in merged.values()) / requests if requests else 0,
+        'cache_hit_rate': sum(t['cached'] for t in merged.values()) / requests * 100 if requests else 0,
+    }
+
+
+class AnalyticsService:
+    """
+    Серии дашборда аналитики поверх дневных агрегатов.
+
+    Закрытые дни считаются один раз и хранятся в AnalyticsRollup бессрочно,
+    текущий день пересчитывается (с коротким кэшем), поэтому запрос за 90 дней
+    не требует пересчёта 90 дней.
+    """
+
+    ROLLUPS = {
+        'api': (_compute_api, dict),
+        'hourly': (_compute_hourly, dict),
+        'searches': (_compute_searches, lambda: {'total': 0, 'successful': 0, 'modes': {}}),
+        'routes': (_compute_routes, list),
+        'errors': (_compute_errors, list),
+        'latency': (_compute_latency, dict),
+    }
+
+    # Серия -> (нужные дневные агрегаты, функция сборки)
+    SERIES = {
+        'summary': (('api', 'searches'), _build_summary),
+        'provider_stats': (('api', 'latency'), _build_provider_stats),
+        'response_times': (('latency',), _build_response_times),
+        'daily_trends': (('api',), _build_daily_trends),
+        'hourly_activity': (('hourly',), _build_hourly_activity),
+        'travel_modes': (('searches',), _build_travel_modes),
+        'top_routes': (('routes',), _build_top_routes),
+        'errors': (('errors',), _build_errors),
+    }
+
+    # Серии, для которых строится график (имена совпадают с core.charts.CHART_RENDERERS)
+    CHART_SERIES = ('top_routes', 'provider_stats', 'hourly_activity', 'travel_modes',
+                    'daily_trends', 'response_times')
+
+    @staticmethod
+    def resolve_range(start=None, end=None, days=None, max_days=MAX_RANGE_DAYS):
+        """
+        Диапазон дат из параметров запроса: start/end в формате YYYY-MM-DD
+        или days — количество последних дней, включая сегодняшний.
+        max_days=None снимает ограничение на длину периода.
+        """
+        today = timezone.localdate()
+        end_date = date.fromisoformat(end) if end else today
+        if start:
+            start_date = date.fromisoformat(start)
+        else:
+            start_date = end_date - timedelta(days=int(days or 7) - 1)
+        if start_date > end_date:
+            raise ValueError("Начало периода позже конца")
+        if max_days is not None and (end_date - start_date).days + 1 > max_days:
+            raise ValueError(f"Период не может превышать {max_days} дней")
+        return start_date, end_date
+
+    def __init__(self):
+        # Агрегаты, уже прочитанные этим экземпляром: серии дашборда делят api и latency
+        self._days = {}
+
+    def get_series(self, name, start, end):
+        kinds, builder = self.SERIES[name]
+        rollups = {}
+        for kind in kinds:
+            key = (kind, start, end)
+            if key not in self._days:
+                self._days[key] = self.get_days(kind, start, end)
+            rollups[kind] = self._days[key]
+        return builder(rollups)
+
+    def get_days(self, kind, start, end):
+        """Список (день, агрегат) за период: закрытые дни из БД, сегодня — на лету"""
+        compute, empty = self.ROLLUPS[kind]
+        today = timezone.localdate()
+        result = {}
+
+        closed_end = min(end, today - timedelta(days=1))
+        if start <= closed_end:
+            stored = {
+                rollup.day: rollup.data
+                for rollup in AnalyticsRollup.objects.filter(
+                    kind=kind, version=ROLLUP_VERSION, day__range=(start, closed_end)
+                )
+            }
+            missing = [day for day in _date_range(start, closed_end) if day not in stored]
+            if missing:
+                logger.debug(f"[AnalyticsService] Пересчёт {kind}: {len(missing)} дн.")
+                computed = compute(missing[0], missing[-1])
+                rollups = [
+                    AnalyticsRollup(kind=kind, day=day, version=ROLLUP_VERSION, data=computed.get(day, empty()))
+                    for day in missing
+                ]
+                AnalyticsRollup.objects.bulk_create(
+                    rollups,
+                    update_conflicts=True,
+                    unique_fields=['kind', 'day'],
+                    update_fields=['data', 'version', 'computed_at'],
+                )
+                stored.update({rollup.day: rollup.data for rollup in rollups})
+            result.update(stored)
+
+        if start <= today <= end:
+            cache_key = f"analytics_today_{kind}_{today.strftime('%Y%m%d')}"
+            today_data = cache.get(cache_key)
+            if today_data is None:
+                today_data = compute(today, today).get(today, empty())
+                cache.set(cache_key, today_data, TODAY_CACHE_SECONDS)
+            result[today] = today_data
+
+        return sorted(result.items())
@@ -1,28 +1,46 @@
 import hashlib
-import json
 import time
-from datetime import timedelta
+from datetime import datetime
+from typing import Optional, Tuple
+from django.conf import settings
 from django.utils import timezone
 from core.models import CachedRoute, ApiLog
+from core import metrics
+from core.timing import span
+from . import geometry, geometry_store, presentation, route_model
+from .routing_service import collect_routes, stream_routes
 import logging
 
 logger = logging.getLogger(__name__)
 
 class CachedRoutingService:
-    """Обертка для любого сервиса маршрутизации с кэшированием"""
+    """
+    Обертка для любого сервиса маршрутизации с кэшированием.
+
+    Ключ записи включает версию схемы (schema_version): формат словаря
+    маршрута и версии разбора ответов провайдеров. После изменения разбора
+    записи прежнего формата не находятся — это промах, а не отдача старых
+    данных, и весь кэш сбрасывать не нужно: при выкладке старые и новые
+    процессы пользуются каждый своими записями. Записи прежних версий
+    удаляются, когда истекут (при следующей записи того же запроса), или
+    переводятся в новый формат из сохранённого ответа провайдера
+    (manage.py upgrade_route_cache, ROUTE_CACHE_STORE_RAW).
+    """
     
     def __init__(self, routing_service, provider_name="stub"):
         self.routing_service = routing_service
         self.provider_name = provider_name
-    
-    def get_routes(self, start_lat, start_lon, end_lat, end_lon, **kwargs):
+
+    def schema_version(self, travel_mode=None) -> str:
+        """Версия записей кэша для режима: формат маршрутов и версии разбора провайдеров"""
+        parser_version = getattr(self.routing_service, 'parser_version', None)
+        return f"{route_model.SCHEMA_VERSION}:{parser_version(travel_mode) if parser_version else ''}"
+
+    @staticmethod
+    def make_cache_key(start_lat, start_lon, end_lat, end_lon, schema_version='', **kwargs):
         """
-        Получение маршрутов с кэшированием.
-        Поддерживает передачу дополнительных параметров:
-        - travel_mode: режим передвижения ('public', 'car', 'pedestrian', 'bicycle')
-        - transport_types: список типов транспорта
-        - max_transfers: максимальное количество пересадок
-        - only_direct: только прямые маршруты
+        Строка параметров запроса и ключ CachedRoute — md5 версии схемы и этой строки.
+        Параметры со значением None не влияют на ключ, списки сортируются.
         """
         cache_key_data = f"{start_lat}:{start_lon}:{end_lat}:{end_lon}"
         if kwargs:
@@ -32,50 +50,105 @@ class CachedRoutingService:
                     if isinstance(value, list):
                         value = sorted(value)
                     cache_key_data += f":{key}:{value}"
-        
-        hash_key = hashlib.md5(cache_key_data.encode()).hexdigest()
+        return cache_key_data, hashlib.md5(f"{schema_version}|{cache_key_data}".encode()).hexdigest()
+    
+    def get_routes(self, start_lat, start_lon, end_lat, end_lon, **kwargs):
+        """
+        Получение маршрутов с кэшированием.
+        Поддерживает передачу дополнительных параметров:
+        - travel_mode: режим передвижения ('public', 'car', 'pedestrian', 'bicycle')
+        - transport_types: список типов транспорта
+        - max_transfers: максимальное количество пересадок
+        - only_direct: только прямые маршруты
+        """
+        return collect_routes(self.stream_routes(start_lat, start_lon, end_lat, end_lon, **kwargs))
+
+    def stream_routes(self, start_lat, start_lon, end_lat, end_lon, **kwargs):
+        """
+        get_routes по одному маршруту (генератор; return — весь ответ): при
+        промахе каждый маршрут готовится к показу и отдаётся сразу после
+        разбора ответа провайдера, запись в кэш — после последнего. Время
+        ответа провайдера в ApiLog не включает обработку маршрутов вызывающим.
+        """
+        schema_version = self.schema_version(kwargs.get('travel_mode'))
+        cache_key_data, hash_key = self.make_cache_key(start_lat, start_lon, end_lat, end_lon,
+                                                       schema_version=schema_version, **kwargs)
         logger.debug(f"[CachedRoutingService] Ключ кэша: {hash_key[:8]}...")
         logger.debug(f"[CachedRoutingService] Данные для ключа: {cache_key_data}")
-        cache_expiry = timezone.now() - timedelta(minutes=30)
-        logger.debug(f"[CachedRoutingService] Ищем кэш старше: {cache_expiry}")
         
+        lookup_start = time.time()
+        route_data = None
         try:
-            cached = CachedRoute.objects.filter(
-                hash_key=hash_key, 
-                expires_at__gt=timezone.now()
-            ).first()
+            with span('cache_lookup'):
+                # Исходный ответ провайдера нужен только upgrade_route_cache
+                cached = CachedRoute.objects.filter(
+                    hash_key=hash_key, 
+                    expires_at__gt=timezone.now()
+                ).defer('raw_response').first()
             
             if cached:
+                # Ссылки на общую геометрию участков разрешаются одним запросом
+                with span('unpack'):
+                    route_data = geometry_store.unpack_route_data(cached.route_data)
+                    if route_data is not None:
+                        route_data = route_model.load_route_data(route_data)
+                if route_data is not None and not presentation.is_prepared(route_data):
+                    # Запись подготовлена прежней версией этапа показа
+                    with span('present'):
+                        presentation.prepare_route_data(route_data, (start_lat, start_lon), (end_lat, end_lon),
+                                                        kwargs.get('travel_mode'))
+            if route_data is not None:
                 logger.debug(f"[CachedRoutingService] Данные из кэша")
+                metrics.ROUTE_CACHE_REQUESTS.inc(tier='db', result='hit')
                 ApiLog.objects.create(
                     provider=self.provider_name,
                     request_params=cache_key_data,
                     response_status=200,
-                    response_time_ms=5,  
+                    response_time_ms=(time.time() - lookup_start) * 1000,
                     was_cached=True
                 )
-                return cached.route_data
+                route_data.update(cache_key=hash_key, cache_created_at=cached.created_at.isoformat(),
+                                  cache_expires_at=cached.expires_at.isoformat())
             else:
                 logger.debug(f"[CachedRoutingService]  Не найдено в кэше.")
+                metrics.ROUTE_CACHE_REQUESTS.inc(tier='db', result='miss')
         except Exception as e:
             logger.error(f"Ошибка при чтении кэша: {e}")
-        start_time = time.time()
+            metrics.ROUTE_CACHE_REQUESTS.inc(tier='db', result='error')
+            route_data = None
+        if route_data is not None:
+            if isinstance(route_data, dict):
+                yield from route_data.get('result', [])
+            return route_data
+
+        provider_routes = stream_routes(self.routing_service, start_lat, start_lon, end_lat, end_lon, **kwargs)
+        provider_time = 0.0
         try:
-            route_data = self.routing_service.get_routes(
-                start_lat, start_lon, end_lat, end_lon, **kwargs
-            )
-            response_time = (time.time() - start_time) * 1000
-            try:
-                CachedRoute.objects.update_or_create(
-                    hash_key=hash_key,
-                    defaults={
-                        'route_data': route_data,
-                        'expires_at': timezone.now() + timedelta(minutes=30)
-                    }
-                )
-                logger.debug(f" Данные сохранены/обновлены в кэш: {hash_key[:8]}...")
-            except Exception as e:
-                logger.error(f" Не удалось сохранить в кэш: {e}")
+            number = 0
+            while True:
+                step_start = time.time()
+                try:
+                    with span('provider'):
+                        route = next(provider_routes)
+                except StopIteration as stop:
+                    route_data = stop.value
+                    break
+                finally:
+                    provider_time += time.time() - step_start
+                # Подготовка всего ответа в _store уже подготовленные маршруты не меняет
+                number += 1
+                with span('present'):
+                    presentation.prepare_route(route, number, (start_lat, start_lon), (end_lat, end_lon),
+                                               kwargs.get('travel_mode'))
+                with span('simplify'):
+                    geometry.add_route_levels(route)
+                yield route
+            response_time = provider_time * 1000
+            metrics.PROVIDER_REQUESTS.inc(provider=self.provider_name, outcome='success')
+            metrics.PROVIDER_REQUEST_DURATION.observe(response_time / 1000, provider=self.provider_name)
+            raw = route_data.pop('raw', None) if isinstance(route_data, dict) else None
+            stored = self._store(hash_key, cache_key_data, schema_version, route_data, (start_lat, start_lon),
+                                 (end_lat, end_lon), kwargs, raw)
             ApiLog.objects.create(
                 provider=self.provider_name,
                 request_params=cache_key_data,
@@ -83,11 +156,16 @@ class CachedRoutingService:
                 response_time_ms=response_time,
                 was_cached=False
             )
-            
+            if stored and isinstance(route_data, dict):
+                # Ключ записи и её время (ISO 8601) — подробностям маршрутов и ETag ответов (views)
+                route_data = dict(route_data, cache_key=hash_key, cache_created_at=stored[0].isoformat(),
+                                  cache_expires_at=stored[1].isoformat())
             return route_data
             
         except Exception as e:
-            response_time = (time.time() - start_time) * 1000
+            response_time = provider_time * 1000
+            metrics.PROVIDER_REQUESTS.inc(provider=self.provider_name, outcome='error')
+            metrics.PROVIDER_REQUEST_DURATION.observe(response_time / 1000, provider=self.provider_name)
             ApiLog.objects.create(
                 provider=self.provider_name,
                 request_params=cache_key_data,
@@ -97,4 +175,113 @@ class CachedRoutingService:
                 error_message=str(e)
             )
             logger.error(f"Ошибка при получении маршрутов: {e}")
-            raise
\ No newline at end of file
+            raise
+
+    def find_record(self, start_lat, start_lon, end_lat, end_lon, **kwargs):
+        """
+        (ключ, created_at, expires_at, routes_count) действующей записи запроса
+        без чтения маршрутов — для проверки ETag до поиска; None — записи нет.
+        """
+        _, hash_key = self.make_cache_key(start_lat, start_lon, end_lat, end_lon,
+                                          schema_version=self.schema_version(kwargs.get('travel_mode')), **kwargs)
+        record = CachedRoute.objects.filter(
+            hash_key=hash_key,
+            expires_at__gt=timezone.now()
+        ).values_list('created_at', 'expires_at', 'routes_count').first()
+        return (hash_key, *record) if record else None
+
+    @staticmethod
+    def get_route(hash_key, index):
+        """
+        Маршрут index действующей записи кэша hash_key (ключ отдаёт get_routes
+        в route_data['cache_key']). Раскодируется и собирается только этот
+        маршрут; None — записи нет, она истекла или маршрута с таким номером нет.
+        """
+        cached = CachedRoute.objects.filter(
+            hash_key=hash_key,
+            expires_at__gt=timezone.now()
+        ).defer('raw_response').first()
+        if not cached or not isinstance(cached.route_data, dict):
+            return None
+        routes = cached.route_data.get('result') or []
+        if not 0 <= index < len(routes):
+            return None
+        route_data = geometry_store.unpack_route_data(dict(cached.route_data, result=[routes[index]]))
+        if route_data is None:
+            return None
+        route_data = route_model.load_route_data(route_data)
+        if not presentation.is_prepared(route_data):
+            # Точки запроса в записи не хранятся: без прямой между ними
+            presentation.prepare_route_data(route_data, None, None)
+            route_data['result'][0].number = index + 1
+        return route_data['result'][0]
+
+    def _store(self, hash_key, cache_key_data, schema_version, route_data, start, end, kwargs, raw=None,
+               expires_at=None) -> Optional[Tuple[datetime, datetime]]:
+        """
+        Подготовка маршрутов к показу, уровни детализации и запись в кэш.
+        Возвращает (created_at, expires_at) записи, None — запись не удалась.
+        """
+        # Подготовка к показу и уровни детализации считаются один раз
+        # и хранятся в кэше вместе с маршрутом
+        with span('present'):
+            presentation.prepare_route_data(route_data, start, end, kwargs.get('travel_mode'))
+        with span('simplify'):
+            geometry.add_levels_of_detail(route_data)
+        raw_response = None
+        if raw is not None and getattr(settings, 'ROUTE_CACHE_STORE_RAW', False):
+            raw_response = dict(raw, request={'start': list(start), 'end': list(end), 'kwargs': kwargs})
+        request_hash = hashlib.md5(cache_key_data.encode()).hexdigest()
+        try:
+            with span('cache_store'):
+                now = timezone.now()
+                expires_at = expires_at or now + CachedRoute.ttl()
+                record, _ = CachedRoute.objects.update_or_create(
+                    hash_key=hash_key,
+                    defaults={
+                        # Линии и уровни детализации хранятся закодированными строками,
+                        # участки общественного транспорта — один раз в RouteGeometry
+                        'route_data': geometry_store.pack_route_data(route_data),
+                        # Перезапись истёкшей записи — новые данные: от created_at зависят ETag ответов
+                        'created_at': now,
+                        'expires_at': expires_at,
+                        'schema_version': schema_version,
+                        'request_hash': request_hash,
+                        'raw_response': raw_response,
+                        'routes_count': len(route_data.get('result') or []),
+                    }
+                )
+                # Истёкшие записи того же запроса (в том числе прежних версий)
+                CachedRoute.objects.filter(request_hash=request_hash, expires_at__lte=now).exclude(
+                    hash_key=hash_key
+                ).delete()
+            logger.debug(f" Данные сохранены/обновлены в кэш: {hash_key[:8]}...")
+            return record.created_at, record.expires_at
+        except Exception as e:
+            logger.error(f" Не удалось сохранить в кэш: {e}")
+            return None
+
+    def upgrade(self, record: CachedRoute) -> bool:
+        """
+        Переводит запись прежней версии в текущую по сохранённому ответу
+        провайдера: повторный разбор, подготовка и запись под новым ключом с
+        прежним сроком жизни. False — записи без ответа и записи текущей версии.
+        """
+        raw = record.raw_response
+        if not raw or 'request' not in raw:
+            return False
+        request = raw['request']
+        kwargs = request['kwargs']
+        schema_version = self.schema_version(kwargs.get('travel_mode'))
+        if record.schema_version == schema_version:
+            return False
+        route_data = self.routing_service.parse_raw(raw, *request['start'], *request['end'])
+        route_data.pop('raw', None)
+        cache_key_data, hash_key = self.make_cache_key(*request['start'], *request['end'],
+                                                       schema_version=schema_version, **kwargs)
+        raw = {name: value for name, value in raw.items() if name != 'request'}
+        if not self._store(hash_key, cache_key_data, schema_version, route_data, tuple(request['start']),
+                           tuple(request['end']), kwargs, raw, expires_at=record.expires_at):
+            return False
+        CachedRoute.objects.filter(pk=record.pk).exclude(hash_key=hash_key).delete()
+        return True
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.urls import reverse
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+# Меняется при изменении внешнего вида графиков, чтобы старые файлы не переиспользовались
+CHART_RENDER_VERSION = 3
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = {}
+_pruned_at = 0.0
+
+
+def _get_executor():
+    """Ленивое создание общего пула процессов для рендеринга графиков"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn: дочерние процессы не наследуют соединения с БД и потоки gunicorn
+            _executor = ProcessPoolExecutor(
+                max_workers=getattr(settings, 'CHART_RENDER_WORKERS', 2),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _executor
+
+
+def _render_in_worker(name, records, fmt, path):
+    """Выполняется в процессе пула: matplotlib и pandas импортируются только там"""
+    from core.charts import render_chart_to_file
+    return render_chart_to_file(name, records, fmt, path)
+
+
+class ChartCacheService:
+    """
+    Контентно-адресуемый кэш графиков дашборда.
+
+    Имя файла графика — хэш входных данных, поэтому неизменившиеся графики
+    никогда не перерисовываются. Рендеринг выполняется в фоновом пуле
+    процессов, представление только ссылается на готовые файлы.
+
+    Данные за текущий день меняются при каждом обновлении, поэтому каталог
+    чистится при постановке графиков (не чаще CHART_CACHE_PRUNE_INTERVAL
+    секунд): удаляются файлы, не использованные дольше CHART_CACHE_MAX_AGE
+    секунд, затем самые старые — пока каталог больше CHART_CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = Path(cache_dir or getattr(settings, 'CHART_CACHE_DIR', settings.BASE_DIR / 'chart_cache'))
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def normalize_records(records):
+        """Приводит записи QuerySet.values() к JSON-совместимому виду"""
+        return json.loads(json.dumps(list(records), cls=DjangoJSONEncoder))
+
+    @staticmethod
+    def make_digest(name, records):
+        payload = json.dumps(
+            {'chart': name, 'version': CHART_RENDER_VERSION, 'data': records},
+            sort_keys=True, ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path_for(self, digest, fmt='png'):
+        return self.cache_dir / f"{digest}.{fmt}"
+
+    def spec_path(self, digest):
+        return self.cache_dir / f"{digest}.json"
+
+    def is_ready(self, digest, fmt='png'):
+        return self.path_for(digest, fmt).exists()
+
+    def load_spec(self, digest):
+        try:
+            with open(self.spec_path(digest), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_spec(self, digest, name, records):
+        path = self.spec_path(digest)
+        if path.exists():
+            return
+        tmp_path = path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'chart': name, 'data': records}, f, ensure_ascii=False)
+        tmp_path.replace(path)
+
+    def submit(self, name, records, fmt='png'):
+        """
+        Ставит график в очередь на рендеринг, если его ещё нет на диске.
+        Не блокирует запрос: возвращает описание графика со ссылкой на файл.
+        """
+        records = self.normalize_records(records)
+        digest = self.make_digest(name, records)
+        ready = self.is_ready(digest, fmt)
+        if ready:
+            # Время изменения — время последнего использования для prune
+            self.path_for(digest, fmt).touch()
+        self.prune_if_due()
+        if not ready:
+            self._save_spec(digest, name, records)
+            self._schedule(digest, name, records, fmt)
+        return self.describe(digest, fmt)
+
+    def prune_if_due(self):
+        global _pruned_at
+        interval = getattr(settings, 'CHART_CACHE_PRUNE_INTERVAL', 600)
+        with _executor_lock:
+            if time.time() - _pruned_at < interval:
+                return
+            _pruned_at = time.time()
+        self.prune()
+
+    def prune(self, max_age=None, max_bytes=None, now=None):
+        """
+        Удаляет графики и спецификации, не использованные дольше max_age
+        секунд, затем самые старые, пока каталог больше max_bytes. Графики в
+        очереди рендеринга не трогаются. Возвращает число удалённых файлов.
+        """
+        max_age = max_age if max_age is not None else getattr(settings, 'CHART_CACHE_MAX_AGE', 7 * 24 * 3600)
+        max_bytes = max_bytes if max_bytes is not None else getattr(settings, 'CHART_CACHE_MAX_BYTES', 200 * 2 ** 20)
+        now = now or time.time()
+        with _executor_lock:
+            pending = {digest for digest, _ in _pending}
+        files = []
+        for path in self.cache_dir.iterdir():
+            if path.name.split('.', 1)[0] in pending:
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if now - mtime <= max_age and total <= max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"Кэш графиков: удалено файлов {removed}, осталось {total} байт")
+        return removed
+
+    def submit_digest(self, digest, fmt='png'):
+        """Ставит в очередь график по ранее сохранённой спецификации"""
+        spec = self.load_spec(digest)
+        if spec is None:
+            return False
+        self._schedule(digest, spec['chart'], spec['data'], fmt)
+        return True
+
+    def _schedule(self, digest, name, records, fmt):
+        key = (digest, fmt)
+        with _executor_lock:
+            if key in _pending and not _pending[key].done():
+                return
+        try:
+            future = _get_executor().submit(
+                _render_in_worker, name, records, fmt, str(self.path_for(digest, fmt))
+            )
+        except Exception as e:
+            logger.error(f"Не удалось поставить график {name} в очередь: {e}")
+            return
+        with _executor_lock:
+            _pending[key] = future
+            metrics.CHART_RENDER_QUEUE.set(len(_pending))
+        future.add_done_callback(lambda f, key=key: self._on_done(key, name, f))
+
+    @staticmethod
+    def _on_done(key, name, future):
+        with _executor_lock:
+            if _pending.get(key) is future:
+                del _pending[key]
+            metrics.CHART_RENDER_QUEUE.set(len(_pending))
+        if future.exception() is not None:
+            logger.error(f"Ошибка рендеринга графика {name}: {future.exception()}")
+
+    def describe(self, digest, fmt='png'):
+        return {
+            'digest': digest,
+            'ready': self.is_ready(digest, fmt),
+            'url': reverse('analytics_chart', kwargs={'digest': digest, 'fmt': fmt}),
+        }
@@ -1,7 +1,8 @@
 from django.conf import settings
 import logging
+from core import metrics
 from .twogis_public_transport_service import TwoGisPublicTransportService
-from .routing_service import TomTomRoutingService, StubRoutingService
+from .routing_service import TomTomRoutingService, StubRoutingService, collect_routes, stream_routes
 
 logger = logging.getLogger(__name__)
 
@@ -16,10 +17,33 @@ class CompositeRoutingService:
         self.use_2gis_public = getattr(settings, 'USE_PUBLIC_TRANSPORT_API', True)
         self.use_2gis_car = getattr(settings, 'USE_2GIS_CAR_ROUTING', True)
         self.use_real_api = getattr(settings, 'USE_REAL_API', True)
+
+    def _services(self, travel_mode=None):
+        """Сервисы, ответы которых могут вернуться для режима (с учётом фолбэков)"""
+        services = [self.tomtom_service, self.stub_service]
+        if (travel_mode or 'public') == 'public':
+            services.insert(0, self.public_transport_service)
+        return services
+
+    def parser_version(self, travel_mode=None):
+        """Версии разбора всех провайдеров режима: смена любой из них меняет ключ кэша"""
+        return '+'.join(service.parser_version(travel_mode) for service in self._services(travel_mode))
+
+    def parse_raw(self, raw, start_lat, start_lon, end_lat, end_lon):
+        """Повторный разбор сохранённого ответа сервисом, который его получил"""
+        for service in self._services():
+            if service.PARSER_NAME == raw.get('parser'):
+                return service.parse_raw(raw, start_lat, start_lon, end_lat, end_lon)
+        raise ValueError(f"Неизвестный разборщик ответа: {raw.get('parser')}")
     
     def get_routes(self, start_lat, start_lon, end_lat, end_lon, **kwargs):
+        """Интеллектуальный выбор провайдера маршрутизации (см. stream_routes)"""
+        return collect_routes(self.stream_routes(start_lat, start_lon, end_lat, end_lon, **kwargs))
+
+    def stream_routes(self, start_lat, start_lon, end_lat, end_lon, **kwargs):
         """
-        Интеллектуальный выбор провайдера маршрутизации
+        Интеллектуальный выбор провайдера маршрутизации; маршруты отдаются
+        по мере разбора ответа провайдера (routing_service.stream_routes)
         
         :param kwargs: Может содержать:
           - travel_mode: 'public' (общественный транспорт), 'car', 'pedestrian', 'bicycle'
@@ -36,39 +60,48 @@ class CompositeRoutingService:
             if self.use_2gis_public:
                 try:
                     logger.info("Используем 2GIS Public Transport API")
-                    return self.public_transport_service.get_routes(
-                        start_lat, start_lon, end_lat, end_lon, **kwargs
-                    )
+                    return (yield from stream_routes(
+                        self.public_transport_service, start_lat, start_lon, end_lat, end_lon, **kwargs
+                    ))
                 except Exception as e:
                     logger.error(f"2GIS Public Transport API ошибка: {e}")
+                    metrics.FALLBACKS.inc(source='2gis_public_transport', target='tomtom_pedestrian')
                     try:
                         logger.info("Фолбэк: TomTom (пешком)")
                         kwargs['travel_mode'] = 'pedestrian'
-                        return self.tomtom_service.get_routes(
-                            start_lat, start_lon, end_lat, end_lon, **kwargs
-                        )
+                        return (yield from stream_routes(
+                            self.tomtom_service, start_lat, start_lon, end_lat, end_lon, **kwargs
+                        ))
                     except Exception as tomtom_error:
                         logger.error(f"TomTom также упал: {tomtom_error}")
-                        return self.stub_service.get_routes(
-                            start_lat, start_lon, end_lat, end_lon, **kwargs
-                        )
+                        metrics.FALLBACKS.inc(source='tomtom_pedestrian', target='stub')
+                        return (yield from stream_routes(
+                            self.stub_service, start_lat, start_lon, end_lat, end_lon, **kwargs
+                        ))
             else:
                 logger.info("2GIS Public Transport отключен, используем TomTom пешком")
                 kwargs['travel_mode'] = 'pedestrian'
-                return self.tomtom_service.get_routes(
-                    start_lat, start_lon, end_lat, end_lon, **kwargs
-                )
+                return (yield from stream_routes(
+                    self.tomtom_service, start_lat, start_lon, end_lat, end_lon, **kwargs
+                ))
         
 
         elif travel_mode in ['car', 'pedestrian', 'bicycle']:
             logger.info(f"Используем TomTom API для режима {travel_mode}")
             try:
                 kwargs['travel_mode'] = travel_mode
-                return self.tomtom_service.get_routes(start_lat, start_lon, end_lat, end_lon, **kwargs)
+                return (yield from stream_routes(
+                    self.tomtom_service, start_lat, start_lon, end_lat, end_lon, **kwargs
+                ))
             except Exception as e:
                 logger.error(f"TomTom API ошибка: {e}")
                 logger.info("Фолбэк на заглушку")
-                return self.stub_service.get_routes(start_lat, start_lon, end_lat, end_lon, **kwargs)
+                metrics.FALLBACKS.inc(source=f'tomtom_{travel_mode}', target='stub')
+                return (yield from stream_routes(
+                    self.stub_service, start_lat, start_lon, end_lat, end_lon, **kwargs
+                ))
         else:
             logger.warning(f"Неизвестный режим {travel_mode}, используем заглушку")
-            return self.stub_service.get_routes(start_lat, start_lon, end_lat, end_lon, **kwargs)
\ No newline at end of file
+            return (yield from stream_routes(
+                self.stub_service, start_lat, start_lon, end_lat, end_lon, **kwargs
+            ))
\ No newline at end of file
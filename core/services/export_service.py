@@ -0,0 +1,178 @@
+import csv
+import importlib.util
+import logging
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+
+from core.models import ApiLog, SearchHistory
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_SIZE = 5000
+
+
+class ExportError(Exception):
+    """Экспорт невозможен с указанными параметрами"""
+
+
+class _StreamBuffer:
+    """
+    Файлоподобный приёмник: накапливает записанные байты до следующего
+    drain(), чтобы писатель (csv, parquet) не держал весь файл в памяти.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ExportService:
+    """
+    Потоковая выгрузка SearchHistory и ApiLog за период в CSV или Parquet.
+
+    Строки читаются серверным курсором порциями по chunk_size и сразу
+    отдаются потребителю, поэтому память не зависит от размера периода.
+    """
+
+    DATASETS = {
+        'search_history': (SearchHistory, (
+            'id', 'timestamp', 'start_query', 'end_query', 'start_coords', 'end_coords',
+            'is_successful', 'routes_count', 'travel_mode', 'transport_types', 'max_transfers',
+        )),
+        'api_logs': (ApiLog, (
+            'id', 'timestamp', 'provider', 'response_status', 'response_time_ms',
+            'was_cached', 'request_params', 'error_message',
+        )),
+    }
+    FORMATS = {
+        'csv': 'text/csv; charset=utf-8',
+        'parquet': 'application/vnd.apache.parquet',
+    }
+
+    def __init__(self, chunk_size=EXPORT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def day_bounds(start, end):
+        """Границы [start 00:00, end+1 00:00) в текущем часовом поясе"""
+        tz = timezone.get_current_timezone()
+        return (
+            timezone.make_aware(datetime.combine(start, time.min), tz),
+            timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min), tz),
+        )
+
+    def validate(self, dataset, fmt):
+        if dataset not in self.DATASETS:
+            raise ExportError(f"Неизвестный набор данных: {dataset}")
+        if fmt not in self.FORMATS:
+            raise ExportError(f"Неизвестный формат: {fmt}")
+        # Наличие pyarrow проверяется без импорта: он нужен только при записи файла
+        if fmt == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+            raise ExportError("Экспорт в Parquet недоступен: не установлен pyarrow")
+
+    def filename(self, dataset, fmt, start, end):
+        return f"{dataset}_{start:%Y%m%d}_{end:%Y%m%d}.{fmt}"
+
+    def iter_rows(self, dataset, start, end):
+        """Кортежи значений полей набора за период, по порядку первичного ключа"""
+        model, fields = self.DATASETS[dataset]
+        start_dt, end_dt = self.day_bounds(start, end)
+        return model.objects.filter(
+            timestamp__gte=start_dt, timestamp__lt=end_dt
+        ).order_by('pk').values_list(*fields).iterator(chunk_size=self.chunk_size)
+
+    def iter_batches(self, dataset, start, end):
+        batch = []
+        for row in self.iter_rows(dataset, start, end):
+            batch.append(row)
+            if len(batch) >= self.chunk_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def stream(self, dataset, fmt, start, end):
+        """Генератор байтовых фрагментов файла выгрузки"""
+        self.validate(dataset, fmt)
+        if fmt == 'parquet':
+            return self._stream_parquet(dataset, start, end)
+        return self._stream_csv(dataset, start, end)
+
+    def _stream_csv(self, dataset, start, end):
+        _, fields = self.DATASETS[dataset]
+        buffer = _StreamBuffer()
+        # BOM, чтобы Excel правильно определил кодировку кириллицы
+        buffer.write('\ufeff')
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+        yield buffer.drain()
+        rows = 0
+        for batch in self.iter_batches(dataset, start, end):
+            writer.writerows(
+                [value.isoformat() if isinstance(value, datetime) else value for value in row]
+                for row in batch
+            )
+            rows += len(batch)
+            yield buffer.drain()
+        logger.info(f"Экспорт {dataset} в CSV завершён: {rows} строк")
+
+    def _stream_parquet(self, dataset, start, end):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        model, fields = self.DATASETS[dataset]
+        schema = pa.schema([self._arrow_field(pa, model, name) for name in fields])
+        buffer = _StreamBuffer()
+        rows = 0
+        # Одна порция строк — одна группа строк Parquet
+        with pq.ParquetWriter(buffer, schema, compression='snappy') as writer:
+            for batch in self.iter_batches(dataset, start, end):
+                columns = list(zip(*batch))
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(column, type=schema.field(i).type) for i, column in enumerate(columns)],
+                    schema=schema,
+                ))
+                rows += len(batch)
+                yield buffer.drain()
+        yield buffer.drain()
+        logger.info(f"Экспорт {dataset} в Parquet завершён: {rows} строк")
+
+    @staticmethod
+    def _arrow_field(pa, model, name):
+        field = model._meta.get_field(name)
+        internal_type = field.get_internal_type()
+        if internal_type == 'DateTimeField':
+            arrow_type = pa.timestamp('us', tz='UTC')
+        elif internal_type in ('AutoField', 'BigAutoField', 'IntegerField'):
+            arrow_type = pa.int64()
+        elif internal_type == 'FloatField':
+            arrow_type = pa.float64()
+        elif internal_type == 'BooleanField':
+            arrow_type = pa.bool_()
+        else:
+            arrow_type = pa.string()
+        return pa.field(name, arrow_type, nullable=True)
+
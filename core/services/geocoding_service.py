@@ -3,6 +3,7 @@ import random
 import requests
 from abc import ABC, abstractmethod
 from django.conf import settings
+from . import provider_http
 
 class BaseGeocodingService(ABC):
     @abstractmethod
@@ -63,7 +64,7 @@ class TomTomGeocodingService(BaseGeocodingService):
     
     def __init__(self, api_key):
         self.api_key = api_key
-        self.base_url = "https://api.tomtom.com/search/2/search"
+        self.base_url = f"{getattr(settings, 'TOMTOM_API_URL', 'https://api.tomtom.com').rstrip('/')}/search/2/search"
     
     def geocode(self, query: str):
         try:
@@ -77,7 +78,7 @@ class TomTomGeocodingService(BaseGeocodingService):
                 'lon': 60.5975,
             }
             
-            response = requests.get(f"{self.base_url}/{query}.json", params=params)
+            response = provider_http.get('tomtom_search', f"{self.base_url}/{query}.json", params=params, timeout=15)
             response.raise_for_status()
             
             data = response.json()
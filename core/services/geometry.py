@@ -0,0 +1,577 @@
+"""
+Разбор WKT-геометрии маршрутов 2GIS в массивы NumPy.
+
+    lines = parse_wkt_lines("MULTILINESTRING((60.57 56.85, 60.58 56.86), (60.59 56.87, 60.60 56.88))")
+    points = parse_wkt_points("LINESTRING(60.572251 56.851534, 60.572335 56.851504)")
+
+Координаты возвращаются массивами формы (n, 2) float64 в порядке [lat, lon]
+(в WKT — lon lat), как их ждёт Leaflet. Числа всего WKT переводятся в
+float одним вызовом np.fromstring после замены скобок и запятых на
+пробелы — без регулярного выражения и цикла Python по точкам. Результат
+совпадает с float() для каждого числа. Z и M отбрасываются.
+
+Уровни детализации маршрутов (LOD): линии упрощаются алгоритмом
+Дугласа–Пекера с допуском ROUTE_LOD_TOLERANCE_PX пикселей на масштабах
+ROUTE_LOD_ZOOMS и хранятся рядом с полной геометрией маршрута
+(services/route_model.py):
+
+    route.lines  — полная геометрия [массив (n, 2), ...]
+    route.lod    — {'13': линии для масштаба 13, ...}
+
+В словаре маршрута (кэш, страница) это coordinates и coordinates_lod.
+
+Упрощение выполняется один раз для всех уровней: проход Дугласа–Пекера с
+нулевым допуском даёт каждой точке «важность», и уровень — это точки с
+важностью больше допуска уровня. На страницу уходит уровень, достаточный
+для масштаба, в который карта впишет маршрут (route_for_map).
+
+Компактное хранение и передача (ROUTE_GEOMETRY_ENCODING='polyline'):
+линии кодируются алгоритмом Google Encoded Polyline с точностью
+ROUTE_GEOMETRY_PRECISION знаков (6 — как у WKT 2GIS, ~4–6 байт на точку
+вместо ~40 в JSON). pack_route заменяет в словаре маршрута coordinates и
+coordinates_lod на
+
+    route['geometry'] = {'encoding': 'polyline', 'precision': 6,
+                         'lines': ['...', ...], 'lod': {'13': ['...'], ...}}
+
+unpack_route возвращает исходный вид. В браузере линии раскодирует
+static/js/polyline.js.
+
+Маршруты общественного транспорта состоят из участков (движений 2GIS):
+route.parts — число точек каждого участка в единой линии.
+Уровни детализации такого маршрута строятся по участкам (и запоминаются
+по содержимому участка в памяти процесса), а в кэше участки хранятся
+один раз в общем хранилище (services/geometry_store.py) — одинаковый
+отрезок трамвая между двумя остановками разные маршруты не дублируют.
+
+NumPy импортируется внутри функций: модуль загружается при старте воркера
+(через views), а библиотека — только с первым разбором геометрии
+(см. HEAVY_MODULES в benchmark_startup).
+"""
+from __future__ import annotations
+
+import hashlib
+import math
+import re
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+if TYPE_CHECKING:
+    import numpy as np
+
+_HEADER_RE = re.compile(r'\s*(MULTILINESTRING|LINESTRING)\s*(?:ZM|Z|M)?\s*', re.IGNORECASE)
+_SEPARATORS = str.maketrans('(),', '   ')
+# Граница частей MULTILINESTRING; WKT допускает пробелы вокруг запятой
+_PART_SEPARATOR_RE = re.compile(r'\)\s*,\s*\(')
+
+# Метров в пикселе на экваторе при масштабе 0 (тайлы 256 px, Web Mercator)
+EQUATOR_METERS_PER_PIXEL = 156543.03392
+MAX_ZOOM = 18
+METERS_PER_DEGREE_LAT = 110540.0
+METERS_PER_DEGREE_LON = 111320.0
+# Допуски меньше сантиметра не имеют смысла для карты
+MIN_TOLERANCE_M = 0.01
+# Участки короче этого числа точек обходятся без NumPy
+SHORT_SEGMENT = 32
+
+GEOMETRY_ENCODINGS = ('json', 'polyline')
+# Значение координаты кодируется группами по 5 бит, не больше 7 групп на число
+MAX_CHUNKS = 7
+
+
+class Memo:
+    """Словарь ограниченного размера: при переполнении вытесняется давно не использованное"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._items = OrderedDict()
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+# Уровни детализации участков по хэшу их точек (общие для всех запросов процесса)
+_PART_LEVELS = Memo(getattr(settings, 'ROUTE_PART_LEVELS_MEMO_SIZE', 2048))
+
+
+class WKTError(ValueError):
+    """Строка не является корректным WKT LINESTRING/MULTILINESTRING"""
+
+
+class PolylineError(ValueError):
+    """Строка не является корректной закодированной линией"""
+
+
+def parse_wkt_lines(wkt: str) -> List[np.ndarray]:
+    """Линии геометрии: одна для LINESTRING, по одной на часть MULTILINESTRING"""
+    import numpy as np
+    match = _HEADER_RE.match(wkt)
+    if match is None:
+        raise WKTError(f"Неподдерживаемая геометрия: {wkt[:40]}")
+    body = wkt[match.end():].rstrip()
+    if body.upper() == 'EMPTY':
+        return []
+    multi = match.group(1).upper() == 'MULTILINESTRING'
+    if not body.startswith('((' if multi else '(') or not body.endswith('))' if multi else ')'):
+        raise WKTError(f"Нет скобок вокруг координат: {wkt[:40]}")
+
+    first_point = body[:body.find(',')] if ',' in body else body
+    dims = len(first_point.translate(_SEPARATORS).split())
+    if dims not in (2, 3, 4):
+        raise WKTError(f"Неверное число координат точки ({dims}): {first_point.strip('( ')}")
+
+    try:
+        values = np.fromstring(body.translate(_SEPARATORS), sep=' ')
+    except (ValueError, DeprecationWarning) as e:
+        # Нечисловой токен: NumPy 1.x предупреждает и обрезает результат (это
+        # ловит проверка размера ниже), будущие версии выбрасывают ValueError
+        raise WKTError(f"Некорректные числа в WKT: {e}")
+    point_count = body.count(',') + 1
+    if values.size != point_count * dims:
+        raise WKTError(f"Разобрано {values.size} чисел вместо {point_count * dims}: {wkt[:40]}")
+    # [lon, lat, ...] -> [lat, lon]
+    points = values.reshape(point_count, dims)[:, 1::-1]
+
+    if not multi:
+        return [points]
+    sizes = [part.count(',') + 1 for part in _PART_SEPARATOR_RE.split(body)]
+    return np.split(points, np.cumsum(sizes[:-1]))
+
+
+def parse_wkt_points(wkt: str) -> np.ndarray:
+    """Все точки геометрии подряд (части MULTILINESTRING одна за другой)"""
+    import numpy as np
+    lines = parse_wkt_lines(wkt)
+    if not lines:
+        return np.empty((0, 2))
+    if len(lines) == 1:
+        return lines[0]
+    return np.concatenate(lines)
+
+
+def simplification_importance(points: np.ndarray, floor: float = 0.0) -> np.ndarray:
+    """
+    Важность точек линии [lat, lon] в метрах для Дугласа–Пекера: точка
+    остаётся при допуске t, если её важность больше t. Концы линии — inf.
+    Участки, где все точки не важнее floor, не делятся дальше: результат
+    точен для любого допуска не меньше floor.
+    """
+    import numpy as np
+    count = len(points)
+    importance = np.full(count, np.inf)
+    if count < 3:
+        return importance
+    # Локальная равнопромежуточная проекция: для маршрута по городу погрешность мала
+    scale_lon = METERS_PER_DEGREE_LON * math.cos(math.radians(float(points[:, 0].mean())))
+    xy = np.column_stack((points[:, 1] * scale_lon, points[:, 0] * METERS_PER_DEGREE_LAT))
+    xs, ys = xy[:, 0].tolist(), xy[:, 1].tolist()
+
+    stack = [(0, count - 1, np.inf)]
+    while stack:
+        first, last, parent = stack.pop()
+        if last - first < 2:
+            continue
+        if last - first <= SHORT_SEGMENT:
+            index, distance_sq = _farthest_short(xs, ys, first, last)
+        else:
+            index, distance_sq = _farthest(xy, first, last)
+        # Точка не важнее той, что разделила её отрезок: уровни вложены друг в друга
+        value = min(math.sqrt(distance_sq), parent)
+        if value <= max(floor, MIN_TOLERANCE_M):
+            # Дальнейшее деление не нужно ни одному уровню
+            importance[first + 1:last] = value
+            continue
+        split = first + 1 + index
+        importance[split] = value
+        stack.append((first, split, value))
+        stack.append((split, last, value))
+    return importance
+
+
+def _farthest(xy, first, last):
+    """Самая удалённая от отрезка first–last внутренняя точка (NumPy): (смещение, квадрат расстояния)"""
+    import numpy as np
+    start = xy[first]
+    direction = xy[last] - start
+    offsets = xy[first + 1:last] - start
+    length_sq = direction @ direction
+    if length_sq > 0:
+        # Расстояние до отрезка, а не до прямой: петли и развороты не теряются
+        t = offsets @ direction
+        t /= length_sq
+        np.maximum(t, 0.0, out=t)
+        np.minimum(t, 1.0, out=t)
+        offsets -= t[:, None] * direction
+    distances_sq = np.einsum('ij,ij->i', offsets, offsets)
+    index = int(distances_sq.argmax())
+    return index, float(distances_sq[index])
+
+
+def _farthest_short(xs, ys, first, last):
+    """То же для коротких участков: на десятке точек вызовы NumPy дороже самих вычислений"""
+    x0, y0 = xs[first], ys[first]
+    dx, dy = xs[last] - x0, ys[last] - y0
+    length_sq = dx * dx + dy * dy
+    best, best_sq = 0, -1.0
+    for i in range(first + 1, last):
+        px, py = xs[i] - x0, ys[i] - y0
+        if length_sq > 0:
+            t = min(max((px * dx + py * dy) / length_sq, 0.0), 1.0)
+            px, py = px - t * dx, py - t * dy
+        distance_sq = px * px + py * py
+        if distance_sq > best_sq:
+            best, best_sq = i - first - 1, distance_sq
+    return best, best_sq
+
+
+def simplify(points: np.ndarray, tolerance_m: float) -> np.ndarray:
+    """Дуглас–Пекер: точки линии [lat, lon], отстоящие от упрощённой больше чем на tolerance_m"""
+    import numpy as np
+    points = np.asarray(points, dtype=float)
+    return points[simplification_importance(points) > tolerance_m]
+
+
+def meters_per_pixel(zoom: float, lat: float) -> float:
+    return EQUATOR_METERS_PER_PIXEL * math.cos(math.radians(lat)) / 2 ** zoom
+
+
+def lod_zooms() -> Tuple[int, ...]:
+    return tuple(sorted(getattr(settings, 'ROUTE_LOD_ZOOMS', (11, 12, 13, 14, 15))))
+
+
+def build_levels(lines: Sequence, zooms: Optional[Sequence[int]] = None,
+                 tolerance_px: Optional[float] = None, arrays: bool = False) -> Dict[str, List]:
+    """Уровни детализации линий маршрута: {'масштаб': [линия, ...]} (массивами при arrays)"""
+    import numpy as np
+    zooms = lod_zooms() if zooms is None else zooms
+    if tolerance_px is None:
+        tolerance_px = getattr(settings, 'ROUTE_LOD_TOLERANCE_PX', 1.0)
+    lines = [np.asarray(line, dtype=float).reshape(-1, 2) for line in lines]
+    lines = [line for line in lines if len(line)]
+    if not lines:
+        return {}
+    lat = float(np.concatenate(lines)[:, 0].mean())
+    tolerances = {zoom: tolerance_px * meters_per_pixel(zoom, lat) for zoom in zooms}
+    floor = min(tolerances.values(), default=0.0)
+    importances = [simplification_importance(line, floor) for line in lines]
+    return {
+        str(zoom): [
+            line[importance > tolerance] if arrays else line[importance > tolerance].tolist()
+            for line, importance in zip(lines, importances)
+        ]
+        for zoom, tolerance in tolerances.items()
+    }
+
+
+def route_parts(route) -> Optional[List[int]]:
+    """Размеры участков единой линии маршрута (Route) или None, если маршрут не делится на участки"""
+    if not route.parts or len(route.lines) != 1 or sum(route.parts) != len(route.lines[0]):
+        return None
+    return route.parts
+
+
+def part_levels(points: np.ndarray) -> Dict[str, np.ndarray]:
+    """Уровни детализации одного участка; повторные участки берутся из памяти"""
+    import numpy as np
+    points = np.ascontiguousarray(points, dtype=float)
+    key = hashlib.blake2b(points.tobytes(), digest_size=16).digest()
+    levels = _PART_LEVELS.get(key)
+    if levels is None:
+        levels = {zoom: lines[0] for zoom, lines in build_levels([points], arrays=True).items()}
+        for level in levels.values():
+            level.flags.writeable = False
+        _PART_LEVELS.put(key, levels)
+    return levels
+
+
+def split_parts(route) -> List[Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+    """
+    Участки маршрута (Route) с parts: [(точки, {'масштаб': точки}), ...].
+    Уровни берутся из route.lod и route.lod_parts, если они уже посчитаны.
+    """
+    import numpy as np
+    parts = route_parts(route)
+    if parts is None:
+        return []
+    bounds = np.cumsum([0] + parts)
+    line = route.lines[0]
+    stored = {}
+    for zoom, sizes in route.lod_parts.items():
+        lines = route.lod.get(zoom) or []
+        if len(lines) == 1 and len(sizes) == len(parts) and sum(sizes) == len(lines[0]):
+            stored[zoom] = (lines[0], np.cumsum([0] + sizes))
+    if not stored or len(stored) != len(route.lod_parts):
+        return [(line[bounds[i]:bounds[i + 1]], part_levels(line[bounds[i]:bounds[i + 1]]))
+                for i in range(len(parts))]
+    return [
+        (line[bounds[i]:bounds[i + 1]],
+         {zoom: level[edges[i]:edges[i + 1]] for zoom, (level, edges) in stored.items()})
+        for i in range(len(parts))
+    ]
+
+
+def join_levels(parts: Sequence[Tuple[np.ndarray, Dict[str, np.ndarray]]]) -> Tuple[Dict, Dict]:
+    """Уровни участков: уровни единой линии ({'масштаб': [точки]}) и размеры участков на них"""
+    import numpy as np
+    zooms = set.intersection(*(set(levels) for _, levels in parts)) if parts else set()
+    lod, lod_parts = {}, {}
+    for zoom in sorted(zooms, key=int):
+        lod[zoom] = [np.concatenate([levels[zoom] for _, levels in parts])]
+        lod_parts[zoom] = [len(levels[zoom]) for _, levels in parts]
+    return lod, lod_parts
+
+
+def join_parts(parts: Sequence[Tuple[np.ndarray, Dict[str, np.ndarray]]]) -> Dict:
+    """
+    Обратное к split_parts: поля словаря маршрута (coordinates, coordinate_parts,
+    coordinates_lod, coordinate_parts_lod) с линиями-массивами
+    """
+    import numpy as np
+    lod, lod_parts = join_levels(parts)
+    return {
+        'coordinates': [np.concatenate([points for points, _ in parts])] if parts else [],
+        'coordinate_parts': [len(points) for points, _ in parts],
+        'coordinates_lod': lod,
+        'coordinate_parts_lod': lod_parts,
+    }
+
+
+def add_levels_of_detail(route_data: Dict) -> Dict:
+    """Дописывает уровни детализации маршрутам (Route) ответа провайдера ({'result': [...]}), где их нет"""
+    for route in route_data.get('result', []) if isinstance(route_data, dict) else []:
+        add_route_levels(route)
+    return route_data
+
+
+def add_route_levels(route):
+    """Уровни детализации одного маршрута (Route), если их ещё нет"""
+    if not route.lines or route.lod:
+        return route
+    if route_parts(route):
+        route.lod, route.lod_parts = join_levels(split_parts(route))
+    else:
+        route.lod = build_levels(route.lines, arrays=True)
+    return route
+
+
+def fit_zoom(lines: Sequence, viewport: Optional[Tuple[int, int]] = None, padding: int = 50) -> int:
+    """
+    Масштаб, в который карта впишет линии (как fitBounds с padding в
+    script.js) при размере карты viewport (ширина, высота) в пикселях
+    """
+    import numpy as np
+    width, height = viewport or getattr(settings, 'MAP_VIEWPORT_PX', (800, 500))
+    points = np.concatenate([np.asarray(line, dtype=float).reshape(-1, 2) for line in lines])
+    lat = np.radians(np.clip(points[:, 0], -85.0, 85.0))
+    x = points[:, 1] / 360.0
+    y = np.log(np.tan(lat) + 1 / np.cos(lat)) / (2 * math.pi)
+    span_x, span_y = float(np.ptp(x)) * 256, float(np.ptp(y)) * 256
+    zooms = [MAX_ZOOM]
+    if span_x > 0:
+        zooms.append(math.log2(max(width - 2 * padding, 1) / span_x))
+    if span_y > 0:
+        zooms.append(math.log2(max(height - 2 * padding, 1) / span_y))
+    return max(0, min(MAX_ZOOM, math.floor(min(zooms))))
+
+
+def map_geometry(route, viewport: Optional[Tuple[int, int]] = None) -> Dict:
+    """
+    Геометрия маршрута (Route) для карты: coordinates — наименее подробный
+    уровень, достаточный для начального масштаба (coordinates_zoom; None —
+    полная геометрия). Остальные уровни клиенту не отправляются.
+    """
+    lines = route.lines
+    if not lines or not any(len(line) for line in lines):
+        return {'coordinates': lines, 'coordinates_zoom': None}
+    levels = route.lod or build_levels(lines, arrays=True)
+    zoom = fit_zoom(lines, viewport)
+    suitable = [int(level) for level in levels if int(level) >= zoom]
+    if not suitable:
+        return {'coordinates': lines, 'coordinates_zoom': None}
+    level = min(suitable)
+    return {'coordinates': levels[str(level)], 'coordinates_zoom': level}
+
+
+def route_for_map(route, viewport: Optional[Tuple[int, int]] = None) -> Dict:
+    """Словарь маршрута (Route) для страницы: поля маршрута и map_geometry"""
+    data = route.to_dict(geometry=False)
+    data.update(map_geometry(route, viewport))
+    return data
+
+
+def encode_polyline(points, precision: int = 6) -> str:
+    """Линия [[lat, lon], ...] в строку Google Encoded Polyline с precision знаками"""
+    return encode_polylines([points], precision)[0]
+
+
+def encode_polylines(lines: Sequence, precision: int = 6) -> List[str]:
+    """encode_polyline для многих линий одним проходом NumPy (короткие участки маршрутов)"""
+    import numpy as np
+    arrays = [np.asarray(line, dtype=float).reshape(-1, 2) for line in lines]
+    counts = np.array([len(array) for array in arrays], dtype=np.int64)
+    if not counts.sum():
+        return [''] * len(arrays)
+    scaled = np.round(np.concatenate(arrays) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    # Каждая линия начинается с абсолютной точки
+    firsts = np.cumsum(counts) - counts
+    firsts = firsts[counts > 0]
+    deltas[firsts] = scaled[firsts]
+    deltas = deltas.ravel()
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    chunk_shifts = np.arange(MAX_CHUNKS, dtype=np.int64) * 5
+    groups = values[:, None] >> chunk_shifts
+    chunk_count = 1 + np.count_nonzero(groups[:, 1:], axis=1)
+    chunks = groups & 31
+    # Бит продолжения 0x20 у всех групп числа, кроме последней
+    chunks[chunk_shifts[None, :] < (chunk_count[:, None] - 1) * 5] |= 0x20
+    chunks += 63
+    used = chunk_shifts[None, :] < chunk_count[:, None] * 5
+    text = chunks[used].astype(np.uint8).tobytes().decode('ascii')
+    # Границы строк линий: символы каждой точки — сумма групп двух её чисел
+    char_ends = np.cumsum(chunk_count.reshape(-1, 2).sum(axis=1)).tolist()
+    result, offset = [], 0
+    for count, last in zip(counts.tolist(), (np.cumsum(counts) - 1).tolist()):
+        end = char_ends[last] if count else offset
+        result.append(text[offset:end])
+        offset = end
+    return result
+
+
+def decode_polyline(encoded: str, precision: int = 6) -> np.ndarray:
+    """Строка Google Encoded Polyline в массив (n, 2) [lat, lon]"""
+    return decode_polylines([encoded], precision)[0]
+
+
+def decode_polylines(encoded_lines: Sequence[str], precision: int = 6) -> List[np.ndarray]:
+    """decode_polyline для многих строк одним проходом NumPy"""
+    import numpy as np
+    lengths = np.array([len(encoded) for encoded in encoded_lines], dtype=np.int64)
+    joined = ''.join(encoded_lines)
+    if not joined:
+        return [np.empty((0, 2)) for _ in encoded_lines]
+    try:
+        data = np.frombuffer(joined.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    except UnicodeEncodeError:
+        raise PolylineError("Недопустимые символы в закодированной линии")
+    if data.min() < 0 or data.max() > 63:
+        raise PolylineError("Недопустимые символы в закодированной линии")
+    is_end = (data & 0x20) == 0
+    # Числа в каждой строке: строка должна заканчиваться последней группой числа и нести пары
+    ended = np.concatenate(([0], np.cumsum(is_end)))
+    bounds = np.cumsum(lengths)
+    values_per_line = ended[bounds] - ended[bounds - lengths]
+    if not is_end[bounds[lengths > 0] - 1].all() or (values_per_line % 2).any():
+        raise PolylineError("Закодированная линия обрезана")
+    ends = np.flatnonzero(is_end)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    positions = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    values = np.add.reduceat((data & 31) << (positions * 5), starts)
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+    points = np.cumsum(deltas.reshape(-1, 2), axis=0)
+    # Каждая строка начинается с абсолютной точки: вычитается сумма предыдущих строк
+    point_counts = values_per_line // 2
+    point_bounds = np.cumsum(point_counts)
+    firsts = point_bounds - point_counts
+    offsets = np.zeros((len(point_counts), 2), dtype=np.int64)
+    offsets[firsts > 0] = points[firsts[firsts > 0] - 1]
+    points -= np.repeat(offsets, point_counts, axis=0)
+    return np.split(points / 10 ** precision, point_bounds[:-1])
+
+
+def geometry_encoding() -> str:
+    value = getattr(settings, 'ROUTE_GEOMETRY_ENCODING', 'polyline')
+    if value not in GEOMETRY_ENCODINGS:
+        raise ValueError(f"ROUTE_GEOMETRY_ENCODING должен быть одним из {', '.join(GEOMETRY_ENCODINGS)}")
+    return value
+
+
+def _with_lists(route: Dict) -> Dict:
+    """Словарь маршрута с линиями-списками вместо массивов NumPy (для JSON)"""
+    import numpy as np
+    lines = route.get('coordinates') or []
+    lod = route.get('coordinates_lod') or {}
+    if not any(isinstance(line, np.ndarray) for line in [*lines, *(line for level in lod.values() for line in level)]):
+        return route
+    route = dict(route, coordinates=[np.asarray(line).tolist() for line in lines])
+    if lod:
+        route['coordinates_lod'] = {zoom: [np.asarray(line).tolist() for line in level] for zoom, level in lod.items()}
+    return route
+
+
+def pack_route(route: Dict, levels: bool = True) -> Dict:
+    """
+    Копия словаря маршрута с линиями (и уровнями детализации, если levels) в
+    виде закодированных строк. При ROUTE_GEOMETRY_ENCODING='json' — без
+    изменений (массивы NumPy заменяются списками).
+    """
+    if geometry_encoding() != 'polyline' or not route.get('coordinates') or 'geometry' in route:
+        return _with_lists(route)
+    precision = getattr(settings, 'ROUTE_GEOMETRY_PRECISION', 6)
+    route = dict(route)
+    lines = route.pop('coordinates')
+    lod = route.pop('coordinates_lod', None)
+    if not levels:
+        lod = None
+    encoded = iter(encode_polylines(
+        list(lines) + [line for level in (lod or {}).values() for line in level], precision
+    ))
+    packed = {
+        'encoding': 'polyline',
+        'precision': precision,
+        'lines': [next(encoded) for _ in lines],
+    }
+    if lod:
+        packed['lod'] = {zoom: [next(encoded) for _ in level] for zoom, level in lod.items()}
+    route['geometry'] = packed
+    return route
+
+
+def unpack_route(route: Dict, arrays: bool = False) -> Dict:
+    """Обратное к pack_route: coordinates (и coordinates_lod) списками [lat, lon] или массивами"""
+    packed = route.get('geometry')
+    if not isinstance(packed, dict) or packed.get('encoding') != 'polyline':
+        return route
+    lod = packed.get('lod', {})
+    decoded = iter(decode_polylines(
+        packed['lines'] + [line for level in lod.values() for line in level], packed.get('precision', 6)
+    ))
+    route = dict(route)
+    del route['geometry']
+    convert = (lambda line: line) if arrays else (lambda line: line.tolist())
+    route['coordinates'] = [convert(next(decoded)) for _ in packed['lines']]
+    if 'lod' in packed:
+        route['coordinates_lod'] = {zoom: [convert(next(decoded)) for _ in level] for zoom, level in lod.items()}
+    return route
+
+
+def pack_route_data(route_data: Dict) -> Dict:
+    """pack_route для всех маршрутов ответа провайдера ({'result': [...]})"""
+    if not isinstance(route_data, dict) or 'result' not in route_data:
+        return route_data
+    return dict(route_data, result=[pack_route(route) for route in route_data['result']])
+
+
+def unpack_route_data(route_data: Dict, arrays: bool = False) -> Dict:
+    if not isinstance(route_data, dict) or 'result' not in route_data:
+        return route_data
+    return dict(route_data, result=[unpack_route(route, arrays) for route in route_data['result']])
+
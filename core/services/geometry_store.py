@@ -0,0 +1,134 @@
+"""
+Общее хранилище геометрии участков маршрутов общественного транспорта.
+
+Разные варианты одного ответа 2GIS и соседние поиски проезжают одни и те же
+отрезки (трамвай между двумя остановками). Вместо копии геометрии в каждой
+записи CachedRoute участок (движение 2GIS, route.parts) хранится один раз
+в RouteGeometry, а маршрут в кэше ссылается на него:
+
+    route['geometry'] = {'encoding': 'polyline', 'precision': 6,
+                         'parts': ['ключ участка', ...]}
+
+Ключ — хэш закодированной линии участка и его уровней детализации, поэтому
+одинаковые участки совпадают независимо от маршрута, в который входят.
+Ссылки разрешаются при чтении из кэша одним запросом на все маршруты ответа.
+
+Записи живут, пока на них могут ссылаться действующие записи кэша: каждое
+сохранение маршрута обновляет last_used_at его участков, purge_unused
+удаляет участки, не использованные дольше срока жизни записи кэша
+(CachedRoute.ttl(), ROUTE_CACHE_TTL_MINUTES).
+ROUTE_GEOMETRY_SHARED=False хранит геометрию внутри записей, как раньше.
+"""
+import hashlib
+import json
+import logging
+from typing import Dict, Iterable, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from core.models import CachedRoute, RouteGeometry
+from . import geometry, route_model
+
+logger = logging.getLogger(__name__)
+
+
+def enabled() -> bool:
+    return getattr(settings, 'ROUTE_GEOMETRY_SHARED', True) and geometry.geometry_encoding() == 'polyline'
+
+
+def part_key(precision: int, line: str, lod: Dict[str, str]) -> str:
+    payload = json.dumps([precision, line, lod], sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(payload.encode('ascii'), digest_size=16).hexdigest()
+
+
+def pack_route_data(route_data: Dict) -> Dict:
+    """
+    Ответ провайдера ({'result': [Route, ...]}) для записи в кэш: участки
+    маршрутов сохраняются в RouteGeometry, маршруты получают ссылки на них.
+    Маршруты без участков кодируются geometry.pack_route.
+    """
+    if not enabled() or not isinstance(route_data, dict) or 'result' not in route_data:
+        return geometry.pack_route_data(route_model.dump_route_data(route_data, arrays=True))
+    precision = getattr(settings, 'ROUTE_GEOMETRY_PRECISION', 6)
+    routes = [(route, geometry.split_parts(route)) for route in route_data['result']]
+    # Все линии и уровни участков ответа кодируются одним вызовом
+    lines = [
+        array
+        for _, parts in routes
+        for points, levels in parts
+        for array in [points, *levels.values()]
+    ]
+    encoded = iter(geometry.encode_polylines(lines, precision))
+    rows = {}
+    result = []
+    for route, parts in routes:
+        if not parts:
+            result.append(geometry.pack_route(route.to_dict(arrays=True)))
+            continue
+        keys = []
+        for points, levels in parts:
+            line = next(encoded)
+            lod = {zoom: next(encoded) for zoom in levels}
+            key = part_key(precision, line, lod)
+            if key not in rows:
+                rows[key] = RouteGeometry(key=key, precision=precision, points=len(points), line=line, lod=lod)
+            keys.append(key)
+        packed = route.to_dict(geometry=False)
+        packed['geometry'] = {'encoding': 'polyline', 'precision': precision, 'parts': keys}
+        result.append(packed)
+    if rows:
+        save_parts(rows.values())
+    return dict(route_data, result=result)
+
+
+def save_parts(rows: Iterable[RouteGeometry]):
+    """Добавляет новые участки и продлевает жизнь уже сохранённых (два запроса)"""
+    rows = list(rows)
+    RouteGeometry.objects.bulk_create(rows, ignore_conflicts=True)
+    RouteGeometry.objects.filter(key__in=[row.key for row in rows]).update(last_used_at=timezone.now())
+
+
+def unpack_route_data(route_data: Dict) -> Optional[Dict]:
+    """
+    Обратное к pack_route_data: словари маршрутов с линиями-массивами (для
+    Route.from_dict). None, если часть участков уже удалена — запись кэша
+    тогда считается промахом.
+    """
+    if not isinstance(route_data, dict) or 'result' not in route_data:
+        return route_data
+    keys = {
+        key
+        for route in route_data['result']
+        for key in (route.get('geometry') or {}).get('parts', ())
+    }
+    parts = {}
+    if keys:
+        rows = list(RouteGeometry.objects.filter(key__in=keys).values_list('key', 'precision', 'line', 'lod'))
+        if len(rows) != len(keys):
+            logger.info(f"В кэше маршрута нет {len(keys) - len(rows)} участков геометрии")
+            return None
+        # Линии всех участков с одной точностью раскодируются одним вызовом
+        for precision in {row[1] for row in rows}:
+            group = [row for row in rows if row[1] == precision]
+            decoded = iter(geometry.decode_polylines(
+                [text for _, _, line, lod in group for text in [line, *lod.values()]], precision
+            ))
+            for key, _, _, lod in group:
+                parts[key] = (next(decoded), {zoom: next(decoded) for zoom in lod})
+    result = []
+    for route in route_data['result']:
+        packed = route.get('geometry')
+        if isinstance(packed, dict) and 'parts' in packed:
+            route = {name: value for name, value in route.items() if name != 'geometry'}
+            route.update(geometry.join_parts([parts[key] for key in packed['parts']]))
+            result.append(route)
+        else:
+            result.append(geometry.unpack_route(route, arrays=True))
+    return dict(route_data, result=result)
+
+
+def purge_unused(now=None) -> int:
+    """Удаляет участки, на которые не может ссылаться ни одна действующая запись кэша"""
+    now = now or timezone.now()
+    return RouteGeometry.objects.filter(last_used_at__lt=now - CachedRoute.ttl()).delete()[0]
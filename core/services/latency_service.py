@@ -0,0 +1,240 @@
+import logging
+import math
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from core.models import AnalyticsRollup, ApiLatencyRollup, ApiLog
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class LatencyHistogram:
+    """
+    Мёржируемая гистограмма времени ответа с логарифмическими корзинами.
+
+    Граница корзины i — MIN_VALUE * GROWTH**i, поэтому относительная ошибка
+    квантиля не превышает ~1% при любом масштабе значений. Гистограммы за
+    разные часы и провайдеров складываются покорзинно без потери точности.
+    """
+
+    MIN_VALUE = 0.1  # мс
+    GROWTH = 1.02
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def bucket_index(cls, value):
+        if value <= cls.MIN_VALUE:
+            return 0
+        return int(math.log(value / cls.MIN_VALUE, cls.GROWTH))
+
+    @classmethod
+    def bucket_value(cls, index):
+        """Представитель корзины — её геометрическая середина"""
+        return cls.MIN_VALUE * cls.GROWTH ** (index + 0.5)
+
+    def add(self, value, count=1):
+        index = self.bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        if other.max is not None:
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        target = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= target:
+                return min(max(self.bucket_value(index), self.min), self.max)
+        return self.max
+
+    def summary(self, quantiles=DEFAULT_QUANTILES):
+        result = {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+        }
+        for q in quantiles:
+            result[f"p{round(q * 100):g}"] = self.percentile(q)
+        return result
+
+    def to_dict(self):
+        return {
+            'b': {str(index): count for index, count in self.buckets.items()},
+            'n': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        if data:
+            histogram.buckets = {int(index): count for index, count in data.get('b', {}).items()}
+            histogram.count = data.get('n', 0)
+            histogram.total = data.get('sum', 0.0)
+            histogram.min = data.get('min')
+            histogram.max = data.get('max')
+        return histogram
+
+
+class LatencyService:
+    """
+    Почасовые гистограммы по провайдерам и запросы квантилей за период.
+
+    Гистограммы строятся из ApiLog при чтении, а не при каждой записи лога:
+    закрытые часы сворачиваются один раз и хранятся в ApiLatencyRollup,
+    часы после последнего свёрнутого считаются по ApiLog на лету тем же
+    проходом, который их сворачивает. История до начала запрошенного
+    интервала сворачивается только командой rebuild_latency_histograms и
+    страницами персонала (hourly с backfill).
+    """
+
+    # Час считается закрытым с запасом: лог, начатый в конце часа, мог ещё не сохраниться
+    CLOSE_DELAY = timedelta(minutes=1)
+
+    @staticmethod
+    def truncate_hour(timestamp):
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+
+    def open_hour(self, now=None):
+        """Начало первого часа, который ещё не сворачивается в ApiLatencyRollup"""
+        return self.truncate_hour((now or timezone.now()) - self.CLOSE_DELAY)
+
+    def from_logs(self, start, end, provider=None):
+        """
+        {(провайдер, час): гистограмма} по ApiLog за [start, end) без ответов
+        из кэша; start=None — с первого лога
+        """
+        logs = ApiLog.objects.filter(timestamp__lt=end, was_cached=False)
+        if start is not None:
+            logs = logs.filter(timestamp__gte=start)
+        if provider:
+            logs = logs.filter(provider=provider)
+        histograms = {}
+        for provider_name, timestamp, value in logs.values_list(
+            'provider', 'timestamp', 'response_time_ms'
+        ).iterator(chunk_size=2000):
+            key = (provider_name, self.truncate_hour(timestamp))
+            histograms.setdefault(key, LatencyHistogram()).add(value)
+        return histograms
+
+    def _save(self, histograms):
+        ApiLatencyRollup.objects.bulk_create([
+            ApiLatencyRollup(provider=provider, hour=hour, histogram=histogram.to_dict())
+            for (provider, hour), histogram in histograms.items()
+        ], batch_size=500, update_conflicts=True, unique_fields=['provider', 'hour'], update_fields=['histogram'])
+
+    def rolled_up_until(self):
+        """Конец последнего свёрнутого часа; None, если свёрнутых часов нет"""
+        last = ApiLatencyRollup.objects.aggregate(last=Max('hour'))['last']
+        return last + timedelta(hours=1) if last is not None else None
+
+    def roll_up(self, since, now=None):
+        """
+        Гистограммы по ApiLog после since (конца свёрнутых часов) до now;
+        закрытые часы среди них сохраняются в ApiLatencyRollup. Повторный
+        или параллельный вызов записывает те же гистограммы.
+        """
+        now = now or timezone.now()
+        recent = self.from_logs(since, now)
+        open_hour = self.open_hour(now)
+        closed = {key: histogram for key, histogram in recent.items() if key[1] < open_hour}
+        if closed:
+            self._save(closed)
+        return recent
+
+    def hourly(self, start, end, provider=None, backfill=False):
+        """
+        (провайдер, час, гистограмма) за интервал [start, end) с точностью до
+        часа: свёрнутые часы из ApiLatencyRollup, остальные — одним проходом
+        по ApiLog. Закрывшиеся часы сворачиваются, только если проход
+        продолжает свёрнутые; иначе ApiLog читается с начала интервала без
+        записи — публичный api_status не должен запускать сворачивание
+        истории. backfill (страницы персонала) сворачивает все часы после
+        свёрнутых, а без них — с первого лога, как rebuild_latency_histograms.
+        """
+        start = self.truncate_hour(start)
+        rolled_end = self.rolled_up_until()
+        if rolled_end is not None and start < rolled_end:
+            rollups = ApiLatencyRollup.objects.filter(hour__gte=start, hour__lt=min(end, rolled_end))
+            if provider:
+                rollups = rollups.filter(provider=provider)
+            for provider_name, hour, data in rollups.values_list('provider', 'hour', 'histogram'):
+                yield provider_name, hour, LatencyHistogram.from_dict(data)
+        if rolled_end is not None and end <= rolled_end:
+            return
+        if backfill or (rolled_end is not None and rolled_end >= start):
+            recent = self.roll_up(rolled_end)
+        else:
+            recent = self.from_logs(start, end, provider)
+        for (provider_name, hour), histogram in recent.items():
+            if start <= hour < end and provider in (None, provider_name):
+                yield provider_name, hour, histogram
+
+    def histograms(self, start, end, provider=None):
+        """Гистограммы по провайдерам, слитые за интервал [start, end) с точностью до часа"""
+        merged = {}
+        for provider_name, _, histogram in self.hourly(start, end, provider):
+            merged.setdefault(provider_name, LatencyHistogram()).merge(histogram)
+        return merged
+
+    def percentiles(self, start, end, provider=None, quantiles=DEFAULT_QUANTILES):
+        return {
+            provider_name: histogram.summary(quantiles)
+            for provider_name, histogram in self.histograms(start, end, provider).items()
+        }
+
+    def rebuild(self, start, end):
+        """
+        Пересобирает гистограммы закрытых часов за период из ApiLog (после
+        правки логов или изменения корзин). Границы периода расширяются до
+        целых часов. Дневные агрегаты задержек дашборда за эти дни
+        удаляются и пересчитываются при следующем чтении.
+        """
+        start = self.truncate_hour(start)
+        if self.truncate_hour(end) != end:
+            end = self.truncate_hour(end) + timedelta(hours=1)
+        end = min(end, self.open_hour())
+        # Часы между последним свёрнутым и началом периода иначе остались бы пропущенными
+        rolled_end = self.rolled_up_until()
+        if rolled_end is not None:
+            start = min(start, rolled_end)
+        if start >= end:
+            return 0
+        rebuilt = self.from_logs(start, end)
+        with transaction.atomic():
+            ApiLatencyRollup.objects.filter(hour__gte=start, hour__lt=end).delete()
+            self._save(rebuilt)
+            AnalyticsRollup.objects.filter(
+                kind='latency',
+                day__range=(timezone.localdate(start), timezone.localdate(end - timedelta(microseconds=1))),
+            ).delete()
+        return len(rebuilt)
@@ -0,0 +1,71 @@
+"""
+Подготовка маршрутов к показу.
+
+Всё, что зависит только от ответа провайдера и параметров, входящих в ключ
+кэша (режим передвижения, точки начала и конца), считается один раз перед
+записью в кэш (CachedRoutingService):
+
+    номер маршрута, режим, инструкции для авто из сегментов,
+    прямая между точками, если провайдер не вернул геометрию
+
+Попадание в кэш отдаёт уже подготовленные маршруты. Иконка и подписи —
+свойства Route (services/route_model.py) и отдельного этапа не требуют.
+
+Версия этапа хранится в route_data['presentation']. Если подготовка
+меняется, VERSION увеличивается: записи прежней версии готовятся заново
+при чтении из кэша (этап повторяем — уже готовые поля не пересчитываются).
+
+Поля конкретного запроса (filters_applied) сюда не входят: views добавляет
+их при сериализации, не копируя и не изменяя маршруты.
+"""
+from typing import Dict, Optional, Tuple
+
+from .route_model import Instruction
+
+VERSION = 1
+
+
+def is_prepared(route_data: Dict) -> bool:
+    return isinstance(route_data, dict) and route_data.get('presentation') == VERSION
+
+
+def prepare_route_data(route_data: Dict, start: Optional[Tuple[float, float]],
+                       end: Optional[Tuple[float, float]], travel_mode: Optional[str] = None) -> Dict:
+    """
+    Готовит маршруты (Route) ответа провайдера ({'result': [...]}) к показу.
+    travel_mode — режим запроса; None оставляет режим, указанный провайдером.
+    Без start и end маршрут без геометрии прямой не дополняется.
+    """
+    if not isinstance(route_data, dict) or 'result' not in route_data:
+        return route_data
+    for i, route in enumerate(route_data['result']):
+        prepare_route(route, i + 1, start, end, travel_mode)
+    route_data['presentation'] = VERSION
+    return route_data
+
+
+def prepare_route(route, number: int, start: Optional[Tuple[float, float]],
+                  end: Optional[Tuple[float, float]], travel_mode: Optional[str] = None):
+    """
+    Подготовка одного маршрута (Route) с номером number — для маршрутов,
+    отдаваемых по мере разбора до записи ответа в кэш
+    """
+    import numpy as np
+    if travel_mode:
+        route.travel_mode = travel_mode
+    route.number = number
+    if route.travel_mode == 'car' and not route.instructions:
+        route.instructions = [
+            Instruction(
+                step=seg_idx + 1,
+                action=segment.details.get('text', 'Продолжайте движение'),
+                direction=segment.details.get('direction', ''),
+                distance=segment.details.get('distance', ''),
+                time=f"{segment.time} мин",
+                extra={'street': segment.details.get('street', '')}
+            )
+            for seg_idx, segment in enumerate(route.segments)
+        ]
+    if not route.lines and start and end:
+        route.lines = [np.array([start, end], dtype=float)]
+    return route
@@ -0,0 +1,287 @@
+"""
+HTTP-запросы к внешним провайдерам (2GIS, TomTom) с записью и
+воспроизведением кассет.
+
+Режим задаётся PROVIDER_CASSETTE_MODE:
+- off — обычные запросы в сеть;
+- record — запросы идут в сеть, а пары запрос/ответ (и сетевые ошибки)
+  дописываются в <PROVIDER_CASSETTE_DIR>/<провайдер>.jsonl.gz. Ключи API
+  в кассету не попадают;
+- replay — сеть не используется: ответ берётся из кассеты и отдаётся с
+  исходной задержкой, умноженной на PROVIDER_CASSETTE_LATENCY_SCALE
+  (0 — без задержки). Десятичные числа (координаты) в URL, параметрах
+  и теле запроса сравниваются с допуском PROVIDER_CASSETTE_COORD_TOLERANCE
+  и выбирается ближайшая запись; всё остальное должно совпасть точно.
+  Если подходящей записи нет — CassetteMiss (сетевая ошибка для сервисов,
+  они переходят на свои фолбэки).
+"""
+import fcntl
+import gzip
+import ipaddress
+import json
+import logging
+import re
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from urllib.parse import parse_qsl, unquote, urlencode, urlsplit, urlunsplit
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+MODES = ('off', 'record', 'replay')
+SECRET_PARAMS = ('key',)
+RECORDED_HEADERS = ('Content-Type', 'Retry-After')
+
+_NUMBER_RE = re.compile(r'-?\d+\.\d+')
+# Параметр с ключом в строке запроса внутри текста (адрес в ошибке requests)
+_SECRET_QUERY_RE = re.compile(r'([?&])(?:%s)=[^&#\s\'"()]*(&?)' % '|'.join(SECRET_PARAMS))
+
+
+class CassetteMiss(requests.exceptions.ConnectionError):
+    """В кассете нет записи для запроса (режим replay)"""
+
+
+def mode():
+    value = getattr(settings, 'PROVIDER_CASSETTE_MODE', 'off') or 'off'
+    if value not in MODES:
+        raise ValueError(f"PROVIDER_CASSETTE_MODE должен быть одним из {', '.join(MODES)}")
+    return value
+
+
+def status():
+    """
+    Куда идут запросы к провайдерам: record/replay (кассеты), local (все
+    базовые адреса — локальный двойник, manage.py fake_providers) или live
+    """
+    current_mode = mode()
+    if current_mode != 'off':
+        return current_mode
+    urls = (
+        getattr(settings, 'TWOGIS_PUBLIC_TRANSPORT_URL', ''),
+        getattr(settings, 'TOMTOM_API_URL', ''),
+    )
+    return 'local' if all(_is_loopback(url) for url in urls) else 'live'
+
+
+def _is_loopback(url):
+    host = urlsplit(url).hostname or ''
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def cassette_dir():
+    return Path(getattr(settings, 'PROVIDER_CASSETTE_DIR', settings.BASE_DIR / 'cassettes'))
+
+
+def _public_params(params):
+    return {key: value for key, value in (params or {}).items() if key not in SECRET_PARAMS}
+
+
+def _public_url(url):
+    parts = urlsplit(url)
+    query = urlencode([(key, value) for key, value in parse_qsl(parts.query) if key not in SECRET_PARAMS])
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, query, ''))
+
+
+def _public_message(message, params=None):
+    """Текст ошибки requests без ключей API: в нём бывает адрес запроса со строкой параметров"""
+    # Как в _public_url: параметр удаляется, соседние остаются
+    message = _SECRET_QUERY_RE.sub(
+        lambda match: match.group(2) if match.group(1) == '&' else match.group(1) * bool(match.group(2)), message
+    )
+    for key in SECRET_PARAMS:
+        value = (params or {}).get(key)
+        if value:
+            message = message.replace(str(value), '***')
+    return message
+
+
+def _body_value(data):
+    """Тело запроса для кассеты: JSON как объект (порядок ключей не важен), иначе строка"""
+    if data is None:
+        return None
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    try:
+        return json.loads(data)
+    except ValueError:
+        return data
+
+
+def signature(method, url, params=None, body=None):
+    """
+    Шаблон запроса с десятичными числами, заменёнными на '#', и сами числа.
+    Хост не учитывается: кассету можно воспроизвести для другого base URL.
+    """
+    parts = urlsplit(url)
+    query = sorted(
+        [(key, str(value)) for key, value in parse_qsl(parts.query)] +
+        [(key, str(value)) for key, value in _public_params(params).items()]
+    )
+    query = [(key, value) for key, value in query if key not in SECRET_PARAMS]
+    body_text = json.dumps(body, sort_keys=True, ensure_ascii=False) if body is not None else ''
+    text = f"{method.upper()} {unquote(parts.path)}?{urlencode(query)} {body_text}"
+    numbers = tuple(float(number) for number in _NUMBER_RE.findall(text))
+    return _NUMBER_RE.sub('#', text), numbers
+
+
+class Cassette:
+    """Записи одного провайдера: gzip-файл, по члену gzip на запись"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = []
+        self._index = {}
+        self._mtime = None
+
+    def load(self):
+        """Перечитывает файл, если он изменился с прошлого чтения"""
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self.entries, self._index, self._mtime = [], {}, None
+            return self
+        if mtime == self._mtime:
+            return self
+        entries = []
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entries.append(json.loads(line))
+        index = {}
+        for entry in entries:
+            request = entry['request']
+            template, numbers = signature(request['method'], request['url'], request.get('params'), request.get('body'))
+            index.setdefault(template, []).append((numbers, entry))
+        self.entries, self._index, self._mtime = entries, index, mtime
+        return self
+
+    def find(self, method, url, params=None, body=None, tolerance=0.001):
+        """Запись с тем же шаблоном и ближайшими (в пределах tolerance) числами"""
+        template, numbers = signature(method, url, params, body)
+        best, best_distance = None, None
+        for candidate_numbers, entry in self._index.get(template, ()):
+            if len(candidate_numbers) != len(numbers):
+                continue
+            distance = max((abs(a - b) for a, b in zip(numbers, candidate_numbers)), default=0.0)
+            if distance <= tolerance and (best_distance is None or distance < best_distance):
+                best, best_distance = entry, distance
+        return best
+
+    def append(self, entry):
+        """Дописывает запись; flock — на случай нескольких воркеров gunicorn"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        line = (json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8')
+        with open(self.path, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(gzip.compress(line, mtime=0))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def cassette(provider, directory=None):
+    path = Path(directory or cassette_dir()) / f'{provider}.jsonl.gz'
+    with _cassettes_lock:
+        if path not in _cassettes:
+            _cassettes[path] = Cassette(path)
+        return _cassettes[path].load()
+
+
+def _replay(provider, method, url, params, body):
+    entry = cassette(provider).find(
+        method, url, params, body, tolerance=getattr(settings, 'PROVIDER_CASSETTE_COORD_TOLERANCE', 0.001)
+    )
+    if entry is None:
+        logger.warning(f"Кассета {provider}: нет записи для {method} {_public_url(url)}")
+        raise CassetteMiss(f"Нет записи в кассете {provider} для {method} {_public_url(url)}")
+
+    elapsed_ms = entry.get('elapsed_ms', 0)
+    scale = getattr(settings, 'PROVIDER_CASSETTE_LATENCY_SCALE', 1.0)
+    if scale > 0 and elapsed_ms:
+        time.sleep(elapsed_ms * scale / 1000)
+
+    recorded = entry['response']
+    if 'error' in recorded:
+        error_class = getattr(requests.exceptions, recorded['error'], requests.exceptions.RequestException)
+        raise error_class(f"{_public_message(recorded.get('message', ''))} (из кассеты)")
+    response = requests.Response()
+    response.status_code = recorded['status']
+    response.reason = recorded.get('reason', '')
+    response.headers = CaseInsensitiveDict(recorded.get('headers', {}))
+    response._content = recorded.get('body', '').encode('utf-8')
+    response.encoding = 'utf-8'
+    response.url = _public_url(url)
+    response.elapsed = timedelta(milliseconds=elapsed_ms)
+    return response
+
+
+def _record(provider, method, url, params, body, response, error, elapsed_ms):
+    if error is not None:
+        recorded = {'error': type(error).__name__, 'message': _public_message(str(error), params)[:500]}
+    else:
+        recorded = {
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {name: response.headers[name] for name in RECORDED_HEADERS if name in response.headers},
+            'body': response.text,
+        }
+    entry = {
+        'recorded_at': timezone.now().isoformat(),
+        'elapsed_ms': round(elapsed_ms, 1),
+        'request': {
+            'method': method,
+            'url': _public_url(url),
+            'params': _public_params(params),
+            'body': body,
+        },
+        'response': recorded,
+    }
+    try:
+        cassette(provider).append(entry)
+    except OSError as e:
+        logger.error(f"Не удалось записать кассету {provider}: {e}")
+
+
+def request(provider, method, url, params=None, data=None, headers=None, timeout=None):
+    """
+    requests.request с учётом режима кассет. provider — имя кассеты
+    (2gis_public_transport, tomtom_routing, tomtom_search).
+    """
+    current_mode = mode()
+    body = _body_value(data)
+    if current_mode == 'replay':
+        return _replay(provider, method, url, params, body)
+
+    start = time.perf_counter()
+    try:
+        response = requests.request(method, url, params=params, data=data, headers=headers, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        if current_mode == 'record':
+            _record(provider, method, url, params, body, None, e, (time.perf_counter() - start) * 1000)
+        raise
+    if current_mode == 'record':
+        _record(provider, method, url, params, body, response, None, (time.perf_counter() - start) * 1000)
+    return response
+
+
+def get(provider, url, params=None, **kwargs):
+    return request(provider, 'GET', url, params=params, **kwargs)
+
+
+def post(provider, url, params=None, data=None, **kwargs):
+    return request(provider, 'POST', url, params=params, data=data, **kwargs)
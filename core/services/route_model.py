@@ -0,0 +1,301 @@
+"""
+Типизированная модель маршрута: Route, Segment, Stop, Instruction.
+
+Парсеры провайдеров строят объекты модели, кэш и views работают с ними
+же; в словари (JSON) маршрут превращается один раз — на границе: при
+записи в CachedRoute и при отдаче на страницу.
+
+    route = Route(id='tomtom_car_route', travel_mode='car', lines=[points])
+    route.icon, route.mode_display        # вычисляются, а не хранятся
+    data = route.to_dict()                # JSON-совместимый словарь
+    route = Route.from_dict(data)
+
+Геометрия хранится массивами NumPy (n, 2) [lat, lon]:
+
+    route.lines      — линии маршрута (coordinates в словаре)
+    route.parts      — размеры участков единой линии (coordinate_parts)
+    route.lod        — {'масштаб': [линия, ...]} (coordinates_lod)
+    route.lod_parts  — размеры участков на каждом уровне (coordinate_parts_lod)
+
+Подписи (icon, mode_display, transport_types_display, total_transfers)
+выводятся из travel_mode, transport_types и счётчиков пересадок; в
+словарь они попадают только для клиента и при чтении игнорируются.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+# Версия словаря маршрута (to_dict/from_dict) в кэше: увеличивается при
+# несовместимом изменении и входит в ключ CachedRoute
+SCHEMA_VERSION = 1
+
+TRANSPORT_NAMES = {
+    'bus': 'Автобус',
+    'tram': 'Трамвай',
+    'trolleybus': 'Троллейбус',
+    'shuttle_bus': 'Маршрутка',
+    'subway': 'Метро',
+    'train': 'Электричка',
+}
+
+TRANSPORT_ICONS = {
+    'bus': '🚌', 'tram': '🚋', 'trolleybus': '🚎',
+    'subway': '🚇', 'train': '🚆', 'shuttle_bus': '🚐',
+    'funicular': '🚡', 'monorail': '🚝', 'water': '⛴️',
+    'cable_car': '🚠', 'aeroexpress': '🚄', 'mcd': '🚆',
+    'mck': '🚆', 'transport': '🚌'
+}
+
+MODE_ICONS = {'car': '🚗', 'pedestrian': '🚶', 'bicycle': '🚲'}
+
+MODE_DISPLAY = {
+    'public': 'Общественный транспорт',
+    'car': 'На машине',
+    'pedestrian': 'Пешком',
+    'bicycle': 'На велосипеде'
+}
+
+
+def _points(line) -> np.ndarray:
+    import numpy as np
+    return np.asarray(line, dtype=float).reshape(-1, 2)
+
+
+@dataclass(slots=True)
+class Stop:
+    name: str
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+    type: str = 'waypoint'
+    id: Optional[str] = None
+    comment: str = ''
+    subtype: Optional[str] = None
+    order: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.id, 'name': self.name, 'type': self.type, 'lat': self.lat, 'lon': self.lon,
+            'comment': self.comment, 'subtype': self.subtype, 'order': self.order,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Stop':
+        return cls(
+            name=data.get('name', ''), lat=data.get('lat'), lon=data.get('lon'),
+            type=data.get('type', 'waypoint'), id=data.get('id'), comment=data.get('comment', ''),
+            subtype=data.get('subtype'), order=data.get('order', 0),
+        )
+
+
+@dataclass(slots=True)
+class Segment:
+    """Участок маршрута: walk, transport или instruction; details зависят от типа"""
+    type: str
+    time: int = 0
+    waiting_time: int = 0
+    details: Dict[str, Any] = field(default_factory=dict)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'type': self.type, 'time': self.time, 'waiting_time': self.waiting_time, 'details': self.details}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Segment':
+        return cls(
+            type=data.get('type', ''), time=data.get('time', 0),
+            waiting_time=data.get('waiting_time', 0), details=data.get('details') or {},
+        )
+
+
+@dataclass(slots=True)
+class Instruction:
+    """Шаг инструкции; поля, специфичные для провайдера, — в extra"""
+    action: str
+    step: int = 0
+    type: str = ''
+    direction: str = ''
+    details: str = ''
+    distance: str = ''
+    time: str = ''
+    icon: str = ''
+    point_index: Optional[int] = None
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+    _FIELDS = ('step', 'type', 'direction', 'details', 'distance', 'time', 'icon')
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {'action': self.action}
+        for name in self._FIELDS:
+            value = getattr(self, name)
+            if value:
+                data[name] = value
+        if self.point_index is not None:
+            data['point_index'] = self.point_index
+        data.update(self.extra)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Instruction':
+        data = dict(data)
+        # Старый формат TomTom: {'text': ..., 'index': ...}
+        action = data.pop('action', None)
+        if action is None:
+            action = data.pop('text', '')
+        point_index = data.pop('point_index', data.pop('index', None))
+        known = {name: data.pop(name) for name in cls._FIELDS if name in data}
+        return cls(action=action, point_index=point_index, extra=data, **known)
+
+
+@dataclass(slots=True)
+class Route:
+    id: str
+    travel_mode: str
+    source: str = ''
+    total_time: int = 0
+    total_distance: float = 0
+    transport_types: List[str] = field(default_factory=list)
+    transfer_count: Optional[int] = None
+    crossing_count: int = 0
+    traffic_delay: int = 0
+    segments: List[Segment] = field(default_factory=list)
+    instructions: List[Instruction] = field(default_factory=list)
+    stops: List[Stop] = field(default_factory=list)
+    lines: List[np.ndarray] = field(default_factory=list)
+    parts: List[int] = field(default_factory=list)
+    lod: Dict[str, List[np.ndarray]] = field(default_factory=dict)
+    lod_parts: Dict[str, List[int]] = field(default_factory=dict)
+    number: int = 0
+    # Маршрут резервной заглушки после ошибки провайдера
+    fallback: bool = False
+
+    @property
+    def total_transfers(self) -> int:
+        return (self.transfer_count or 0) + self.crossing_count
+
+    @property
+    def has_detailed_stops(self) -> bool:
+        return bool(self.stops)
+
+    @property
+    def icon(self) -> str:
+        if self.fallback:
+            return '⚠️'
+        if self.travel_mode == 'public':
+            return TRANSPORT_ICONS.get(self.transport_types[0], '🚌') if self.transport_types else '🚌'
+        return MODE_ICONS.get(self.travel_mode, '📍')
+
+    @property
+    def mode_display(self) -> str:
+        if self.fallback:
+            return 'Резервный режим'
+        return MODE_DISPLAY.get(self.travel_mode, 'Маршрут')
+
+    @property
+    def transport_types_display(self) -> str:
+        return ', '.join(TRANSPORT_NAMES.get(code, code) for code in self.transport_types)
+
+    def summary(self) -> Dict[str, Any]:
+        """Краткие сведения для списков: без сегментов, инструкций, остановок и геометрии"""
+        data = {
+            'id': self.id,
+            'number': self.number,
+            'travel_mode': self.travel_mode,
+            'mode_display': self.mode_display,
+            'icon': self.icon,
+            'total_time': self.total_time,
+            'total_distance': self.total_distance,
+            'transport_types': self.transport_types,
+            'transport_types_display': self.transport_types_display,
+            'total_transfers': self.total_transfers,
+            'traffic_delay': self.traffic_delay,
+        }
+        if self.fallback:
+            data['fallback'] = True
+        return data
+
+    def to_dict(self, geometry: bool = True, arrays: bool = False) -> Dict[str, Any]:
+        """
+        Словарь для JSON. geometry=False — без линий и уровней;
+        arrays=True — линии остаются массивами (для кодирования в polyline).
+        """
+        data = {
+            'id': self.id,
+            'travel_mode': self.travel_mode,
+            'source': self.source,
+            'total_time': self.total_time,
+            'total_distance': self.total_distance,
+            'transport_types': self.transport_types,
+            'transport_types_display': self.transport_types_display,
+            'transfer_count': self.transfer_count,
+            'crossing_count': self.crossing_count,
+            'total_transfers': self.total_transfers,
+            'traffic_delay': self.traffic_delay,
+            'icon': self.icon,
+            'mode_display': self.mode_display,
+            'number': self.number,
+            'segments': [segment.to_dict() for segment in self.segments],
+            'instructions': [instruction.to_dict() for instruction in self.instructions],
+            'stops': [stop.to_dict() for stop in self.stops],
+        }
+        if self.fallback:
+            data['fallback'] = True
+        if geometry:
+            convert = (lambda line: line) if arrays else (lambda line: line.tolist())
+            data['coordinates'] = [convert(line) for line in self.lines]
+            if self.parts:
+                data['coordinate_parts'] = self.parts
+            if self.lod:
+                data['coordinates_lod'] = {
+                    zoom: [convert(line) for line in lines] for zoom, lines in self.lod.items()
+                }
+            if self.lod_parts:
+                data['coordinate_parts_lod'] = self.lod_parts
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Route':
+        return cls(
+            id=data.get('id', ''),
+            travel_mode=data.get('travel_mode', ''),
+            source=data.get('source', ''),
+            total_time=data.get('total_time', 0),
+            total_distance=data.get('total_distance', 0),
+            transport_types=list(data.get('transport_types') or []),
+            transfer_count=data.get('transfer_count'),
+            crossing_count=data.get('crossing_count', 0),
+            traffic_delay=data.get('traffic_delay', 0),
+            segments=[Segment.from_dict(segment) for segment in data.get('segments') or []],
+            instructions=[Instruction.from_dict(instruction) for instruction in data.get('instructions') or []],
+            stops=[Stop.from_dict(stop) for stop in data.get('stops') or []],
+            lines=[_points(line) for line in data.get('coordinates') or []],
+            parts=list(data.get('coordinate_parts') or []),
+            lod={
+                zoom: [_points(line) for line in lines]
+                for zoom, lines in (data.get('coordinates_lod') or {}).items()
+            },
+            lod_parts=dict(data.get('coordinate_parts_lod') or {}),
+            number=data.get('number', 0),
+            fallback=data.get('fallback', False),
+        )
+
+
+def dump_route_data(route_data: Dict, **kwargs) -> Dict:
+    """Ответ провайдера ({'result': [Route, ...], ...}) со словарями вместо маршрутов"""
+    if not isinstance(route_data, dict) or 'result' not in route_data:
+        return route_data
+    return dict(route_data, result=[
+        route.to_dict(**kwargs) if isinstance(route, Route) else route for route in route_data['result']
+    ])
+
+
+def load_route_data(route_data: Dict) -> Dict:
+    """Обратное к dump_route_data"""
+    if not isinstance(route_data, dict) or 'result' not in route_data:
+        return route_data
+    return dict(route_data, result=[
+        route if isinstance(route, Route) else Route.from_dict(route) for route in route_data['result']
+    ])
@@ -4,17 +4,81 @@ import requests
 from django.conf import settings
 import time
 import logging
+from itertools import chain
+from operator import itemgetter
+from core.timing import span
+from . import provider_http
+from .route_model import Instruction, Route, Segment, load_route_data
+
+_LAT_LON = itemgetter('latitude', 'longitude')
 
 class BaseRoutingService(ABC):
-    """Абстрактный класс для всех сервисов маршрутизации"""
+    """
+    Абстрактный класс для всех сервисов маршрутизации.
+
+    PARSER_VERSION увеличивается при любом изменении результата разбора
+    ответа провайдера: версия входит в ключ кэша маршрутов, и записи
+    прежнего формата перестают находиться. Сервисы с разбором ответа
+    кладут в результат 'raw' — исходный ответ и параметры разбора, по
+    которым parse_raw повторяет разбор (обновление кэша без запроса к API).
+
+    Сервис может добавить генератор stream_routes с параметрами get_routes:
+    он отдаёт маршруты по одному сразу после разбора и возвращает (return)
+    весь ответ. Остальные сервисы отдают маршруты после ответа целиком
+    (stream_routes ниже).
+    """
+    PARSER_NAME = ''
+    PARSER_VERSION = 1
+
     @abstractmethod
     def get_routes(self, start_lat: float, start_lon: float, 
                    end_lat: float, end_lon: float, **kwargs):
         pass
 
+    def parser_version(self, travel_mode=None) -> str:
+        return f"{self.PARSER_NAME}{self.PARSER_VERSION}"
+
+    def parse_raw(self, raw, start_lat, start_lon, end_lat, end_lon):
+        raise NotImplementedError(f"{type(self).__name__} не разбирает сохранённые ответы")
+
+
+def stream_routes(service, start_lat, start_lon, end_lat, end_lon, **kwargs):
+    """
+    Маршруты ответа сервиса по одному (генератор; return — весь ответ, как
+    у get_routes). Маршруты ответа, которые stream_routes сервиса не отдал
+    (заглушка после ошибки провайдера), и маршруты сервисов без
+    stream_routes отдаются после ответа.
+    """
+    emitted = 0
+    if hasattr(service, 'stream_routes'):
+        routes = service.stream_routes(start_lat, start_lon, end_lat, end_lon, **kwargs)
+        while True:
+            try:
+                route = next(routes)
+            except StopIteration as stop:
+                route_data = stop.value
+                break
+            emitted += 1
+            yield route
+    else:
+        route_data = service.get_routes(start_lat, start_lon, end_lat, end_lon, **kwargs)
+    if isinstance(route_data, dict):
+        yield from route_data.get('result', [])[emitted:]
+    return route_data
+
+
+def collect_routes(routes):
+    """Весь ответ генератора маршрутов (значение return) — для get_routes поверх stream_routes"""
+    while True:
+        try:
+            next(routes)
+        except StopIteration as stop:
+            return stop.value
+
 
 class StubRoutingService(BaseRoutingService):
     """Заглушка. Возвращает фиктивные маршруты."""
+    PARSER_NAME = 'stub'
     
     def get_routes(self, start_lat, start_lon, end_lat, end_lon, **kwargs):
         import time
@@ -40,8 +104,6 @@ class StubRoutingService(BaseRoutingService):
                     "travel_mode": travel_mode,
                     "transport_types": transport_types,
                     "transfer_count": 0 if only_direct else 1,
-                    "mode_display": "Заглушка",
-                    "icon": "🚗" if travel_mode == 'car' else "🚌",
                     "segments": [
                         {
                             "type": "walk",
@@ -68,9 +130,12 @@ class StubRoutingService(BaseRoutingService):
             ],
             "source": "stub"
         }
-        return stub_response
+        return load_route_data(stub_response)
 
 class TomTomRoutingService(BaseRoutingService):
+    PARSER_NAME = 'tomtom'
+    PARSER_VERSION = 1
+
     def __init__(self, api_key, travel_mode='car'):
         self.api_key = api_key
         self.default_travel_mode = travel_mode
@@ -88,7 +153,8 @@ class TomTomRoutingService(BaseRoutingService):
 
         try:
             locations = f"{start_lat},{start_lon}:{end_lat},{end_lon}"
-            url = f"https://api.tomtom.com/routing/1/calculateRoute/{locations}/json"
+            base_url = getattr(settings, 'TOMTOM_API_URL', 'https://api.tomtom.com').rstrip('/')
+            url = f"{base_url}/routing/1/calculateRoute/{locations}/json"
 
             params = {
                 'key': self.api_key,
@@ -103,71 +169,74 @@ class TomTomRoutingService(BaseRoutingService):
             if travel_mode in ['pedestrian', 'bicycle']:
                 params['avoid'] = 'motorways'  
 
-            response = requests.get(url, params=params)
+            with span('provider_http'):
+                response = provider_http.get('tomtom_routing', url, params=params, timeout=15)
             response.raise_for_status()
             api_data = response.json()
-            return self._parse_tomtom_response(api_data, travel_mode)  
+            raw = {'parser': self.PARSER_NAME, 'options': {'travel_mode': travel_mode}, 'response': api_data}
+            with span('parse'):
+                result = self.parse_raw(raw, start_lat, start_lon, end_lat, end_lon)
+            result['raw'] = raw
+            return result
 
         except requests.exceptions.RequestException as e:
             self.logger.error(f"Ошибка TomTom Routing API: {e}")
             raise Exception(f"TomTom Routing API недоступен: {e}")
+
+    def parse_raw(self, raw, start_lat, start_lon, end_lat, end_lon):
+        return self._parse_tomtom_response(raw['response'], raw['options']['travel_mode'])
+
     def _parse_tomtom_response(self, api_data, travel_mode):
         """Преобразует ответ TomTom API в наш формат."""
+        import numpy as np
         parsed_response = {"result": [], "source": "tomtom"}
 
         if 'routes' in api_data and api_data['routes']:
             route = api_data['routes'][0]
             summary = route.get('summary', {})
             guidance = route.get('guidance', {})
-            route_coordinates = []
+            route_lines = []
             for leg in route.get('legs', []):
-                leg_points = [[point.get('latitude'), point.get('longitude')] for point in leg.get('points', [])]
-                if leg_points:
-                    route_coordinates.append(leg_points)
-
-            mode_info = {
-                'car': {'icon': '🚗', 'display': 'На машине', 'type': 'transport'},
-                'pedestrian': {'icon': '🚶', 'display': 'Пешком', 'type': 'walk'},
-                'bicycle': {'icon': '🚲', 'display': 'На велосипеде', 'type': 'transport'}
-            }
-            info = mode_info.get(travel_mode, mode_info['car'])
+                points = leg.get('points', [])
+                if points:
+                    # fromiter по парам без промежуточного списка: np.array из списка кортежей в разы медленнее
+                    route_lines.append(np.fromiter(
+                        chain.from_iterable(map(_LAT_LON, points)), dtype=float, count=2 * len(points)
+                    ).reshape(-1, 2))
+
             travel_time = summary.get('travelTimeInSeconds', 0) // 60
             traffic_delay = summary.get('trafficDelayInSeconds', 0) // 60 if travel_mode == 'car' else 0
             total_time = travel_time + traffic_delay
             instructions_list = []
             if guidance and 'instructions' in guidance:
                 for step in guidance['instructions']:
-                    instruction_text = step.get('message', '')  
-                    point_index = step.get('pointIndex')  
-                    instructions_list.append({
-                        'text': instruction_text,
-                        'index': point_index
-                    })
+                    instructions_list.append(Instruction(
+                        action=step.get('message', ''),
+                        point_index=step.get('pointIndex')
+                    ))
             segments = []
             for instr in instructions_list:
-                segments.append({
-                    "type": "instruction",
-                    "time": 0, 
-                    "details": {
-                        "text": instr['text'],
+                segments.append(Segment(
+                    type="instruction",
+                    details={
+                        "text": instr.action,
                         "direction": "Следуйте инструкции",
                         "street": "", 
                         "distance": "" 
                     }
-                })
-
-            route_data = {
-                "id": f"tomtom_{travel_mode}_route",
-                "total_time": total_time,
-                "total_distance": summary.get('lengthInMeters', 0),
-                "travel_mode": travel_mode,
-                "icon": info['icon'],
-                "mode_display": info['display'],
-                "traffic_delay": traffic_delay,
-                "coordinates": route_coordinates,
-                "segments": segments,  
-                "instructions": instructions_list 
-            }
+                ))
+
+            route_data = Route(
+                id=f"tomtom_{travel_mode}_route",
+                travel_mode=travel_mode,
+                source="tomtom",
+                total_time=total_time,
+                total_distance=summary.get('lengthInMeters', 0),
+                traffic_delay=traffic_delay,
+                lines=route_lines,
+                segments=segments,
+                instructions=instructions_list
+            )
             parsed_response["result"].append(route_data)
 
         return parsed_response
@@ -1,25 +1,27 @@
+from __future__ import annotations
+
 import requests
 import json
 import logging
-from typing import List, Optional, Dict, Any
+from typing import TYPE_CHECKING, Iterator, List, Optional, Dict, Any
 from django.conf import settings
-from .routing_service import BaseRoutingService
-import re 
+from .routing_service import BaseRoutingService, collect_routes
+from . import geometry, provider_http
+from .route_model import TRANSPORT_NAMES, Instruction, Route, Segment, Stop, load_route_data
+from core import metrics
+from core.timing import span
+
+if TYPE_CHECKING:
+    import numpy as np
 
 logger = logging.getLogger(__name__)
 
 class TwoGisPublicTransportService(BaseRoutingService):
     """Сервис маршрутизации через 2GIS Public Transport API для Екатеринбурга"""
+    PARSER_NAME = '2gis'
+    PARSER_VERSION = 1
     
-    
-    TRANSPORT_TYPES = {
-        'bus': {'name': 'Автобус'},
-        'tram': {'name': 'Трамвай'},
-        'trolleybus': {'name': 'Троллейбус'},
-        'shuttle_bus': {'name': 'Маршрутка'},
-        'subway': {'name': 'Метро'},
-        'train': {'name': 'Электричка'},
-    }
+    TRANSPORT_TYPES = {code: {'name': name} for code, name in TRANSPORT_NAMES.items()}
     
     def __init__(self, api_key=None):
         self.api_key = api_key or getattr(settings, 'TWOGIS_PUBLIC_TRANSPORT_API_KEY', '')
@@ -43,6 +45,20 @@ class TwoGisPublicTransportService(BaseRoutingService):
         :param only_direct: Только прямые маршруты (без пересадок)
         :return: Словарь с маршрутами в стандартизированном формате
         """
+        return collect_routes(self.stream_routes(start_lat, start_lon, end_lat, end_lon, transport_types,
+                                                 max_transfers, only_direct, **kwargs))
+
+    def stream_routes(self, start_lat: float, start_lon: float,
+                      end_lat: float, end_lon: float,
+                      transport_types: Optional[List[str]] = None,
+                      max_transfers: Optional[int] = None,
+                      only_direct: bool = False,
+                      **kwargs) -> Iterator[Route]:
+        """
+        get_routes по одному маршруту: каждый маршрут, прошедший фильтры,
+        отдаётся сразу после разбора, весь ответ возвращается (return) в конце.
+        Заглушка после ошибки API отдаёт маршруты только в ответе.
+        """
         logger.info(f"2GIS API: Поиск маршрута ({start_lat:.6f}, {start_lon:.6f}) -> ({end_lat:.6f}, {end_lon:.6f})")
         if not self.api_key:
             logger.warning("API ключ отсутствует, используем заглушку")
@@ -69,40 +85,79 @@ class TwoGisPublicTransportService(BaseRoutingService):
         try:
             print(f"URL: {self.base_url}")
             print(f"Payload: {json.dumps(payload, ensure_ascii=False)}")
-            response = requests.post(
-                f"{self.base_url}?key={self.api_key}",
-                headers={
-                    'Content-Type': 'application/json',
-                    'Accept': 'application/json'
-                },
-                data=json.dumps(payload, ensure_ascii=False),
-                timeout=15
-            )
+            with span('provider_http'):
+                response = provider_http.post(
+                    '2gis_public_transport',
+                    self.base_url,
+                    params={'key': self.api_key},
+                    headers={
+                        'Content-Type': 'application/json',
+                        'Accept': 'application/json'
+                    },
+                    data=json.dumps(payload, ensure_ascii=False),
+                    timeout=15
+                )
             
             logger.debug(f"Статус ответа: {response.status_code}")
             raw_response_text = response.text
             logger.debug(f"Тело ответа API (первые 2000 символов):\n{raw_response_text[:2000]}")
             if response.status_code != 200:
                 logger.error(f"2GIS API ошибка: {response.status_code} - {response.text[:200]}")
+                metrics.FALLBACKS.inc(source='2gis_public_transport', target='stub')
                 return self._get_enhanced_stub_routes(start_lat, start_lon, end_lat, end_lon, transport_types)
             api_data = response.json()
             if isinstance(api_data, list) and api_data:
                 if 'movements' in api_data[0]:
                     logger.info(f"Получено {len(api_data)} маршрутов от 2GIS API")
-            result = self._parse_api_response(api_data, start_lat, start_lon, end_lat, end_lon)
-            filtered_result = self._apply_filters(result, max_transfers, only_direct)
+            raw = {
+                'parser': self.PARSER_NAME,
+                'options': {'max_transfers': max_transfers, 'only_direct': only_direct},
+                'response': api_data,
+            }
+            filtered_result = yield from self._stream_parsed(raw, start_lat, start_lon, end_lat, end_lon)
+            filtered_result['raw'] = raw
             return filtered_result
             
         except requests.exceptions.Timeout:
             logger.error("2GIS API: Таймаут запроса (15 сек)")
+            metrics.FALLBACKS.inc(source='2gis_public_transport', target='stub')
             return self._get_enhanced_stub_routes(start_lat, start_lon, end_lat, end_lon, transport_types)
         except requests.exceptions.RequestException as e:
             logger.error(f"Ошибка 2GIS API: {e}")
+            metrics.FALLBACKS.inc(source='2gis_public_transport', target='stub')
             return self._get_enhanced_stub_routes(start_lat, start_lon, end_lat, end_lon, transport_types)
         except json.JSONDecodeError as e:
             logger.error(f"Ошибка парсинга JSON: {e}")
+            metrics.FALLBACKS.inc(source='2gis_public_transport', target='stub')
             return self._get_enhanced_stub_routes(start_lat, start_lon, end_lat, end_lon, transport_types)
     
+    def parse_raw(self, raw: Dict, start_lat: float, start_lon: float,
+                  end_lat: float, end_lon: float) -> Dict[str, Any]:
+        """Разбор ответа API с фильтрами запроса (raw — см. BaseRoutingService)"""
+        return collect_routes(self._stream_parsed(raw, start_lat, start_lon, end_lat, end_lon))
+
+    def _stream_parsed(self, raw: Dict, start_lat: float, start_lon: float,
+                       end_lat: float, end_lon: float) -> Iterator[Route]:
+        """parse_raw по одному маршруту: маршруты, прошедшие фильтры, по мере разбора"""
+        options = raw['options']
+        result = {
+            "result": [],
+            "source": "2gis_public_transport",
+            "total_routes": len(raw['response'])
+        }
+        routes = self._parse_routes(raw['response'], start_lat, start_lon, end_lat, end_lon)
+        while True:
+            try:
+                with span('parse'):
+                    route = next(routes)
+            except StopIteration:
+                break
+            if self._matches_filters(route, options['max_transfers'], options['only_direct']):
+                result['result'].append(route)
+                yield route
+        result['filtered_routes'] = len(result['result'])
+        return result
+
     def _validate_transport_types(self, transport_types: List[str]) -> List[str]:
         """Валидация и фильтрация типов транспорта для Екатеринбурга"""
         valid_types = []
@@ -116,35 +171,41 @@ class TwoGisPublicTransportService(BaseRoutingService):
     def _parse_api_response(self, api_data: List[Dict], start_lat: float, start_lon: float,
                            end_lat: float, end_lon: float) -> Dict[str, Any]:
         """Парсинг ответа API в унифицированный формат"""
-        result = {
-            "result": [],
+        return {
+            "result": list(self._parse_routes(api_data, start_lat, start_lon, end_lat, end_lon)),
             "source": "2gis_public_transport",
             "total_routes": len(api_data)
         }
+
+    def _parse_routes(self, api_data: List[Dict], start_lat: float, start_lon: float,
+                      end_lat: float, end_lon: float) -> Iterator[Route]:
+        """Маршруты ответа API (не больше пяти) по мере разбора"""
+        # Варианты маршрута часто едут по одним и тем же участкам: WKT разбирается один раз на ответ
+        wkt_memo = {}
         for idx, route in enumerate(api_data[:5]): 
             try:
-                parsed_route = self._parse_single_route(route, idx, start_lat, start_lon, end_lat, end_lon)
-                if parsed_route:
-                    result["result"].append(parsed_route)
+                parsed_route = self._parse_single_route(route, idx, start_lat, start_lon, end_lat, end_lon,
+                                                        wkt_memo=wkt_memo)
             except Exception as e:
                 logger.error(f"Ошибка парсинга маршрута {idx}: {e}")
                 continue
-        
-        return result
+            if parsed_route:
+                yield parsed_route
     
     def _parse_single_route(self, route: Dict, idx: int, 
                        start_lat: float, start_lon: float,
-                       end_lat: float, end_lon: float) -> Optional[Dict[str, Any]]:
+                       end_lat: float, end_lon: float,
+                       wkt_memo: Optional[Dict[str, np.ndarray]] = None) -> Optional[Route]:
         """Полная переработка парсинга маршрута"""
+        import numpy as np
         try:
             total_duration = route.get('total_duration', 0)
             total_distance = route.get('total_distance', 0)
             transfer_count = route.get('transfer_count', 0)
             crossing_count = route.get('crossing_count', 0)
             transport_types_in_route = route.get('transport', [])
-            primary_type = transport_types_in_route[0] if transport_types_in_route else 'bus'
             segments = []
-            all_coordinates = []
+            coordinate_parts = []
             
             if 'movements' in route:
                 for movement in route['movements']:
@@ -153,37 +214,29 @@ class TwoGisPublicTransportService(BaseRoutingService):
                         segments.append(segment)
                     
                     # Координаты из геометрии
-                    segment_coords = self._extract_coordinates_from_movement(movement)
-                    if segment_coords:
-                        all_coordinates.extend(segment_coords)
+                    segment_coords = self._extract_coordinates_from_movement(movement, wkt_memo)
+                    if len(segment_coords):
+                        coordinate_parts.append(segment_coords)
             stops = self._extract_stops_from_route(route)
             segments = self._enrich_with_stops(segments, stops)
             instructions = self._generate_complete_instructions(segments)
-            route_data = {
-                "id": f"2gis_route_{idx + 1}",
-                "total_time": total_duration // 60,
-                "total_distance": total_distance,
-                "transfer_count": transfer_count,
-                "crossing_count": crossing_count,
-                "total_transfers": transfer_count + crossing_count,
-                "transport_types": transport_types_in_route,
-                "transport_types_display": [
-                    self.TRANSPORT_TYPES.get(t, {}).get('name', t) 
-                    for t in transport_types_in_route
-                ],
-                "segments": segments,
-                "coordinates": [all_coordinates] if all_coordinates else [],
-                "instructions": instructions,
-                "stops": stops, 
-                "icon": self.TRANSPORT_TYPES.get(primary_type, {}).get('icon', '🚌'),
-                "mode_display": "Общественный транспорт",
-                "travel_mode": "public",
-                "source": "2gis_public_transport",
-                "start_address": f"{start_lat:.6f}, {start_lon:.6f}",
-                "end_address": f"{end_lat:.6f}, {end_lon:.6f}",
-                "has_detailed_stops": len(stops) > 0
-            }
-            return route_data
+            return Route(
+                id=f"2gis_route_{idx + 1}",
+                travel_mode="public",
+                source="2gis_public_transport",
+                total_time=total_duration // 60,
+                total_distance=total_distance,
+                transport_types=transport_types_in_route,
+                transfer_count=transfer_count,
+                crossing_count=crossing_count,
+                segments=segments,
+                instructions=instructions,
+                stops=stops,
+                # Одна линия из движений подряд; число точек каждого движения — участки
+                # общего хранилища геометрии
+                lines=[np.concatenate(coordinate_parts)] if coordinate_parts else [],
+                parts=[len(part) for part in coordinate_parts],
+            )
             
         except Exception as e:
             logger.error(f"Ошибка парсинга маршрута {idx}: {e}", exc_info=True)
@@ -206,7 +259,7 @@ class TwoGisPublicTransportService(BaseRoutingService):
         
         return None
 
-    def _parse_movement_segment(self, movement: Dict) -> Optional[Dict[str, Any]]:
+    def _parse_movement_segment(self, movement: Dict) -> Optional[Segment]:
         """
         Парсинг сегмента движения с полной обработкой формата 2GIS API
         Актуально для версии API 2.0 (2025-2026)
@@ -236,11 +289,11 @@ class TwoGisPublicTransportService(BaseRoutingService):
                 from_stop = waypoint_name or "Текущая позиция"
                 to_stop = "Следующая точка"
             
-            return {
-                "type": "walk",
-                "time": moving_duration,
-                "waiting_time": 0,
-                "details": {
+            return Segment(
+                type="walk",
+                time=moving_duration,
+                waiting_time=0,
+                details={
                     "text": text,
                     "distance": f"{distance} м",
                     "from_stop": from_stop,
@@ -250,7 +303,7 @@ class TwoGisPublicTransportService(BaseRoutingService):
                     "subtype": subtype,
                     "direction": self._generate_walk_direction(waypoint_comment, distance)
                 }
-            }
+            )
             
         elif move_type == 'passage':
             moving_duration = movement.get('moving_duration', 0) // 60
@@ -282,11 +335,11 @@ class TwoGisPublicTransportService(BaseRoutingService):
                 waypoint_comment
             )
             
-            return {
-                "type": "transport",
-                "time": moving_duration,
-                "waiting_time": waiting_duration,
-                "details": {
+            return Segment(
+                type="transport",
+                time=moving_duration,
+                waiting_time=waiting_duration,
+                details={
                     "route_numbers": route_numbers,
                     "route_number": primary_route,
                     "route_name": transport_type_name,
@@ -304,17 +357,17 @@ class TwoGisPublicTransportService(BaseRoutingService):
                     "direction": direction,
                     "full_description": f"{route_display}: {direction}"
                 }
-            }
+            )
             
         elif move_type == 'crossing':
             moving_duration = movement.get('moving_duration', 0) // 60
             distance = movement.get('distance', 0)
             
-            return {
-                "type": "walk",
-                "time": moving_duration,
-                "waiting_time": 0,
-                "details": {
+            return Segment(
+                type="walk",
+                time=moving_duration,
+                waiting_time=0,
+                details={
                     "text": f"Пересадка между транспортом ({distance} м)",
                     "distance": f"{distance} м",
                     "from_stop": "Место выхода",
@@ -323,52 +376,56 @@ class TwoGisPublicTransportService(BaseRoutingService):
                     "subtype": "crossing",
                     "is_transfer": True
                 }
-            }
+            )
         
         return None
-    def _generate_complete_instructions(self, segments: List[Dict]) -> List[Dict[str, Any]]:
+    def _generate_complete_instructions(self, segments: List[Segment]) -> List[Instruction]:
         """Генерация полных инструкций с остановками"""
         instructions = []
         
         for i, segment in enumerate(segments):
             step_num = i + 1
-            details = segment.get('details', {})
+            details = segment.details
             
-            if segment['type'] == 'transport':
-                instruction = {
-                    'step': step_num,
-                    'action': f"Садитесь на {details.get('transport_name', 'транспорт')}",
-                    'details': f"Маршрут: {details.get('route_display', '')}",
-                    'route_info': details.get('route_display', ''),
-                    'direction': details.get('direction', ''),
-                    'from': details.get('from_stop', 'Остановка'),
-                    'to': details.get('to_stop', 'Остановка'),
-                    'stops': f"{details.get('stops_count', 0)} остановок",
-                    'time': f"{segment['time']} мин в пути",
-                    'waiting': f"Ожидание: {segment['waiting_time']} мин" if segment['waiting_time'] > 0 else "Без ожидания",
-                    'icon': details.get('transport_icon', '🚌'),
-                    'type': 'transport',
-                    'has_stops': bool(details.get('from_stop') and details.get('to_stop'))
-                }
+            if segment.type == 'transport':
+                instruction = Instruction(
+                    step=step_num,
+                    action=f"Садитесь на {details.get('transport_name', 'транспорт')}",
+                    details=f"Маршрут: {details.get('route_display', '')}",
+                    direction=details.get('direction', ''),
+                    time=f"{segment.time} мин в пути",
+                    icon=details.get('transport_icon', '🚌'),
+                    type='transport',
+                    extra={
+                        'route_info': details.get('route_display', ''),
+                        'from': details.get('from_stop', 'Остановка'),
+                        'to': details.get('to_stop', 'Остановка'),
+                        'stops': f"{details.get('stops_count', 0)} остановок",
+                        'waiting': f"Ожидание: {segment.waiting_time} мин" if segment.waiting_time > 0 else "Без ожидания",
+                        'has_stops': bool(details.get('from_stop') and details.get('to_stop'))
+                    }
+                )
                 
-            elif segment['type'] == 'walk':
-                instruction = {
-                    'step': step_num,
-                    'action': "Идите пешком",
-                    'details': details.get('text', ''),
-                    'direction': details.get('direction', 'Следуйте по маршруту'),
-                    'distance': details.get('distance', ''),
-                    'time': f"{segment['time']} мин",
-                    'from': details.get('from_stop', 'Текущая позиция'),
-                    'to': details.get('to_stop', 'Следующая точка'),
-                    'icon': '🚶',
-                    'type': 'walk',
-                    'subtype': details.get('subtype', ''),
-                    'is_transfer': details.get('is_transfer', False)
-                }
+            elif segment.type == 'walk':
+                instruction = Instruction(
+                    step=step_num,
+                    action="Идите пешком",
+                    details=details.get('text', ''),
+                    direction=details.get('direction', 'Следуйте по маршруту'),
+                    distance=details.get('distance', ''),
+                    time=f"{segment.time} мин",
+                    icon='🚶',
+                    type='walk',
+                    extra={
+                        'from': details.get('from_stop', 'Текущая позиция'),
+                        'to': details.get('to_stop', 'Следующая точка'),
+                        'subtype': details.get('subtype', ''),
+                        'is_transfer': details.get('is_transfer', False)
+                    }
+                )
                 if details.get('is_transfer'):
-                    instruction['action'] = "Перейдите для пересадки"
-                    instruction['details'] = "Пеший переход между остановками"
+                    instruction.action = "Перейдите для пересадки"
+                    instruction.details = "Пеший переход между остановками"
             
             instructions.append(instruction)
         
@@ -395,7 +452,7 @@ class TwoGisPublicTransportService(BaseRoutingService):
             return f"Проедьте {stops_count} остановок на {transport_type} №{route_number}"
         else:
             return f"Поездка на {transport_type} №{route_number}"
-    def _enrich_with_stops(self, segments: List[Dict], stops: List[Dict]) -> List[Dict]:
+    def _enrich_with_stops(self, segments: List[Segment], stops: List[Stop]) -> List[Segment]:
         """Обогащение сегментов информацией об остановках"""
         if not stops:
             return segments
@@ -404,26 +461,26 @@ class TwoGisPublicTransportService(BaseRoutingService):
         enriched_segments = []
         
         for segment in segments:
-            segment_type = segment.get('type')
-            details = segment.get('details', {})
+            segment_type = segment.type
+            details = segment.details
             
             if segment_type == 'walk':
                 if details.get('subtype') == 'start':
                     details['from_stop'] = details.get('from_stop', 'Начало')
                     if stop_index < len(stops):
-                        details['to_stop'] = stops[stop_index].get('name', 'Остановка')
+                        details['to_stop'] = (stops[stop_index].name or 'Остановка')
                 elif details.get('subtype') == 'finish':
                     if stop_index > 0:
-                        details['from_stop'] = stops[stop_index-1].get('name', 'Остановка')
+                        details['from_stop'] = (stops[stop_index-1].name or 'Остановка')
                     details['to_stop'] = details.get('to_stop', 'Конец')
                 elif details.get('is_transfer'):
                     details['from_stop'] = f"Переход {stop_index+1}"
                     details['to_stop'] = f"Переход {stop_index+2}"
                 else:
                     if stop_index < len(stops):
-                        details['from_stop'] = stops[stop_index].get('name', 'Остановка')
+                        details['from_stop'] = (stops[stop_index].name or 'Остановка')
                         if stop_index + 1 < len(stops):
-                            details['to_stop'] = stops[stop_index + 1].get('name', 'Остановка')
+                            details['to_stop'] = (stops[stop_index + 1].name or 'Остановка')
                             stop_index += 1
             
             elif segment_type == 'transport':
@@ -431,10 +488,10 @@ class TwoGisPublicTransportService(BaseRoutingService):
                     from_stop = stops[stop_index]
                     to_stop = stops[stop_index + 1]
                     
-                    details['from_stop'] = from_stop.get('name', 'Остановка')
-                    details['to_stop'] = to_stop.get('name', 'Остановка')
-                    details['from_stop_coords'] = [from_stop.get('lat'), from_stop.get('lon')]
-                    details['to_stop_coords'] = [to_stop.get('lat'), to_stop.get('lon')]
+                    details['from_stop'] = (from_stop.name or 'Остановка')
+                    details['to_stop'] = (to_stop.name or 'Остановка')
+                    details['from_stop_coords'] = [from_stop.lat, from_stop.lon]
+                    details['to_stop_coords'] = [to_stop.lat, to_stop.lon]
                     if details['from_stop'] and details['to_stop']:
                         details['direction'] = (
                             f"{details['transport_name']} №{details['route_number']} "
@@ -447,74 +504,82 @@ class TwoGisPublicTransportService(BaseRoutingService):
         
         return enriched_segments
     
-    def _extract_coordinates_from_movement(self, movement: Dict) -> List[List[float]]:
-        """Извлечение координат пути из сегмента движения (теперь с поддержкой WKT)"""
-        coordinates = []
+    def _extract_coordinates_from_movement(self, movement: Dict,
+                                           wkt_memo: Optional[Dict[str, np.ndarray]] = None) -> np.ndarray:
+        """
+        Извлечение координат пути из сегмента движения (WKT LINESTRING и MULTILINESTRING).
+        wkt_memo — уже разобранные строки WKT того же ответа.
+        """
+        import numpy as np
+        lines = []
         if 'alternatives' in movement and movement['alternatives']:
             for alternative in movement['alternatives']:
                 if 'geometry' in alternative:
                     for geom_item in alternative['geometry']:
                         wkt_string = geom_item.get('selection', '')
-                        if wkt_string:
-                            coords = self._parse_wkt_linestring(wkt_string)
-                            coordinates.extend(coords)
+                        if not wkt_string:
+                            continue
+                        if wkt_memo is None:
+                            lines.append(self._parse_wkt_points(wkt_string))
+                        else:
+                            if wkt_string not in wkt_memo:
+                                wkt_memo[wkt_string] = self._parse_wkt_points(wkt_string)
+                            lines.append(wkt_memo[wkt_string])
         for stop_key in ['from_stop', 'to_stop']:
             if stop_key in movement and movement[stop_key]:
                 stop = movement[stop_key]
                 if 'location' in stop:
-                    coordinates.append([
+                    lines.append(np.array([[
                         stop['location']['lat'],
                         stop['location']['lon']
-                    ])
+                    ]], dtype=float))
         
-        return coordinates
+        return np.concatenate(lines) if lines else np.empty((0, 2))
     
-    def _extract_stops_from_route(self, route: Dict) -> List[Dict]:
+    def _extract_stops_from_route(self, route: Dict) -> List[Stop]:
         """Извлечение остановок из всего маршрута"""
         stops = []
         waypoints = route.get('waypoints', [])
         for wp in waypoints:
             if wp.get('type') in ['stop', 'station', 'platform', 'entrance']:
                 point = wp.get('point', {})
-                stops.append({
-                    'id': wp.get('id'),
-                    'name': wp.get('name', 'Остановка'),
-                    'type': wp.get('type'),
-                    'lat': point.get('lat'),
-                    'lon': point.get('lon'),
-                    'order': len(stops)  
-                })
+                stops.append(Stop(
+                    id=wp.get('id'),
+                    name=wp.get('name', 'Остановка'),
+                    type=wp.get('type'),
+                    lat=point.get('lat'),
+                    lon=point.get('lon'),
+                    order=len(stops)
+                ))
         if not stops:
             movements = route.get('movements', [])
             for movement in movements:
                 waypoint = movement.get('waypoint', {})
                 if waypoint and waypoint.get('subtype') not in ['start', 'finish']:
-                    stops.append({
-                        'name': waypoint.get('name', ''),
-                        'type': 'waypoint',
-                        'comment': waypoint.get('comment', ''),
-                        'subtype': waypoint.get('subtype'),
-                        'order': len(stops)
-                    })
+                    stops.append(Stop(
+                        name=waypoint.get('name', ''),
+                        type='waypoint',
+                        comment=waypoint.get('comment', ''),
+                        subtype=waypoint.get('subtype'),
+                        order=len(stops)
+                    ))
         
         return stops
+    def _parse_wkt_points(self, wkt_string: str) -> np.ndarray:
+        """WKT LINESTRING/MULTILINESTRING в массив (n, 2) [lat, lon]; пустой при ошибке"""
+        import numpy as np
+        try:
+            return geometry.parse_wkt_points(wkt_string)
+        except geometry.WKTError as e:
+            logger.error(f"Ошибка парсинга WKT: {e}, строка: {wkt_string[:100]}")
+            return np.empty((0, 2))
+
     def _parse_wkt_linestring(self, wkt_string: str) -> List[List[float]]:
         """
-        Преобразует WKT LINESTRING в массив координат [[lat, lon], ...].
+        Преобразует WKT LINESTRING или MULTILINESTRING в массив координат [[lat, lon], ...].
         Пример: "LINESTRING(60.572251 56.851534, 60.572335 56.851504)"
         """
-        coordinates = []
-        try:
-            match = re.search(r'LINESTRING\((.+?)\)', wkt_string)
-            if match:
-                points_str = match.group(1)
-                points = points_str.split(',')
-                for point in points:
-                    lon, lat = point.strip().split()
-                    coordinates.append([float(lat), float(lon)])
-        except Exception as e:
-            logger.error(f"Ошибка парсинга WKT: {e}, строка: {wkt_string[:100]}")
-        return coordinates
+        return self._parse_wkt_points(wkt_string).tolist()
     
     def _generate_realistic_path(self, start_lat: float, start_lon: float,
                                 end_lat: float, end_lon: float,
@@ -574,29 +639,16 @@ class TwoGisPublicTransportService(BaseRoutingService):
         
         return instructions
     
-    def _apply_filters(self, result: Dict[str, Any], 
-                      max_transfers: Optional[int],
-                      only_direct: bool) -> Dict[str, Any]:
-        """Применение фильтров к результатам"""
-        if not result.get('result'):
-            return result
-        
-        filtered_routes = []
-        
-        for route in result['result']:
-            if max_transfers is not None:
-                total_transfers = route.get('total_transfers', 0)
-                if total_transfers > max_transfers:
-                    continue
-            if only_direct and route.get('transfer_count', 0) > 0:
-                continue
-            
-            filtered_routes.append(route)
-        
-        result['result'] = filtered_routes
-        result['filtered_routes'] = len(filtered_routes)
-        
-        return result
+    def _matches_filters(self, route: Route,
+                         max_transfers: Optional[int],
+                         only_direct: bool) -> bool:
+        """Маршрут проходит фильтры запроса"""
+        if max_transfers is not None:
+            if route.total_transfers > max_transfers:
+                return False
+        if only_direct and (route.transfer_count or 0) > 0:
+            return False
+        return True
     
     def _get_enhanced_stub_routes(self, start_lat: float, start_lon: float,
                                  end_lat: float, end_lon: float,
@@ -710,10 +762,10 @@ class TwoGisPublicTransportService(BaseRoutingService):
             "end_address": f"{end_lat:.6f}, {end_lon:.6f}"
         }
         
-        return {
+        return load_route_data({
             "result": [stub_route],
             "source": "stub_2gis_ekb",
             "total_routes": 1,
             "filtered_routes": 1,
             "note": "Используются тестовые данные для Екатеринбурга"
-        }
\ No newline at end of file
+        })
\ No newline at end of file
@@ -1,14 +1,14 @@
-let currentGraphBase64 = '';
+let currentGraphUrl = '';
 let currentGraphTitle = '';
 let isZoomed = false;
-function openGraphModal(base64Image, title) {
-    currentGraphBase64 = base64Image;
+function openGraphModal(imageUrl, title) {
+    currentGraphUrl = imageUrl;
     currentGraphTitle = title;
     
     const modalImage = document.getElementById('modalGraphImage');
     const modalLabel = document.getElementById('graphModalLabel');
     
-    modalImage.src = `data:image/png;base64,${base64Image}`;
+    modalImage.src = imageUrl;
     modalLabel.textContent = title;
     modalImage.classList.remove('zoomed');
     isZoomed = false;
@@ -27,14 +27,14 @@ function toggleZoom() {
         '<i class="fas fa-search-plus me-2"></i>Увеличить';
 }
 function downloadGraph() {
-    if (!currentGraphBase64) return;
+    if (!currentGraphUrl) return;
     
     const link = document.createElement('a');
     const timestamp = new Date().toISOString().slice(0,19).replace(/:/g, '-');
     const filename = `graph_${currentGraphTitle.replace(/\s+/g, '_')}_${timestamp}.png`;
     
     link.download = filename;
-    link.href = `data:image/png;base64,${currentGraphBase64}`;
+    link.href = currentGraphUrl;
     document.body.appendChild(link);
     link.click();
     document.body.removeChild(link);
@@ -81,7 +81,7 @@ function printGraph() {
                     <p>Дашборд аналитики - ЕкбТранспорт+</p>
                     <p>Сформировано: ${new Date().toLocaleString('ru-RU')}</p>
                 </div>
-                <img src="data:image/png;base64,${currentGraphBase64}" alt="${currentGraphTitle}">
+                <img src="${window.location.origin}${currentGraphUrl}" alt="${currentGraphTitle}">
                 <div class="footer">
                     <p>© ЕкбТранспорт+ - Планировщик поездок</p>
                 </div>
@@ -130,6 +130,129 @@ function updateTime() {
         });
     }
 }
+// Графики рендерятся в фоне: опрашиваем сервер, пока файл не будет готов (202 -> 200)
+function pollChart(img) {
+    const url = img.dataset.chartUrl;
+    let attempts = 0;
+    const poll = () => {
+        attempts += 1;
+        fetch(url, { credentials: 'same-origin' })
+            .then(response => {
+                if (img.dataset.chartUrl !== url) return;
+                if (response.status === 200) {
+                    img.src = url;
+                    img.dataset.chartReady = '1';
+                } else if (response.status === 202 && attempts < 30) {
+                    setTimeout(poll, 1000);
+                }
+            })
+            .catch(error => console.error('Ошибка загрузки графика:', error));
+    };
+    poll();
+}
+function loadPendingCharts() {
+    document.querySelectorAll('img[data-chart-ready="0"]').forEach(pollChart);
+}
+
+// Серии дашборда загружаются независимо и параллельно через JSON API
+const ANALYTICS_SERIES = ['summary', 'top_routes', 'provider_stats', 'hourly_activity', 'travel_modes', 'daily_trends', 'response_times'];
+function formatDate(isoDate) {
+    const [year, month, day] = isoDate.split('-');
+    return `${day}.${month}.${year}`;
+}
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text == null ? '' : String(text);
+    return div.innerHTML;
+}
+function loadAnalyticsRange(days) {
+    ANALYTICS_SERIES.forEach(series => {
+        const url = window.analyticsApiUrl.replace('SERIES', series) + `?days=${days}`;
+        fetch(url, { credentials: 'same-origin' })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`HTTP ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(payload => renderSeries(series, payload))
+            .catch(error => {
+                console.error(`Ошибка загрузки серии ${series}:`, error);
+                showNotification(`Не удалось загрузить данные: ${series}`, 'danger');
+            });
+    });
+}
+function renderSeries(series, payload) {
+    document.getElementById('period-label').textContent =
+        `${formatDate(payload.start)} - ${formatDate(payload.end)}`;
+
+    if (payload.chart) {
+        const img = document.querySelector(`img[data-chart-name="${series}"]`);
+        if (img && img.dataset.chartUrl !== payload.chart.url) {
+            img.dataset.chartUrl = payload.chart.url;
+            if (payload.chart.ready) {
+                img.src = payload.chart.url;
+                img.dataset.chartReady = '1';
+            } else {
+                img.dataset.chartReady = '0';
+                pollChart(img);
+            }
+        }
+    }
+
+    if (series === 'summary') {
+        const summary = payload.data;
+        document.getElementById('metric-total-searches').textContent = summary.total_searches;
+        document.getElementById('metric-successful-searches').textContent = summary.successful_searches;
+        document.getElementById('metric-failed-searches').textContent = summary.failed_searches;
+        document.getElementById('metric-conversion-rate').textContent = summary.conversion_rate;
+    } else if (series === 'provider_stats') {
+        renderProviderStats(payload.data);
+    } else if (series === 'top_routes') {
+        renderTopRoutes(payload.data);
+    }
+}
+function renderProviderStats(stats) {
+    const tbody = document.getElementById('provider-stats-body');
+    if (!tbody) return;
+    tbody.innerHTML = stats.map(stat => `
+        <tr>
+            <td><span class="badge bg-info">${escapeHtml(stat.provider)}</span></td>
+            <td class="fw-bold">${stat.request_count}</td>
+            <td>${stat.avg_response_time.toFixed(1)} мс</td>
+            <td><small class="text-muted">${stat.success_rate.toFixed(1)}%</small></td>
+            <td><small class="text-muted">${stat.cache_hit_rate.toFixed(1)}%</small></td>
+            <td><small>${stat.p50 != null ? `${stat.p50.toFixed(0)} / <strong>${stat.p99.toFixed(0)}</strong> мс` : '—'}</small></td>
+            <td></td>
+        </tr>
+    `).join('');
+}
+function renderTopRoutes(routes) {
+    const tbody = document.getElementById('top-routes-body');
+    if (!tbody) return;
+    tbody.innerHTML = routes.map((route, index) => `
+        <tr>
+            <td><span class="badge bg-secondary">${index + 1}</span></td>
+            <td class="fw-semibold">${escapeHtml(route.start_query)}</td>
+            <td class="fw-semibold">${escapeHtml(route.end_query)}</td>
+            <td><span class="badge bg-primary rounded-pill px-3 py-2">${route.count}</span></td>
+            <td><span class="text-info fw-bold">${route.avg_routes.toFixed(1)}</span></td>
+            <td></td>
+            <td></td>
+        </tr>
+    `).join('');
+}
+function setupRangeSelector() {
+    const selector = document.getElementById('range-selector');
+    if (!selector || !window.analyticsApiUrl) return;
+    selector.querySelectorAll('button[data-days]').forEach(button => {
+        button.addEventListener('click', function() {
+            selector.querySelectorAll('button').forEach(btn => btn.classList.remove('active'));
+            this.classList.add('active');
+            loadAnalyticsRange(parseInt(this.dataset.days, 10));
+        });
+    });
+}
 function setupAutoRefresh() {
     setTimeout(function() {
         window.location.href = '?refresh=1';
@@ -158,6 +281,8 @@ document.addEventListener('DOMContentLoaded', function() {
             if (modal) modal.hide();
         }
     });
+    loadPendingCharts();
+    setupRangeSelector();
     setInterval(updateTime, 60000);
     updateTime();
     setupAutoRefresh();
@@ -0,0 +1,36 @@
+// Раскодирование линий маршрутов (Google Encoded Polyline), см. core/services/geometry.py
+function decodePolyline(encoded, precision) {
+    const factor = Math.pow(10, precision === undefined ? 6 : precision);
+    const points = [];
+    let index = 0;
+    let lat = 0;
+    let lon = 0;
+    while (index < encoded.length) {
+        const deltas = [0, 0];
+        for (let axis = 0; axis < 2; axis++) {
+            let result = 0;
+            let shift = 0;
+            let chunk;
+            do {
+                chunk = encoded.charCodeAt(index++) - 63;
+                // Умножение вместо << : значения шире 32 бит при больших скачках
+                result += (chunk & 0x1f) * Math.pow(2, shift);
+                shift += 5;
+            } while (chunk >= 0x20);
+            deltas[axis] = result % 2 === 1 ? -(result + 1) / 2 : result / 2;
+        }
+        lat += deltas[0];
+        lon += deltas[1];
+        points.push([lat / factor, lon / factor]);
+    }
+    return points;
+}
+
+function unpackRouteGeometry(route) {
+    const geometry = route.geometry;
+    if (geometry && geometry.encoding === 'polyline') {
+        route.coordinates = geometry.lines.map(line => decodePolyline(line, geometry.precision));
+        delete route.geometry;
+    }
+    return route;
+}
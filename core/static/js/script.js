@@ -4,6 +4,7 @@ let markers = [];
 let currentRouteIndex = -1;
 let routesData = [];
 let geocodedPoints = {};
+let routeDetailsRequests = {};
 function initMap() {
     DG.then(function() {
         DG.key = '5ef601a4-d465-4d49-8a46-e8f62b1c159a';
@@ -95,7 +96,56 @@ function showPointsOnMap() {
         map.fitBounds(bounds, { padding: [50, 50] });
     }
 }
+// Подробности маршрута (геометрия, сегменты, HTML блока «Подробный маршрут») по details_url:
+// на страницу целиком приходит только первый маршрут
+function loadRouteDetails(routeIndex) {
+    const route = routesData[routeIndex];
+    if (!route || !route.details_url) {
+        return Promise.resolve(route);
+    }
+    if (!routeDetailsRequests[routeIndex]) {
+        const container = document.getElementById(`route-details-${routeIndex + 1}`);
+        routeDetailsRequests[routeIndex] = fetch(route.details_url, { headers: { 'Accept': 'application/json' } })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`HTTP ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(data => {
+                Object.assign(route, unpackRouteGeometry(data.route));
+                delete route.details_url;
+                if (container) {
+                    container.innerHTML = data.html;
+                }
+                return route;
+            })
+            .catch(error => {
+                console.error('Ошибка загрузки подробностей маршрута:', error);
+                delete routeDetailsRequests[routeIndex];
+                if (container) {
+                    container.innerHTML = '<div class="text-danger small">Не удалось загрузить подробности маршрута. Повторите поиск.</div>';
+                }
+                throw error;
+            });
+    }
+    return routeDetailsRequests[routeIndex];
+}
+
+function prefetchRouteDetails() {
+    const whenIdle = window.requestIdleCallback || (callback => setTimeout(callback, 1000));
+    routesData.forEach((route, index) => {
+        if (route.details_url) {
+            whenIdle(() => loadRouteDetails(index).catch(() => {}));
+        }
+    });
+}
+
 function showRouteOnMap(routeIndex) {
+    if (routesData[routeIndex] && routesData[routeIndex].details_url) {
+        loadRouteDetails(routeIndex).then(() => showRouteOnMap(routeIndex)).catch(() => {});
+        return;
+    }
     if (routeIndex === currentRouteIndex) {
         return;
     }
@@ -512,13 +562,115 @@ function fetchAutocompleteResults(query, container, input) {
     }
     function initializeDjangoData() {
         if (typeof window.djangoData !== 'undefined') {
-            routesData = window.djangoData.routesData || [];
+            routesData = (window.djangoData.routesData || []).map(unpackRouteGeometry);
             geocodedPoints = window.djangoData.geocodedPoints || {};
         }
     }
+    // JSON API поиска (api/v1/routes/): параметры как у формы поиска, маршруты с геометрией
+    // приходят в том же виде, что routesData. Повторные запросы браузер проверяет по ETag
+    function fetchRoutes(params, withGeometry) {
+        const query = new URLSearchParams(params);
+        if (withGeometry) {
+            query.set('geometry', '1');
+        }
+        return fetch(`${window.djangoData.routesApiUrl}?${query}`, { headers: { 'Accept': 'application/json' } })
+            .then(response => response.json())
+            .then(data => {
+                data.routes = (data.routes || []).map(unpackRouteGeometry);
+                return data;
+            });
+    }
+    // Поиск потоком Server-Sent Events (api/v1/routes/stream/): точки, маршруты и итог
+    // показываются по мере готовности, без перезагрузки страницы
+    let searchSource = null;
+
+    function showSearchError(message) {
+        const container = document.getElementById('search-error');
+        container.innerHTML = '';
+        if (!message) {
+            return;
+        }
+        const box = document.createElement('div');
+        box.className = 'error-box';
+        box.innerHTML = '<h6><i class="fas fa-exclamation-triangle me-1"></i>Ошибка</h6><p class="mb-0"></p>';
+        box.querySelector('p').textContent = message;
+        container.appendChild(box);
+    }
+
+    function resetSearchResults() {
+        routesData = [];
+        routeDetailsRequests = {};
+        currentRouteIndex = -1;
+        geocodedPoints = {};
+        clearMap();
+        showSearchError(null);
+        document.getElementById('routesAccordion').innerHTML = '';
+        document.getElementById('routes-count').textContent = '0';
+        document.getElementById('routes-card').hidden = true;
+        const noResults = document.getElementById('no-results');
+        if (noResults) {
+            noResults.remove();
+        }
+    }
+
+    function streamSearch(form) {
+        const params = new URLSearchParams(new FormData(form));
+        if (searchSource) {
+            searchSource.close();
+        }
+        resetSearchResults();
+        history.pushState(null, '', `${form.action}?${params}`);
+        const source = new EventSource(`${window.djangoData.routesStreamUrl}?${params}`);
+        searchSource = source;
+        const finish = () => {
+            source.close();
+            hideLoading();
+            prefetchRouteDetails();
+        };
+
+        source.addEventListener('points', event => {
+            const data = JSON.parse(event.data);
+            geocodedPoints = data.points;
+            document.getElementById('search-summary').innerHTML = data.summary_html;
+            hideLoading();
+            showPointsOnMap();
+        });
+        source.addEventListener('route', event => {
+            const data = JSON.parse(event.data);
+            routesData[data.index] = unpackRouteGeometry(data.route);
+            document.getElementById('routesAccordion').insertAdjacentHTML('beforeend', data.html);
+            document.getElementById('routes-count').textContent = routesData.length;
+            document.getElementById('routes-card').hidden = false;
+            if (data.index === 0) {
+                showRouteOnMap(0);
+            }
+        });
+        source.addEventListener('done', event => {
+            const data = JSON.parse(event.data);
+            document.getElementById('search-summary').innerHTML = data.summary_html;
+            showSearchError(data.message);
+            if (data.total_routes === 0) {
+                showSearchError('Маршруты не найдены. Попробуйте изменить параметры поиска или уточнить адреса');
+            }
+            finish();
+        });
+        source.addEventListener('failed', event => {
+            showSearchError(JSON.parse(event.data).message);
+            finish();
+        });
+        // Обрыв соединения: EventSource переподключился бы и повторил поиск
+        source.onerror = () => {
+            if (source.readyState !== EventSource.CLOSED) {
+                showSearchError('Соединение прервано. Повторите поиск.');
+                finish();
+            }
+        };
+    }
+
     document.addEventListener('DOMContentLoaded', function() {
         initializeDjangoData();
         initMap();
+        prefetchRouteDetails();
         setupAutocomplete('id_start_point', 'start-autocomplete');
         setupAutocomplete('id_end_point', 'end-autocomplete');
         const form = document.getElementById('route-form');
@@ -534,6 +686,11 @@ function fetchAutocompleteResults(query, container, input) {
                 }
                 
                 showLoading();
+                if (window.EventSource && window.djangoData && window.djangoData.routesStreamUrl) {
+                    e.preventDefault();
+                    streamSearch(form);
+                    return;
+                }
                 
                 setTimeout(hideLoading, 10000);
             });
@@ -0,0 +1,108 @@
+"""
+Помощники тестов: проверки числа SQL-запросов и разобранные ответы
+провайдеров из фикстур бенчмарков.
+
+    class StatusTests(QueryBudgetTestMixin, TestCase):
+        def test_budget(self):
+            self.assertWithinQueryBudget('/api/status/')
+
+        def test_no_n_plus_one(self):
+            with self.assertMaxQueries(3, max_duplicates=1):
+                ...
+
+assertWithinQueryBudget берёт бюджет представления так же, как
+QueryBudgetMiddleware (QUERY_BUDGETS, @query_budget, QUERY_BUDGET_DEFAULT),
+поэтому тест падает при том же превышении, что и предупреждение в DEBUG.
+
+parsed_public_routes и parsed_car_routes разбирают сохранённые ответы 2GIS
+и TomTom для Екатеринбурга (core/benchmarks/fixtures), FixtureRoutingService
+отдаёт готовый ответ вместо провайдера:
+
+    service = CachedRoutingService(FixtureRoutingService(parsed_public_routes()), provider_name='test')
+
+TempDirTestMixin.temp_dir создаёт каталог, удаляемый после теста, и при
+необходимости подставляет его путь в настройку:
+
+    def setUp(self):
+        self.charts = self.temp_dir('charts-', 'CHART_CACHE_DIR')
+"""
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.test import override_settings
+from django.urls import resolve
+
+from core.benchmarks import load_fixture
+from core.query_budget import QueryCounter, budget_for
+from core.services.routing_service import TomTomRoutingService
+from core.services.twogis_public_transport_service import TwoGisPublicTransportService
+
+ROUTE_START = (56.858675, 60.600974)  # ЖД вокзал
+ROUTE_END = (56.844228, 60.653954)    # УрФУ
+
+
+def parsed_public_routes():
+    """Разобранный ответ 2GIS: 5 вариантов проезда с геометрией по участкам"""
+    service = TwoGisPublicTransportService(api_key='fixture')
+    return service._parse_api_response(load_fixture('twogis_public_transport'), *ROUTE_START, *ROUTE_END)
+
+
+def parsed_car_routes():
+    """Разобранный ответ TomTom: маршрут на машине на ~900 точек"""
+    return TomTomRoutingService(api_key='fixture')._parse_tomtom_response(load_fixture('tomtom_route_car'), 'car')
+
+
+class FixtureRoutingService:
+    """Провайдер, мгновенно отдающий заранее разобранный ответ"""
+
+    def __init__(self, route_data):
+        self.route_data = route_data
+
+    def get_routes(self, start_lat, start_lon, end_lat, end_lon, **kwargs):
+        return self.route_data
+
+
+class QueryBudgetTestMixin:
+    """Примесь к django.test.TestCase"""
+
+    @contextmanager
+    def assertMaxQueries(self, max_queries, max_duplicates=None, using=None):
+        """
+        Блок выполнил не больше max_queries запросов; при заданном
+        max_duplicates ни один SQL не повторился чаще (признак N+1)
+        """
+        with QueryCounter(using) as counter:
+            yield counter
+        self.assertLessEqual(
+            counter.count, max_queries,
+            f"{counter.count} SQL-запросов при бюджете {max_queries}:\n{counter.report()}"
+        )
+        if max_duplicates is not None:
+            duplicates = counter.duplicates(max_duplicates + 1)
+            if duplicates:
+                sql, count = duplicates[0]
+                self.fail(f"Запрос выполнен {count} раз (допустимо {max_duplicates}): {sql}")
+
+    def assertWithinQueryBudget(self, path, method='get', data=None, budget=None,
+                                max_duplicates=None, status_code=200, **extra):
+        """
+        Запрос тестовым клиентом укладывается в бюджет представления по path
+        (или в явно переданный budget). Возвращает ответ.
+        """
+        if budget is None:
+            budget = budget_for(resolve(path.split('?', 1)[0]))
+        with self.assertMaxQueries(budget, max_duplicates):
+            response = getattr(self.client, method)(path, data, **extra)
+        self.assertEqual(response.status_code, status_code)
+        return response
+
+
+class TempDirTestMixin:
+    """Примесь к django.test.TestCase: временные каталоги на время теста"""
+
+    def temp_dir(self, prefix, setting=None):
+        directory = Path(self.enterContext(tempfile.TemporaryDirectory(prefix=prefix)))
+        if setting:
+            self.enterContext(override_settings(**{setting: str(directory)}))
+        return directory
@@ -1,3 +1,1071 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+from datetime import datetime, time, timedelta
+from io import StringIO
+from time import perf_counter
+from types import SimpleNamespace
 
-# Create your tests here.
+import numpy as np
+import requests
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import LiveServerTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import memory, metrics, timing
+from .models import (AnalyticsRollup, ApiLatencyRollup, ApiLog, CachedRoute, ProfileRecord, RouteGeometry,
+                     SearchHistory)
+from .benchmarks import fake_providers, load_fixture
+from .benchmarks.hot_paths import legacy_parse_wkt_linestring, long_wkt, wkt_selections
+from .profiling import SamplingProfiler, top_functions
+from .query_budget import QueryBudgetExceeded, QueryCounter, limit_queries
+from .services import geometry, geometry_store, presentation, provider_http
+from .services.analytics_service import AnalyticsService
+from .services.cached_routing_service import CachedRoutingService
+from .services.chart_cache_service import ChartCacheService
+from .services.export_service import ExportService
+from .services.latency_service import LatencyHistogram, LatencyService
+from .services.provider_http import Cassette
+from .services.route_model import Instruction, Route, dump_route_data
+from .services.routing_service import TomTomRoutingService, collect_routes
+from .services.twogis_public_transport_service import TwoGisPublicTransportService
+from .testing import (ROUTE_END, ROUTE_START, FixtureRoutingService, QueryBudgetTestMixin, TempDirTestMixin,
+                      parsed_car_routes, parsed_public_routes)
+from .views import geocode_points, route_details_url, routes_for_map, routes_for_page
+
+
+class QueryCounterTests(TestCase):
+
+    def test_counts_queries_and_duplicates(self):
+        with QueryCounter() as counter:
+            for provider in ('stub', 'tomtom_car', 'tomtom_pedestrian'):
+                ApiLog.objects.filter(provider=provider).count()
+            CachedRoute.objects.count()
+        self.assertEqual(counter.count, 4)
+        [(sql, count)] = counter.duplicates()
+        self.assertIn('core_apilog', sql)
+        self.assertEqual(count, 3)
+
+    def test_limit_queries_raises_with_report(self):
+        with self.assertRaisesMessage(QueryBudgetExceeded, 'пересчёт: 2 SQL-запросов при бюджете 1'):
+            with limit_queries(1, 'пересчёт'):
+                ApiLog.objects.count()
+                CachedRoute.objects.count()
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class EndpointQueryBudgetTests(QueryBudgetTestMixin, TempDirTestMixin, TestCase):
+    """Бюджеты SQL-запросов эндпоинтов не зависят от объёма данных"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('staff', password='secret', is_staff=True)
+        now = timezone.now()
+        providers = ('2gis_public_transport', 'tomtom_car', 'tomtom_pedestrian', 'tomtom_bicycle', 'stub')
+        ApiLog.objects.bulk_create([
+            ApiLog(provider=provider, response_status=200 if i % 4 else 500,
+                   response_time_ms=100 + i, was_cached=bool(i % 2),
+                   error_message='' if i % 4 else 'Таймаут')
+            for provider in providers for i in range(8)
+        ])
+        SearchHistory.objects.bulk_create([
+            SearchHistory(start_query=f'Старт {i % 3}', end_query=f'Финиш {i % 2}',
+                          routes_count=i % 4, is_successful=bool(i % 4))
+            for i in range(20)
+        ])
+        CachedRoute.objects.bulk_create([
+            CachedRoute(hash_key=f'key{i}', route_data={}, expires_at=now + timedelta(hours=1 if i % 2 else -1))
+            for i in range(6)
+        ])
+
+    def setUp(self):
+        cache.clear()
+        self.temp_dir('charts-', 'CHART_CACHE_DIR')
+        self.client.force_login(self.staff)
+
+    def test_api_status(self):
+        response = self.assertWithinQueryBudget('/api/status/', max_duplicates=1)
+        stats = response.json()
+        self.assertEqual(stats['total_cached_routes'], 6)
+        self.assertEqual(stats['active_cached_routes'], 3)
+        self.assertEqual(stats['provider_stats']['stub']['requests'], 8)
+        self.assertEqual(stats['provider_stats']['stub']['success_rate'], 75.0)
+        self.assertEqual(stats['provider_stats']['stub']['cache_hit_rate'], 50.0)
+
+    def test_clear_cache(self):
+        response = self.assertWithinQueryBudget('/admin/clear-cache/')
+        self.assertEqual(response.context['cache_stats']['expired'], 3)
+        self.assertWithinQueryBudget('/admin/clear-cache/', method='post')
+        self.assertEqual(CachedRoute.objects.count(), 3)
+
+    def test_analytics_dashboard(self):
+        # Дневные агрегаты читаются одним запросом на вид, а не на серию или день
+        self.assertWithinQueryBudget('/admin/analytics/', max_duplicates=len(AnalyticsService.ROLLUPS))
+        # Повторный показ — из кэша дашборда
+        self.assertWithinQueryBudget('/admin/analytics/', budget=2)
+
+    def test_analytics_series(self):
+        self.assertWithinQueryBudget('/admin/analytics/api/provider_stats/', data={'days': 30})
+
+    def test_metrics(self):
+        self.assertWithinQueryBudget('/metrics')
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class QueryBudgetMiddlewareTests(TestCase):
+
+    @override_settings(QUERY_BUDGET_ENABLED=True, QUERY_BUDGET_ACTION='raise', QUERY_BUDGETS={'api_status': 1})
+    def test_raises_over_budget(self):
+        with self.assertRaisesMessage(QueryBudgetExceeded, 'при бюджете 1'):
+            self.client.get('/api/status/')
+
+    @override_settings(QUERY_BUDGET_ENABLED=True, QUERY_BUDGET_ACTION='warn', QUERY_BUDGETS={'api_status': 1})
+    def test_warns_over_budget(self):
+        with self.assertLogs('core.middleware', 'WARNING') as logs:
+            response = self.client.get('/api/status/')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(int(response['X-DB-Queries']), 1)
+        self.assertTrue(any('при бюджете 1' in line for line in logs.output))
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, SERVER_TIMING_ENABLED=True, USE_REAL_API=False,
+                   USE_PUBLIC_TRANSPORT_API=True, TWOGIS_PUBLIC_TRANSPORT_API_KEY='test',
+                   PROVIDER_CASSETTE_MODE='replay', PROVIDER_CASSETTE_LATENCY_SCALE=0)
+class ServerTimingTests(TempDirTestMixin, TestCase):
+    PARAMS = {'start_point': 'Плотинка', 'end_point': 'Гринвич', 'travel_mode': 'public'}
+
+    def setUp(self):
+        cache.clear()
+        # Точки геокодируются (и кэшируются) заранее, ответ 2GIS — из кассеты
+        directory = self.temp_dir('cassettes-', 'PROVIDER_CASSETTE_DIR')
+        points, _ = geocode_points(self.PARAMS)
+        body = {'locale': 'ru', 'output': 'routes'}
+        for name, key in (('Start', 'start'), ('End', 'end')):
+            point = {'lat': points[key]['lat'], 'lon': points[key]['lon']}
+            body['source' if key == 'start' else 'target'] = {'name': name, 'point': point}
+        Cassette(directory / '2gis_public_transport.jsonl.gz').append({
+            'request': {'method': 'POST', 'url': 'https://routing.api.2gis.com/public_transport/2.0',
+                        'params': {}, 'body': body},
+            'response': {'status': 200, 'body': json.dumps(load_fixture('twogis_public_transport'))},
+        })
+
+    def stages(self, response):
+        return [part.split(';')[0] for part in response['Server-Timing'].split(', ')]
+
+    def test_header_lists_search_stages(self):
+        response = self.client.get('/api/v1/routes/', self.PARAMS)
+        self.assertEqual(response.json()['status'], 'success')
+        stages = self.stages(response)
+        self.assertLessEqual({'cache_lookup', 'provider_http', 'parse', 'present'}, set(stages))
+        self.assertEqual(stages[-1], 'total')
+
+        cached = self.stages(self.client.get('/api/v1/routes/', self.PARAMS))
+        self.assertIn('cache_lookup', cached)
+        self.assertNotIn('provider_http', cached)
+
+    @override_settings(SERVER_TIMING_ENABLED=False)
+    def test_disabled_middleware_adds_no_header(self):
+        response = self.client.get('/api/v1/routes/', self.PARAMS)
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertNotIn('Server-Timing', response)
+
+    def test_span_outside_request_is_noop(self):
+        self.assertIs(timing.span('parse'), timing._NULL_SPAN)
+        timings, token = timing.activate()
+        try:
+            with timing.span('parse'):
+                pass
+            with timing.span('parse'):
+                pass
+        finally:
+            timing.deactivate(token)
+        self.assertIsNone(timing.current())
+        self.assertEqual(timings.stages['parse'][1], 2)
+        self.assertRegex(timings.header_value(1.0), r'^parse;dur=[0-9.]+;desc="x2", total;dur=1\.0$')
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, PROFILER_INTERVAL_MS=1, QUERY_BUDGET_ENABLED=False)
+class ProfilingTests(TestCase):
+
+    def setUp(self):
+        self.staff = User.objects.create_user('staff', password='secret', is_staff=True)
+
+    def test_staff_request_is_profiled(self):
+        self.client.force_login(self.staff)
+        response = self.client.get('/api/status/', {'_profile': '1'})
+        self.assertEqual(response['X-Profile-Status'], 'recorded')
+        self.assertIn('private', response['Cache-Control'])
+        record = ProfileRecord.objects.get(pk=response['X-Profile-Id'])
+        self.assertEqual((record.username, record.path, record.status_code), ('staff', '/api/status/?_profile=1', 200))
+
+        response = self.client.get('/api/status/', HTTP_X_PROFILE='1')
+        self.assertEqual(response['X-Profile-Status'], 'recorded')
+        self.assertEqual(ProfileRecord.objects.count(), 2)
+
+    def test_other_users_are_not_profiled(self):
+        response = self.client.get('/api/status/', {'_profile': '1'})
+        self.assertNotIn('X-Profile-Status', response)
+        self.client.force_login(User.objects.create_user('user', password='secret'))
+        response = self.client.get('/api/status/', HTTP_X_PROFILE='1')
+        self.assertNotIn('X-Profile-Status', response)
+        self.assertFalse(ProfileRecord.objects.exists())
+
+    @override_settings(PROFILER_MAX_PER_HOUR=1)
+    def test_hourly_limit(self):
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get('/api/status/', {'_profile': '1'})['X-Profile-Status'], 'recorded')
+        with self.assertLogs('core.middleware', 'WARNING'):
+            response = self.client.get('/api/status/', {'_profile': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Profile-Status'], 'rate-limited')
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(ProfileRecord.objects.count(), 1)
+
+    def test_collapsed_stacks(self):
+        def busy():
+            deadline = perf_counter() + 0.05
+            while perf_counter() < deadline:
+                pass
+
+        with SamplingProfiler(interval=0.001) as profiler:
+            busy()
+        lines = profiler.collapsed().splitlines()
+        self.assertEqual(sum(int(line.rpartition(' ')[2]) for line in lines), profiler.samples)
+        self.assertGreater(profiler.samples, 0)
+        stack, _, count = lines[0].rpartition(' ')
+        self.assertTrue(count.isdigit())
+        self.assertRegex(stack.split(';')[-1], r'^busy \(core/tests\.py:\d+\)$')
+
+        top = top_functions('a;b;c 3\na;c 1\nmalformed')
+        self.assertEqual(top[0], ('c', 4, 4, 4))
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class MemoryStatusTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('staff', password='secret', is_staff=True))
+        self.addCleanup(memory.TRACKER.stop)
+
+    def post(self, action, **data):
+        return self.client.post(reverse('memory_status'), dict(data, action=action))
+
+    def test_start_diff_stop(self):
+        state = self.client.get(reverse('memory_status')).json()
+        self.assertEqual((state['status'], state['tracemalloc']['tracing']), ('success', False))
+        self.assertNotIn('diff', state)
+
+        with self.assertLogs('core.views', 'INFO'):
+            started = self.post('start', frames=2).json()
+        self.assertTrue(started['tracemalloc']['tracing'])
+        self.assertNotIn('diff', started)
+
+        retained = [bytearray(1024) for _ in range(256)]
+        diff = self.post('diff', key_type='filename', limit=5).json()['diff']
+        self.assertLessEqual(len(diff['top']), 5)
+        self.assertGreater(diff['total_diff_kb'], 0)
+        self.assertIn('diff', self.client.get(reverse('memory_status'), {'objects': '1'}).json())
+        del retained
+
+        with self.assertLogs('core.views', 'INFO'):
+            stopped = self.post('stop').json()
+        self.assertFalse(stopped['tracemalloc']['tracing'])
+        self.assertFalse(memory.TRACKER.active)
+
+    def test_errors(self):
+        for action in ('diff', 'stop'):
+            response = self.post(action)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('action=start', response.json()['message'])
+        self.assertEqual(self.post('restart').status_code, 400)
+        self.assertEqual(self.post('start', frames='x').status_code, 400)
+        self.assertFalse(memory.TRACKER.active)
+
+        self.post('start')
+        response = self.client.get(reverse('memory_status'), {'key_type': 'module'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_staff_only(self):
+        self.client.logout()
+        response = self.post('start')
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(memory.TRACKER.active)
+
+
+class FakeProvidersTests(TestCase):
+    POINTS = (56.858675, 60.600974, 56.844228, 60.653954)
+
+    def setUp(self):
+        scenario = fake_providers.build_scenario(overrides={
+            '*': {'latency': {'distribution': 'fixed', 'ms': 0}},
+            'tomtom_routing': {'rate_limit': {'rps': 0.001, 'burst': 1}},
+        })
+        server = fake_providers.make_server('127.0.0.1', 0, scenario, seed=1)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f'http://127.0.0.1:{server.server_port}'
+
+    def test_provider_responses(self):
+        with override_settings(TWOGIS_PUBLIC_TRANSPORT_URL=f'{self.url}/public_transport/2.0', TOMTOM_API_URL=self.url):
+            public = TwoGisPublicTransportService(api_key='fake').get_routes(*self.POINTS)
+            car = TomTomRoutingService(api_key='fake').get_routes(*self.POINTS, travel_mode='car')
+            # Ведро на один запрос: второй маршрут TomTom получает 429
+            with self.assertLogs('core.services.routing_service', 'ERROR'):
+                with self.assertRaisesMessage(Exception, '429'):
+                    TomTomRoutingService(api_key='fake').get_routes(*self.POINTS, travel_mode='car')
+        self.assertEqual(public['raw']['parser'], '2gis')
+        self.assertTrue(public['result'])
+        self.assertEqual(car['raw']['parser'], 'tomtom')
+        self.assertEqual(len(car['result']), 1)
+
+        response = requests.post(f'{self.url}/_fake/scenario', json={'2gis': {'outages': [[0, 3600]]}}, timeout=5)
+        self.assertEqual(response.status_code, 200)
+        body = {'source': {'point': {'lat': 56.85, 'lon': 60.6}}, 'target': {'point': {'lat': 56.84, 'lon': 60.65}}}
+        outage = requests.post(f'{self.url}/public_transport/2.0', params={'key': 'fake'}, json=body, timeout=5)
+        self.assertEqual(outage.status_code, 503)
+        self.assertEqual(requests.post(f'{self.url}/public_transport/2.0', json=body, timeout=5).status_code, 403)
+
+        stats = requests.get(f'{self.url}/_fake/stats', timeout=5).json()['stats']
+        self.assertEqual(stats['2gis'], {'ok': 1, 'outage': 1})
+        self.assertEqual(stats['tomtom_routing'], {'ok': 1, 'rate_limited': 1})
+
+
+# Закрытая модель нагрузки против тестового сервера с заглушками провайдеров
+@override_settings(SECURE_SSL_REDIRECT=False, SERVER_TIMING_ENABLED=True, USE_REAL_API=False,
+                   USE_PUBLIC_TRANSPORT_API=False, TOMTOM_API_URL='http://127.0.0.1:9')
+class LoadTestSmokeTests(LiveServerTestCase):
+
+    def test_report(self):
+        out = StringIO()
+        call_command('loadtest', url=self.live_server_url, source='synthetic', mix='home=1,status=1',
+                     requests=4, concurrency=2, seed=1, json=True, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual((report['model'], report['requests'], report['errors']), ('closed', 4, 0))
+        self.assertLessEqual({'p50', 'p90', 'p95', 'p99', 'max'}, set(report['latency_ms']))
+        self.assertLessEqual(set(report['endpoints']), {'home', 'status'})
+        self.assertEqual(sum(stats['requests'] for stats in report['endpoints'].values()), 4)
+        self.assertGreater(report['throughput_rps'], 0)
+        self.assertEqual(report['config']['requests'], 4)
+        self.assertEqual(report['server_services']['routing_other'], 'stub')
+        if 'home' in report['endpoints']:
+            self.assertEqual(report['cache']['source'], 'server-timing')
+
+
+class StartupTests(TestCase):
+
+    def test_worker_starts_without_heavy_modules(self):
+        # Модули геометрии загружаются с views, NumPy — только при разборе маршрутов
+        out = StringIO()
+        call_command('benchmark_startup', runs=1, stdout=out)
+        self.assertIn('Регрессий старта не обнаружено', out.getvalue())
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ChartCacheTests(TempDirTestMixin, TestCase):
+    RECORDS = [{'provider': 'stub', 'request_count': 2}]
+
+    def setUp(self):
+        self.directory = self.temp_dir('charts-', 'CHART_CACHE_DIR')
+
+    def test_digest_depends_on_chart_and_data_only(self):
+        digest = ChartCacheService.make_digest('provider_stats', self.RECORDS)
+        self.assertEqual(digest, ChartCacheService.make_digest('provider_stats', [{'request_count': 2, 'provider': 'stub'}]))
+        self.assertNotEqual(digest, ChartCacheService.make_digest('provider_stats', [{'provider': 'stub', 'request_count': 3}]))
+        self.assertNotEqual(digest, ChartCacheService.make_digest('travel_modes', self.RECORDS))
+
+    def test_rendered_chart_is_reused(self):
+        service = ChartCacheService()
+        digest = service.make_digest('provider_stats', self.RECORDS)
+        service.path_for(digest).write_bytes(b'png')
+        chart = service.submit('provider_stats', self.RECORDS)
+        self.assertEqual((chart['digest'], chart['ready']), (digest, True))
+        # Спецификация сохраняется только перед постановкой в очередь рендеринга
+        self.assertFalse(service.spec_path(digest).exists())
+
+        self.client.force_login(User.objects.create_user('staff', password='secret', is_staff=True))
+        response = self.client.get(chart['url'])
+        self.assertEqual(b''.join(response.streaming_content), b'png')
+        self.assertIn('immutable', response['Cache-Control'])
+        unknown = reverse('analytics_chart', kwargs={'digest': '0' * 64, 'fmt': 'png'})
+        self.assertEqual(self.client.get(unknown).status_code, 404)
+
+    def test_prune_by_age_then_size(self):
+        service = ChartCacheService()
+        now = timezone.now().timestamp()
+        for index, age in enumerate((10, 20, 30, 10 ** 6)):
+            path = service.path_for(f'{index:064d}')
+            path.write_bytes(b'x' * 100)
+            os.utime(path, (now - age, now - age))
+        # Неиспользуемый дольше max_age удаляется, затем самые старые сверх max_bytes
+        self.assertEqual(service.prune(max_age=3600, max_bytes=250, now=now), 2)
+        self.assertEqual(sorted(path.name[63] for path in self.directory.iterdir()), ['0', '1'])
+
+    @override_settings(CHART_CACHE_MAX_AGE=60, CHART_CACHE_PRUNE_INTERVAL=0)
+    def test_submit_prunes_and_keeps_reused_chart(self):
+        service = ChartCacheService()
+        digest = service.make_digest('provider_stats', self.RECORDS)
+        old = timezone.now().timestamp() - 3600
+        for path in (service.path_for(digest), service.path_for('0' * 64), service.spec_path('0' * 64)):
+            path.write_bytes(b'png')
+            os.utime(path, (old, old))
+        self.assertTrue(service.submit('provider_stats', self.RECORDS)['ready'])
+        self.assertEqual([path.name for path in self.directory.iterdir()], [f'{digest}.png'])
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class MetricsTests(TempDirTestMixin, TestCase):
+
+    def setUp(self):
+        self.directory = self.temp_dir('metrics-')
+        self.registry = metrics.MetricsRegistry()
+        self.requests = metrics.Counter('test_requests_total', 'Запросы', ('view',), registry=self.registry)
+        self.workers = metrics.Gauge('test_workers', 'Воркеры', registry=self.registry)
+
+    def write_worker(self, pid, requests):
+        (self.directory / f'worker_{pid}.json').write_text(json.dumps({'pid': pid, 'metrics': {
+            'test_requests_total': {'type': 'counter', 'samples': [[['home'], requests]]},
+            'test_workers': {'type': 'gauge', 'samples': [[[], 1]]},
+        }}))
+
+    def test_workers_are_merged_and_dead_ones_archived(self):
+        finished = subprocess.Popen([sys.executable, '-c', ''])
+        finished.wait()
+        with override_settings(METRICS_MULTIPROCESS_DIR=str(self.directory)):
+            self.requests.inc(view='home')
+            self.workers.set(1)
+            self.write_worker(os.getppid(), 2)
+            self.write_worker(finished.pid, 3)
+            values = self.registry.collect()
+            self.assertEqual(values['test_requests_total'], {('home',): 6})
+            # Gauge завершившегося воркера отбрасывается, счётчик переносится в архив
+            self.assertEqual(values['test_workers'], {(): 2})
+            self.assertFalse((self.directory / f'worker_{finished.pid}.json').exists())
+            self.assertEqual(self.registry.collect()['test_requests_total'], {('home',): 6})
+
+    def test_access_requires_token_or_staff(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE http_requests_total counter', response.content.decode())
+        self.client.force_login(User.objects.create_user('staff', password='secret', is_staff=True))
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class AnalyticsRollupTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, day=None):
+        search = SearchHistory.objects.create(start_query='Плотинка', end_query='Гринвич', routes_count=2)
+        if day:
+            timestamp = datetime.combine(day, time(12), timezone.get_current_timezone())
+            SearchHistory.objects.filter(pk=search.pk).update(timestamp=timestamp)
+
+    def test_closed_days_are_stored_and_today_expires(self):
+        today = timezone.localdate()
+        yesterday = today - timedelta(days=1)
+        self.search(yesterday)
+        self.search()
+        self.assertEqual(AnalyticsService().get_series('summary', yesterday, today)['total_searches'], 2)
+        self.assertEqual(AnalyticsRollup.objects.get(kind='searches').day, yesterday)
+
+        self.search(yesterday)
+        self.search()
+        with QueryCounter() as counter:
+            summary = AnalyticsService().get_series('summary', yesterday, today)
+        self.assertEqual((summary['total_searches'], counter.count), (2, 2))
+        # Сегодняшний агрегат живёт TODAY_CACHE_SECONDS, закрытый день не пересчитывается
+        cache.clear()
+        self.assertEqual(AnalyticsService().get_series('summary', yesterday, today)['total_searches'], 3)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        SearchHistory.objects.bulk_create([
+            SearchHistory(start_query=f'Старт {i}', end_query='Финиш, 1', routes_count=i) for i in range(5)
+        ])
+
+    def test_csv_is_streamed_in_chunks(self):
+        today = timezone.localdate()
+        chunks = list(ExportService(chunk_size=2).stream('search_history', 'csv', today, today))
+        # Заголовок и по фрагменту на каждую порцию строк
+        self.assertEqual(len(chunks), 4)
+        rows = list(csv.reader(b''.join(chunks).decode('utf-8-sig').splitlines()))
+        self.assertEqual(rows[0], list(ExportService.DATASETS['search_history'][1]))
+        self.assertEqual([row[2] for row in rows[1:]], [f'Старт {i}' for i in range(5)])
+        self.assertEqual(rows[1][3], 'Финиш, 1')
+
+    def test_export_endpoint(self):
+        self.client.force_login(User.objects.create_user('staff', password='secret', is_staff=True))
+        response = self.client.get('/admin/analytics/export/search_history/', {'days': 1})
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment; filename="search_history_', response['Content-Disposition'])
+        self.assertEqual(b''.join(response.streaming_content).decode('utf-8-sig').count('Старт'), 5)
+        response = self.client.get('/admin/analytics/export/users/', {'format': 'xlsx'})
+        self.assertEqual(response.status_code, 400)
+
+
+class LatencyHistogramTests(TestCase):
+
+    def test_percentiles_within_bucket_error(self):
+        values = [float(value) for value in range(1, 2001)]
+        histogram = LatencyHistogram()
+        for value in values:
+            histogram.add(value)
+        for q in (0.5, 0.9, 0.99):
+            exact = values[math.ceil(q * len(values)) - 1]
+            self.assertAlmostEqual(histogram.percentile(q), exact, delta=exact * (LatencyHistogram.GROWTH - 1))
+        self.assertEqual((histogram.count, histogram.min, histogram.max), (2000, 1.0, 2000.0))
+
+    def test_merge_matches_single_histogram(self):
+        odd, even, whole = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+        for value in range(1, 500):
+            (odd if value % 2 else even).add(value)
+            whole.add(value)
+        merged = LatencyHistogram.from_dict(odd.to_dict()).merge(LatencyHistogram.from_dict(even.to_dict()))
+        self.assertEqual(merged.to_dict(), whole.to_dict())
+
+
+class LatencyServiceTests(TestCase):
+
+    def log(self, value, timestamp, was_cached=False):
+        log = ApiLog.objects.create(provider='tomtom_car', response_status=200, response_time_ms=value,
+                                    was_cached=was_cached)
+        ApiLog.objects.filter(pk=log.pk).update(timestamp=timestamp)
+
+    def test_closed_hours_are_rolled_up_on_backfill(self):
+        now = timezone.now()
+        hour = LatencyService.truncate_hour(now) - timedelta(hours=3)
+        self.log(100, hour + timedelta(minutes=5))
+        self.log(300, hour + timedelta(minutes=6), was_cached=True)
+        self.log(200, now)
+        self.assertFalse(ApiLatencyRollup.objects.exists())
+
+        hours = list(LatencyService().hourly(hour, now + timedelta(hours=1), backfill=True))
+        self.assertEqual(sum(histogram.count for _, _, histogram in hours), 2)
+        # Текущий час не сворачивается: его логи ещё пишутся
+        self.assertEqual(list(ApiLatencyRollup.objects.values_list('hour', flat=True)), [hour])
+
+        # Следующие часы продолжают свёрнутые и сворачиваются при обычном чтении
+        self.log(400, hour + timedelta(hours=1, minutes=5))
+        summary = LatencyService().percentiles(hour, now + timedelta(hours=1))['tomtom_car']
+        self.assertEqual((summary['count'], summary['min'], summary['max']), (3, 100, 400))
+        self.assertEqual(ApiLatencyRollup.objects.count(), 2)
+
+    def test_status_read_does_not_backfill_history(self):
+        now = timezone.now()
+        self.log(100, now - timedelta(days=3))
+        self.log(200, now - timedelta(minutes=1))
+        with QueryCounter() as counter:
+            summary = LatencyService().percentiles(now - timedelta(hours=1), now)['tomtom_car']
+        self.assertEqual((summary['count'], summary['max']), (1, 200))
+        self.assertFalse(ApiLatencyRollup.objects.exists())
+        self.assertFalse(any(sql.startswith('INSERT') for sql, _ in counter.queries))
+
+    def test_rebuild_refreshes_dashboard_rollups(self):
+        day = timezone.localdate() - timedelta(days=2)
+        at = datetime.combine(day, time(12), timezone.get_current_timezone())
+        self.log(100, at)
+        self.assertEqual(AnalyticsService().get_series('response_times', day, day)[0]['count'], 1)
+        self.assertTrue(AnalyticsRollup.objects.filter(kind='latency', day=day).exists())
+
+        self.log(500, at + timedelta(minutes=1))
+        LatencyService().rebuild(at - timedelta(hours=1), at + timedelta(hours=1))
+        [times] = AnalyticsService().get_series('response_times', day, day)
+        self.assertEqual((times['count'], times['max_time']), (2, 500))
+
+
+@override_settings(PROVIDER_CASSETTE_LATENCY_SCALE=0)
+class ProviderCassetteTests(TempDirTestMixin, TestCase):
+    URL = 'http://127.0.0.1:9/routing/1/calculateRoute/56.85,60.6:56.84,60.65/json'
+
+    def setUp(self):
+        self.directory = self.temp_dir('cassettes-', 'PROVIDER_CASSETTE_DIR')
+
+    def test_nearest_coordinates_within_tolerance(self):
+        recorded = Cassette(self.directory / 'tomtom_routing.jsonl.gz')
+        for lat in ('56.8501', '56.8503'):
+            recorded.append({
+                'request': {'method': 'GET', 'url': f'http://a/route/{lat},60.6/json',
+                            'params': {'travelMode': 'car'}, 'body': None},
+                'response': {'status': 200, 'body': lat},
+            })
+        recorded.load()
+        # Хост и ключ API не сравниваются, координаты — с допуском
+        entry = recorded.find('GET', 'http://b/route/56.85025,60.6/json', {'travelMode': 'car', 'key': 'x'})
+        self.assertEqual(entry['response']['body'], '56.8503')
+        self.assertIsNone(recorded.find('GET', 'http://b/route/56.86,60.6/json', {'travelMode': 'car'}))
+        self.assertIsNone(recorded.find('GET', 'http://b/route/56.8501,60.6/json', {'travelMode': 'bicycle'}))
+
+    @override_settings(PROVIDER_CASSETTE_MODE='record')
+    def test_api_key_is_not_recorded(self):
+        params = {'key': 'SECRETKEY123', 'travelMode': 'car'}
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            provider_http.get('redaction', self.URL, params=params, timeout=1)
+        text = gzip.decompress((provider_http.cassette_dir() / 'redaction.jsonl.gz').read_bytes()).decode()
+        self.assertIn('travelMode=car', text)
+        self.assertNotIn('SECRETKEY123', text)
+
+        with override_settings(PROVIDER_CASSETTE_MODE='replay'):
+            with self.assertRaises(requests.exceptions.ConnectionError) as raised:
+                provider_http.get('redaction', self.URL, params=dict(params, key='OTHER'))
+        self.assertIn('из кассеты', str(raised.exception))
+        self.assertNotIn('SECRETKEY123', str(raised.exception))
+
+
+class WKTParsingTests(TestCase):
+
+    def setUp(self):
+        self.service = TwoGisPublicTransportService(api_key='test')
+
+    def test_same_output_as_legacy_parser(self):
+        for wkt in wkt_selections() + [long_wkt(), 'LINESTRING(60 56, -0.5 1e-3, 60.1234567 56.7654321)']:
+            self.assertEqual(self.service._parse_wkt_linestring(wkt), legacy_parse_wkt_linestring(wkt))
+
+    def test_multilinestring(self):
+        lines = geometry.parse_wkt_lines('MULTILINESTRING ((60.1 56.1, 60.2 56.2),(60.3 56.3, 60.4 56.4, 60.5 56.5))')
+        self.assertEqual([line.tolist() for line in lines], [
+            [[56.1, 60.1], [56.2, 60.2]],
+            [[56.3, 60.3], [56.4, 60.4], [56.5, 60.5]],
+        ])
+        self.assertEqual(self.service._parse_wkt_linestring('MULTILINESTRING((60.1 56.1, 60.2 56.2),(60.3 56.3))'),
+                         [[56.1, 60.1], [56.2, 60.2], [56.3, 60.3]])
+        # Пробелы вокруг запятой между частями
+        lines = geometry.parse_wkt_lines('MULTILINESTRING ((1 2, 3 4) , (5 6, 7 8))')
+        self.assertEqual([line.tolist() for line in lines], [[[2, 1], [4, 3]], [[6, 5], [8, 7]]])
+
+    def test_z_coordinates_and_empty(self):
+        self.assertEqual(geometry.parse_wkt_points('LINESTRING Z (60.1 56.1 250, 60.2 56.2 251)').tolist(),
+                         [[56.1, 60.1], [56.2, 60.2]])
+        self.assertEqual(geometry.parse_wkt_points('LINESTRING EMPTY').shape, (0, 2))
+
+    def test_malformed(self):
+        for wkt in ('POINT(60.1 56.1)', 'LINESTRING(60.1 56.1, 60.2)', 'LINESTRING(60.1 56.1, 60.2 x)',
+                    'LINESTRING(60.1 56.1'):
+            with self.assertRaises(geometry.WKTError, msg=wkt):
+                geometry.parse_wkt_points(wkt)
+        with self.assertLogs('core.services.twogis_public_transport_service', 'ERROR'):
+            self.assertEqual(self.service._parse_wkt_linestring('LINESTRING(60.1 56.1, 60.2)'), [])
+
+
+class LevelOfDetailTests(TestCase):
+
+    def test_simplify_keeps_shape_within_tolerance(self):
+        line = parsed_car_routes()['result'][0].lines[0]
+        simplified = geometry.simplify(line, 10.0)
+        self.assertLess(len(simplified), len(line) / 3)
+        self.assertEqual(simplified[0].tolist(), line[0].tolist())
+        self.assertEqual(simplified[-1].tolist(), line[-1].tolist())
+        # Каждая исходная точка не дальше допуска от упрощённой линии
+        scale = np.array([geometry.METERS_PER_DEGREE_LAT,
+                          geometry.METERS_PER_DEGREE_LON * np.cos(np.radians(line[:, 0].mean()))])
+        a, b = simplified[:-1] * scale, simplified[1:] * scale
+        for point in line * scale:
+            t = np.clip(np.einsum('ij,ij->i', point - a, b - a) / np.maximum(np.einsum('ij,ij->i', b - a, b - a), 1e-9), 0, 1)
+            self.assertLessEqual(np.hypot(*(a + t[:, None] * (b - a) - point).T).min(), 10.0 + 1e-6)
+
+    def test_levels_are_nested(self):
+        route = geometry.add_levels_of_detail(parsed_public_routes())['result'][0]
+        levels = route.lod
+        self.assertEqual(sorted(levels, key=int), [str(zoom) for zoom in geometry.lod_zooms()])
+        previous = set()
+        for zoom in geometry.lod_zooms():
+            points = {tuple(point) for point in levels[str(zoom)][0].tolist()}
+            self.assertTrue(previous <= points)
+            previous = points
+        self.assertLess(len(previous), len(route.lines[0]))
+
+    @override_settings(MAP_VIEWPORT_PX=(800, 500))
+    def test_route_for_map_sends_one_level(self):
+        route = geometry.add_levels_of_detail(parsed_car_routes())['result'][0]
+        payload = geometry.route_for_map(route)
+        self.assertNotIn('coordinates_lod', payload)
+        self.assertTrue(route.lod)
+        zoom = geometry.fit_zoom(route.lines)
+        self.assertEqual(payload['coordinates_zoom'], min(z for z in geometry.lod_zooms() if z >= zoom))
+        self.assertIs(payload['coordinates'], route.lod[str(payload['coordinates_zoom'])])
+        # Для маленькой карты маршрут вписывается мельче — уровень грубее
+        public = geometry.add_levels_of_detail(parsed_public_routes())['result'][0]
+        small = geometry.route_for_map(public, viewport=(200, 150))
+        self.assertLess(small['coordinates_zoom'], geometry.route_for_map(public)['coordinates_zoom'])
+        self.assertLess(len(small['coordinates'][0]), len(geometry.route_for_map(public)['coordinates'][0]))
+
+    def test_route_for_map_without_levels(self):
+        straight = Route(id='straight', travel_mode='car', lines=[np.array([[56.83, 60.59], [56.84, 60.60]])])
+        self.assertEqual(geometry.route_for_map(straight)['coordinates'][0].tolist(), [[56.83, 60.59], [56.84, 60.60]])
+        self.assertEqual(geometry.route_for_map(Route(id='empty', travel_mode='car'))['coordinates_zoom'], None)
+
+
+class EncodedPolylineTests(TestCase):
+
+    def test_reference_example(self):
+        points = [[38.5, -120.2], [40.7, -120.95], [43.252, -126.453]]
+        self.assertEqual(geometry.encode_polyline(points, 5), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+        self.assertEqual(geometry.decode_polyline('_p~iF~ps|U_ulLnnqC_mqNvxq`@', 5).tolist(), points)
+
+    def test_round_trip_is_exact_at_precision(self):
+        line = geometry.parse_wkt_points(long_wkt()).tolist() + [[-89.999999, -179.999999], [89.999999, 179.999999]]
+        self.assertEqual(geometry.decode_polyline(geometry.encode_polyline(line)).tolist(), line)
+        self.assertEqual(geometry.encode_polyline([]), '')
+        self.assertEqual(geometry.decode_polyline('').shape, (0, 2))
+
+    def test_truncated(self):
+        encoded = geometry.encode_polyline([[56.838011, 60.597465], [56.84, 60.6]])
+        for broken in (encoded[:-1], encoded[:-3], 'ё'):
+            with self.assertRaises(geometry.PolylineError):
+                geometry.decode_polyline(broken)
+
+    def test_cache_stores_packed_geometry(self):
+        route_data = parsed_public_routes()
+        service = CachedRoutingService(FixtureRoutingService(route_data), provider_name='test')
+        fresh = service.get_routes(56.858675, 60.600974, 56.844228, 60.653954)
+        stored = CachedRoute.objects.get().route_data
+        self.assertNotIn('coordinates', stored['result'][0])
+        self.assertEqual(stored['result'][0]['geometry']['encoding'], 'polyline')
+        self.assertLess(len(json.dumps(stored)), len(json.dumps(dump_route_data(fresh))) / 2)
+
+        cached = service.get_routes(56.858675, 60.600974, 56.844228, 60.653954)
+        self.assertEqual(cached['result'][0].to_dict(), fresh['result'][0].to_dict())
+
+    @override_settings(ROUTE_GEOMETRY_ENCODING='json')
+    def test_json_encoding_leaves_routes_as_is(self):
+        route = {'coordinates': [[[56.838011, 60.597465], [56.84, 60.6]]]}
+        self.assertIs(geometry.pack_route(route), route)
+
+
+
+class RouteModelTests(TestCase):
+
+    def test_round_trip(self):
+        for route in parsed_public_routes()['result'] + parsed_car_routes()['result']:
+            data = json.loads(json.dumps(route.to_dict()))
+            self.assertEqual(Route.from_dict(data).to_dict(), data)
+
+    def test_display_fields_are_derived(self):
+        route = Route(id='r', travel_mode='public', transport_types=['tram', 'bus'], transfer_count=1, crossing_count=1)
+        self.assertEqual((route.icon, route.transport_types_display, route.total_transfers), ('🚋', 'Трамвай, Автобус', 2))
+        route.fallback = True
+        self.assertEqual((route.icon, route.mode_display), ('⚠️', 'Резервный режим'))
+        # Поля для клиента при чтении игнорируются
+        self.assertEqual(Route.from_dict(dict(route.to_dict(), icon='🚗', total_transfers=9)).total_transfers, 2)
+
+    def test_legacy_tomtom_instruction(self):
+        instruction = Instruction.from_dict({'text': 'Поверните направо', 'index': 12, 'street': 'Ленина'})
+        self.assertEqual((instruction.action, instruction.point_index, instruction.extra),
+                         ('Поверните направо', 12, {'street': 'Ленина'}))
+
+
+class PresentationTests(TestCase):
+
+    def setUp(self):
+        self.service = CachedRoutingService(FixtureRoutingService(parsed_car_routes()), provider_name='test')
+
+    def test_routes_are_prepared_before_caching(self):
+        fresh = self.service.get_routes(56.858675, 60.600974, 56.844228, 60.653954, travel_mode='car')
+        stored = CachedRoute.objects.get().route_data
+        self.assertEqual(stored['presentation'], presentation.VERSION)
+        self.assertEqual(stored['result'][0]['number'], 1)
+        cached = self.service.get_routes(56.858675, 60.600974, 56.844228, 60.653954, travel_mode='car')
+        self.assertEqual(cached['result'][0].to_dict(), fresh['result'][0].to_dict())
+
+    def test_stale_version_is_prepared_on_hit(self):
+        self.service.get_routes(56.858675, 60.600974, 56.844228, 60.653954, travel_mode='car')
+        record = CachedRoute.objects.get()
+        record.route_data['presentation'] = presentation.VERSION - 1
+        for route in record.route_data['result']:
+            route['number'] = 0
+            route['instructions'] = []
+        record.save()
+        cached = self.service.get_routes(56.858675, 60.600974, 56.844228, 60.653954, travel_mode='car')
+        self.assertEqual(ApiLog.objects.filter(was_cached=False).count(), 1)
+        route = cached['result'][0]
+        self.assertEqual(route.number, 1)
+        self.assertEqual([instruction.action for instruction in route.instructions],
+                         [segment.details['text'] for segment in route.segments])
+
+    def test_request_filters_are_overlaid(self):
+        routes = presentation.prepare_route_data(parsed_public_routes(), (56.86, 60.6), (56.84, 60.65), 'public')['result']
+        filters = {'transport_types': ['tram'], 'max_transfers': None, 'only_direct': False}
+        payload = routes_for_map(routes, filters)
+        self.assertTrue(all(data['filters_applied'] == filters for data in payload))
+        self.assertNotIn('filters_applied', routes[0].to_dict())
+
+
+class FixtureTomTomService(TomTomRoutingService):
+    """TomTom с ответом из фикстуры вместо запроса к API"""
+
+    def get_routes(self, start_lat, start_lon, end_lat, end_lon, **kwargs):
+        raw = {'parser': self.PARSER_NAME, 'options': {'travel_mode': 'car'}, 'response': load_fixture('tomtom_route_car')}
+        result = self.parse_raw(raw, start_lat, start_lon, end_lat, end_lon)
+        result['raw'] = raw
+        return result
+
+
+class CacheSchemaVersionTests(TestCase):
+    POINTS = (56.858675, 60.600974, 56.844228, 60.653954)
+
+    def setUp(self):
+        self.provider = FixtureTomTomService(api_key='test')
+        self.service = CachedRoutingService(self.provider, provider_name='test')
+
+    def misses(self):
+        return ApiLog.objects.filter(was_cached=False).count()
+
+    def test_parser_version_change_is_a_miss(self):
+        self.service.get_routes(*self.POINTS, travel_mode='car')
+        self.service.get_routes(*self.POINTS, travel_mode='car')
+        self.assertEqual(self.misses(), 1)
+        self.provider.PARSER_VERSION += 1
+        self.service.get_routes(*self.POINTS, travel_mode='car')
+        self.assertEqual(self.misses(), 2)
+        # Запись прежней версии живёт до истечения: процессы до выкладки продолжают её читать
+        self.assertEqual(CachedRoute.objects.count(), 2)
+        self.assertEqual(CachedRoute.objects.filter(schema_version=self.service.schema_version('car')).count(), 1)
+        self.assertIsNone(CachedRoute.objects.first().raw_response)
+
+    def test_expired_old_version_is_reclaimed_on_write(self):
+        self.service.get_routes(*self.POINTS, travel_mode='car')
+        CachedRoute.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        self.provider.PARSER_VERSION += 1
+        self.service.get_routes(*self.POINTS, travel_mode='car')
+        self.assertEqual(CachedRoute.objects.get().schema_version, self.service.schema_version('car'))
+
+    @override_settings(ROUTE_CACHE_STORE_RAW=True)
+    def test_upgrade_from_raw_response(self):
+        fresh = self.service.get_routes(*self.POINTS, travel_mode='car')
+        self.provider.PARSER_VERSION += 1
+        old = CachedRoute.objects.get()
+        self.assertTrue(self.service.upgrade(old))
+        self.assertFalse(self.service.upgrade(CachedRoute.objects.get()))
+        record = CachedRoute.objects.get()
+        self.assertEqual((record.schema_version, record.expires_at), (self.service.schema_version('car'), old.expires_at))
+        cached = self.service.get_routes(*self.POINTS, travel_mode='car')
+        self.assertEqual(self.misses(), 1)
+        self.assertEqual(cached['result'][0].to_dict(), fresh['result'][0].to_dict())
+
+
+class SharedGeometryTests(TestCase):
+
+    def setUp(self):
+        self.route_data = parsed_public_routes()
+        self.provider = FixtureRoutingService(self.route_data)
+        self.service = CachedRoutingService(self.provider, provider_name='test')
+
+    def test_parts_cover_route_line(self):
+        for route in self.route_data['result']:
+            self.assertEqual(sum(route.parts), len(route.lines[0]))
+
+    def test_overlapping_searches_share_parts(self):
+        self.service.get_routes(56.858675, 60.600974, 56.844228, 60.653954)
+        parts = RouteGeometry.objects.count()
+        references = sum(len(route['geometry']['parts']) for route in CachedRoute.objects.get().route_data['result'])
+        self.assertGreater(parts, 0)
+        self.assertLessEqual(parts, references)
+
+        # Соседний поиск с теми же участками не добавляет геометрию
+        self.service.get_routes(56.8587, 60.601, 56.8442, 60.654)
+        self.assertEqual(CachedRoute.objects.count(), 2)
+        self.assertEqual(RouteGeometry.objects.count(), parts)
+
+    def test_cache_hit_resolves_parts_in_one_query(self):
+        fresh = self.service.get_routes(56.858675, 60.600974, 56.844228, 60.653954)
+        with QueryCounter() as counter:
+            cached = self.service.get_routes(56.858675, 60.600974, 56.844228, 60.653954)
+        self.assertEqual(len(counter.duplicates()), 0)
+        self.assertEqual(sum('core_routegeometry' in sql for sql, _ in counter.queries), 1)
+        for cached_route, fresh_route in zip(cached['result'], fresh['result']):
+            self.assertEqual(cached_route.to_dict(), fresh_route.to_dict())
+
+    def test_purged_parts_turn_hit_into_miss(self):
+        self.service.get_routes(56.858675, 60.600974, 56.844228, 60.653954)
+        self.assertGreater(geometry_store.purge_unused(timezone.now() + timedelta(minutes=31)), 0)
+        self.assertEqual(RouteGeometry.objects.count(), 0)
+        self.service.get_routes(56.858675, 60.600974, 56.844228, 60.653954)
+        self.assertEqual(ApiLog.objects.filter(was_cached=False).count(), 2)
+        self.assertGreater(RouteGeometry.objects.count(), 0)
+
+    @override_settings(ROUTE_CACHE_TTL_MINUTES=5)
+    def test_records_and_parts_share_lifetime(self):
+        self.service.get_routes(56.858675, 60.600974, 56.844228, 60.653954)
+        record = CachedRoute.objects.get()
+        self.assertLessEqual(record.expires_at - record.created_at, timedelta(minutes=5, seconds=1))
+        self.assertEqual(geometry_store.purge_unused(timezone.now() + timedelta(minutes=4)), 0)
+        self.assertGreater(geometry_store.purge_unused(timezone.now() + timedelta(minutes=6)), 0)
+
+    @override_settings(ROUTE_GEOMETRY_SHARED=False)
+    def test_disabled_store_keeps_geometry_in_record(self):
+        self.service.get_routes(56.858675, 60.600974, 56.844228, 60.653954)
+        self.assertEqual(RouteGeometry.objects.count(), 0)
+        self.assertIn('lines', CachedRoute.objects.get().route_data['result'][0]['geometry'])
+
+
+# Недоступный адрес TomTom: поиск сразу переходит на заглушку без запросов в сеть
+@override_settings(SECURE_SSL_REDIRECT=False, USE_REAL_API=False, USE_PUBLIC_TRANSPORT_API=False,
+                   TOMTOM_API_URL='http://127.0.0.1:9')
+class RoutesApiTests(TestCase):
+    PARAMS = {'start_point': 'Плотинка', 'end_point': 'Гринвич', 'travel_mode': 'car'}
+
+    def setUp(self):
+        cache.clear()
+
+    def test_summaries_and_optional_geometry(self):
+        data = self.client.get('/api/v1/routes/', self.PARAMS).json()
+        self.assertEqual(data['status'], 'success')
+        self.assertEqual(set(data['points']), {'start', 'end'})
+        route = data['routes'][0]
+        self.assertEqual((route['number'], route['travel_mode']), (1, 'car'))
+        self.assertFalse({'segments', 'instructions', 'stops', 'geometry'} & set(route))
+
+        route = self.client.get('/api/v1/routes/', dict(self.PARAMS, geometry=1)).json()['routes'][0]
+        self.assertEqual(route['geometry']['encoding'], 'polyline')
+        self.assertIn('coordinates_zoom', route)
+
+    def test_matching_etag_is_not_modified(self):
+        response = self.client.get('/api/v1/routes/', self.PARAMS)
+        cached = self.client.get('/api/v1/routes/', self.PARAMS, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b'')
+        geometry = self.client.get('/api/v1/routes/', dict(self.PARAMS, geometry=1),
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(geometry.status_code, 200)
+
+    def test_page_revalidation_skips_search(self):
+        response = self.client.get('/', self.PARAMS)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertNotIn('Cookie', response.get('Vary', ''))
+        self.assertNotContains(response, 'csrfmiddlewaretoken')
+        with QueryCounter() as counter:
+            cached = self.client.get('/', self.PARAMS, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached['ETag'], response['ETag'])
+        # Запись кэша и запись в историю поиска, без маршрутизации
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(ApiLog.objects.count(), 1)
+
+    def test_revalidated_search_is_recorded(self):
+        response = self.client.get('/api/v1/routes/', self.PARAMS)
+        self.client.get('/api/v1/routes/', self.PARAMS, HTTP_IF_NONE_MATCH=response['ETag'])
+        searches = SearchHistory.objects.order_by('id')
+        self.assertEqual(searches.count(), 2)
+        self.assertEqual([search.routes_count for search in searches], [len(response.json()['routes'])] * 2)
+        self.assertTrue(all(search.is_successful for search in searches))
+
+    def test_autocomplete_etag_follows_geocode_cache(self):
+        response = self.client.get('/api/autocomplete/', {'q': 'Плотинка'})
+        self.assertIn('public', response['Cache-Control'])
+        cached = self.client.get('/api/autocomplete/', {'q': 'Плотинка'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        cache.clear()
+        fresh = self.client.get('/api/autocomplete/', {'q': 'Плотинка'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(fresh.status_code, 200)
+
+    def test_invalid_parameters(self):
+        response = self.client.get('/api/v1/routes/', {'start_point': 'Плотинка', 'travel_mode': 'plane'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()['errors']), {'end_point', 'travel_mode'})
+
+    def test_stream_sends_points_before_routes(self):
+        response = self.client.get('/api/v1/routes/stream/', self.PARAMS)
+        self.assertEqual(response['Content-Type'], 'text/event-stream; charset=utf-8')
+        events = [
+            (block.split('\n')[0].removeprefix('event: '), json.loads(block.split('\n')[1].removeprefix('data: ')))
+            for block in b''.join(response.streaming_content).decode().strip().split('\n\n')
+        ]
+        self.assertEqual([name for name, _ in events], ['points', 'routing', 'route', 'done'])
+        self.assertEqual(set(events[0][1]['points']), {'start', 'end'})
+        self.assertEqual(events[2][1]['index'], 0)
+        self.assertIn('id="collapse1"', events[2][1]['html'])
+        self.assertEqual(events[3][1]['total_routes'], 1)
+
+        response = self.client.get('/api/v1/routes/stream/', {'start_point': 'Плотинка'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_stream_looks_up_route_cache_once(self):
+        b''.join(self.client.get('/api/v1/routes/stream/', self.PARAMS).streaming_content)
+        with QueryCounter() as counter:
+            b''.join(self.client.get('/api/v1/routes/stream/', self.PARAMS).streaming_content)
+        self.assertEqual(sum('FROM "core_cachedroute"' in sql for sql, _ in counter.queries), 1)
+
+    @override_settings(QUERY_BUDGET_ENABLED=True, QUERY_BUDGET_ACTION='raise', QUERY_BUDGETS={'routes_stream': 1})
+    def test_stream_enforces_query_budget(self):
+        response = self.client.get('/api/v1/routes/stream/', self.PARAMS)
+        with self.assertRaisesMessage(QueryBudgetExceeded, 'при бюджете 1'):
+            b''.join(response.streaming_content)
+
+
+class StreamRoutesTests(TestCase):
+
+    def setUp(self):
+        parser = TwoGisPublicTransportService(api_key='test')
+        raw = {'parser': '2gis', 'options': {'max_transfers': None, 'only_direct': False},
+               'response': load_fixture('twogis_public_transport')}
+        self.parsed = []
+
+        def stream_routes(*points, **kwargs):
+            for route in parser._stream_parsed(raw, *points):
+                self.parsed.append(route)
+                yield route
+            return parser.parse_raw(raw, *points)
+        self.service = CachedRoutingService(SimpleNamespace(stream_routes=stream_routes), provider_name='test')
+
+    def test_route_is_prepared_before_next_is_parsed(self):
+        routes = self.service.stream_routes(*ROUTE_START, *ROUTE_END)
+        first = next(routes)
+        self.assertEqual((first.number, len(self.parsed)), (1, 1))
+        self.assertTrue(first.lod)
+        self.assertFalse(CachedRoute.objects.exists())
+
+        route_data = collect_routes(routes)
+        self.assertGreater(len(self.parsed), 1)
+        self.assertEqual(CachedRoute.objects.get().routes_count, len(route_data['result']))
+        cached = self.service.get_routes(*ROUTE_START, *ROUTE_END)
+        self.assertEqual([route.to_dict() for route in cached['result']],
+                         [route.to_dict() for route in route_data['result']])
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class RouteDetailsTests(TestCase):
+    POINTS = (56.858675, 60.600974, 56.844228, 60.653954)
+
+    def setUp(self):
+        service = CachedRoutingService(FixtureRoutingService(parsed_public_routes()), provider_name='test')
+        self.route_data = service.get_routes(*self.POINTS, travel_mode='public')
+        self.cache_key = self.route_data['cache_key']
+
+    def test_details_are_read_from_cache(self):
+        fresh = self.route_data['result'][2]
+        with QueryCounter() as counter:
+            details = self.client.get(route_details_url(self.cache_key, 2)).json()
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(details['route']['number'], 3)
+        self.assertEqual(details['route']['segments'], [segment.to_dict() for segment in fresh.segments])
+        self.assertEqual(details['route']['geometry']['encoding'], 'polyline')
+        self.assertIn('Подробный маршрут', details['html'])
+
+    def test_unknown_route(self):
+        self.assertEqual(self.client.get(route_details_url(self.cache_key, 99)).status_code, 404)
+        self.assertEqual(self.client.get(route_details_url('0' * 32, 0)).status_code, 404)
+
+    def test_page_sends_details_of_first_route_only(self):
+        routes = routes_for_page(self.route_data['result'], cache_key=self.cache_key)
+        self.assertIn('geometry', routes[0])
+        self.assertNotIn('details_url', routes[0])
+        self.assertTrue(all('details_url' in route and 'segments' not in route for route in routes[1:]))
+        self.assertEqual(routes_for_page(self.route_data['result']), routes_for_map(self.route_data['result']))
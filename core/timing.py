@@ -0,0 +1,113 @@
+"""
+Замер времени этапов обработки запроса.
+
+    from core.timing import span
+
+    with span('geocode'):
+        results = geocoder.geocode(query)
+
+Замеры копятся в объекте RequestTimings текущего запроса, который
+активирует ServerTimingMiddleware. Вне запроса или при выключенном
+SERVER_TIMING_ENABLED span() возвращает общий пустой контекстный
+менеджер — накладные расходы сводятся к одному ContextVar.get().
+"""
+import functools
+import time
+from contextvars import ContextVar
+
+_current = ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """Суммарное время и количество вызовов по каждому этапу запроса"""
+
+    __slots__ = ('stages',)
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, duration_ms, count=1):
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = [duration_ms, count]
+        else:
+            stage[0] += duration_ms
+            stage[1] += count
+
+    def header_value(self, total_ms=None):
+        """Значение заголовка Server-Timing"""
+        parts = [
+            f'{name};dur={duration:.1f}' + (f';desc="x{count}"' if count > 1 else '')
+            for name, (duration, count) in self.stages.items()
+        ]
+        if total_ms is not None:
+            parts.append(f'total;dur={total_ms:.1f}')
+        return ', '.join(parts)
+
+    def summary(self):
+        return ' '.join(
+            f"{name}={duration:.1f}ms" + (f"(x{count})" if count > 1 else '')
+            for name, (duration, count) in self.stages.items()
+        )
+
+
+class _Span:
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.timings.add(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name):
+    """Контекстный менеджер, добавляющий длительность блока к этапу name"""
+    timings = _current.get()
+    if timings is None:
+        return _NULL_SPAN
+    return _Span(timings, name)
+
+
+def timed(name):
+    """Декоратор: весь вызов функции считается этапом name"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def activate():
+    """Начинает сбор замеров для текущего запроса, возвращает (timings, token)"""
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
@@ -1,14 +1,18 @@
 from django.urls import path
-from . import views
+from . import views, analytics_views
 from django.conf import settings
 from django.conf.urls.static import static
 
 urlpatterns = [
     path('', views.home, name='home'),
     path('api/autocomplete/', views.autocomplete_api, name='autocomplete'),
+    path('api/v1/routes/', views.routes_api, name='routes_api'),
+    path('api/v1/routes/stream/', views.routes_stream, name='routes_stream'),
+    path('api/v1/routes/<str:cache_key>/<int:index>/', views.route_details_api, name='route_details'),
     path('admin/clear-cache/', views.clear_cache_view, name='clear_cache'),
     path('api/status/', views.api_status, name='api_status'),
-    path('admin/analytics/', views.analytics_dashboard, name='analytics_dashboard'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('admin/analytics/', analytics_views.analytics_dashboard, name='analytics_dashboard'),
 ]
 if settings.DEBUG:
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
\ No newline at end of file
@@ -1,34 +1,427 @@
-import pandas as pd
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from io import BytesIO
-import base64
+import hashlib
 import json
 import logging
-from datetime import datetime, date, timedelta
+import os
+from datetime import datetime, timedelta
 import time
 
 from django.shortcuts import render, redirect
+from django.template.loader import render_to_string
+from django.urls import reverse
 from django.conf import settings
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.contrib.admin.views.decorators import staff_member_required
-from django.db.models import Count, Avg, Q, Case, When, FloatField, Max, Min
-from django.db.models.functions import TruncHour, TruncDay
+from django.db.models import Count, Avg, Max, Q
 from django.core.cache import cache
 from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
-import numpy as np
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.crypto import constant_time_compare
+from django.utils.html import json_script
+from django.utils.http import quote_etag
 
-from .models import SearchHistory, CachedRoute, ApiLog
+from .models import SearchHistory, CachedRoute, ApiLog, RouteGeometry
 from .forms import RouteSearchForm
 from .services.geocoding_service import StubGeocodingService, TomTomGeocodingService
-from .services.routing_service import StubRoutingService, TomTomRoutingService
-from .services.twogis_public_transport_service import TwoGisPublicTransportService
+from .services.routing_service import StubRoutingService, TomTomRoutingService, collect_routes
 from .services.cached_routing_service import CachedRoutingService
 from .services.composite_routing_service import CompositeRoutingService
+from .services.latency_service import LatencyService
+from .services import geometry, geometry_store, provider_http
+from .query_budget import budget_for, limit_stream_queries, query_budget
+from .timing import span
+from . import memory, metrics
 logger = logging.getLogger(__name__)
 
+
+class UnicodeJSONEncoder(DjangoJSONEncoder):
+    """DjangoJSONEncoder без \\uXXXX для кириллицы: страница в UTF-8"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs['ensure_ascii'] = False
+        super().__init__(*args, **kwargs)
+
+
+# Увеличивается при изменении страницы или формата ответов поиска и автодополнения:
+# ETag, выданные прежней версией, перестают совпадать
+ETAG_VERSION = 1
+
+
+def _geocode(geocoder, query):
+    """
+    Геокодирование с кэшем найденных адресов (GEOCODE_CACHE_SECONDS), замером
+    этапа и метриками по геокодеру. Результат из кэша содержит cached_at —
+    время записи (timestamp), от него зависят ETag ответов.
+    """
+    name = 'tomtom' if isinstance(geocoder, TomTomGeocodingService) else 'stub'
+    cache_key = 'geocode:' + hashlib.md5(f"{name}:{query}".encode()).hexdigest()
+    cached = cache.get(cache_key)
+    if cached is not None:
+        metrics.GEOCODE_REQUESTS.inc(geocoder=name, outcome='cached')
+        return cached
+    outcome = 'error'
+    start = time.perf_counter()
+    try:
+        with span('geocode'):
+            results = geocoder.geocode(query)
+        timeout = getattr(settings, 'GEOCODE_CACHE_SECONDS', 3600)
+        if name == 'tomtom' and results.get('source') != 'tomtom':
+            # Ответ заглушки после ошибки TomTom не запоминается
+            metrics.FALLBACKS.inc(source='tomtom_geocode', target='stub')
+        elif results.get('results') and timeout:
+            results = dict(results, cached_at=time.time())
+            cache.set(cache_key, results, timeout)
+        outcome = 'found' if results.get('results') else 'empty'
+        return results
+    finally:
+        metrics.GEOCODE_REQUESTS.inc(geocoder=name, outcome=outcome)
+        metrics.GEOCODE_DURATION.observe(time.perf_counter() - start, geocoder=name)
+
+
+def _public_response(response, etag, ttl=None):
+    """
+    Ответ не зависит от пользователя: ETag и Cache-Control: public для
+    браузеров и CDN. max-age не дольше HTTP_CACHE_MAX_AGE и ttl — оставшегося
+    срока данных в секундах.
+    """
+    max_age = getattr(settings, 'HTTP_CACHE_MAX_AGE', 300)
+    if ttl is not None:
+        max_age = min(max_age, max(0, int(ttl)))
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=max_age)
+    return response
+
+
+def search_etag(kind, cache_key, cached_at, geocoded_points, *extra):
+    """
+    ETag результатов поиска: ключ и время записи кэша маршрутов и найденные
+    точки (адреса из кэша геокодирования). kind и extra различают
+    представления одного поиска (страница, API с геометрией и без).
+    """
+    payload = json.dumps([ETAG_VERSION, kind, cache_key, cached_at, geocoded_points, *extra],
+                         cls=DjangoJSONEncoder, ensure_ascii=False, sort_keys=True)
+    return quote_etag(hashlib.md5(payload.encode()).hexdigest())
+
+
+def _not_modified(request, kind, cleaned_data, geocoded, *extra):
+    """
+    304 для поиска, если If-None-Match совпадает с ETag действующей записи
+    кэша маршрутов: проверка — один запрос к CachedRoute без маршрутизации и
+    показа. Поиск записывается в историю и при 304 (число маршрутов — из
+    записи кэша). None — ответ нужно построить.
+    """
+    geocoded_points, _ = geocoded
+    if not request.headers.get('If-None-Match') or not geocoded_points:
+        return None
+    routing_kwargs, applied_filters = routing_options(cleaned_data)
+    record = routing_service(cleaned_data['travel_mode']).find_record(
+        geocoded_points['start']['lat'],
+        geocoded_points['start']['lon'],
+        geocoded_points['end']['lat'],
+        geocoded_points['end']['lon'],
+        **routing_kwargs
+    )
+    if record is None:
+        return None
+    cache_key, cached_at, expires_at, routes_count = record
+    etag = search_etag(kind, cache_key, cached_at.isoformat(), geocoded_points, *extra)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        return None
+    record_search(cleaned_data, geocoded_points, applied_filters, routes_count)
+    return _public_response(response, etag, (expires_at - timezone.now()).total_seconds())
+
+
+def _cache_search_response(response, kind, search, *extra):
+    """Результаты из кэша маршрутов отдаются с ETag и Cache-Control: public"""
+    if not search['cache_key']:
+        return response
+    etag = search_etag(kind, search['cache_key'], search['cached_at'], search['geocoded_points'], *extra)
+    return _public_response(response, etag, (search['expires_at'] - timezone.now()).total_seconds())
+
+
+def routes_for_map(routes, applied_filters=None):
+    """
+    Маршруты для карты: уровень детализации под начальный масштаб,
+    закодированный строкой. filters_applied запроса добавляется в словари
+    для страницы — маршруты из кэша не изменяются.
+    """
+    payload = []
+    for route in routes:
+        data = geometry.route_for_map(route)
+        if applied_filters and route.travel_mode == 'public':
+            data['filters_applied'] = applied_filters
+        payload.append(geometry.pack_route(data))
+    return payload
+
+
+def route_details_url(cache_key, index):
+    return reverse('route_details', args=[cache_key, index])
+
+
+def routes_for_page(routes, applied_filters=None, cache_key=None):
+    """
+    Маршруты для страницы: первый (раскрыт при загрузке) — целиком, как
+    routes_for_map, остальные — краткие сведения и details_url: геометрию,
+    сегменты и остановки страница загружает при раскрытии маршрута или в
+    простое. Без cache_key (маршруты не записаны в кэш) все — целиком.
+    """
+    if not cache_key:
+        return routes_for_map(routes, applied_filters)
+    payload = routes_for_map(routes[:1], applied_filters)
+    for index, route in enumerate(routes[1:], start=1):
+        data = route.summary()
+        data['details_url'] = route_details_url(cache_key, index)
+        payload.append(data)
+    return payload
+
+
+def geocode_points(cleaned_data):
+    """
+    Геокодирование точек начала и конца из данных RouteSearchForm.
+    Возвращает (geocoded_points, error_message): при ненайденном адресе
+    точек нет, а сообщение объясняет, какой адрес не найден.
+    """
+    geocoded_points = {}
+    error_message = None
+    start_query = cleaned_data['start_point']
+    end_query = cleaned_data['end_point']
+    if getattr(settings, 'USE_REAL_API', False):
+        geocoder = TomTomGeocodingService(api_key=settings.TOMTOM_API_KEY)
+        logger.debug("Используем реальное геокодирование (TomTom)")
+    else:
+        geocoder = StubGeocodingService()
+        logger.debug("Используем заглушку для геокодирования")
+    try:
+        start_results = _geocode(geocoder, start_query)
+        logger.debug(f"Результаты геокодирования начала: {len(start_results.get('results', []))} вариантов")
+    except Exception as e:
+        logger.error(f"Ошибка геокодирования начальной точки: {e}")
+        start_results = {'results': []}
+    try:
+        end_results = _geocode(geocoder, end_query)
+        logger.debug(f"Результаты геокодирования конца: {len(end_results.get('results', []))} вариантов")
+    except Exception as e:
+        logger.error(f"Ошибка геокодирования конечной точки: {e}")
+        end_results = {'results': []}
+    if not start_results.get('results'):
+        error_message = f'Не удалось найти адрес: "{start_query}". Попробуйте уточнить запрос.'
+        logger.warning(f"Не найдена начальная точка: {start_query}")
+    elif not end_results.get('results'):
+        error_message = f'Не удалось найти адрес: "{end_query}". Попробуйте уточнить запрос.'
+        logger.warning(f"Не найдена конечная точка: {end_query}")
+    else:
+        start_best = start_results['results'][0]
+        end_best = end_results['results'][0]
+
+        logger.info(f"Начальная точка: {start_best['address']} ({start_best['lat']:.4f}, {start_best['lon']:.4f})")
+        logger.info(f"Конечная точка: {end_best['address']} ({end_best['lat']:.4f}, {end_best['lon']:.4f})")
+        geocoded_points = {
+            'start': {
+                'address': start_best['address'],
+                'lat': start_best['lat'],
+                'lon': start_best['lon'],
+                'source': start_results.get('source', 'unknown'),
+                'query': start_query
+            },
+            'end': {
+                'address': end_best['address'],
+                'lat': end_best['lat'],
+                'lon': end_best['lon'],
+                'source': end_results.get('source', 'unknown'),
+                'query': end_query
+            }
+        }
+    return geocoded_points, error_message
+
+
+def routing_options(cleaned_data):
+    """
+    Параметры маршрутизации (travel_mode и фильтры общественного транспорта)
+    из данных RouteSearchForm. Возвращает (routing_kwargs, applied_filters).
+    """
+    travel_mode = cleaned_data['travel_mode']
+    applied_filters = {}
+    routing_kwargs = {
+        'travel_mode': travel_mode,
+    }
+    if travel_mode == 'public':
+        transport_types = cleaned_data.get('transport_types', [])
+        if 'all' in transport_types or not transport_types:
+            routing_kwargs['transport_types'] = None
+            logger.debug("Используем все типы транспорта")
+        else:
+            routing_kwargs['transport_types'] = transport_types
+            logger.debug(f"Фильтры транспорта: {transport_types}")
+        max_transfers = cleaned_data.get('max_transfers', 'any')
+        if max_transfers != 'any':
+            try:
+                routing_kwargs['max_transfers'] = int(max_transfers)
+                logger.debug(f"Макс. пересадок: {max_transfers}")
+            except ValueError:
+                routing_kwargs['max_transfers'] = None
+        else:
+            routing_kwargs['max_transfers'] = None
+        only_direct = cleaned_data.get('only_direct', False)
+        if only_direct:
+            routing_kwargs['only_direct'] = True
+            logger.debug("Только прямые маршруты")
+        else:
+            routing_kwargs['only_direct'] = False
+        applied_filters = {
+            'transport_types': transport_types if transport_types and 'all' not in transport_types else None,
+            'max_transfers': max_transfers if max_transfers != 'any' else None,
+            'only_direct': only_direct
+        }
+    return routing_kwargs, applied_filters
+
+
+def provider_name(travel_mode):
+    """Имя провайдера режима для ApiLog и метрик"""
+    if travel_mode == 'public':
+        return "2gis_public_transport"
+    return f"tomtom_{travel_mode}"
+
+
+def routing_service(travel_mode):
+    """Кэширующий сервис маршрутизации режима"""
+    return CachedRoutingService(
+        routing_service=CompositeRoutingService(),
+        provider_name=provider_name(travel_mode)
+    )
+
+
+def record_search(cleaned_data, geocoded_points, applied_filters, routes_count):
+    """Запись поиска в историю (аналитика); ошибка записи не прерывает поиск"""
+    try:
+        with span('history'):
+            search_history = SearchHistory.objects.create(
+                start_query=cleaned_data['start_point'],
+                end_query=cleaned_data['end_point'],
+                start_coords=f"{geocoded_points['start']['lat']:.6f},{geocoded_points['start']['lon']:.6f}",
+                end_coords=f"{geocoded_points['end']['lat']:.6f},{geocoded_points['end']['lon']:.6f}",
+                is_successful=bool(routes_count),
+                routes_count=routes_count,
+                travel_mode=cleaned_data['travel_mode'],
+                transport_types=','.join(applied_filters.get('transport_types', []))
+                    if applied_filters.get('transport_types') else '',
+                max_transfers=applied_filters.get('max_transfers', ''),
+            )
+        logger.debug(f"Сохранено в историю поиска: ID {search_history.id}")
+    except Exception as e:
+        logger.error(f"Ошибка сохранения в историю поиска: {e}")
+
+
+def search_routes(cleaned_data, geocoded=None):
+    """
+    Поиск маршрутов по данным RouteSearchForm: геокодирование точек,
+    маршрутизация через кэш, запись в историю поиска. Общий для страницы
+    и JSON API. geocoded — уже полученный результат geocode_points.
+
+    Возвращает словарь: routes (Route), geocoded_points, applied_filters,
+    error_message, cache_key — ключ записи кэша для подробностей маршрутов
+    (route_details_api; None, если маршруты не из кэша), cached_at (ISO 8601)
+    и expires_at этой записи и status — 404, если адрес не найден, 502, если
+    не сработал и резервный маршрутизатор, иначе 200.
+    """
+    return collect_routes(stream_search(cleaned_data, geocoded))
+
+
+def stream_search(cleaned_data, geocoded=None):
+    """
+    search_routes по одному маршруту (генератор): маршруты отдаются по мере
+    разбора ответа провайдера, словарь search_routes возвращается (return)
+    после записи в кэш и историю поиска.
+    """
+    routes = []
+    cache_key = cached_at = expires_at = None
+    status = 200
+
+    travel_mode = cleaned_data['travel_mode']
+    logger.info(f"Режим маршрутизации: {travel_mode}")
+    geocoded_points, error_message = geocoded or geocode_points(cleaned_data)
+    applied_filters = {}
+    if geocoded_points:
+        routing_kwargs, applied_filters = routing_options(cleaned_data)
+        try:
+            cached_service = routing_service(travel_mode)
+            logger.info(f"Ищем маршруты с параметрами: {routing_kwargs}")
+            routes_data = yield from cached_service.stream_routes(
+                geocoded_points['start']['lat'],
+                geocoded_points['start']['lon'],
+                geocoded_points['end']['lat'],
+                geocoded_points['end']['lon'],
+                **routing_kwargs
+            )
+
+            # Маршруты из кэша уже подготовлены к показу (services/presentation.py)
+            routes = routes_data.get('result', [])
+            cache_key = routes_data.get('cache_key')
+            cached_at = routes_data.get('cache_created_at')
+            if routes_data.get('cache_expires_at'):
+                expires_at = datetime.fromisoformat(routes_data['cache_expires_at'])
+            logger.info(f"Получено маршрутов: {len(routes)}")
+            record_search(cleaned_data, geocoded_points, applied_filters, len(routes))
+
+        except Exception as e:
+            error_message = f'Ошибка при поиске маршрута: {str(e)}'
+            logger.error(f"Ошибка маршрутизации: {e}", exc_info=True)
+            try:
+                logger.info("Пробуем использовать заглушку как фолбэк")
+                metrics.FALLBACKS.inc(source=f'routing_{travel_mode}', target='stub_fallback')
+                stub_service = StubRoutingService()
+                cached_service = CachedRoutingService(
+                    routing_service=stub_service,
+                    provider_name="stub_fallback"
+                )
+
+                routes = []
+                for route in cached_service.stream_routes(
+                    geocoded_points['start']['lat'],
+                    geocoded_points['start']['lon'],
+                    geocoded_points['end']['lat'],
+                    geocoded_points['end']['lon']
+                ):
+                    route.fallback = True
+                    route.travel_mode = travel_mode
+                    routes.append(route)
+                    yield route
+            except Exception as fallback_error:
+                logger.error(f"Фолбэк также не сработал: {fallback_error}")
+
+    if error_message and not geocoded_points:
+        status = 404
+    elif error_message and not routes:
+        status = 502
+    return {
+        'routes': routes,
+        'geocoded_points': geocoded_points,
+        'applied_filters': applied_filters,
+        'error_message': error_message,
+        'cache_key': cache_key,
+        'cached_at': cached_at,
+        'expires_at': expires_at,
+        'status': status,
+    }
+
+
+def route_stats(routes):
+    """Число маршрутов, среднее время и расстояние — для страницы и потока поиска"""
+    total_routes = len(routes)
+    if total_routes > 0:
+        avg_time = sum(r.total_time for r in routes) / total_routes
+        avg_distance = sum(r.total_distance for r in routes) / total_routes
+    else:
+        avg_time = 0
+        avg_distance = 0
+    return {
+        'total_routes': total_routes,
+        'avg_time': round(avg_time, 1),
+        'avg_distance': round(avg_distance, 0),
+    }
+
+
+@query_budget(25)
 def home(request):
     """
     Главная страница приложения. Обрабатывает поиск маршрутов.
@@ -39,247 +432,47 @@ def home(request):
     geocoded_points = {}
     error_message = None
     applied_filters = {}
+    cache_key = None
+    search = None
     
     
     if request.GET:
         logger.debug(f"GET параметры: {dict(request.GET)}")
     
     if request.method == 'GET' and form.is_valid():
-        start_query = form.cleaned_data['start_point']
-        end_query = form.cleaned_data['end_point']
-        travel_mode = form.cleaned_data['travel_mode']
-        logger.info(f"Режим маршрутизации: {travel_mode}")
         logger.debug(f"✅ Форма валидна! travel_mode={form.cleaned_data.get('travel_mode')}")
         logger.debug(f"✅ transport_types={form.cleaned_data.get('transport_types')}")
-        if getattr(settings, 'USE_REAL_API', False):
-            geocoder = TomTomGeocodingService(api_key=settings.TOMTOM_API_KEY)
-            logger.debug("Используем реальное геокодирование (TomTom)")
-        else:
-            geocoder = StubGeocodingService()
-            logger.debug("Используем заглушку для геокодирования")
-        try:
-            start_results = geocoder.geocode(start_query)
-            logger.debug(f"Результаты геокодирования начала: {len(start_results.get('results', []))} вариантов")
-        except Exception as e:
-            logger.error(f"Ошибка геокодирования начальной точки: {e}")
-            start_results = {'results': []}
-        try:
-            end_results = geocoder.geocode(end_query)
-            logger.debug(f"Результаты геокодирования конца: {len(end_results.get('results', []))} вариантов")
-        except Exception as e:
-            logger.error(f"Ошибка геокодирования конечной точки: {e}")
-            end_results = {'results': []}
-        if not start_results.get('results'):
-            error_message = f'Не удалось найти адрес: "{start_query}". Попробуйте уточнить запрос.'
-            logger.warning(f"Не найдена начальная точка: {start_query}")
-        elif not end_results.get('results'):
-            error_message = f'Не удалось найти адрес: "{end_query}". Попробуйте уточнить запрос.'
-            logger.warning(f"Не найдена конечная точка: {end_query}")
-        else:
-            start_best = start_results['results'][0]
-            end_best = end_results['results'][0]
-            
-            logger.info(f"Начальная точка: {start_best['address']} ({start_best['lat']:.4f}, {start_best['lon']:.4f})")
-            logger.info(f"Конечная точка: {end_best['address']} ({end_best['lat']:.4f}, {end_best['lon']:.4f})")
-            geocoded_points = {
-                'start': {
-                    'address': start_best['address'],
-                    'lat': start_best['lat'],
-                    'lon': start_best['lon'],
-                    'source': start_results.get('source', 'unknown'),
-                    'query': start_query
-                },
-                'end': {
-                    'address': end_best['address'],
-                    'lat': end_best['lat'],
-                    'lon': end_best['lon'],
-                    'source': end_results.get('source', 'unknown'),
-                    'query': end_query
-                }
-            }
-            routing_kwargs = {
-                'travel_mode': travel_mode,
-            }
-            if travel_mode == 'public':
-                transport_types = form.cleaned_data.get('transport_types', [])
-                if 'all' in transport_types or not transport_types:
-                    routing_kwargs['transport_types'] = None
-                    logger.debug("Используем все типы транспорта")
-                else:
-                    routing_kwargs['transport_types'] = transport_types
-                    logger.debug(f"Фильтры транспорта: {transport_types}")
-                max_transfers = form.cleaned_data.get('max_transfers', 'any')
-                if max_transfers != 'any':
-                    try:
-                        routing_kwargs['max_transfers'] = int(max_transfers)
-                        logger.debug(f"Макс. пересадок: {max_transfers}")
-                    except ValueError:
-                        routing_kwargs['max_transfers'] = None
-                else:
-                    routing_kwargs['max_transfers'] = None
-                only_direct = form.cleaned_data.get('only_direct', False)
-                if only_direct:
-                    routing_kwargs['only_direct'] = True
-                    logger.debug("Только прямые маршруты")
-                else:
-                    routing_kwargs['only_direct'] = False
-                applied_filters = {
-                    'transport_types': transport_types if transport_types and 'all' not in transport_types else None,
-                    'max_transfers': max_transfers if max_transfers != 'any' else None,
-                    'only_direct': only_direct
-                }
-            
-            try:
-                composite_service = CompositeRoutingService()
-                if travel_mode == 'public':
-                    provider_name = "2gis_public_transport"
-                else:
-                    provider_name = f"tomtom_{travel_mode}"
-                cached_service = CachedRoutingService(
-                    routing_service=composite_service,
-                    provider_name=provider_name
-                )
-                
-                logger.info(f"Ищем маршруты с параметрами: {routing_kwargs}")
-                routes_data = cached_service.get_routes(
-                    geocoded_points['start']['lat'],
-                    geocoded_points['start']['lon'],
-                    geocoded_points['end']['lat'],
-                    geocoded_points['end']['lon'],
-                    **routing_kwargs
-                )
-                
-                logger.info(f"Получено маршрутов: {len(routes_data.get('result', []))}")
-                if routes_data and 'result' in routes_data:
-                    for i, route in enumerate(routes_data['result']):
-                        if travel_mode == 'public' and applied_filters:
-                            route['filters_applied'] = applied_filters
-                        if travel_mode == 'public':
-                            transport_types_in_route = route.get('transport_types', [])
-                            if transport_types_in_route:
-                                primary_type = transport_types_in_route[0]
-                                transport_icons = {
-                                    'bus': '🚌', 'tram': '🚋', 'trolleybus': '🚎',
-                                    'subway': '🚇', 'train': '🚆', 'shuttle_bus': '🚐',
-                                    'funicular': '🚡', 'monorail': '🚝', 'water': '⛴️',
-                                    'cable_car': '🚠', 'aeroexpress': '🚄', 'mcd': '🚆',
-                                    'mck': '🚆', 'transport': '🚌'
-                                }
-                                route['icon'] = transport_icons.get(primary_type, '🚌')
-                            else:
-                                route['icon'] = '🚌'
-                            if transport_types_in_route:
-                                type_names = []
-                                for t_type in transport_types_in_route:
-                                    if t_type in TwoGisPublicTransportService.TRANSPORT_TYPES:
-                                        type_names.append(TwoGisPublicTransportService.TRANSPORT_TYPES[t_type]['name'])
-                                    else:
-                                        type_names.append(t_type)
-                                route['transport_types_display'] = ', '.join(type_names)
-                        else:
-                            mode_icons = {
-                                'car': '🚗', 'pedestrian': '🚶', 'bicycle': '🚲'
-                            }
-                            if travel_mode == 'car' and 'instructions' not in route:
-                                route['instructions'] = []
-                                for seg_idx, segment in enumerate(route.get('segments', [])):
-                                    instruction = {
-                                        'step': seg_idx + 1,
-                                        'action': segment.get('details', {}).get('text', 'Продолжайте движение'),
-                                        'direction': segment.get('details', {}).get('direction', ''),
-                                        'distance': segment.get('details', {}).get('distance', ''),
-                                        'time': f"{segment.get('time', 0)} мин",
-                                        'street': segment.get('details', {}).get('street', '')
-                                    }
-                                    route['instructions'].append(instruction)
-                            route['icon'] = mode_icons.get(travel_mode, '📍')
-                        mode_display_map = {
-                            'public': 'Общественный транспорт',
-                            'car': 'На машине',
-                            'pedestrian': 'Пешком',
-                            'bicycle': 'На велосипеде'
-                        }
-                        route['mode_display'] = mode_display_map.get(travel_mode, 'Маршрут')
-                        route['travel_mode'] = travel_mode
-                        route['number'] = i + 1
-                        for segment in route.get('segments', []):
-                            if 'details' not in segment:
-                                segment['details'] = {}
-                        if 'coordinates' not in route or not route['coordinates']:
-                            route['coordinates'] = [[
-                                [geocoded_points['start']['lat'], geocoded_points['start']['lon']],
-                                [geocoded_points['end']['lat'], geocoded_points['end']['lon']]
-                            ]]
-                        
-                        routes.append(route)
-                try:
-                    search_history = SearchHistory.objects.create(
-                        start_query=start_query,
-                        end_query=end_query,
-                        start_coords=f"{geocoded_points['start']['lat']:.6f},{geocoded_points['start']['lon']:.6f}",
-                        end_coords=f"{geocoded_points['end']['lat']:.6f},{geocoded_points['end']['lon']:.6f}",
-                        is_successful=bool(routes),
-                        routes_count=len(routes),
-                        travel_mode=travel_mode,
-                        transport_types=','.join(applied_filters.get('transport_types', [])) 
-                            if applied_filters.get('transport_types') else '',
-                        max_transfers=applied_filters.get('max_transfers', ''),
-                    )
-                    logger.debug(f"Сохранено в историю поиска: ID {search_history.id}")
-                except Exception as e:
-                    logger.error(f"Ошибка сохранения в историю поиска: {e}")
-                
-            except Exception as e:
-                error_message = f'Ошибка при поиске маршрута: {str(e)}'
-                logger.error(f"Ошибка маршрутизации: {e}", exc_info=True)
-                try:
-                    logger.info("Пробуем использовать заглушку как фолбэк")
-                    stub_service = StubRoutingService()
-                    cached_service = CachedRoutingService(
-                        routing_service=stub_service,
-                        provider_name="stub_fallback"
-                    )
-                    
-                    routes_data = cached_service.get_routes(
-                        geocoded_points['start']['lat'],
-                        geocoded_points['start']['lon'],
-                        geocoded_points['end']['lat'],
-                        geocoded_points['end']['lon']
-                    )
-                    
-                    if routes_data and 'result' in routes_data:
-                        routes = routes_data['result']
-                        for i, route in enumerate(routes):
-                            route['number'] = i + 1
-                            route['icon'] = '⚠️'
-                            route['mode_display'] = 'Резервный режим'
-                            route['travel_mode'] = travel_mode
-                except Exception as fallback_error:
-                    logger.error(f"Фолбэк также не сработал: {fallback_error}")
+        geocoded = geocode_points(form.cleaned_data)
+        not_modified = _not_modified(request, 'page', form.cleaned_data, geocoded)
+        if not_modified is not None:
+            return not_modified
+        search = search_routes(form.cleaned_data, geocoded)
+        routes = search['routes']
+        geocoded_points = search['geocoded_points']
+        applied_filters = search['applied_filters']
+        error_message = search['error_message']
+        cache_key = search['cache_key']
     
     elif request.method == 'GET' and form.errors:
 
         error_message = 'Пожалуйста, проверьте введенные данные'
         logger.warning(f"Ошибки в форме: {form.errors}")
-    routes_json = json.dumps(routes, cls=DjangoJSONEncoder, ensure_ascii=False)
+    # На карту уходит уровень детализации под начальный масштаб, а не полная геометрия,
+    # закодированный строкой (раскодирует static/js/polyline.js), и только для первого
+    # маршрута: остальные загружаются по details_url. json_script вместо escapejs:
+    # экранирование кавычек и обратных слэшей раздувало JSON в разы
+    routes_script = json_script(routes_for_page(routes, applied_filters, cache_key), 'routes-data',
+                                encoder=UnicodeJSONEncoder)
     geocoded_points_json = json.dumps(geocoded_points, cls=DjangoJSONEncoder, ensure_ascii=False)
-    total_routes = len(routes)
-    if total_routes > 0:
-        avg_time = sum(r.get('total_time', 0) for r in routes) / total_routes
-        avg_distance = sum(r.get('total_distance', 0) for r in routes) / total_routes
-    else:
-        avg_time = 0
-        avg_distance = 0
     context = {
         'form': form,
         'routes': routes,
-        'routes_json': routes_json,
+        'routes_script': routes_script,
+        'routes_lazy': bool(cache_key),
         'geocoded_points': geocoded_points,
         'geocoded_points_json': geocoded_points_json,
         'error_message': error_message,
-        'total_routes': total_routes,
-        'avg_time': round(avg_time, 1),
-        'avg_distance': round(avg_distance, 0),
+        **route_stats(routes),
         'applied_filters': applied_filters,
         'use_real_api': getattr(settings, 'USE_REAL_API', False),
         'use_public_transport': getattr(settings, 'USE_PUBLIC_TRANSPORT_API', True),
@@ -288,9 +481,155 @@ def home(request):
         'selected_max_transfers': form.cleaned_data.get('max_transfers', 'any') if form.is_bound else 'any',
         'selected_only_direct': form.cleaned_data.get('only_direct', False) if form.is_bound else False,
     }
-    return render(request, 'core/home.html', context)
+    with span('render'):
+        response = render(request, 'core/home.html', context)
+    return _cache_search_response(response, 'page', search) if search else response
+
+
+def route_summaries(routes, with_geometry=False, cache_key=None):
+    """
+    Краткие сведения о маршрутах для JSON API; with_geometry добавляет
+    геометрию под начальный масштаб в том же виде, что и на странице
+    (geometry раскодирует static/js/polyline.js, и coordinates_zoom),
+    cache_key — ссылки на подробности (details_url).
+    """
+    payload = []
+    for index, route in enumerate(routes):
+        data = route.summary()
+        if with_geometry:
+            data.update(geometry.pack_route(geometry.map_geometry(route)))
+        if cache_key:
+            data['details_url'] = route_details_url(cache_key, index)
+        payload.append(data)
+    return payload
+
+
+@query_budget(25)
+def routes_api(request):
+    """
+    JSON API поиска маршрутов (v1): параметры RouteSearchForm, ответ —
+    найденные точки и краткие сведения о маршрутах, ?geometry=1 — с
+    геометрией. Поддерживает условные запросы: ETag по записи кэша
+    маршрутов (search_etag), If-None-Match с тем же значением получает 304
+    без поиска.
+    """
+    form = RouteSearchForm(request.GET)
+    if not form.is_valid():
+        logger.warning(f"Ошибки в параметрах API поиска: {form.errors}")
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Пожалуйста, проверьте введенные данные',
+            'errors': form.errors.get_json_data(),
+        }, status=400, encoder=UnicodeJSONEncoder)
+
+    with_geometry = request.GET.get('geometry') in ('1', 'true')
+    geocoded = geocode_points(form.cleaned_data)
+    not_modified = _not_modified(request, 'api', form.cleaned_data, geocoded, with_geometry)
+    if not_modified is not None:
+        return not_modified
+    search = search_routes(form.cleaned_data, geocoded)
+    data = {
+        'status': 'success' if search['status'] == 200 else 'error',
+        'query': {
+            'start_point': form.cleaned_data['start_point'],
+            'end_point': form.cleaned_data['end_point'],
+            'travel_mode': form.cleaned_data['travel_mode'],
+            'filters': search['applied_filters'] or None,
+        },
+        'points': search['geocoded_points'],
+        'routes': route_summaries(search['routes'], with_geometry, search['cache_key']),
+    }
+    if search['error_message']:
+        data['message'] = search['error_message']
+    response = JsonResponse(data, status=search['status'], encoder=UnicodeJSONEncoder)
+    return _cache_search_response(response, 'api', search, with_geometry)
+
 
+def _sse(event, data):
+    """Событие Server-Sent Events: имя и JSON в одной строке data"""
+    return f"event: {event}\ndata: {json.dumps(data, cls=UnicodeJSONEncoder)}\n\n"
 
+
+def search_events(cleaned_data):
+    """
+    События поиска по мере готовности: points — найденные точки (и блок
+    «Точки маршрута»), routing — начат поиск маршрутов у провайдера,
+    route — каждый маршрут сразу после разбора ответа провайдера (данные
+    для карты и HTML пункта списка), done — итог (статистика, фильтры,
+    сообщение). failed — поиск не удался.
+    """
+    geocoded = geocode_points(cleaned_data)
+    geocoded_points, error_message = geocoded
+    if not geocoded_points:
+        yield _sse('failed', {'status': 404, 'message': error_message})
+        return
+    yield _sse('points', {
+        'points': geocoded_points,
+        'summary_html': render_to_string('core/search_summary.html', {'geocoded_points': geocoded_points}),
+    })
+    yield _sse('routing', {'provider': provider_name(cleaned_data['travel_mode'])})
+
+    # Маршрут уходит целиком (карта и подробности) сразу после разбора:
+    # ключа записи кэша для details_url до конца поиска ещё нет
+    _, applied_filters = routing_options(cleaned_data)
+    search = stream_search(cleaned_data, geocoded)
+    index = 0
+    while True:
+        try:
+            route = next(search)
+        except StopIteration as stop:
+            search = stop.value
+            break
+        yield _sse('route', {
+            'index': index,
+            'route': routes_for_map([route], applied_filters)[0],
+            'html': render_to_string('core/route_item.html', {
+                'route': route,
+                'number': index + 1,
+                'expanded': index == 0,
+                'geocoded_points': geocoded_points,
+            }),
+        })
+        index += 1
+
+    if search['status'] != 200:
+        yield _sse('failed', {'status': search['status'], 'message': search['error_message']})
+        return
+    routes = search['routes']
+    stats = route_stats(routes)
+    done = dict(stats, summary_html=render_to_string('core/search_summary.html', dict(
+        stats, routes=routes, geocoded_points=geocoded_points, applied_filters=search['applied_filters'],
+    )))
+    if search['error_message']:
+        done['message'] = search['error_message']
+    yield _sse('done', done)
+
+
+@query_budget(25)
+def routes_stream(request):
+    """
+    Поиск маршрутов потоком Server-Sent Events (text/event-stream) с
+    параметрами RouteSearchForm: страница показывает точки и маршруты по
+    мере готовности (search_events), а не после всего поиска. Бюджет
+    SQL-запросов проверяется при итерации потока (limit_stream_queries).
+    """
+    form = RouteSearchForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Пожалуйста, проверьте введенные данные',
+            'errors': form.errors.get_json_data(),
+        }, status=400, encoder=UnicodeJSONEncoder)
+    events = limit_stream_queries(search_events(form.cleaned_data), budget_for(request.resolver_match),
+                                  f"{request.path} (routes_stream)")
+    response = StreamingHttpResponse(events, content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    # nginx не должен копить события в буфере
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@query_budget(5)
 def autocomplete_api(request):
     """
     API для автодополнения адресов с использованием TomTom Search или заглушки.
@@ -309,7 +648,17 @@ def autocomplete_api(request):
             geocoder = StubGeocodingService()
             logger.debug("Используем заглушку для автодополнения")
 
-        results = geocoder.geocode(query)
+        results = _geocode(geocoder, query)
+        cached_at = results.get('cached_at')
+        if cached_at:
+            # Ответ определяется записью кэша геокодирования
+            etag = quote_etag(hashlib.md5(
+                f"{ETAG_VERSION}:autocomplete:{query}:{results.get('source')}:{cached_at}".encode()
+            ).hexdigest())
+            ttl = cached_at + getattr(settings, 'GEOCODE_CACHE_SECONDS', 3600) - time.time()
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                return _public_response(not_modified, etag, ttl)
         formatted_results = []
         for i, item in enumerate(results.get('results', [])[:8]):  # Ограничиваем 8 результатами
             formatted_results.append({
@@ -332,7 +681,8 @@ def autocomplete_api(request):
             'query': query
         }
         
-        return JsonResponse(response_data)
+        response = JsonResponse(response_data)
+        return _public_response(response, etag, ttl) if cached_at else response
         
     except Exception as e:
         logger.error(f"Ошибка автодополнения: {e}", exc_info=True)
@@ -343,6 +693,7 @@ def autocomplete_api(request):
         }, status=500)
 
 
+@query_budget(12)
 @staff_member_required
 def clear_cache_view(request):
     """
@@ -361,19 +712,26 @@ def clear_cache_view(request):
 
         if 'clear_all' in request.POST:
             all_count = CachedRoute.objects.all().delete()[0]
+            parts_count = RouteGeometry.objects.all().delete()[0]
             message = f'Удалено всех записей кэша: {all_count}'
-            logger.info(f"Администратор {request.user} очистил весь кэш: {all_count} записей")
+            logger.info(f"Администратор {request.user} очистил весь кэш: {all_count} записей, "
+                        f"{parts_count} участков геометрии")
         else:
+            parts_count = geometry_store.purge_unused()
             message = f'Удалено устаревших записей кэша: {expired_count}'
-            logger.info(f"Администратор {request.user} очистил устаревший кэш: {expired_count} записей")
-
-    cache_stats = {
-        'total': CachedRoute.objects.count(),
-        'active': CachedRoute.objects.filter(expires_at__gt=timezone.now()).count(),
-        'expired': CachedRoute.objects.filter(expires_at__lt=timezone.now()).count(),
+            logger.info(f"Администратор {request.user} очистил устаревший кэш: {expired_count} записей, "
+                        f"{parts_count} участков геометрии")
+
+    now = timezone.now()
+    cache_stats = CachedRoute.objects.aggregate(
+        total=Count('id'),
+        active=Count('id', filter=Q(expires_at__gt=now)),
+        expired=Count('id', filter=Q(expires_at__lt=now)),
+    )
+    cache_stats.update({
         'oldest': CachedRoute.objects.order_by('created_at').first(),
         'newest': CachedRoute.objects.order_by('-created_at').first(),
-    }
+    })
     
     return render(request, 'core/admin/clear_cache.html', {
         'message': message,
@@ -383,6 +741,7 @@ def clear_cache_view(request):
     })
 
 
+@query_budget(8)
 def api_status(request):
     """
     Простой API-эндпоинт для проверки статуса сервиса и статистики.
@@ -391,37 +750,63 @@ def api_status(request):
     hour_ago = timezone.now() - timezone.timedelta(hours=1)
     day_ago = timezone.now() - timezone.timedelta(days=1)
 
+    log_counts = ApiLog.objects.filter(timestamp__gte=day_ago).aggregate(
+        last_hour=Count('id', filter=Q(timestamp__gte=hour_ago)),
+        last_day=Count('id'),
+        cached_last_hour=Count('id', filter=Q(timestamp__gte=hour_ago, was_cached=True)),
+    )
+    route_counts = CachedRoute.objects.aggregate(
+        total=Count('id'),
+        active=Count('id', filter=Q(expires_at__gt=timezone.now())),
+    )
+
     stats = {
         'status': 'operational',
         'timestamp': timezone.now().isoformat(),
-        'requests_last_hour': ApiLog.objects.filter(timestamp__gte=hour_ago).count(),
-        'requests_last_day': ApiLog.objects.filter(timestamp__gte=day_ago).count(),
-        'cache_hits_last_hour': ApiLog.objects.filter(timestamp__gte=hour_ago, was_cached=True).count(),
+        'requests_last_hour': log_counts['last_hour'],
+        'requests_last_day': log_counts['last_day'],
+        'cache_hits_last_hour': log_counts['cached_last_hour'],
         'successful_searches_last_hour': SearchHistory.objects.filter(
             timestamp__gte=hour_ago, is_successful=True
         ).count(),
-        'total_cached_routes': CachedRoute.objects.count(),
-        'active_cached_routes': CachedRoute.objects.filter(expires_at__gt=timezone.now()).count(),
+        'total_cached_routes': route_counts['total'],
+        'active_cached_routes': route_counts['active'],
         'services': {
             'geocoding': 'tomtom' if getattr(settings, 'USE_REAL_API', False) else 'stub',
             'routing_public_transport': '2gis' if getattr(settings, 'USE_PUBLIC_TRANSPORT_API', True) else 'stub',
             'routing_other': 'tomtom' if getattr(settings, 'USE_REAL_API', False) else 'stub',
-            'caching': 'enabled'
+            'caching': 'enabled',
+            'provider_http': provider_http.status(),
         }
     }
     
 
+    # Квантили по почасовым гистограммам, без учёта ответов из кэша
+    latency = LatencyService().percentiles(hour_ago, timezone.now())
+
+    # Один сгруппированный запрос вместо шести на каждого провайдера
+    providers = ['2gis_public_transport', 'tomtom_car', 'tomtom_pedestrian', 'tomtom_bicycle', 'stub']
+    grouped = {
+        row['provider']: row
+        for row in ApiLog.objects.filter(provider__in=providers, timestamp__gte=hour_ago).values('provider').annotate(
+            requests=Count('id'),
+            avg_response_time=Avg('response_time_ms'),
+            successful=Count('id', filter=Q(response_status=200)),
+            cached=Count('id', filter=Q(was_cached=True)),
+        )
+    }
     provider_stats = {}
-    for provider in ['2gis_public_transport', 'tomtom_car', 'tomtom_pedestrian', 'tomtom_bicycle', 'stub']:
-        logs = ApiLog.objects.filter(provider=provider, timestamp__gte=hour_ago)
-        if logs.exists():
+    for provider in providers:
+        row = grouped.get(provider)
+        if row:
             provider_stats[provider] = {
-                'requests': logs.count(),
-                'avg_response_time': logs.aggregate(avg=Avg('response_time_ms'))['avg'] or 0,
-                'success_rate': (logs.filter(response_status=200).count() / logs.count() * 100) 
-                    if logs.count() > 0 else 0,
-                'cache_hit_rate': (logs.filter(was_cached=True).count() / logs.count() * 100) 
-                    if logs.count() > 0 else 0
+                'requests': row['requests'],
+                'avg_response_time': row['avg_response_time'] or 0,
+                'success_rate': row['successful'] / row['requests'] * 100,
+                'cache_hit_rate': row['cached'] / row['requests'] * 100,
+                'latency_ms': {
+                    key: latency[provider][key] for key in ('p50', 'p90', 'p99')
+                } if provider in latency else None
             }
     
     stats['provider_stats'] = provider_stats
@@ -429,524 +814,32 @@ def api_status(request):
     return JsonResponse(stats)
 
 
-@staff_member_required
-def analytics_dashboard(request):
-    """Дашборд аналитики для администраторов с графиками и статистикой"""
-
-    cache_key = f"analytics_dashboard_{date.today().strftime('%Y%m%d')}"
-    
-
-    if (cached_data := cache.get(cache_key)) is not None and not request.GET.get('refresh'):
-        context = cached_data
-        logger.debug("Используем кэшированные данные дашборда")
-    else:
-        logger.info("Генерация новых данных для дашборда")
-        
-
-        total_searches = SearchHistory.objects.count()
-        successful_searches = SearchHistory.objects.filter(is_successful=True).count()
-        failed_searches = SearchHistory.objects.filter(is_successful=False).count()
-
-        week_ago = timezone.now() - timedelta(days=7)
-        today = timezone.now().date()
-        
-
-        top_routes = SearchHistory.objects.filter(
-            is_successful=True,
-            timestamp__gte=week_ago
-        ).values('start_query', 'end_query').annotate(
-            count=Count('id'),
-            avg_routes=Avg('routes_count'),
-            success_rate=Avg(
-                Case(When(is_successful=True, then=100), default=0, output_field=FloatField())
-            )
-        ).order_by('-count')[:10]
-
-        provider_stats = ApiLog.objects.filter(
-            timestamp__gte=week_ago
-        ).values('provider').annotate(
-            request_count=Count('id'),
-            avg_response_time=Avg('response_time_ms'),
-            success_rate=Avg(
-                Case(When(response_status=200, then=100), default=0, output_field=FloatField())
-            ),
-            cache_hit_rate=Avg(
-                Case(When(was_cached=True, then=100), default=0, output_field=FloatField())
-            )
-        ).order_by('-request_count')
-        
-
-        hourly_stats = ApiLog.objects.filter(
-            timestamp__date=today
-        ).annotate(
-            hour=TruncHour('timestamp')
-        ).values('hour').annotate(
-            requests=Count('id'),
-            avg_time=Avg('response_time_ms')
-        ).order_by('hour')
-        
-
-        travel_mode_stats = SearchHistory.objects.filter(
-            is_successful=True,
-            timestamp__gte=week_ago
-        ).exclude(travel_mode__isnull=True).exclude(travel_mode='').values(
-            'travel_mode'
-        ).annotate(
-            count=Count('id'),
-            avg_routes=Avg('routes_count'),
-            avg_success=Avg(
-                Case(When(is_successful=True, then=100), default=0, output_field=FloatField())
-            )
-        ).order_by('-count')
-        
-        conversion_rate = (successful_searches / total_searches * 100) if total_searches > 0 else 0
-        
-        common_errors = ApiLog.objects.filter(
-            response_status__gte=400
-        ).values('error_message', 'provider').annotate(
-            count=Count('id'),
-            last_occurred=Max('timestamp')
-        ).exclude(error_message='').order_by('-count')[:10]
-        
-
-        peak_hours = SearchHistory.objects.annotate(
-            hour=TruncHour('timestamp')
-        ).values('hour').annotate(
-            searches=Count('id')
-        ).order_by('-searches')[:10]
-        
-
-        graphs = {}
-        
-        # 1. График ТОП маршрутов
-        if top_routes:
-            df_routes = pd.DataFrame(list(top_routes))
-            if not df_routes.empty:
-                graphs['top_routes'] = create_top_routes_chart(df_routes)
-        
-        # 2. График статистики по провайдерам
-        if provider_stats:
-            df_providers = pd.DataFrame(list(provider_stats))
-            if not df_providers.empty:
-                graphs['provider_stats'] = create_provider_stats_chart(df_providers)
-        
-        # 3. График почасовой активности
-        if hourly_stats:
-            df_hourly = pd.DataFrame(list(hourly_stats))
-            if not df_hourly.empty:
-                graphs['hourly_activity'] = create_hourly_chart(df_hourly)
-        
-        # 4. График типов маршрутов
-        if travel_mode_stats:
-            df_modes = pd.DataFrame(list(travel_mode_stats))
-            if not df_modes.empty:
-                graphs['travel_modes'] = create_travel_modes_chart(df_modes)
-        
-        # 5. График трендов по дням
-        daily_trends = ApiLog.objects.filter(
-            timestamp__gte=week_ago
-        ).annotate(
-            day=TruncDay('timestamp')
-        ).values('day').annotate(
-            requests=Count('id'),
-            avg_time=Avg('response_time_ms'),
-            cache_hits=Count('id', filter=Q(was_cached=True))
-        ).order_by('day')
-        
-        if daily_trends:
-            df_daily = pd.DataFrame(list(daily_trends))
-            if not df_daily.empty:
-                graphs['daily_trends'] = create_daily_trends_chart(df_daily)
-        
-        # 6. График распределения времени ответа
-        response_time_stats = ApiLog.objects.filter(
-            timestamp__gte=week_ago,
-            response_time_ms__isnull=False
-        ).values('provider').annotate(
-            min_time=Min('response_time_ms'),
-            max_time=Max('response_time_ms'),
-            avg_time=Avg('response_time_ms'),
-            count=Count('id')
-        ).order_by('provider')
-        if response_time_stats:
-            df_response = pd.DataFrame(list(response_time_stats))
-            if not df_response.empty:
-                graphs['response_times'] = create_response_times_chart(df_response)
-        
-
-        context = {
-            'total_searches': total_searches,
-            'successful_searches': successful_searches,
-            'failed_searches': failed_searches,
-            'conversion_rate': round(conversion_rate, 1),
-            'top_routes': list(top_routes),
-            'provider_stats': list(provider_stats),
-            'hourly_stats': list(hourly_stats),
-            'travel_mode_stats': list(travel_mode_stats),
-            'common_errors': list(common_errors),
-            'peak_hours': list(peak_hours),
-            'graphs': graphs,
-            'week_ago': week_ago.date(),
-            'today': today,
-            'cache_timestamp': timezone.now(),
-            'total_api_requests': ApiLog.objects.count(),
-            'total_cached_items': CachedRoute.objects.count(),
-            'avg_response_time': ApiLog.objects.aggregate(
-                avg=Avg('response_time_ms')
-            )['avg'] or 0,
-        }
-        
-
-        cache.set(cache_key, context, 300)
-        logger.info("Данные дашборда сгенерированы и закэшированы")
-    
-    return render(request, 'core/admin/analytics_dashboard.html', context)
-
-
-
-def create_top_routes_chart(df):
-    """Создает горизонтальную столбчатую диаграмму ТОП маршрутов"""
-    try:
-        plt.figure(figsize=(14, 8))
-        
-
-        labels = []
-        for _, row in df.iterrows():
-            start = str(row['start_query'])[:20] + ('...' if len(str(row['start_query'])) > 20 else '')
-            end = str(row['end_query'])[:20] + ('...' if len(str(row['end_query'])) > 20 else '')
-            labels.append(f"{start}\n→ {end}")
-
-        colors = plt.cm.viridis(np.linspace(0.2, 0.8, len(df)))
-        bars = plt.barh(range(len(df)), df['count'], color=colors, edgecolor='black', linewidth=0.5)
-
-        plt.yticks(range(len(df)), labels, fontsize=10)
-        plt.xlabel('Количество запросов', fontsize=12, fontweight='bold')
-        plt.title('ТОП-10 популярных маршрутов за неделю', fontsize=14, fontweight='bold', pad=20)
-        plt.gca().invert_yaxis()
-        plt.grid(axis='x', alpha=0.3, linestyle='--')
-        
-
-        for i, (_, row) in enumerate(df.iterrows()):
-            plt.text(row['count'] + max(df['count']) * 0.01, i, 
-                    f"{int(row['count'])} запр.\n({row['success_rate']:.0f}% успешных)", 
-                    va='center', fontsize=9, fontweight='bold')
-        
-        plt.tight_layout()
-        return save_plot_to_base64()
-    except Exception as e:
-        logger.error(f"Ошибка создания графика top_routes: {e}")
-        return None
-
-
-def create_provider_stats_chart(df):
-    """Создает комбинированный график статистики по провайдерам"""
-    try:
-        plt.figure(figsize=(14, 8))
-        
-        x = np.arange(len(df))
-        width = 0.35
-
-        fig, ax1 = plt.subplots(figsize=(14, 8))
-        bars = ax1.bar(x - width/2, df['request_count'], width, 
-                      label='Запросы', color='#4e79a7', edgecolor='black', alpha=0.8)
-
-        ax2 = ax1.twinx()
-        line = ax2.plot(x + width/2, df['avg_response_time'], 'o-', color='#e15759', 
-                       linewidth=3, markersize=10, markerfacecolor='white', 
-                       markeredgewidth=2, label='Ср. время ответа (мс)')
-        
-
-        ax1.set_xlabel('Провайдер API', fontsize=12, fontweight='bold')
-        ax1.set_ylabel('Количество запросов', fontsize=12, fontweight='bold')
-        ax2.set_ylabel('Среднее время ответа (мс)', fontsize=12, fontweight='bold', color='#e15759')
-        ax2.tick_params(axis='y', labelcolor='#e15759')
-
-        ax1.set_xticks(x)
-        ax1.set_xticklabels([p[:15] + '...' if len(p) > 15 else p for p in df['provider']], 
-                           rotation=45, ha='right', fontsize=10)
-
-        plt.title('Статистика по провайдерам API за неделю', fontsize=14, fontweight='bold', pad=20)
-        
-
-        lines1, labels1 = ax1.get_legend_handles_labels()
-        lines2, labels2 = ax2.get_legend_handles_labels()
-        ax1.legend(lines1 + lines2, labels1 + labels2, loc='upper left', fontsize=10)
-        
-
-        ax1.grid(axis='y', alpha=0.3, linestyle='--')
-        
-
-        for bar in bars:
-            height = bar.get_height()
-            ax1.text(bar.get_x() + bar.get_width()/2., height + max(df['request_count']) * 0.01,
-                    f'{int(height)}', ha='center', va='bottom', fontsize=9, fontweight='bold')
-        
-        plt.tight_layout()
-        return save_plot_to_base64()
-    except Exception as e:
-        logger.error(f"Ошибка создания графика provider_stats: {e}")
-        return None
-
-
-def create_hourly_chart(df):
-    """Создает график почасовой активности"""
-    try:
-        if df.empty:
-            return None
-
-        df['hour'] = pd.to_datetime(df['hour']).dt.hour
-        df = df.sort_values('hour')
-        
-        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 10), sharex=True, 
-                                       gridspec_kw={'height_ratios': [2, 1]})
-        
-        # График 1: Количество запросов по часам
-        bars = ax1.bar(df['hour'], df['requests'], color='#76b7b2', 
-                      edgecolor='black', alpha=0.7, width=0.8)
-        ax1.set_ylabel('Количество запросов', fontsize=12, fontweight='bold')
-        ax1.set_title('Почасовая активность API (сегодня)', fontsize=14, fontweight='bold', pad=20)
-        ax1.grid(True, alpha=0.3, linestyle='--')
-        ax1.set_axisbelow(True)
-
-        for bar in bars:
-            height = bar.get_height()
-            ax1.text(bar.get_x() + bar.get_width()/2., height + 0.1,
-                    f'{int(height)}', ha='center', va='bottom', fontsize=9, fontweight='bold')
-        
-        # График 2: Среднее время ответа по часам
-        ax2.plot(df['hour'], df['avg_time'], 'o-', color='#edc949', 
-                linewidth=2.5, markersize=10, markerfacecolor='white', 
-                markeredgewidth=2, markeredgecolor='#edc949')
-        ax2.fill_between(df['hour'], 0, df['avg_time'], color='#edc949', alpha=0.2)
-        ax2.set_xlabel('Час дня', fontsize=12, fontweight='bold')
-        ax2.set_ylabel('Среднее время ответа (мс)', fontsize=12, fontweight='bold')
-        ax2.grid(True, alpha=0.3, linestyle='--')
-        ax2.set_axisbelow(True)
-        ax2.set_xticks(df['hour'])
-        ax2.set_xticklabels([f'{int(h)}:00' for h in df['hour']], rotation=45)
-        
-
-        avg_time = df['avg_time'].mean()
-        ax2.axhline(y=avg_time, color='r', linestyle='--', alpha=0.5, 
-                   label=f'Среднее: {avg_time:.0f} мс')
-        ax2.legend(loc='upper right')
-        
-        plt.tight_layout()
-        return save_plot_to_base64()
-    except Exception as e:
-        logger.error(f"Ошибка создания графика hourly_activity: {e}")
-        return None
-
-
-def create_travel_modes_chart(df):
-    """Создает круговую диаграмму типов маршрутов"""
-    try:
-        if df.empty:
-            return None
-            
-        plt.figure(figsize=(12, 10))
-        
-        labels = []
-        for mode in df['travel_mode']:
-            mode_names = {
-                'public': 'Общественный транспорт',
-                'car': 'Автомобиль',
-                'pedestrian': 'Пешком',
-                'bicycle': 'Велосипед'
-            }
-            labels.append(mode_names.get(mode, mode))
-        
-
-        colors = ['#4e79a7', '#f28e2c', '#e15759', '#76b7b2', '#59a14f', 
-                 '#edc949', '#af7aa1', '#ff9da7', '#9c755f', '#bab0ab']
-        
-
-        wedges, texts, autotexts = plt.pie(
-            df['count'], 
-            labels=labels,
-            autopct=lambda pct: f'{pct:.1f}%\n({int(pct/100.*df["count"].sum()):d})',
-            colors=colors[:len(df)],
-            startangle=90,
-            textprops={'fontsize': 11},
-            wedgeprops={'edgecolor': 'white', 'linewidth': 2},
-            explode=[0.05] * len(df)  
-        )
-        
-
-        for autotext in autotexts:
-            autotext.set_color('white')
-            autotext.set_fontweight('bold')
-            autotext.set_fontsize(10)
-        
-        for text in texts:
-            text.set_fontsize(12)
-            text.set_fontweight('bold')
-        
-        plt.title('Распределение по типам маршрутов за неделю', 
-                 fontsize=14, fontweight='bold', pad=30)
-        
-
-        plt.legend(wedges, [f"{l} ({c})" for l, c in zip(labels, df['count'])],
-                  title="Типы маршрутов", loc="center left", bbox_to_anchor=(1, 0, 0.5, 1),
-                  fontsize=10)
-        
-        plt.tight_layout()
-        return save_plot_to_base64()
-    except Exception as e:
-        logger.error(f"Ошибка создания графика travel_modes: {e}")
-        return None
-
-
-def create_daily_trends_chart(df):
-    """Создает график трендов по дням"""
-    try:
-        if df.empty:
-            return None
-            
-
-        df['day'] = pd.to_datetime(df['day']).dt.strftime('%d.%m')
-        df = df.sort_values('day')
-        
-        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 10), 
-                                       gridspec_kw={'height_ratios': [2, 1]})
-        
-        # График 1: Количество запросов по дням
-        x = range(len(df))
-        bars = ax1.bar(x, df['requests'], color='#59a14f', alpha=0.7, 
-                      edgecolor='black', linewidth=1, width=0.7)
-        ax1.set_ylabel('Количество запросов', fontsize=12, fontweight='bold')
-        ax1.set_title('Динамика запросов по дням', fontsize=14, fontweight='bold', pad=20)
-        ax1.grid(axis='y', alpha=0.3, linestyle='--')
-        ax1.set_axisbelow(True)
-        ax1.set_xticks(x)
-        ax1.set_xticklabels(df['day'], rotation=45, ha='right', fontsize=10)
-        for bar in bars:
-            height = bar.get_height()
-            ax1.text(bar.get_x() + bar.get_width()/2., height + max(df['requests']) * 0.02,
-                    f'{int(height)}', ha='center', va='bottom', fontsize=9, fontweight='bold')
-        
-        # График 2: Время ответа и кэш-хиты
-        ax2.plot(x, df['avg_time'], 's-', color='#b07aa1', linewidth=2.5, 
-                markersize=8, markerfacecolor='white', markeredgewidth=2, 
-                label='Ср. время ответа (мс)')
-        
-        if 'cache_hits' in df.columns:
-            ax2_twin = ax2.twinx()
-            ax2_twin.bar(x, df['cache_hits'], color='#ff9da7', alpha=0.5, 
-                        width=0.6, label='Кэш-хиты')
-            ax2_twin.set_ylabel('Кэш-хиты', fontsize=12, fontweight='bold', color='#ff9da7')
-            ax2_twin.tick_params(axis='y', labelcolor='#ff9da7')
-
-            lines1, labels1 = ax2.get_legend_handles_labels()
-            lines2, labels2 = ax2_twin.get_legend_handles_labels()
-            ax2.legend(lines1 + lines2, labels1 + labels2, loc='upper left')
-        else:
-            ax2.legend(loc='upper left')
-        
-        ax2.set_xlabel('Дата', fontsize=12, fontweight='bold')
-        ax2.set_ylabel('Ср. время ответа (мс)', fontsize=12, fontweight='bold')
-        ax2.grid(True, alpha=0.3, linestyle='--')
-        ax2.set_axisbelow(True)
-        ax2.set_xticks(x)
-        ax2.set_xticklabels(df['day'], rotation=45, ha='right', fontsize=10)
-        
-
-        if len(df) > 2:
-            x_numeric = np.array(x)
-            z = np.polyfit(x_numeric, df['avg_time'], 1)
-            p = np.poly1d(z)
-            ax2.plot(x, p(x_numeric), "r--", alpha=0.7, linewidth=2, label='Тренд')
-        
-        plt.tight_layout()
-        return save_plot_to_base64()
-    except Exception as e:
-        logger.error(f"Ошибка создания графика daily_trends: {e}")
-        return None
-
-
-def create_response_times_chart(df):
-            """Создает график распределения времени ответа (боксплот)"""
-            try:
-                if df.empty or len(df) == 0:
-                    return None
-                    
-                plt.figure(figsize=(12, 8))
-                data_to_plot = []
-                labels = []
-                
-                for _, row in df.iterrows():
-                    mean = row['avg_time']
-                    std = mean * 0.2 if mean > 0 else 1
-                    synthetic_data = np.random.normal(mean, std, 50)
-                    synthetic_data = np.clip(synthetic_data, row['min_time'], row['max_time'])
-                    data_to_plot.append(synthetic_data)
-                    labels.append(f"{row['provider'][:15]}...\n(n={row['count']})" if len(row['provider']) > 15 else f"{row['provider']}\n(n={row['count']})")
-                box = plt.boxplot(data_to_plot, labels=labels, patch_artist=True, 
-                                medianprops={'color': 'white', 'linewidth': 2},
-                                whiskerprops={'color': '#333', 'linewidth': 1.5},
-                                capprops={'color': '#333', 'linewidth': 1.5},
-                                flierprops={'marker': 'o', 'markersize': 5, 'markerfacecolor': 'red'})
-                colors = plt.cm.Set3(np.linspace(0, 1, len(data_to_plot)))
-                for patch, color in zip(box['boxes'], colors):
-                    patch.set_facecolor(color)
-                    patch.set_alpha(0.7)
-                plt.title('Распределение времени ответа по провайдерам', 
-                        fontsize=14, fontweight='bold', pad=20)
-                plt.xlabel('Провайдер API', fontsize=12, fontweight='bold')
-                plt.ylabel('Время ответа (мс)', fontsize=12, fontweight='bold')
-                plt.grid(axis='y', alpha=0.3, linestyle='--')
-                plt.xticks(rotation=45, ha='right')
-                
-                # Добавляем подписи со средним значением
-                for i, (_, row) in enumerate(df.iterrows()):
-                    plt.text(i + 1, row['max_time'] * 1.05, f"Ø{row['avg_time']:.0f}мс", 
-                            ha='center', va='bottom', fontsize=9, fontweight='bold',
-                            bbox=dict(boxstyle="round,pad=0.3", facecolor="white", alpha=0.8))
-                
-                plt.tight_layout()
-                return save_plot_to_base64()
-            except Exception as e:
-                logger.error(f"Ошибка создания графика response_times: {e}")
-                return None
-
-
-def save_plot_to_base64():
-    """Сохраняет текущий график matplotlib в строку base64"""
-    try:
-        buffer = BytesIO()
-        plt.savefig(buffer, format='png', bbox_inches='tight', 
-                   dpi=100, facecolor='white', edgecolor='none')
-        buffer.seek(0)
-        image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        plt.close()
-        return image_base64
-    except Exception as e:
-        logger.error(f"Ошибка сохранения графика в base64: {e}")
-        plt.close()
-        return None
-
-
-
-
-def route_details_api(request, route_id):
+@query_budget(2)
+def route_details_api(request, cache_key, index):
     """
-    API для получения детальной информации о маршруте.
+    API подробностей маршрута: геометрия для карты, сегменты, остановки и
+    инструкции маршрута index из записи кэша cache_key (details_url в ответах
+    поиска) и готовый HTML блока «Подробный маршрут». Маршрут собирается из
+    записи кэша при запросе; ETag по телу ответа, как у routes_api.
     """
-    try:
-
-        return JsonResponse({
-            'status': 'success',
-            'message': 'Детальная информация о маршруте',
-            'route_id': route_id,
-            'timestamp': timezone.now().isoformat()
-        })
-    except Exception as e:
+    route = CachedRoutingService.get_route(cache_key, index)
+    if route is None:
         return JsonResponse({
             'status': 'error',
-            'message': str(e)
-        }, status=500)
-
-
+            'message': 'Маршрут не найден: результаты поиска устарели, повторите поиск'
+        }, status=404)
+    response = JsonResponse({
+        'status': 'success',
+        'cache_key': cache_key,
+        'index': index,
+        'route': geometry.pack_route(geometry.route_for_map(route)),
+        'html': render_to_string('core/route_details.html', {'route': route}),
+    }, encoder=UnicodeJSONEncoder)
+    response['ETag'] = quote_etag(hashlib.md5(response.content).hexdigest())
+    return get_conditional_response(request, etag=response['ETag'], response=response)
+
+
+@query_budget(5)
 def popular_routes_api(request):
     """
     API для получения списка популярных маршрутов.
@@ -977,4 +870,69 @@ def popular_routes_api(request):
         return JsonResponse({
             'status': 'error',
             'message': str(e)
-        }, status=500)
\ No newline at end of file
+        }, status=500)
+
+@query_budget(2)
+def metrics_view(request):
+    """
+    Метрики в текстовом формате Prometheus.
+    Доступ: заголовок Authorization: Bearer <METRICS_TOKEN>, сотрудники
+    или, пока токен не задан, режим DEBUG.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        allowed = constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+    else:
+        allowed = settings.DEBUG
+    # Токен проверяется первым: сбор Prometheus обходится без запросов к сессиям
+    if not (allowed or request.user.is_staff):
+        return JsonResponse({'status': 'error', 'message': 'Требуется токен доступа к метрикам'}, status=401)
+    return HttpResponse(metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@query_budget(5)
+@staff_member_required
+def memory_status(request):
+    """
+    Память воркера, обработавшего запрос: RSS, сборщик мусора, tracemalloc.
+
+    GET — состояние и, если отслеживание запущено, прирост аллокаций с
+    момента start (параметры limit, key_type=lineno|filename|traceback,
+    rebase=1, objects=1 — подсчёт объектов по типам).
+    POST action=start (frames) | diff (те же параметры, что у GET) | stop —
+    управление tracemalloc; diff и stop без start — ошибка 400.
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    try:
+        limit = int(params.get('limit', 20))
+        frames = int(params.get('frames', 1))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'limit и frames должны быть числами'}, status=400)
+
+    action = None
+    if request.method == 'POST':
+        action = request.POST.get('action')
+        if action not in ('start', 'diff', 'stop'):
+            return JsonResponse({'status': 'error', 'message': f'Неизвестное действие: {action}'}, status=400)
+        if action != 'start' and not memory.TRACKER.active:
+            return JsonResponse({'status': 'error', 'message': 'Отслеживание не запущено: сначала action=start'},
+                                status=400)
+        if action == 'start':
+            memory.TRACKER.start(frames=max(1, min(frames, 25)))
+            logger.info(f"{request.user} включил tracemalloc в процессе {os.getpid()}")
+        elif action == 'stop':
+            memory.TRACKER.stop()
+            logger.info(f"{request.user} выключил tracemalloc в процессе {os.getpid()}")
+
+    show_objects = params.get('objects') == '1'
+    result = {'status': 'success', **memory.memory_info(count_objects=show_objects, top_types=20 if show_objects else 0)}
+    if memory.TRACKER.active and action in (None, 'diff'):
+        try:
+            result['diff'] = memory.TRACKER.diff(
+                limit=limit,
+                key_type=params.get('key_type', 'lineno'),
+                rebase=params.get('rebase') == '1',
+            )
+        except ValueError as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return JsonResponse(result)
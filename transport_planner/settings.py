@@ -14,9 +14,8 @@ from pathlib import Path
 import os
 from dotenv import load_dotenv
 import dj_database_url
-import matplotlib
-matplotlib.use('Agg')
-os.environ['MPLBACKEND'] = 'Agg'
+# matplotlib импортируется только в процессах рендеринга графиков (core/charts.py)
+os.environ.setdefault('MPLBACKEND', 'Agg')
 
 load_dotenv()
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -39,7 +38,64 @@ TOMTOM_API_KEY = os.getenv('TOMTOM_API_KEY')
 TWOGIS_PUBLIC_TRANSPORT_API_KEY = os.getenv('TWOGIS_PUBLIC_TRANSPORT_API_KEY')
 USE_PUBLIC_TRANSPORT_API = os.getenv('USE_PUBLIC_TRANSPORT_API', 'False') == 'True'
 USE_2GIS_CAR_ROUTING = os.getenv('USE_2GIS_CAR_ROUTING', 'False') == 'True'
-TWOGIS_PUBLIC_TRANSPORT_URL = 'https://routing.api.2gis.com/public_transport/2.0'
+TWOGIS_PUBLIC_TRANSPORT_URL = os.getenv('TWOGIS_PUBLIC_TRANSPORT_URL', 'https://routing.api.2gis.com/public_transport/2.0')
+# Базовый адрес TomTom Routing/Search API (для локальной подмены: manage.py fake_providers)
+TOMTOM_API_URL = os.getenv('TOMTOM_API_URL', 'https://api.tomtom.com')
+# Контентно-адресуемый кэш графиков дашборда и пул процессов для их рендеринга
+CHART_CACHE_DIR = Path(os.getenv('CHART_CACHE_DIR', BASE_DIR / 'chart_cache'))
+CHART_RENDER_WORKERS = int(os.getenv('CHART_RENDER_WORKERS', '2'))
+# Чистка кэша графиков: срок хранения неиспользуемых файлов (с), предельный размер каталога (байт)
+CHART_CACHE_MAX_AGE = int(os.getenv('CHART_CACHE_MAX_AGE', str(7 * 24 * 3600)))
+CHART_CACHE_MAX_BYTES = int(os.getenv('CHART_CACHE_MAX_BYTES', str(200 * 2 ** 20)))
+CHART_CACHE_PRUNE_INTERVAL = int(os.getenv('CHART_CACHE_PRUNE_INTERVAL', '600'))
+# Замеры этапов запроса: заголовок Server-Timing и сводка в лог core.timing
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'False') == 'True'
+SERVER_TIMING_SLOW_MS = int(os.getenv('SERVER_TIMING_SLOW_MS', '1000'))
+# Метрики Prometheus на /metrics. Для нескольких воркеров gunicorn нужен общий каталог.
+# Без METRICS_TOKEN метрики доступны только сотрудникам (и всем при DEBUG)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+METRICS_MULTIPROCESS_DIR = os.getenv('METRICS_MULTIPROCESS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# Профилирование запроса сотрудником: ?_profile=1 или заголовок X-Profile: 1
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', 'True') == 'True'
+PROFILER_INTERVAL_MS = float(os.getenv('PROFILER_INTERVAL_MS', '5'))
+PROFILER_MAX_PER_HOUR = int(os.getenv('PROFILER_MAX_PER_HOUR', '10'))
+# Уровни детализации геометрии маршрутов: масштабы карты и допуск упрощения в пикселях;
+# MAP_VIEWPORT_PX — размер карты на главной, по нему выбирается уровень для страницы
+ROUTE_LOD_ZOOMS = (11, 12, 13, 14, 15)
+ROUTE_LOD_TOLERANCE_PX = float(os.getenv('ROUTE_LOD_TOLERANCE_PX', '1.0'))
+MAP_VIEWPORT_PX = (800, 500)
+# Формат линий в кэше маршрутов и на странице: polyline (Google Encoded Polyline) или json
+ROUTE_GEOMETRY_ENCODING = os.getenv('ROUTE_GEOMETRY_ENCODING', 'polyline')
+ROUTE_GEOMETRY_PRECISION = 6
+# Участки маршрутов общественного транспорта хранятся в кэше один раз (RouteGeometry);
+# уровни детализации участков запоминаются в памяти процесса
+ROUTE_GEOMETRY_SHARED = os.getenv('ROUTE_GEOMETRY_SHARED', 'True') == 'True'
+ROUTE_PART_LEVELS_MEMO_SIZE = 2048
+# Срок жизни записи кэша маршрутов (минуты); участки геометрии живут столько же
+ROUTE_CACHE_TTL_MINUTES = int(os.getenv('ROUTE_CACHE_TTL_MINUTES', '30'))
+# Хранить в записи кэша исходный ответ провайдера: после смены версии разбора
+# manage.py upgrade_route_cache переводит такие записи в новый формат без запросов к API
+ROUTE_CACHE_STORE_RAW = os.getenv('ROUTE_CACHE_STORE_RAW', 'False') == 'True'
+# Найденные адреса хранятся в кэше Django (секунды, 0 — не хранить). Ответы поиска
+# и автодополнения не зависят от пользователя: ETag и Cache-Control: public с max-age
+# не дольше HTTP_CACHE_MAX_AGE и оставшегося срока записи кэша
+GEOCODE_CACHE_SECONDS = int(os.getenv('GEOCODE_CACHE_SECONDS', '3600'))
+HTTP_CACHE_MAX_AGE = int(os.getenv('HTTP_CACHE_MAX_AGE', '300'))
+# Бюджет SQL-запросов на HTTP-запрос (по умолчанию включён в DEBUG): warn — предупреждение
+# в лог, raise — исключение. Бюджеты представлений задаются @query_budget, QUERY_BUDGETS
+# переопределяет их по имени URL
+QUERY_BUDGET_ENABLED = os.getenv('QUERY_BUDGET_ENABLED', str(DEBUG)) == 'True'
+QUERY_BUDGET_ACTION = os.getenv('QUERY_BUDGET_ACTION', 'warn')
+QUERY_BUDGET_DEFAULT = int(os.getenv('QUERY_BUDGET_DEFAULT', '50'))
+QUERY_BUDGET_DUPLICATES = int(os.getenv('QUERY_BUDGET_DUPLICATES', '5'))
+QUERY_BUDGETS = {}
+# Кассеты HTTP-запросов к провайдерам: off, record (запись) или replay (воспроизведение без сети)
+PROVIDER_CASSETTE_MODE = os.getenv('PROVIDER_CASSETTE_MODE', 'off')
+PROVIDER_CASSETTE_DIR = Path(os.getenv('PROVIDER_CASSETTE_DIR', BASE_DIR / 'cassettes'))
+PROVIDER_CASSETTE_LATENCY_SCALE = float(os.getenv('PROVIDER_CASSETTE_LATENCY_SCALE', '1.0'))
+PROVIDER_CASSETTE_COORD_TOLERANCE = float(os.getenv('PROVIDER_CASSETTE_COORD_TOLERANCE', '0.001'))
 if not DEBUG:
     STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 if not DEBUG:
@@ -60,12 +116,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'core.middleware.MetricsMiddleware',
+    'core.middleware.QueryBudgetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.middleware.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
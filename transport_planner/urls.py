@@ -15,13 +15,19 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
-from core.views import analytics_dashboard, clear_cache_view
+from django.urls import path, re_path, include
+from core.views import clear_cache_view, memory_status
+from core.analytics_views import analytics_dashboard, analytics_chart, analytics_series_api, analytics_export
 
 
 urlpatterns = [
     path('admin/analytics/', analytics_dashboard, name='analytics_dashboard'),
+    path('admin/analytics/api/<str:series>/', analytics_series_api, name='analytics_series_api'),
+    re_path(r'^admin/analytics/charts/(?P<digest>[0-9a-f]{64})\.(?P<fmt>png|svg)$',
+            analytics_chart, name='analytics_chart'),
+    path('admin/analytics/export/<str:dataset>/', analytics_export, name='analytics_export'),
     path('admin/clear-cache/', clear_cache_view, name='clear_cache'),
+    path('admin/memory/', memory_status, name='memory_status'),
     path('admin/', admin.site.urls),
     path('', include('core.urls')),
 ]